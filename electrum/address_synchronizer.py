@@ -24,16 +24,18 @@
 import asyncio
 import threading
 import asyncio
+import bisect
+import heapq
 import itertools
 from collections import defaultdict
 from typing import TYPE_CHECKING, Dict, Optional, Set, Tuple, NamedTuple, Sequence, List
 
 from . import bitcoin, util, constants
-from .bitcoin import TYPE_ADDRESS, TYPE_PUBKEY
+from .bitcoin import TYPE_ADDRESS, TYPE_PUBKEY, TOKEN_TRANSFER_TOPIC, hash160_to_p2pkh, b58_address_to_hash160
 from .util import profiler, bfh, TxMinedInfo, UnrelatedTransactionException
 from .util import profiler, bfh, TxMinedInfo
 from .transaction import Transaction, TxOutput, TxInput, PartialTxInput, TxOutpoint, PartialTransaction
-from .synchronizer import Synchronizer
+from .synchronizer import Synchronizer, history_status
 from .verifier import SPV
 from .blockchain import hash_header
 from .i18n import _
@@ -59,6 +61,46 @@ class HistoryItem(NamedTuple):
     balance: int
 
 
+class TokenTransfer(NamedTuple):
+    """A Transfer event decoded from a tx receipt."""
+    contract_addr: str
+    from_hash160: str  # hex
+    to_hash160: str  # hex
+    from_addr: str  # p2pkh address of from_hash160
+    to_addr: str  # p2pkh address of to_hash160
+    amount: int
+    call_index: int
+    log_index: int
+
+
+def decode_token_transfers(tx_receipt: Sequence[dict]) -> List[TokenTransfer]:
+    """Returns the Transfer events logged by the contract calls of a tx receipt."""
+    transfers = []
+    for call_index, contract_call in enumerate(tx_receipt):
+        for log_index, log in enumerate(contract_call.get('log', [])):
+            topics = log.get('topics', [])
+            if len(topics) < 3 or topics[0] != TOKEN_TRANSFER_TOPIC:
+                continue
+            try:
+                amount = int(log.get('data'), 16)
+            except (TypeError, ValueError):
+                continue
+            from_hash160, to_hash160 = topics[1][-40:], topics[2][-40:]
+            try:
+                from_addr, to_addr = hash160_to_p2pkh(bfh(from_hash160)), hash160_to_p2pkh(bfh(to_hash160))
+            except ValueError:
+                continue
+            transfers.append(TokenTransfer(contract_addr=log.get('address', ''),
+                                           from_hash160=from_hash160,
+                                           to_hash160=to_hash160,
+                                           from_addr=from_addr,
+                                           to_addr=to_addr,
+                                           amount=amount,
+                                           call_index=call_index,
+                                           log_index=log_index))
+    return transfers
+
+
 class TxWalletDelta(NamedTuple):
     is_relevant: bool  # "related to wallet?"
     is_any_input_ismine: bool
@@ -96,8 +138,6 @@ class AddressSynchronizer(Logger):
         # thread local storage for caching stuff
         self.threadlocal_cache = threading.local()
 
-        self._get_addr_balance_cache = {}
-
         self.load_and_cleanup()
 
     def with_lock(func):
@@ -114,6 +154,7 @@ class AddressSynchronizer(Logger):
 
     def load_and_cleanup(self):
         self.load_local_history()
+        self.load_token_transfers()
         self.check_history()
         self.load_unverified_transactions()
         self.remove_local_transactions_we_dont_have()
@@ -202,10 +243,6 @@ class AddressSynchronizer(Logger):
         if self.network is not None:
             self.synchronizer = Synchronizer(self)
             self.verifier = SPV(self.network, self)
-            util.register_callback(self.on_blockchain_updated, ['blockchain_updated'])
-
-    def on_blockchain_updated(self, event, *args):
-        self._get_addr_balance_cache = {}  # invalidate cache
 
     def stop(self):
         if self.network:
@@ -215,7 +252,6 @@ class AddressSynchronizer(Logger):
             if self.verifier:
                 asyncio.run_coroutine_threadsafe(self.verifier.stop(), self.network.asyncio_loop)
                 self.verifier = None
-            util.unregister_callback(self.on_blockchain_updated)
             self.db.put('stored_height', self.get_local_height())
 
     def add_address(self, address):
@@ -245,7 +281,7 @@ class AddressSynchronizer(Logger):
                     continue
                 # this outpoint has already been spent, by spending_tx
                 # annoying assert that has revealed several bugs over time:
-                assert self.db.get_transaction(spending_tx_hash), "spending tx not in wallet db"
+                assert self.db.has_transaction(spending_tx_hash), "spending tx not in wallet db"
                 conflicting_txns |= {spending_tx_hash}
             if tx_hash in conflicting_txns:
                 # this tx is already in history, so it conflicts with itself
@@ -320,7 +356,6 @@ class AddressSynchronizer(Logger):
                         pass
                     else:
                         self.db.add_txi_addr(tx_hash, addr, ser, v)
-                        self._get_addr_balance_cache.pop(addr, None)  # invalidate cache
             for txi in tx.inputs():
                 if txi.is_coinbase_input():
                     continue
@@ -328,6 +363,7 @@ class AddressSynchronizer(Logger):
                 prevout_n = txi.prevout.out_idx
                 ser = txi.prevout.to_str()
                 self.db.set_spent_outpoint(prevout_hash, prevout_n, tx_hash)
+                self._utxos_changed(prevout_hash)
                 add_value_from_prev_output()
             # add outputs
             for n, txo in enumerate(tx.outputs()):
@@ -338,14 +374,15 @@ class AddressSynchronizer(Logger):
                 addr = self.get_txout_address(txo)
                 if addr and self.is_mine(addr):
                     self.db.add_txo_addr(tx_hash, addr, n, v, is_coinbase)
-                    self._get_addr_balance_cache.pop(addr, None)  # invalidate cache
                     # give v to txi that spends me
                     next_tx = self.db.get_spent_outpoint(tx_hash, n)
                     if next_tx is not None:
                         self.db.add_txi_addr(next_tx, addr, ser, v)
                         self._add_tx_to_local_history(next_tx)
+                        self._history_changed(next_tx)
             # add to local history
             self._add_tx_to_local_history(tx_hash)
+            self._history_changed(tx_hash)
             # save
             self.db.add_transaction(tx_hash, tx)
             self.db.add_num_inputs_to_tx(tx_hash, len(tx.inputs()))
@@ -362,25 +399,26 @@ class AddressSynchronizer(Logger):
                     prevout_hash = txin.prevout.txid.hex()
                     prevout_n = txin.prevout.out_idx
                     self.db.remove_spent_outpoint(prevout_hash, prevout_n)
+                    self._utxos_changed(prevout_hash)
             else:
                 # expensive but always works
                 for prevout_hash, prevout_n in self.db.list_spent_outpoints():
                     spending_txid = self.db.get_spent_outpoint(prevout_hash, prevout_n)
                     if spending_txid == tx_hash:
                         self.db.remove_spent_outpoint(prevout_hash, prevout_n)
+                        self._utxos_changed(prevout_hash)
 
         with self.lock, self.transaction_lock:
             self.logger.info(f"removing tx from history {tx_hash}")
             tx = self.db.remove_transaction(tx_hash)
             remove_from_spent_outpoints()
             self._remove_tx_from_local_history(tx_hash)
-            for addr in itertools.chain(self.db.get_txi_addresses(tx_hash), self.db.get_txo_addresses(tx_hash)):
-                self._get_addr_balance_cache.pop(addr, None)  # invalidate cache
             self.db.remove_txi(tx_hash)
             self.db.remove_txo(tx_hash)
             self.db.remove_tx_fee(tx_hash)
             self.db.remove_verified_tx(tx_hash)
             self.unverified_tx.pop(tx_hash, None)
+            self._history_changed(tx_hash)
             if tx:
                 for idx, txo in enumerate(tx.outputs()):
                     scripthash = bitcoin.script_to_scripthash(txo.scriptpubkey.hex())
@@ -414,10 +452,12 @@ class AddressSynchronizer(Logger):
                     # make tx local
                     self.unverified_tx.pop(tx_hash, None)
                     self.db.remove_verified_tx(tx_hash)
+                    self._history_changed(tx_hash)
                     if self.verifier:
                         self.verifier.remove_spv_proof_for_tx(tx_hash)
 
             self.db.set_addr_history(addr, hist)
+            self._addr_status.pop(addr, None)
 
         for tx_hash, tx_height in hist:
             # add it in case it was previously unconfirmed
@@ -432,22 +472,39 @@ class AddressSynchronizer(Logger):
         for tx_hash, fee_sat in tx_fees.items():
             self.db.add_tx_fee_from_server(tx_hash, fee_sat)
 
+    def get_addr_status(self, addr: str) -> Optional[str]:
+        """Returns the status of the history we have for addr, as the server
+        would announce it. It is computed once per history received.
+        """
+        with self.lock:
+            if addr not in self._addr_status:
+                self._addr_status[addr] = history_status(self.db.get_addr_history(addr))
+            return self._addr_status[addr]
+
     @profiler
     def load_local_history(self):
         self._history_local = {}  # type: Dict[str, Set[str]]  # address -> set(txid)
         self._address_history_changed_events = defaultdict(asyncio.Event)  # address -> Event
+        self._addr_status = {}  # type: Dict[str, Optional[str]]  # address -> history_status
+        self._reset_history_index()
+        self._reset_utxo_index()
+        self._reset_balance_index()
         for txid in itertools.chain(self.db.list_txi(), self.db.list_txo()):
             self._add_tx_to_local_history(txid)
 
     @profiler
     def check_history(self):
-        hist_addrs_mine = list(filter(lambda k: self.is_mine(k), self.db.get_history()))
-        hist_addrs_not_mine = list(filter(lambda k: not self.is_mine(k), self.db.get_history()))
-        for addr in hist_addrs_not_mine:
-            self.db.remove_addr_history(addr)
+        hist_addrs_mine = []
+        for addr in self.db.get_history():
+            if self.is_mine(addr):
+                hist_addrs_mine.append(addr)
+            else:
+                self.db.remove_addr_history(addr)
+                self._addr_status.pop(addr, None)
         for addr in hist_addrs_mine:
             hist = self.db.get_addr_history(addr)
             for tx_hash, tx_height in hist:
+                # only transactions not yet added need to be deserialized
                 if self.db.get_txi_addresses(tx_hash) or self.db.get_txo_addresses(tx_hash):
                     continue
                 tx = self.db.get_transaction(tx_hash)
@@ -457,7 +514,7 @@ class AddressSynchronizer(Logger):
     def remove_local_transactions_we_dont_have(self):
         for txid in itertools.chain(self.db.list_txi(), self.db.list_txo()):
             tx_height = self.get_tx_height(txid).height
-            if tx_height == TX_HEIGHT_LOCAL and not self.db.get_transaction(txid):
+            if tx_height == TX_HEIGHT_LOCAL and not self.db.has_transaction(txid):
                 self.remove_transaction(txid)
 
     def clear_history(self):
@@ -465,6 +522,13 @@ class AddressSynchronizer(Logger):
             with self.transaction_lock:
                 self.db.clear_history()
                 self._history_local.clear()
+                self._addr_status.clear()
+                self._reset_history_index()
+                self._reset_utxo_index()
+                self._reset_balance_index()
+            with self.token_lock:
+                self._token_transfers.clear()
+                self._token_transfer_keys.clear()
 
     def get_txpos(self, tx_hash):
         """Returns (height, txpos) tuple, even if the tx is unverified."""
@@ -490,46 +554,132 @@ class AddressSynchronizer(Logger):
                 self.threadlocal_cache.local_height = orig_val
         return f
 
+    def _reset_history_index(self) -> None:
+        """Drops the history index; it is rebuilt by the next get_history()."""
+        with self.lock:
+            self._history_index_valid = False
+            self._history_dirty = set()  # type: Set[str]
+            self._history_deltas = {}  # type: Dict[str, int]  # txid -> delta on the wallet
+            self._history_keys = {}  # type: Dict[str, tuple]  # txid -> (height, txpos, txid)
+            self._history_sorted = []  # type: List[tuple]  # sorted keys
+            self._history_balances = []  # type: List[int]  # balance after each tx in _history_sorted
+
+    def _history_changed(self, tx_hash: str) -> None:
+        """Marks the index entry of tx_hash as stale: its delta on the wallet,
+        its position in the history, or whether it is in the history at all,
+        might have changed. Must be called with self.lock held.
+        As the same changes move the outputs of tx_hash in the UTXO index,
+        and the balances of its addresses, they are marked as well.
+        """
+        if self._history_index_valid:
+            self._history_dirty.add(tx_hash)
+        self._utxos_changed(tx_hash)
+        if self._balance_index_valid:
+            self._balance_dirty.add(tx_hash)
+
+    def _get_history_key(self, tx_hash: str) -> tuple:
+        return self.get_txpos(tx_hash) + (tx_hash,)
+
+    def _get_wallet_tx_delta(self, tx_hash: str) -> Optional[int]:
+        """Returns the delta of the tx on is_mine addresses,
+        or None if it does not touch any of them.
+        """
+        addrs = set(itertools.chain(self.db.get_txi_addresses(tx_hash), self.db.get_txo_addresses(tx_hash)))
+        addrs = [addr for addr in addrs if self.is_mine(addr)]
+        if not addrs:
+            return None
+        return sum(self.get_tx_delta(tx_hash, addr) for addr in addrs)
+
+    @profiler
+    def _rebuild_history_index(self) -> None:
+        self._reset_history_index()
+        for tx_hash in set(itertools.chain(self.db.list_txi(), self.db.list_txo())):
+            delta = self._get_wallet_tx_delta(tx_hash)
+            if delta is None:
+                continue
+            self._history_deltas[tx_hash] = delta
+            self._history_keys[tx_hash] = self._get_history_key(tx_hash)
+        self._history_sorted = sorted(self._history_keys.values())
+        self._update_history_balances(0)
+        c, u, x = self.get_balance()
+        if self._history_balances and self._history_balances[-1] != c + u + x:
+            raise Exception("wallet.get_history() failed balance sanity-check")
+        self._history_index_valid = True
+
+    def _update_history_balances(self, start: int) -> None:
+        balances = self._history_balances
+        del balances[start:]
+        balance = balances[-1] if balances else 0
+        deltas = self._history_deltas
+        for key in itertools.islice(self._history_sorted, start, None):
+            balance += deltas[key[-1]]
+            balances.append(balance)
+
+    def _update_history_index(self) -> None:
+        """Re-indexes the txs marked by _history_changed. Only the balances
+        from the first position that moved onwards are recomputed, which,
+        as new and unconfirmed txs sort last, usually means only a few.
+        """
+        if not self._history_index_valid:
+            self._rebuild_history_index()
+            return
+        if not self._history_dirty:
+            return
+        sorted_keys = self._history_sorted
+        start = len(sorted_keys)
+        for tx_hash in self._history_dirty:
+            old_key = self._history_keys.pop(tx_hash, None)
+            if old_key is not None:
+                i = bisect.bisect_left(sorted_keys, old_key)
+                del sorted_keys[i]
+                del self._history_deltas[tx_hash]
+                start = min(start, i)
+            delta = self._get_wallet_tx_delta(tx_hash)
+            if delta is None:
+                continue
+            key = self._get_history_key(tx_hash)
+            self._history_deltas[tx_hash] = delta
+            self._history_keys[tx_hash] = key
+            i = bisect.bisect_left(sorted_keys, key)
+            sorted_keys.insert(i, key)
+            start = min(start, i)
+        self._history_dirty.clear()
+        self._update_history_balances(start)
+
     @with_lock
     @with_transaction_lock
     @with_local_height_cached
     def get_history(self, *, domain=None) -> Sequence[HistoryItem]:
-        # get domain
+        """Returns the history of the wallet, or of the addresses in domain,
+        sorted by txpos, with the balance after each tx.
+
+        The order and the delta of every tx on the whole wallet are kept in
+        an index that is updated as txs are added, removed, verified or
+        reorged. A domain only needs the deltas of its own txs.
+        """
+        self._update_history_index()
         if domain is None:
-            domain = self.get_addresses()
-        domain = set(domain)
-        # 1. Get the history of each address in the domain, maintain the
-        #    delta of a tx as the sum of its deltas on domain addresses
-        tx_deltas = defaultdict(int)  # type: Dict[str, int]
-        for addr in domain:
-            h = self.get_address_history(addr)
-            for tx_hash, height in h:
-                tx_deltas[tx_hash] += self.get_tx_delta(tx_hash, addr)
-        # 2. create sorted history
+            deltas = self._history_deltas
+            balances = self._history_balances
+            keys = self._history_sorted
+        else:
+            # delta of a tx is the sum of its deltas on domain addresses
+            deltas = defaultdict(int)  # type: Dict[str, int]
+            for addr in set(domain):
+                for tx_hash in self._history_local.get(addr, ()):
+                    deltas[tx_hash] += self.get_tx_delta(tx_hash, addr)
+            keys = sorted(self._history_keys.get(tx_hash) or self._get_history_key(tx_hash)
+                          for tx_hash in deltas)
+            balances = list(itertools.accumulate(deltas[key[-1]] for key in keys))
         history = []
-        for tx_hash in tx_deltas:
-            delta = tx_deltas[tx_hash]
-            tx_mined_status = self.get_tx_height(tx_hash)
-            fee = self.get_tx_fee(tx_hash)
-            history.append((tx_hash, tx_mined_status, delta, fee))
-        history.sort(key = lambda x: self.get_txpos(x[0]), reverse=True)
-        # 3. add balance
-        c, u, x = self.get_balance(domain)
-        balance = c + u + x
-        h2 = []
-        for tx_hash, tx_mined_status, delta, fee in history:
-            h2.append(HistoryItem(txid=tx_hash,
-                                  tx_mined_status=tx_mined_status,
-                                  delta=delta,
-                                  fee=fee,
-                                  balance=balance))
-            balance -= delta
-        h2.reverse()
-
-        if balance != 0:
-            raise Exception("wallet.get_history() failed balance sanity-check")
-
-        return h2
+        for key, balance in zip(keys, balances):
+            tx_hash = key[-1]
+            history.append(HistoryItem(txid=tx_hash,
+                                       tx_mined_status=self.get_tx_height(tx_hash),
+                                       delta=deltas[tx_hash],
+                                       fee=self.get_tx_fee(tx_hash),
+                                       balance=balance))
+        return history
 
     def _add_tx_to_local_history(self, txid):
         with self.transaction_lock:
@@ -570,26 +720,35 @@ class AddressSynchronizer(Logger):
             if tx_height in (TX_HEIGHT_UNCONFIRMED, TX_HEIGHT_UNCONF_PARENT):
                 with self.lock:
                     self.db.remove_verified_tx(tx_hash)
+                    self._history_changed(tx_hash)
                 if self.verifier:
                     self.verifier.remove_spv_proof_for_tx(tx_hash)
         else:
             with self.lock:
                 # tx will be verified only if height > 0
                 self.unverified_tx[tx_hash] = tx_height
+                self._history_changed(tx_hash)
 
     def remove_unverified_tx(self, tx_hash, tx_height):
         with self.lock:
             new_height = self.unverified_tx.get(tx_hash)
             if new_height == tx_height:
                 self.unverified_tx.pop(tx_hash, None)
+                self._history_changed(tx_hash)
 
     def add_verified_tx(self, tx_hash: str, info: TxMinedInfo):
+        self.add_verified_txs({tx_hash: info})
+
+    def add_verified_txs(self, infos: Dict[str, TxMinedInfo]):
         # Remove from the unverified map and add to the verified map
         with self.lock:
-            self.unverified_tx.pop(tx_hash, None)
-            self.db.add_verified_tx(tx_hash, info)
-        tx_mined_status = self.get_tx_height(tx_hash)
-        util.trigger_callback('verified', self, tx_hash, tx_mined_status)
+            for tx_hash in infos:
+                self.unverified_tx.pop(tx_hash, None)
+                self._history_changed(tx_hash)
+            self.db.add_verified_txs(infos)
+        for tx_hash in infos:
+            tx_mined_status = self.get_tx_height(tx_hash)
+            util.trigger_callback('verified', self, tx_hash, tx_mined_status)
 
     def get_unverified_txs(self):
         '''Returns a map from tx hash to transaction height'''
@@ -617,6 +776,7 @@ class AddressSynchronizer(Logger):
                         # into unverified_tx with the old height, and if we get
                         # a status update, that will overwrite it.
                         self.unverified_tx[tx_hash] = tx_height
+                        self._history_changed(tx_hash)
                         txs.add(tx_hash)
         return txs
 
@@ -633,6 +793,7 @@ class AddressSynchronizer(Logger):
             tx_was_added = self.add_transaction(tx)
             if tx_was_added:
                 self.future_tx[tx.txid()] = num_blocks
+                self._history_changed(tx.txid())
             return tx_was_added
 
     def get_tx_height(self, tx_hash: str) -> TxMinedInfo:
@@ -771,6 +932,93 @@ class AddressSynchronizer(Logger):
         return received, sent
 
 
+    def _reset_utxo_index(self) -> None:
+        """Drops the UTXO index; it is rebuilt by the next query."""
+        with self.lock:
+            self._utxo_index_valid = False
+            self._utxos_dirty = set()  # type: Set[str]  # txids whose outputs are to be re-indexed
+            self._utxos = {}  # type: Dict[TxOutpoint, Tuple[str, int, bool, int]]  # -> (addr, value, is_cb, height)
+            self._utxos_by_txid = {}  # type: Dict[str, List[TxOutpoint]]
+            self._utxos_by_addr = {}  # type: Dict[str, Set[TxOutpoint]]
+            self._unconfirmed_utxos = set()  # type: Set[TxOutpoint]  # height <= 0
+            self._coinbase_utxos = []  # type: List[Tuple[int, TxOutpoint]]  # sorted by height
+
+    def _utxos_changed(self, tx_hash: str) -> None:
+        """Marks the outputs of tx_hash as stale in the UTXO index: whether
+        they are is_mine, spent, or the height of tx_hash, might have changed.
+        Must be called with self.lock held.
+        """
+        if self._utxo_index_valid:
+            self._utxos_dirty.add(tx_hash)
+
+    def _remove_utxo(self, prevout: TxOutpoint) -> None:
+        addr, value, is_cb, height = self._utxos.pop(prevout)
+        addr_utxos = self._utxos_by_addr[addr]
+        addr_utxos.discard(prevout)
+        if not addr_utxos:
+            del self._utxos_by_addr[addr]
+        self._unconfirmed_utxos.discard(prevout)
+        if is_cb:
+            i = bisect.bisect_left(self._coinbase_utxos, (height, prevout))
+            del self._coinbase_utxos[i]
+
+    def _index_tx_outputs(self, tx_hash: str) -> None:
+        for prevout in self._utxos_by_txid.pop(tx_hash, ()):
+            self._remove_utxo(prevout)
+        prevouts = []
+        tx_height = None
+        for addr in self.db.get_txo_addresses(tx_hash):
+            if not self.is_mine(addr):
+                continue
+            for n, (value, is_cb) in self.db.get_txo_addr(tx_hash, addr).items():
+                if self.db.get_spent_outpoint(tx_hash, n) is not None:
+                    continue
+                if tx_height is None:
+                    tx_height = self.get_tx_height(tx_hash).height
+                prevout = TxOutpoint(bfh(tx_hash), n)
+                prevouts.append(prevout)
+                self._utxos[prevout] = (addr, value, is_cb, tx_height)
+                self._utxos_by_addr.setdefault(addr, set()).add(prevout)
+                if tx_height <= 0:
+                    self._unconfirmed_utxos.add(prevout)
+                if is_cb:
+                    bisect.insort(self._coinbase_utxos, (tx_height, prevout))
+        if prevouts:
+            self._utxos_by_txid[tx_hash] = prevouts
+
+    @profiler
+    def _rebuild_utxo_index(self) -> None:
+        self._reset_utxo_index()
+        for tx_hash in self.db.list_txo():
+            self._index_tx_outputs(tx_hash)
+        self._utxo_index_valid = True
+
+    def _update_utxo_index(self) -> None:
+        """Re-indexes the outputs of the txs marked by _utxos_changed.
+        Must be called with self.lock and self.transaction_lock held.
+        """
+        if not self._utxo_index_valid:
+            self._rebuild_utxo_index()
+            return
+        for tx_hash in self._utxos_dirty:
+            self._index_tx_outputs(tx_hash)
+        self._utxos_dirty.clear()
+
+    def _get_immature_utxos(self, mempool_height: int) -> Set[TxOutpoint]:
+        # coinbase and coinstake outputs are mature once they are
+        # coinbase_maturity blocks deep; only the most recent ones are not
+        min_immature_height = mempool_height - constants.net.coinbase_maturity(mempool_height) + 1
+        i = bisect.bisect_left(self._coinbase_utxos, (min_immature_height,))
+        return {prevout for height, prevout in self._coinbase_utxos[i:]}
+
+    def _make_utxo(self, prevout: TxOutpoint) -> PartialTxInput:
+        addr, value, is_cb, height = self._utxos[prevout]
+        utxo = PartialTxInput(prevout=prevout, is_coinbase_output=is_cb)
+        utxo._trusted_address = addr
+        utxo._trusted_value_sats = value
+        utxo.block_height = height
+        return utxo
+
     def get_addr_outputs(self, address: str) -> Dict[TxOutpoint, PartialTxInput]:
         coins, spent = self.get_addr_io(address)
         out = {}
@@ -786,96 +1034,206 @@ class AddressSynchronizer(Logger):
         return out
 
     def get_addr_utxo(self, address: str) -> Dict[TxOutpoint, PartialTxInput]:
-        out = self.get_addr_outputs(address)
-        for k, v in list(out.items()):
-            if v.spent_height is not None:
-                out.pop(k)
-        return out
+        with self.lock, self.transaction_lock:
+            self._update_utxo_index()
+            return {prevout: self._make_utxo(prevout) for prevout in self._utxos_by_addr.get(address, ())}
 
     # return the total amount ever received by an address
     def get_addr_received(self, address):
         received, sent = self.get_addr_io(address)
         return sum([v for height, v, is_cb in received.values()])
 
+    def _reset_balance_index(self) -> None:
+        """Drops the balance index; it is rebuilt by the next query."""
+        with self.lock:
+            self._balance_index_valid = False
+            self._balance_dirty = set()  # type: Set[str]  # txids whose height, inputs or outputs changed
+            # every is_mine txo adds its value to the (confirmed, unconfirmed, unmatured)
+            # balance of its address, and takes it away again once it is spent
+            self._txo_balances = {}  # type: Dict[str, Tuple[str, int, int, int]]  # txo -> (addr, c, u, x)
+            self._txos_by_txid = {}  # type: Dict[str, List[str]]  # funding txid -> indexed txos
+            self._spends_by_txid = {}  # type: Dict[str, Set[str]]  # spending txid -> indexed txos
+            self._addr_balances = {}  # type: Dict[str, Tuple[int, int, int]]
+            self._total_balance = (0, 0, 0)
+            # txs with coinbase or coinstake txos counted as unmatured, by tx height
+            self._unmatured_txos = []  # type: List[Tuple[int, str]]  # heap
+            self._balance_mempool_height = None  # type: Optional[int]
+
+    def _add_to_balance(self, addr: str, c: int, u: int, x: int) -> None:
+        c0, u0, x0 = self._addr_balances.get(addr, (0, 0, 0))
+        balance = (c0 + c, u0 + u, x0 + x)
+        if balance == (0, 0, 0):
+            self._addr_balances.pop(addr, None)
+        else:
+            self._addr_balances[addr] = balance
+        c0, u0, x0 = self._total_balance
+        self._total_balance = (c0 + c, u0 + u, x0 + x)
+
+    def _index_txo_balances(self, tx_hash: str, mempool_height: int) -> None:
+        """(Re)computes what each is_mine output of tx_hash adds to the balance."""
+        for txo in self._txos_by_txid.pop(tx_hash, ()):
+            addr, c, u, x = self._txo_balances.pop(txo)
+            self._add_to_balance(addr, -c, -u, -x)
+        txos = []
+        tx_height = None
+        unmatured = False
+        for addr in self.db.get_txo_addresses(tx_hash):
+            if not self.is_mine(addr):
+                continue
+            for n, (v, is_cb) in self.db.get_txo_addr(tx_hash, addr).items():
+                if tx_height is None:
+                    tx_height = self.get_tx_height(tx_hash).height
+                txo = tx_hash + ':%d' % n
+                c = u = x = 0
+                if is_cb and tx_height + constants.net.coinbase_maturity(mempool_height) > mempool_height:
+                    x += v
+                    unmatured = True
+                elif tx_height > 0:
+                    c += v
+                else:
+                    u += v
+                spending_txid = self.db.get_spent_outpoint(tx_hash, n)
+                if spending_txid is not None and txo in self._spends_by_txid.get(spending_txid, ()):
+                    if self.get_tx_height(spending_txid).height > 0:
+                        c -= v
+                    else:
+                        u -= v
+                txos.append(txo)
+                self._txo_balances[txo] = (addr, c, u, x)
+                self._add_to_balance(addr, c, u, x)
+        if txos:
+            self._txos_by_txid[tx_hash] = txos
+        if unmatured:
+            heapq.heappush(self._unmatured_txos, (tx_height, tx_hash))
+
+    def _spent_txids(self, tx_hash: str) -> Set[str]:
+        """Returns the txids of the is_mine txos spent by tx_hash, as indexed
+        and as they are now, and records the latter.
+        """
+        txids = {txo.rsplit(':', 1)[0] for txo in self._spends_by_txid.pop(tx_hash, ())}
+        spends = set()
+        for addr in self.db.get_txi_addresses(tx_hash):
+            for txo, v in self.db.get_txi_addr(tx_hash, addr):
+                spends.add(txo)
+        if spends:
+            self._spends_by_txid[tx_hash] = spends
+        txids |= {txo.rsplit(':', 1)[0] for txo in spends}
+        return txids
+
+    @profiler
+    def _rebuild_balance_index(self, mempool_height: int) -> None:
+        self._reset_balance_index()
+        for tx_hash in self.db.list_txi():
+            self._spent_txids(tx_hash)
+        for tx_hash in self.db.list_txo():
+            self._index_txo_balances(tx_hash, mempool_height)
+        self._balance_mempool_height = mempool_height
+        self._balance_index_valid = True
+
+    def _update_balance_index(self) -> None:
+        """Updates the balances for the txs marked by _history_changed, and
+        for the coinbase and coinstake outputs that matured since the last
+        update. Must be called with self.lock and self.transaction_lock held.
+        """
+        mempool_height = self.get_local_height() + 1  # height of next block
+        net = constants.net
+        last_height = self._balance_mempool_height
+        if (not self._balance_index_valid
+                or mempool_height < last_height
+                or net.coinbase_maturity(mempool_height) != net.coinbase_maturity(last_height)):
+            # outputs might have become unmatured again: recompute them all
+            self._rebuild_balance_index(mempool_height)
+            return
+        dirty = set()
+        for tx_hash in self._balance_dirty:
+            dirty.add(tx_hash)
+            dirty |= self._spent_txids(tx_hash)
+        self._balance_dirty.clear()
+        if mempool_height != last_height:
+            max_unmatured_height = mempool_height - net.coinbase_maturity(mempool_height)
+            while self._unmatured_txos and self._unmatured_txos[0][0] <= max_unmatured_height:
+                dirty.add(heapq.heappop(self._unmatured_txos)[1])
+            self._balance_mempool_height = mempool_height
+        for tx_hash in dirty:
+            self._index_txo_balances(tx_hash, mempool_height)
+
     @with_local_height_cached
     def get_addr_balance(self, address, *, excluded_coins: Set[str] = None) -> Tuple[int, int, int]:
         """Return the balance of a bitcoin address:
         confirmed and matured, unconfirmed, unmatured
         """
-        if not excluded_coins:  # cache is only used if there are no excluded_coins
-            cached_value = self._get_addr_balance_cache.get(address)
-            if cached_value:
-                return cached_value
-        if excluded_coins is None:
-            excluded_coins = set()
-        assert isinstance(excluded_coins, set), f"excluded_coins should be set, not {type(excluded_coins)}"
-        received, sent = self.get_addr_io(address)
-        c = u = x = 0
-        mempool_height = self.get_local_height() + 1  # height of next block
-        net = constants.net
-        for txo, (tx_height, v, is_cb) in received.items():
-            if txo in excluded_coins:
-                continue
-            if is_cb and tx_height + net.coinbase_maturity(mempool_height) > mempool_height:
-                x += v
-            elif tx_height > 0:
-                c += v
-            else:
-                u += v
-            if txo in sent:
-                if sent[txo] > 0:
-                    c -= v
-                else:
-                    u -= v
-        result = c, u, x
-        # cache result.
-        if not excluded_coins:
-            # Cache needs to be invalidated if a transaction is added to/
-            # removed from history; or on new blocks (maturity...)
-            self._get_addr_balance_cache[address] = result
-        return result
+        return self.get_balance([address], excluded_coins=excluded_coins)
 
     @with_local_height_cached
     def get_utxos(self, domain=None, *, excluded_addresses=None,
                   mature_only: bool = False, confirmed_only: bool = False,
                   nonlocal_only: bool = False) -> Sequence[PartialTxInput]:
-        coins = []
-        if domain is None:
-            domain = self.get_addresses()
-        domain = set(domain)
-        if excluded_addresses:
-            domain = set(domain) - set(excluded_addresses)
-        mempool_height = self.get_local_height() + 1  # height of next block
-        net = constants.net
-        for addr in domain:
-            utxos = self.get_addr_utxo(addr)
-            for utxo in utxos.values():
-                if confirmed_only and utxo.block_height <= 0:
-                    continue
-                if nonlocal_only and utxo.block_height == TX_HEIGHT_LOCAL:
-                    continue
-                if (mature_only and utxo.is_coinbase_output()
-                        and utxo.block_height + net.coinbase_maturity(mempool_height) > mempool_height):
-                    continue
-                coins.append(utxo)
-                continue
-        return coins
+        """Returns the coins of the addresses in domain, from an index of the
+        unspent is_mine outputs that add_transaction, remove_transaction and
+        height changes keep up to date.
+        """
+        with self.lock, self.transaction_lock:
+            self._update_utxo_index()
+            if domain is None:
+                domain = self._utxos_by_addr.keys()
+            domain = set(domain)
+            if excluded_addresses:
+                domain -= set(excluded_addresses)
+            skipped = set()
+            if mature_only:
+                mempool_height = self.get_local_height() + 1  # height of next block
+                skipped |= self._get_immature_utxos(mempool_height)
+            if confirmed_only:
+                skipped |= self._unconfirmed_utxos
+            elif nonlocal_only:
+                skipped |= {prevout for prevout in self._unconfirmed_utxos
+                            if self._utxos[prevout][3] == TX_HEIGHT_LOCAL}
+            coins = []
+            for addr in domain:
+                for prevout in self._utxos_by_addr.get(addr, ()):
+                    if prevout in skipped:
+                        continue
+                    coins.append(self._make_utxo(prevout))
+            return coins
 
+    @with_local_height_cached
     def get_balance(self, domain=None, *, excluded_addresses: Set[str] = None,
                     excluded_coins: Set[str] = None) -> Tuple[int, int, int]:
-        if domain is None:
-            domain = self.get_addresses()
+        """Returns the (confirmed and matured, unconfirmed, unmatured) balance
+        of the addresses in domain, from running balances per address that
+        are updated as txs change and as coins mature.
+        """
         if excluded_addresses is None:
             excluded_addresses = set()
         assert isinstance(excluded_addresses, set), f"excluded_addresses should be set, not {type(excluded_addresses)}"
-        domain = set(domain) - excluded_addresses
-        cc = uu = xx = 0
-        for addr in domain:
-            c, u, x = self.get_addr_balance(addr, excluded_coins=excluded_coins)
-            cc += c
-            uu += u
-            xx += x
-        return cc, uu, xx
+        if excluded_coins is None:
+            excluded_coins = set()
+        assert isinstance(excluded_coins, set), f"excluded_coins should be set, not {type(excluded_coins)}"
+        with self.lock, self.transaction_lock:
+            self._update_balance_index()
+            if domain is None:
+                cc, uu, xx = self._total_balance
+                excluded = [self._addr_balances.get(addr, (0, 0, 0)) for addr in excluded_addresses]
+                is_counted = lambda addr: addr not in excluded_addresses
+            else:
+                domain = set(domain) - excluded_addresses
+                cc = uu = xx = 0
+                excluded = []
+                for addr in domain:
+                    c, u, x = self._addr_balances.get(addr, (0, 0, 0))
+                    cc += c
+                    uu += u
+                    xx += x
+                is_counted = lambda addr: addr in domain
+            for txo in excluded_coins:
+                txo_balance = self._txo_balances.get(txo)
+                if txo_balance is not None and is_counted(txo_balance[0]):
+                    excluded.append(txo_balance[1:])
+            for c, u, x in excluded:
+                cc -= c
+                uu -= u
+                xx -= x
+            return cc, uu, xx
 
     def is_used(self, address: str) -> bool:
         return self.get_address_history_len(address) != 0
@@ -921,6 +1279,46 @@ class AddressSynchronizer(Logger):
                 return
         with self.token_lock:
             self.db.set_tx_receipt(tx_hash, tx_receipt)
+            self._index_tx_receipt(tx_hash, tx_receipt)
+
+    @profiler
+    def load_token_transfers(self):
+        with self.token_lock:
+            # (contract_addr, hash160) -> (txid, log_index) -> [TokenTransfer]
+            self._token_transfers = defaultdict(dict)  # type: Dict[Tuple[str, str], Dict[Tuple[str, int], List[TokenTransfer]]]
+            # txid -> keys of _token_transfers
+            self._token_transfer_keys = {}  # type: Dict[str, Set[Tuple[str, str]]]
+            for tx_hash in self.db.list_tx_receipts():
+                self._index_tx_receipt(tx_hash, self.db.get_tx_receipt(tx_hash))
+
+    def _index_tx_receipt(self, tx_hash: str, tx_receipt: Sequence[dict]) -> None:
+        for key in self._token_transfer_keys.pop(tx_hash, ()):
+            transfers = self._token_transfers[key]
+            for index_key in [k for k in transfers if k[0] == tx_hash]:
+                del transfers[index_key]
+            if not transfers:
+                del self._token_transfers[key]
+        keys = set()
+        for transfer in decode_token_transfers(tx_receipt):
+            for hash160 in {transfer.from_hash160, transfer.to_hash160}:
+                key = (transfer.contract_addr, hash160)
+                self._token_transfers[key].setdefault((tx_hash, transfer.log_index), []).append(transfer)
+                keys.add(key)
+        if keys:
+            self._token_transfer_keys[tx_hash] = keys
+
+    def get_token_transfers(self, key: str) -> List[Tuple[str, int, TokenTransfer]]:
+        """Returns [(txid, height, transfer)] for the token history of key,
+        in the order of the history, from the Transfer events that moved
+        the token of the contract from or to the bind address.
+        """
+        contract_addr, bind_addr = key.split('_')
+        __, hash160 = b58_address_to_hash160(bind_addr)
+        with self.token_lock:
+            transfers = self._token_transfers.get((contract_addr, hash160.hex()), {})
+            return [(txid, height, transfer)
+                    for txid, height, log_index in self.db.get_token_history(key)
+                    for transfer in transfers.get((txid, log_index), ())]
 
     def add_token_transaction(self, tx_hash, tx):
         with self.token_lock:
@@ -3,6 +3,10 @@
 # file LICENCE or http://www.opensource.org/licenses/mit-license.php
 
 import hashlib
+import itertools
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
 from typing import List, Tuple, NamedTuple, Union, Iterable, Sequence, Optional
 
 from .util import bfh, BitcoinException
@@ -16,6 +20,13 @@ from .logging import get_logger
 _logger = get_logger(__name__)
 BIP32_PRIME = 0x80000000
 UINT32_MAX = (1 << 32) - 1
+# derive_child_pubkeys only fans out to worker processes for at least this many keys per worker
+MIN_KEYS_PER_WORKER = 2000
+
+# worker processes of derive_child_pubkeys, started on first use and kept for later calls
+_executor = None  # type: Optional[ProcessPoolExecutor]
+_executor_num_workers = 0
+_executor_lock = threading.Lock()
 
 
 def protect_against_invalid_ecpoint(func):
@@ -96,6 +107,54 @@ def _CKD_pub(parent_pubkey: bytes, parent_chaincode: bytes, child_index: bytes)
     return child_pubkey, child_chaincode
 
 
+def derive_child_pubkeys(parent_pubkey: bytes, parent_chaincode: bytes, start: int, stop: int,
+                         *, num_workers: int = 1) -> List[bytes]:
+    """Returns the (compressed) pubkeys of the non-hardened children [start, stop)
+    of the given node, i.e. CKD_pub(parent_pubkey, parent_chaincode, i)[0] for each i.
+    The parent pubkey is only parsed once, and each child costs one HMAC and one
+    libsecp256k1 tweak-add. With num_workers > 1, large ranges are split across
+    a pool of worker processes, which is kept for the next calls.
+    """
+    if start < 0: raise ValueError('the bip32 index needs to be non-negative')
+    if stop > BIP32_PRIME: raise Exception('not possible to derive hardened child from parent pubkey')
+    if stop <= start:
+        return []
+    num_workers = min(num_workers, (stop - start) // MIN_KEYS_PER_WORKER)
+    if num_workers <= 1:
+        return _derive_child_pubkeys(parent_pubkey, parent_chaincode, start, stop)
+    chunk_size = -(-(stop - start) // num_workers)
+    starts = range(start, stop, chunk_size)
+    stops = [min(i + chunk_size, stop) for i in starts]
+    chunks = _get_executor(num_workers).map(_derive_child_pubkeys, itertools.repeat(parent_pubkey),
+                                            itertools.repeat(parent_chaincode), starts, stops)
+    return list(itertools.chain.from_iterable(chunks))
+
+
+def _get_executor(num_workers: int) -> ProcessPoolExecutor:
+    global _executor, _executor_num_workers
+    with _executor_lock:
+        if _executor is None or _executor_num_workers < num_workers:
+            if _executor is not None:
+                _executor.shutdown(wait=False)
+            # 'spawn', as forking a process that runs other threads is not safe
+            _executor = ProcessPoolExecutor(max_workers=num_workers,
+                                            mp_context=multiprocessing.get_context('spawn'))
+            _executor_num_workers = num_workers
+        return _executor
+
+
+def _derive_child_pubkeys(parent_pubkey: bytes, parent_chaincode: bytes, start: int, stop: int) -> List[bytes]:
+    tweaks = [hmac_oneshot(parent_chaincode, parent_pubkey + child_index.to_bytes(4, byteorder="big"),
+                           hashlib.sha512)[0:32]
+              for child_index in range(start, stop)]
+    child_pubkeys = ecc.ECPubkey(parent_pubkey).add_tweaks(tweaks)
+    for i, child_pubkey in enumerate(child_pubkeys):
+        if child_pubkey is None:
+            # invalid child; CKD_pub skips to the next index
+            child_pubkeys[i], _ = CKD_pub(parent_pubkey, parent_chaincode, start + i)
+    return child_pubkeys
+
+
 def xprv_header(xtype: str, *, net=None) -> bytes:
     if net is None:
         net = constants.net
@@ -8,7 +8,7 @@ from aiorpcx import TaskGroup
 
 from . import bitcoin
 from .constants import BIP39_WALLET_FORMATS
-from .bip32 import BIP32_PRIME, BIP32Node
+from .bip32 import BIP32_PRIME, BIP32Node, derive_child_pubkeys
 from .bip32 import convert_bip32_path_to_list_of_uint32 as bip32_str_to_ints
 from .bip32 import convert_bip32_intpath_to_strpath as bip32_ints_to_str
 
@@ -46,12 +46,13 @@ async def scan_for_active_accounts(network: 'Network', get_account_xpub, wallet_
 
 async def account_has_history(network: 'Network', account_node: BIP32Node, script_type: str) -> bool:
     gap_limit = 20
+    receiving_node = account_node.subkey_at_public_derivation("0")
+    pubkeys = derive_child_pubkeys(receiving_node.eckey.get_public_key_bytes(compressed=True),
+                                   receiving_node.chaincode, 0, gap_limit)
     async with TaskGroup() as group:
         get_history_tasks = []
-        for address_index in range(gap_limit):
-            address_node = account_node.subkey_at_public_derivation("0/" + str(address_index))
-            pubkey = address_node.eckey.get_public_key_hex()
-            address = bitcoin.pubkey_to_address(script_type, pubkey)
+        for pubkey in pubkeys:
+            address = bitcoin.pubkey_to_address(script_type, pubkey.hex())
             script = bitcoin.address_to_script(address)
             scripthash = bitcoin.script_to_scripthash(script)
             get_history = network.get_history_for_scripthash(scripthash)
@@ -24,16 +24,17 @@ import os
 import math
 import threading
 import sqlite3
-from typing import Optional, Dict, Mapping, Sequence, Union
+from typing import Optional, Dict, Mapping, Sequence, Union, Tuple, Set
 import time
 
 from . import util
 from .bitcoin import hash_encode, int_to_hex, rev_hex, var_int
 from .crypto import sha256d
 from . import constants
-from .util import bfh, unpack_uint16_from, unpack_int32_from, unpack_uint32_from, unpack_int64_from, unpack_uint64_from
+from .util import bfh, LRUCache, unpack_uint16_from, unpack_int32_from, unpack_uint32_from, unpack_int64_from, unpack_uint64_from
 from .simple_config import SimpleConfig
 from .logging import get_logger, Logger
+from .header_store import HeaderStore, SYNCHRONOUS_MODES
 
 
 _logger = get_logger(__name__)
@@ -50,6 +51,10 @@ POW_TARGET_TIMESPAN_RBT = 1000
 POW_TARGET_TIMESPACE = 2 * 60  # bitcoin is 10 * 60
 POW_TARGET_TIMESPACE_RBT = 32
 
+TARGET_CACHE_SIZE = 2 * CHUNK_SIZE
+HASH_INDEX_WINDOW = CHUNK_SIZE  # number of most recent headers of each chain kept in the hash index
+EXP_PRECISION = 128  # fractional bits used by mul_exp
+
 
 class MissingHeader(Exception):
     pass
@@ -166,9 +171,106 @@ def deserialize_header(s: bytes, height: int) -> dict:
     return h
 
 
-def hash_header(header: dict) -> str:
+class BlockHeader(object):
+    '''A block header backed by its serialized bytes.
+
+    Fields are decoded on access and the block hash is computed at most
+    once. Supports the read-only part of the dict interface, so it can be
+    passed where a deserialized header dict is expected; to_dict() returns
+    the same dict as deserialize_header().
+    '''
+
+    __slots__ = ('raw', 'block_height', '_hash')
+
+    FIELDS = frozenset(('block_height', 'version', 'prev_block_hash', 'merkle_root', 'timestamp',
+                        'bits', 'nonce', 'hash_state_root', 'hash_utxo_root', 'hash_prevout_stake',
+                        'hash_prevout_n', 'sig'))
+
+    def __init__(self, raw: bytes, height: int):
+        if not raw:
+            raise InvalidHeader('Invalid header: {}'.format(raw))
+        if len(raw) < BASIC_HEADER_SIZE:
+            raise InvalidHeader('Invalid header length: {}'.format(len(raw)))
+        self.raw = raw
+        self.block_height = height
+        self._hash = None
+
+    @property
+    def hash(self) -> str:
+        if self._hash is None:
+            self._hash = hash_encode(sha256d(self.raw))
+        return self._hash
+
+    @property
+    def version(self) -> int:
+        return unpack_uint32_from(self.raw, 0)[0]
+
+    @property
+    def prev_block_hash(self) -> str:
+        return hash_encode(self.raw[4:36])
+
+    @property
+    def merkle_root(self) -> str:
+        return hash_encode(self.raw[36:68])
+
+    @property
+    def timestamp(self) -> int:
+        return unpack_uint32_from(self.raw, 68)[0]
+
+    @property
+    def bits(self) -> int:
+        return unpack_uint32_from(self.raw, 72)[0]
+
+    @property
+    def nonce(self) -> int:
+        return unpack_uint32_from(self.raw, 76)[0]
+
+    @property
+    def hash_state_root(self) -> str:
+        return hash_encode(self.raw[80:112])
+
+    @property
+    def hash_utxo_root(self) -> str:
+        return hash_encode(self.raw[112:144])
+
+    @property
+    def hash_prevout_stake(self) -> str:
+        return hash_encode(self.raw[144:176])
+
+    @property
+    def hash_prevout_n(self) -> int:
+        return unpack_uint32_from(self.raw, 176)[0]
+
+    @property
+    def sig(self) -> str:
+        sig_length = Deserializer(self.raw, start=BASIC_HEADER_SIZE).read_varint()
+        return hash_encode(self.raw[:-sig_length - 1:-1])
+
+    def is_pos(self) -> bool:
+        return self.raw[144:176] != bytes(32) or self.raw[176:180] != b'\xff\xff\xff\xff'
+
+    def __getitem__(self, key):
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __contains__(self, key):
+        return key in self.FIELDS
+
+    def get(self, key, default=None):
+        if key not in self.FIELDS:
+            return default
+        return getattr(self, key)
+
+    def to_dict(self) -> dict:
+        return deserialize_header(self.raw, self.block_height)
+
+
+def hash_header(header: Union[dict, BlockHeader, None]) -> str:
     if header is None:
         return '0' * 64
+    if isinstance(header, BlockHeader):
+        return header.hash
     if header.get('prev_block_hash') is None:
         header['prev_block_hash'] = '00'*32
     return hash_raw_header(serialize_header(header))
@@ -178,11 +280,48 @@ def hash_raw_header(header: str) -> str:
     return hash_encode(sha256d(bfh(header)))
 
 
+def _exp_fixed(numerator: int, denominator: int) -> int:
+    """Returns exp(numerator / denominator) * 2**EXP_PRECISION, for numerator >= 0."""
+    one = 1 << EXP_PRECISION
+    # exp(x) = exp(x / 2**k) ** (2**k), with x / 2**k < 1 so that the series converges fast
+    k = max(0, (numerator // denominator).bit_length())
+    denominator <<= k
+    result = term = one
+    i = 1
+    while term:
+        term = term * numerator // (denominator * i)
+        result += term
+        i += 1
+    for _ in range(k):
+        result = result * result >> EXP_PRECISION
+    return result
+
+
+def mul_exp(target: int, numerator: int, denominator: int) -> int:
+    """Returns int(target * exp(numerator / denominator)), using integer arithmetic only."""
+    assert denominator > 0, denominator
+    e = _exp_fixed(abs(numerator), denominator)
+    if numerator >= 0:
+        return target * e >> EXP_PRECISION
+    return (target << EXP_PRECISION) // e
+
+
+def _div_trunc(a: int, b: int) -> int:
+    """Integer division rounding towards zero, like int(a / b)."""
+    q = abs(a) // abs(b)
+    return q if (a >= 0) == (b > 0) else -q
+
+
 # key: blockhash hex at forkpoint
 # the chain at some key is the best chain that includes the given hash
 blockchains = {}  # type: Dict[str, Blockchain]
 blockchains_lock = threading.RLock()  # lock order: take this last; so after Blockchain.lock
 
+# block hash -> chains whose own headers include it.
+# Covers, for each chain, at least the headers at or above its _index_start.
+# Chains that are no longer in blockchains are ignored.
+_hash_index = {}  # type: Dict[str, Set[Blockchain]]
+
 
 def read_blockchains(config: 'SimpleConfig'):
     best_chain = Blockchain(config=config,
@@ -196,16 +335,20 @@ def read_blockchains(config: 'SimpleConfig'):
     fdir = os.path.join(util.get_headers_dir(config), 'forks')
     util.make_dir(fdir)
     # files are named as: fork2_{forkpoint}_{prev_hash}_{first_hash}
-    l = filter(lambda x: x.startswith('fork2_') and '.' not in x and len(x.split('_')) == 4, os.listdir(fdir))
+    # (sqlite may keep -wal and -shm files next to them)
+    l = filter(lambda x: x.startswith('fork2_') and '.' not in x and '-' not in x and len(x.split('_')) == 4,
+               os.listdir(fdir))
     l = sorted(l, key=lambda x: int(x.split('_')[1]))  # sort by forkpoint
 
     def delete_chain(filename, reason):
         _logger.info(f"[blockchain] deleting chain {filename}: {reason}")
-        path = os.path.join(fdir, filename)
-        try:
-            os.unlink(path)
-        except BaseException as e:
-            _logger.error(f"failed delete {path} {e}")
+        for path in (os.path.join(fdir, filename + suffix) for suffix in ('', '-wal', '-shm')):
+            if not os.path.exists(path):
+                continue
+            try:
+                os.unlink(path)
+            except BaseException as e:
+                _logger.error(f"failed delete {path} {e}")
 
     def instantiate_chain(filename):
         __, forkpoint, prev_hash, first_hash = filename.split('_')
@@ -231,8 +374,8 @@ def read_blockchains(config: 'SimpleConfig'):
         # consistency checks
         h = b.read_header(b.forkpoint)
         if first_hash != hash_header(h) or not b.parent.can_connect(h, check_height=False):
-            if b.conn:
-                b.conn.close()
+            b._clear_hash_index()
+            b.store.close()
             delete_chain(filename, "invalid fork")
             return
         chain_id = b.get_id()
@@ -246,6 +389,13 @@ def read_blockchains(config: 'SimpleConfig'):
 def get_best_chain() -> 'Blockchain':
     return blockchains[constants.net.GENESIS]
 
+
+def flush_blockchains() -> None:
+    """Commits header writes that are still pending on any chain."""
+    with blockchains_lock: chains = list(blockchains.values())
+    for b in chains:
+        b.store.commit()
+
 # block hash -> chain work; up to and including that block
 _CHAINWORK_CACHE = {
     "0000000000000000000000000000000000000000000000000000000000000000": 0,  # virtual block at height -1
@@ -286,9 +436,14 @@ class Blockchain(Logger):
         self._prev_hash = prev_hash  # blockhash immediately before forkpoint
         self.lock = threading.RLock()
         self.swaping = threading.Event()
-        self.conn = None
+        self.store = None  # type: Optional[HeaderStore]
+        # (height, is_pos) -> target, for targets derived from headers of this chain
+        self._targets = LRUCache(TARGET_CACHE_SIZE)
+        self._hashes = {}  # type: Dict[int, str]  # height -> hash, for the indexed own headers
+        self._index_start = forkpoint
         self.init_db()
         self.update_size()
+        self._init_hash_index()
 
     def with_lock(func):
         def func_wrapper(self, *args, **kwargs):
@@ -297,32 +452,29 @@ class Blockchain(Logger):
         return func_wrapper
 
     def init_db(self):
-        self.conn = sqlite3.connect(self.path(), check_same_thread=False)
-        cursor = self.conn.cursor()
+        synchronous = self.config.get('headers_db_synchronous', 'NORMAL')
+        if synchronous not in SYNCHRONOUS_MODES:
+            self.logger.warning(f'unexpected headers_db_synchronous: {synchronous}, using NORMAL')
+            synchronous = 'NORMAL'
+        # tip headers are committed in batches of this size; chunks are committed at once
+        commit_interval = int(self.config.get('headers_db_commit_interval', 10))
         try:
-            cursor.execute('CREATE TABLE IF NOT EXISTS header '
-                           '(height INT PRIMARY KEY NOT NULL, data BLOB NOT NULL)')
-            self.conn.commit()
+            self.store = HeaderStore(self.path(), deserialize_header,
+                                     synchronous=synchronous, commit_interval=commit_interval)
         except (sqlite3.DatabaseError, ) as e:
             self.logger.info(f"error when init_db', {e}, 'will delete the db file and recreate")
-            os.remove(self.path())
-            self.conn = None
+            for path in (self.path() + suffix for suffix in ('', '-wal', '-shm')):
+                if os.path.exists(path):
+                    os.remove(path)
+            self.store = None
             self.init_db()
-        finally:
-            cursor.close()
 
     @with_lock
     def is_valid(self):
-        conn = sqlite3.connect(self.path(), check_same_thread=False)
-        cursor = conn.cursor()
-        cursor.execute('SELECT min(height), max(height) FROM header')
-        min_height, max_height = cursor.fetchone()
+        min_height, max_height = self.store.min_max_height()
         max_height = max_height or 0
         min_height = min_height or 0
-        cursor.execute('SELECT COUNT(*) FROM header')
-        size = int(cursor.fetchone()[0])
-        cursor.close()
-        conn.close()
+        size = self.store.count()
         if not min_height == self.forkpoint:
             return False
         if size > 0 and not size == max_height - min_height + 1:
@@ -422,15 +574,46 @@ class Blockchain(Logger):
 
     @with_lock
     def update_size(self) -> None:
-        conn = sqlite3.connect(self.path(), check_same_thread=False)
-        cursor = conn.cursor()
-        cursor.execute('SELECT COUNT(*) FROM header')
-        count = int(cursor.fetchone()[0])
-        self._size = count
-        cursor.close()
+        self._size = self.store.count()
+
+    @with_lock
+    def _init_hash_index(self) -> None:
+        self._index_start = max(self.forkpoint, self.height() - HASH_INDEX_WINDOW + 1)
+        rows = self.store.read_range(self._index_start, self.height() - self._index_start + 1)
+        self._index_headers(rows)
+
+    def _index_headers(self, rows: Sequence[Tuple[int, bytes]]) -> None:
+        with self.lock, blockchains_lock:
+            for height, raw_header in rows:
+                self._unindex_header(height)
+                header_hash = hash_encode(sha256d(raw_header))
+                self._hashes[height] = header_hash
+                _hash_index.setdefault(header_hash, set()).add(self)
+            # keep between one and two windows of headers indexed
+            if self.height() - self._index_start + 1 > 2 * HASH_INDEX_WINDOW:
+                self._index_start = self.height() - HASH_INDEX_WINDOW + 1
+                for height in [h for h in self._hashes if h < self._index_start]:
+                    self._unindex_header(height)
+
+    def _unindex_header(self, height: int) -> None:
+        with blockchains_lock:
+            header_hash = self._hashes.pop(height, None)
+            chains = _hash_index.get(header_hash)
+            if chains is not None:
+                chains.discard(self)
+                if not chains:
+                    del _hash_index[header_hash]
+
+    def _clear_hash_index(self) -> None:
+        with blockchains_lock:
+            for height in list(self._hashes):
+                self._unindex_header(height)
+            self._index_start = self.forkpoint
 
     @classmethod
-    def is_pos(cls, header: dict):
+    def is_pos(cls, header: Union[dict, BlockHeader]):
+        if isinstance(header, BlockHeader):
+            return header.is_pos()
         hash_prevout_stake = header.get('hash_prevout_stake', None)
         hash_prevout_n = header.get('hash_prevout_n', 0)
         return hash_prevout_stake and (
@@ -438,7 +621,7 @@ class Blockchain(Logger):
                 or hash_prevout_n != 0xffffffff)
 
     @classmethod
-    def verify_header(cls, header: dict, prev_hash: str, target: int, expected_header_hash: str=None) -> None:
+    def verify_header(cls, header: Union[dict, BlockHeader], prev_hash: str, target: int, expected_header_hash: str=None) -> None:
         _hash = hash_header(header)
         if expected_header_hash and expected_header_hash != _hash:
             raise Exception("hash mismatches with expected: {} vs {}".format(expected_header_hash, _hash))
@@ -456,19 +639,28 @@ class Blockchain(Logger):
 
         bits = cls.target_to_bits(target)
 
-    def verify_chunk(self, index: int, raw_headers: list) -> None:
+    def verify_chunk(self, index: int, raw_headers: list) -> Dict[Tuple[int, bool], int]:
+        """Verifies the chunk against the headers before it.
+        Returns the target of each header, keyed by (height, is_pos).
+        """
         prev_header = None
         pprev_header = None
         if index != 0:
             prev_header = self.read_header(index * CHUNK_SIZE - 1)
             pprev_header = self.read_header(index * CHUNK_SIZE - 2)
+        prev_hash = hash_header(prev_header)
+        targets = {}
         for i, raw_header in enumerate(raw_headers):
             height = index * CHUNK_SIZE + i
-            header = deserialize_header(raw_header, height)
-            target = self.get_target(height, is_pos=self.is_pos(header), prev_header=prev_header, pprev_header=pprev_header)
-            self.verify_header(header, hash_header(prev_header), target)
+            header = BlockHeader(raw_header, height)
+            is_pos = header.is_pos()
+            target = self.get_target(height, is_pos=is_pos, prev_header=prev_header, pprev_header=pprev_header)
+            self.verify_header(header, prev_hash, target)
+            targets[(height, is_pos)] = target
             pprev_header = prev_header
             prev_header = header
+            prev_hash = header.hash
+        return targets
 
     @with_lock
     def path(self):
@@ -484,18 +676,12 @@ class Blockchain(Logger):
         return os.path.join(d, filename)
 
     @with_lock
-    def save_chunk(self, index: int, raw_headers: list):
+    def save_chunk(self, index: int, raw_headers: list, *, targets: Mapping[Tuple[int, bool], int] = None):
         self.logger.info(f'{self.forkpoint} try to save chunk {(index * CHUNK_SIZE)}')
         assert index >= 0, index
 
         if self.swaping.is_set():
             return
-        try:
-            conn = self.conn
-            cursor = self.conn.cursor()
-        except (sqlite3.ProgrammingError, AttributeError):
-            conn = sqlite3.connect(self.path(), check_same_thread=False)
-            cursor = conn.cursor()
 
         forkpoint = self.forkpoint
         if forkpoint is None:
@@ -504,10 +690,13 @@ class Blockchain(Logger):
                    for i, v in enumerate(raw_headers)
                    if index * CHUNK_SIZE + i >= forkpoint]
 
-        cursor.executemany('REPLACE INTO header (height, data) VALUES(?,?)', headers)
-        cursor.close()
-        conn.commit()
+        self.store.write_many(headers)
+        if headers:
+            self._invalidate_targets(headers[0][0], headers[-1][0])
         self.update_size()
+        self._index_headers(headers)
+        if targets:
+            self.cache_targets(targets)
         self.swap_with_parent()
 
     def swap_with_parent(self) -> None:
@@ -533,10 +722,12 @@ class Blockchain(Logger):
             global blockchains
             try:
                 self.logger.info(f'swap, {forkpoint}, {parent_id}')
+                headers = dict(self.store.read_range(forkpoint, self._size))
+                parent_headers = dict(parent.store.read_range(forkpoint, self._size))
                 for i in range(forkpoint, forkpoint + self._size):
                     # print_error('swaping', i)
-                    header = self.read_header(i, deserialize=False)
-                    parent_header = parent.read_header(i, deserialize=False)
+                    header = headers.get(i)
+                    parent_header = parent_headers.get(i)
                     parent.write(header, i)
                     if parent_header:
                         self.write(parent_header, i)
@@ -546,6 +737,11 @@ class Blockchain(Logger):
                 import traceback, sys
                 traceback.print_exc(file=sys.stderr)
                 self.logger.error(f'swap error, {e}')
+            self.store.commit()
+            parent.store.commit()
+            # headers moved between chains; targets cached by any chain may refer to them
+            for chain in blockchains.values():
+                chain.clear_target_cache()
             # update size
             self.update_size()
             parent.update_size()
@@ -578,16 +774,10 @@ class Blockchain(Logger):
             self.logger.info(f'{self.path()} {self.forkpoint} try to write {height}')
             if height > self._size + self.forkpoint:
                 return
-            try:
-                conn = self.conn
-                cursor = self.conn.cursor()
-            except (sqlite3.ProgrammingError, AttributeError):
-                conn = sqlite3.connect(self.path(), check_same_thread=False)
-                cursor = conn.cursor()
-            cursor.execute('REPLACE INTO header (height, data) VALUES(?,?)', (height, raw_header))
-            cursor.close()
-            conn.commit()
+            self.store.write(height, raw_header)
+            self._invalidate_targets(height, height)
             self.update_size()
+            self._index_headers([(height, raw_header)])
 
     def delete(self, height: int):
         self.logger.info(f'{self.forkpoint} try to delete {height}')
@@ -595,30 +785,18 @@ class Blockchain(Logger):
             return
         with self.lock:
             self.logger.info(f'{self.forkpoint} try to delete {height}')
-            try:
-                conn = self.conn
-                cursor = conn.cursor()
-            except (sqlite3.ProgrammingError, AttributeError):
-                conn = sqlite3.connect(self.path(), check_same_thread=False)
-                cursor = conn.cursor()
-            cursor.execute('DELETE FROM header where height=?', (height,))
-            cursor.close()
-            conn.commit()
+            self.store.delete(height)
+            self._invalidate_targets(height, height)
+            self._unindex_header(height)
             self.update_size()
 
     def delete_all(self):
         if self.swaping.is_set():
             return
         with self.lock:
-            try:
-                conn = self.conn
-                cursor = self.conn.cursor()
-            except (sqlite3.ProgrammingError, AttributeError):
-                conn = sqlite3.connect(self.path(), check_same_thread=False)
-                cursor = conn.cursor()
-            cursor.execute('DELETE FROM header')
-            cursor.close()
-            conn.commit()
+            self.store.delete_all()
+            self.clear_target_cache()
+            self._clear_hash_index()
             self._size = 0
 
     @with_lock
@@ -637,25 +815,41 @@ class Blockchain(Logger):
             return
 
         try:
-            conn = sqlite3.connect(self.path(), check_same_thread=False)
-            cursor = conn.cursor()
-            cursor.execute('SELECT data FROM header WHERE height=?', (height,))
-            result = cursor.fetchone()
-            cursor.close()
-            conn.close()
+            if deserialize:
+                header = self.store.read_header(height)
+            else:
+                header = self.store.read_raw(height)
         except BaseException as e:
             self.logger.error(f'read_header error:{e}')
             return
 
-        if not result or len(result) < 1:
-            self.logger.error(f'read_header {height}, {self.forkpoint}, {self.parent.get_id()}, {result}, {self.height()}')
+        if header is None:
+            self.logger.error(f'read_header {height}, {self.forkpoint}, {self.parent.get_id()}, {header}, {self.height()}')
             self.update_size()
             return
-        header = result[0]
-        if deserialize:
-            return deserialize_header(header, height)
         return header
 
+    @with_lock
+    def read_headers(self, start_height: int, count: int, deserialize=True) -> Sequence[Union[dict, bytes]]:
+        """Returns the headers of this chain in [start_height, start_height + count),
+        in height order. Each chain file involved is read with a single query.
+        """
+        start_height = max(start_height, 0)
+        end_height = min(start_height + count, self.height() + 1)
+        if start_height >= end_height:
+            return []
+        headers = []
+        if start_height < self.forkpoint:
+            headers = self.parent.read_headers(start_height, min(end_height, self.forkpoint) - start_height,
+                                               deserialize=deserialize)
+            start_height = self.forkpoint
+        rows = self.store.read_range(start_height, end_height - start_height)
+        if deserialize:
+            headers.extend(deserialize_header(raw_header, height) for height, raw_header in rows)
+        else:
+            headers.extend(raw_header for height, raw_header in rows)
+        return headers
+
     def header_at_tip(self) -> Optional[dict]:
         """Return latest header."""
         height = self.height()
@@ -682,11 +876,15 @@ class Blockchain(Logger):
             return constants.net.GENESIS
         elif str(height) in self.checkpoints:
             return self.checkpoints[str(height)]
-        else:
-            header = self.read_header(height)
-            if header is None:
+        with self.lock:
+            if 0 < height < self.forkpoint:
+                return self.parent.get_hash(height)
+            header_hash = None
+            if 0 < height <= self.height():
+                header_hash = self.store.get_hash(height)
+            if header_hash is None:
                 raise MissingHeader(height)
-            return hash_header(header)
+            return header_hash
 
     @classmethod
     def get_limit(cls, height: int, net, is_pos: bool):
@@ -701,6 +899,8 @@ class Blockchain(Logger):
     def get_target(self, height: int, is_pos: bool, prev_header=None, pprev_header=None) -> int:
         """
         https://github.com/qtumproject/qtum/blob/master/src/pow.cpp CalculateNextWorkRequired
+
+        Targets computed from headers read from this chain are cached.
         """
         net = constants.net
 
@@ -710,6 +910,15 @@ class Blockchain(Logger):
         if height <= POW_BLOCK_COUNT + 2:
             return net.POS_LIMIT
 
+        if prev_header and pprev_header:
+            return self.calculate_target(height, is_pos, prev_header, pprev_header)
+
+        key = (height, bool(is_pos))
+        with self.lock:
+            target = self._targets.get(key)
+        if target is not None:
+            return target
+
         if not prev_header:
             prev_header = self.read_header(height - 1)
         if not pprev_header:
@@ -720,7 +929,34 @@ class Blockchain(Logger):
         if not pprev_header:
             raise Exception('get header failed {}'.format(height - 2))
 
-        new_target = self.bits_to_target(prev_header.get('bits'))
+        target = self.calculate_target(height, is_pos, prev_header, pprev_header)
+        with self.lock:
+            self._targets[key] = target
+        return target
+
+    def cache_targets(self, targets: Mapping[Tuple[int, bool], int]) -> None:
+        with self.lock:
+            for key, target in targets.items():
+                self._targets[key] = target
+
+    def clear_target_cache(self) -> None:
+        with self.lock:
+            self._targets.clear()
+
+    def _invalidate_targets(self, start_height: int, end_height: int) -> None:
+        """Forgets the targets that depend on the headers in [start_height, end_height]."""
+        with self.lock:
+            if end_height - start_height + 2 >= len(self._targets):
+                self._targets.clear()
+                return
+            for height in range(start_height + 1, end_height + 3):
+                self._targets.pop((height, True))
+                self._targets.pop((height, False))
+
+    @classmethod
+    def calculate_target(cls, height: int, is_pos: bool, prev_header, pprev_header) -> int:
+        net = constants.net
+        new_target = cls.bits_to_target(prev_header.get('bits'))
 
         if is_pos:
             if net.POS_NO_RETARGET:
@@ -754,13 +990,45 @@ class Blockchain(Logger):
             new_target *= math.exp(t1 / t2)
             new_target = int(new_target)
 
-        target_limit = self.get_limit(height, net, is_pos)
+        target_limit = cls.get_limit(height, net, is_pos)
         if new_target <= 0 or new_target > target_limit:
             new_target = target_limit
 
-        new_target = self.bits_to_target(self.target_to_bits(new_target))
+        new_target = cls.bits_to_target(cls.target_to_bits(new_target))
         return new_target
 
+    @classmethod
+    def calculate_target_integer(cls, height: int, is_pos: bool, prev_header, pprev_header) -> int:
+        """Reference implementation of calculate_target using integer arithmetic only."""
+        net = constants.net
+        new_target = cls.bits_to_target(prev_header.get('bits'))
+        if not is_pos or net.POS_NO_RETARGET:
+            return new_target
+
+        nActualSpace = max(0, prev_header.get('timestamp') - pprev_header.get('timestamp'))
+        if height < net.QIP9_FORK_HEIGHT:
+            nActualSpace = min(nActualSpace, POW_TARGET_TIMESPACE * 10)
+            nInterval = POW_TARGET_TIMESPAN // POW_TARGET_TIMESPACE
+            new_target *= ((nInterval - 1) * POW_TARGET_TIMESPACE + nActualSpace + nActualSpace)
+            new_target //= ((nInterval + 1) * POW_TARGET_TIMESPACE)
+        elif height < net.REDUCE_BLOCK_TIME_HEIGHT:
+            nActualSpace = min(nActualSpace, POW_TARGET_TIMESPACE * 20)
+            nInterval = POW_TARGET_TIMESPAN_V2 // POW_TARGET_TIMESPACE
+            t1 = _div_trunc(2 * (nActualSpace - POW_TARGET_TIMESPACE), 16)
+            t2 = (nInterval + 1) * POW_TARGET_TIMESPACE // 16
+            new_target = mul_exp(new_target, t1, t2)
+        else:
+            nActualSpace = min(nActualSpace, POW_TARGET_TIMESPACE_RBT * 20)
+            nInterval = POW_TARGET_TIMESPAN_RBT // POW_TARGET_TIMESPACE_RBT
+            t1 = _div_trunc(2 * (nActualSpace - POW_TARGET_TIMESPACE_RBT), 4)
+            t2 = (nInterval + 1) * POW_TARGET_TIMESPACE_RBT // 4
+            new_target = mul_exp(new_target, t1, t2)
+
+        target_limit = cls.get_limit(height, net, is_pos)
+        if new_target <= 0 or new_target > target_limit:
+            new_target = target_limit
+        return cls.bits_to_target(cls.target_to_bits(new_target))
+
     @classmethod
     def bits_to_target(cls, bits: int) -> int:
         mainnet = not constants.net.TESTNET
@@ -787,7 +1055,7 @@ class Blockchain(Logger):
             height = max(0, self.height())
         return height
 
-    def can_connect(self, header: dict, check_height: bool=True) -> bool:
+    def can_connect(self, header: Union[dict, BlockHeader], check_height: bool=True) -> bool:
         if not header:
             return False
         height = header['block_height']
@@ -837,8 +1105,8 @@ class Blockchain(Logger):
         try:
             data = bfh(hexdata)
             raw_heades = self.read_chunk(data)
-            self.verify_chunk(idx, raw_heades)
-            self.save_chunk(idx, raw_heades)
+            targets = self.verify_chunk(idx, raw_heades)
+            self.save_chunk(idx, raw_heades, targets=targets)
             return True
         except BaseException as e:
             self.logger.info(f'verify_chunk idx {idx} failed: {repr(e)}')
@@ -855,23 +1123,58 @@ class Blockchain(Logger):
         return cp
 
 
+def _is_hash_without_header(height: int) -> bool:
+    """Whether get_hash knows the hash at height without reading a header."""
+    return height <= 0 or str(height) in constants.net.CHECKPOINTS
+
+
+def _get_chain_storing_header(height: int, header_hash: str) -> Optional[Blockchain]:
+    """Returns the Blockchain whose own headers (those at or above its
+    forkpoint) include the given one, or None.
+    """
+    with blockchains_lock:
+        for chain in _hash_index.get(header_hash, ()):
+            if chain._hashes.get(height) == header_hash and blockchains.get(chain.get_id()) is chain:
+                return chain
+        chains = list(blockchains.values())
+    # not in the index; that is conclusive unless height is below the indexed headers of a chain
+    for chain in chains:
+        if chain.forkpoint <= height < chain._index_start and chain.check_hash(height, header_hash):
+            return chain
+    return None
+
+
 def check_header(header: dict) -> Optional[Blockchain]:
     """Returns any Blockchain that contains header, or None."""
     if type(header) is not dict:
         return None
-    with blockchains_lock: chains = list(blockchains.values())
-    for b in chains:
-        if b.check_header(header):
-            return b
-    return None
+    height = header.get('block_height')
+    if not isinstance(height, int):
+        return None
+    if _is_hash_without_header(height):
+        with blockchains_lock: chains = list(blockchains.values())
+        for b in chains:
+            if b.check_header(header):
+                return b
+        return None
+    return _get_chain_storing_header(height, hash_header(header))
 
 
 def can_connect(header: dict) -> Optional[Blockchain]:
     """Returns the Blockchain that has a tip that directly links up
     with header, or None.
     """
+    height = header['block_height']
     with blockchains_lock: chains = list(blockchains.values())
-    for b in chains:
+    if _is_hash_without_header(height - 1):
+        candidates = chains
+    else:
+        # the tip at height - 1 is stored by the chain itself, unless the chain has no own headers
+        candidates = [b for b in chains if b.height() == height - 1 and b.forkpoint > height - 1]
+        b = _get_chain_storing_header(height - 1, header.get('prev_block_hash'))
+        if b is not None:
+            candidates.insert(0, b)
+    for b in candidates:
         if b.can_connect(header):
             return b
     return None
@@ -880,7 +1183,19 @@ def can_connect(header: dict) -> Optional[Blockchain]:
 def get_chains_that_contain_header(height: int, header_hash: str) -> Sequence[Blockchain]:
     """Returns a list of Blockchains that contain header, best chain first."""
     with blockchains_lock: chains = list(blockchains.values())
-    chains = [chain for chain in chains
-              if chain.check_hash(height=height, header_hash=header_hash)]
+    if _is_hash_without_header(height):
+        chains = [chain for chain in chains
+                  if chain.check_hash(height=height, header_hash=header_hash)]
+    else:
+        owner = _get_chain_storing_header(height, header_hash)
+        def inherits_header(chain):
+            while chain is not None:
+                if chain is owner:
+                    return True
+                if chain.forkpoint <= height:
+                    return False
+                chain = chain.parent
+            return False
+        chains = [chain for chain in chains if owner is not None and inherits_header(chain)]
     chains = sorted(chains, key=lambda x: x.get_chainwork(), reverse=True)
     return chains
@@ -26,6 +26,9 @@
 import time
 import random
 import os
+import mmap
+import sqlite3
+import struct
 from collections import defaultdict
 from typing import Sequence, List, Tuple, Optional, Dict, NamedTuple, TYPE_CHECKING, Set
 import binascii
@@ -205,6 +208,156 @@ class NodeInfo(NamedTuple):
         return addresses
 
 
+class RoutingPolicy(NamedTuple):
+    """The fields of a Policy that path finding looks at."""
+    fee_base_msat: int
+    fee_proportional_millionths: int
+    cltv_expiry_delta: int
+    htlc_minimum_msat: int
+    htlc_maximum_msat: Optional[int]
+    is_disabled: bool
+
+    @staticmethod
+    def from_policy(policy: Policy) -> 'RoutingPolicy':
+        return RoutingPolicy(
+            fee_base_msat=policy.fee_base_msat,
+            fee_proportional_millionths=policy.fee_proportional_millionths,
+            cltv_expiry_delta=policy.cltv_expiry_delta,
+            htlc_minimum_msat=policy.htlc_minimum_msat,
+            htlc_maximum_msat=policy.htlc_maximum_msat,
+            is_disabled=bool(policy.is_disabled()),
+        )
+
+
+class RoutingGraph:
+    """The public channel graph, laid out for path finding.
+
+    Nodes are numbered, in the order they are first seen, and channels get
+    a slot. incoming[n] lists the edges that can forward a payment to node
+    n, as tuples (start node, slot, fee_base_msat, fee_proportional_millionths,
+    cltv_expiry_delta, htlc_minimum_msat, max_amount_msat), where
+    max_amount_msat accounts for both htlc_maximum_msat and the capacity.
+    An edge is left out if its policy is disabled, or if either direction
+    of the channel has no policy. The slots of removed channels are left
+    empty, until there are more than MAX_EMPTY_SLOTS_RATIO of them: then
+    the graph is rebuilt, renumbering its channels and nodes.
+
+    note: modify needs ChannelDB.lock. Path finding reads without locking,
+          through 'layout', which holds the arrays of the same numbering;
+          it must ignore node numbers it does not know about yet.
+    """
+    MIN_EMPTY_SLOTS_TO_REBUILD = 1000
+    MAX_EMPTY_SLOTS_RATIO = 0.25
+
+    def __init__(self):
+        self.node_ids = []  # type: List[bytes]  # node number -> node_id
+        self.node_index = {}  # type: Dict[bytes, int]  # node_id -> node number
+        self.incoming = []  # type: List[List[tuple]]
+        self.short_channel_ids = []  # type: List[Optional[ShortChannelID]]  # slot -> channel
+        self.slot_for_channel = {}  # type: Dict[ShortChannelID, int]
+        self._endpoints = []  # type: List[Tuple[int, int]]  # slot -> (node1, node2)
+        self._capacity_sat = []  # type: List[Optional[int]]  # slot -> capacity
+        self._policies = []  # type: List[List[Optional[RoutingPolicy]]]  # slot -> [policy1, policy2]
+        self._edges = []  # type: List[List[Optional[tuple]]]  # slot -> [edge from node1, edge from node2]
+        self._num_empty_slots = 0
+        self.layout = (self.node_ids, self.node_index, self.incoming, self.short_channel_ids, self.slot_for_channel)
+
+    def _get_or_add_node(self, node_id: bytes) -> int:
+        n = self.node_index.get(node_id)
+        if n is None:
+            n = len(self.node_ids)
+            self.node_ids.append(node_id)
+            self.incoming.append([])
+            self.node_index[node_id] = n
+        return n
+
+    def _update_edges(self, slot: int) -> None:
+        endpoints = self._endpoints[slot]
+        policies = self._policies[slot]
+        edges = self._edges[slot]
+        capacity_sat = self._capacity_sat[slot]
+        for side in (0, 1):
+            start, end = endpoints[side], endpoints[1 - side]
+            if edges[side] is not None:
+                self.incoming[end].remove(edges[side])
+                edges[side] = None
+            policy = policies[side]
+            # channels that did not publish both policies often return temporary channel failure
+            if policy is None or policies[1 - side] is None or policy.is_disabled:
+                continue
+            max_amount_msat = float('inf')
+            if capacity_sat is not None:
+                max_amount_msat = capacity_sat * 1000 + 999
+            if policy.htlc_maximum_msat is not None:
+                max_amount_msat = min(max_amount_msat, policy.htlc_maximum_msat)
+            edges[side] = (start, slot, policy.fee_base_msat, policy.fee_proportional_millionths,
+                           policy.cltv_expiry_delta, policy.htlc_minimum_msat, max_amount_msat)
+            self.incoming[end].append(edges[side])
+
+    def add_channel(self, channel_info: ChannelInfo,
+                    policy1: Optional[Policy], policy2: Optional[Policy]) -> None:
+        short_channel_id = channel_info.short_channel_id
+        slot = self.slot_for_channel.get(short_channel_id)
+        if slot is None:
+            slot = len(self.short_channel_ids)
+            self.short_channel_ids.append(short_channel_id)
+            self._endpoints.append((self._get_or_add_node(channel_info.node1_id),
+                                    self._get_or_add_node(channel_info.node2_id)))
+            self._capacity_sat.append(None)
+            self._policies.append([None, None])
+            self._edges.append([None, None])
+            self.slot_for_channel[short_channel_id] = slot
+        self._capacity_sat[slot] = channel_info.capacity_sat
+        self._policies[slot] = [RoutingPolicy.from_policy(policy1) if policy1 else None,
+                                RoutingPolicy.from_policy(policy2) if policy2 else None]
+        self._update_edges(slot)
+
+    def remove_channel(self, short_channel_id: ShortChannelID) -> None:
+        slot = self.slot_for_channel.pop(short_channel_id, None)
+        if slot is None:
+            return
+        self._policies[slot] = [None, None]
+        self._update_edges(slot)
+        self.short_channel_ids[slot] = None
+        self._num_empty_slots += 1
+        if self._num_empty_slots > max(self.MIN_EMPTY_SLOTS_TO_REBUILD,
+                                       self.MAX_EMPTY_SLOTS_RATIO * len(self.short_channel_ids)):
+            self._rebuild()
+
+    def _rebuild(self) -> None:
+        """Renumbers the channels and nodes that are left, into new arrays.
+        Path finding still running over the previous ones is not affected.
+        """
+        graph = RoutingGraph()
+        for slot, short_channel_id in enumerate(self.short_channel_ids):
+            if short_channel_id is None:
+                continue
+            new_slot = len(graph.short_channel_ids)
+            graph.short_channel_ids.append(short_channel_id)
+            graph._endpoints.append(tuple(graph._get_or_add_node(self.node_ids[n]) for n in self._endpoints[slot]))
+            graph._capacity_sat.append(self._capacity_sat[slot])
+            graph._policies.append(list(self._policies[slot]))
+            graph._edges.append([None, None])
+            graph.slot_for_channel[short_channel_id] = new_slot
+            graph._update_edges(new_slot)
+        for name in ('node_ids', 'node_index', 'incoming', 'short_channel_ids', 'slot_for_channel',
+                     '_endpoints', '_capacity_sat', '_policies', '_edges', '_num_empty_slots'):
+            setattr(self, name, getattr(graph, name))
+        self.layout = graph.layout
+
+    def update_policy(self, short_channel_id: ShortChannelID, start_node: bytes,
+                      policy: Optional[Policy]) -> None:
+        slot = self.slot_for_channel.get(short_channel_id)
+        if slot is None:
+            return
+        n = self.node_index.get(start_node)
+        if n not in self._endpoints[slot]:
+            return
+        side = self._endpoints[slot].index(n)
+        self._policies[slot][side] = RoutingPolicy.from_policy(policy) if policy else None
+        self._update_edges(slot)
+
+
 class UpdateStatus(IntEnum):
     ORPHANED   = 0
     EXPIRED    = 1
@@ -250,13 +403,113 @@ msg BLOB,
 PRIMARY KEY(node_id)
 )"""
 
+# rows of channel_info, policy and node_info written since the last graph snapshot
+create_gossip_delta = """
+CREATE TABLE IF NOT EXISTS gossip_delta (
+generation INTEGER PRIMARY KEY AUTOINCREMENT,
+kind INTEGER NOT NULL,
+key BLOB
+)"""
+
+create_meta = """
+CREATE TABLE IF NOT EXISTS meta (
+key STRING(32),
+value BLOB,
+PRIMARY KEY(key)
+)"""
+
+
+class DeltaKind(IntEnum):
+    CHANNEL = 0  # key: short_channel_id
+    POLICY  = 1  # key: short_channel_id + start_node
+    NODE    = 2  # key: node_id
+
+
+# Graph snapshot: a header, then fixed-size channel and policy records,
+# then node records followed by their features and alias.
+SNAPSHOT_MAGIC = b'ELGRAPH\x00'
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = struct.Struct('>8sI16sQIII')  # magic, version, db_id, generation, #channels, #policies, #nodes
+SNAPSHOT_CHANNEL = struct.Struct('>8s33s33s')  # short_channel_id, node1_id, node2_id
+SNAPSHOT_POLICY = struct.Struct('>41sHQQIIBBI?')  # the fields of Policy, then whether htlc_maximum_msat is set
+SNAPSHOT_NODE = struct.Struct('>33sIHH')  # node_id, timestamp, len(features), len(alias)
+
+
+def serialize_graph_snapshot(db_id: bytes, generation: int, channels: Sequence[ChannelInfo],
+                             policies: Sequence[Policy], nodes: Sequence[NodeInfo]) -> bytes:
+    out = [SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, db_id, generation,
+                                len(channels), len(policies), len(nodes))]
+    for ci in channels:
+        out.append(SNAPSHOT_CHANNEL.pack(ci.short_channel_id, ci.node1_id, ci.node2_id))
+    for p in policies:
+        out.append(SNAPSHOT_POLICY.pack(p.key, p.cltv_expiry_delta, p.htlc_minimum_msat, p.htlc_maximum_msat or 0,
+                                        p.fee_base_msat, p.fee_proportional_millionths,
+                                        p.channel_flags, p.message_flags, p.timestamp,
+                                        p.htlc_maximum_msat is not None))
+    for node in nodes:
+        features = node.features.to_bytes((node.features.bit_length() + 7) // 8, 'big')
+        alias = node.alias.encode('utf8')
+        out.append(SNAPSHOT_NODE.pack(node.node_id, node.timestamp, len(features), len(alias)))
+        out.append(features)
+        out.append(alias)
+    return b''.join(out)
+
+
+def parse_graph_snapshot(buf) -> Tuple[bytes, int, List[ChannelInfo], List[Policy], List[NodeInfo]]:
+    """Parses a snapshot written by serialize_graph_snapshot from buf
+    (e.g. a memory-mapped file). Returns (db_id, generation, channels,
+    policies, nodes). Raises ValueError if buf is not a valid snapshot.
+    """
+    with memoryview(buf) as mv:
+        try:
+            magic, version, db_id, generation, num_channels, num_policies, num_nodes = SNAPSHOT_HEADER.unpack_from(mv, 0)
+            if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+                raise ValueError('not a graph snapshot, or unsupported version')
+            offset = SNAPSHOT_HEADER.size
+            end = offset + num_channels * SNAPSHOT_CHANNEL.size + num_policies * SNAPSHOT_POLICY.size
+            if end > len(mv):
+                raise ValueError('truncated graph snapshot')
+            end = offset + num_channels * SNAPSHOT_CHANNEL.size
+            channels = [ChannelInfo._make((ShortChannelID(scid), node1_id, node2_id, None))
+                        for scid, node1_id, node2_id in SNAPSHOT_CHANNEL.iter_unpack(mv[offset:end])]
+            offset = end
+            end = offset + num_policies * SNAPSHOT_POLICY.size
+            policies = [Policy._make(fields[:9]) if fields[9] else Policy._make(fields[:3] + (None,) + fields[4:9])
+                        for fields in SNAPSHOT_POLICY.iter_unpack(mv[offset:end])]
+            offset = end
+            nodes = []
+            for i in range(num_nodes):
+                node_id, timestamp, features_len, alias_len = SNAPSHOT_NODE.unpack_from(mv, offset)
+                offset += SNAPSHOT_NODE.size
+                features = int.from_bytes(mv[offset:offset + features_len], 'big')
+                offset += features_len
+                alias = str(mv[offset:offset + alias_len], 'utf8')
+                offset += alias_len
+                nodes.append(NodeInfo(node_id=node_id, features=features, timestamp=timestamp, alias=alias))
+        except struct.error as e:
+            raise ValueError(f'truncated graph snapshot: {e}') from e
+        if offset != len(mv):
+            raise ValueError('trailing data in graph snapshot')
+    return db_id, generation, channels, policies, nodes
+
 
 class ChannelDB(SqlDB):
+    """The gossip graph, persisted in SQLite as the raw gossip messages.
+
+    As decoding all of them is slow, the decoded graph is also written to
+    a snapshot file, every SNAPSHOT_INTERVAL changes and on shutdown. Every
+    change to the database is logged in gossip_delta with an increasing
+    generation; the snapshot records the generation it was taken at, and
+    load_data replays the changes logged after it from the database.
+    """
 
     NUM_MAX_RECENT_PEERS = 20
+    SNAPSHOT_INTERVAL = 20000  # changes
 
     def __init__(self, network: 'Network'):
         path = os.path.join(get_headers_dir(network.config), 'gossip_db')
+        self.snapshot_path = path + '.snapshot'
+        self._writing_snapshot = False
         super().__init__(network.asyncio_loop, path, commit_interval=100)
         self.lock = threading.RLock()
         self.num_nodes = 0
@@ -276,6 +529,7 @@ class ChannelDB(SqlDB):
         self._chans_with_0_policies = set()  # type: Set[ShortChannelID]
         self._chans_with_1_policies = set()  # type: Set[ShortChannelID]
         self._chans_with_2_policies = set()  # type: Set[ShortChannelID]
+        self.routing_graph = RoutingGraph()
 
         self.data_loaded = asyncio.Event()
         self.network = network # only for callback
@@ -367,9 +621,16 @@ class ChannelDB(SqlDB):
             self._channels[channel_info.short_channel_id] = channel_info
             self._channels_for_node[channel_info.node1_id].add(channel_info.short_channel_id)
             self._channels_for_node[channel_info.node2_id].add(channel_info.short_channel_id)
+            self._add_to_routing_graph(channel_info)
+            if 'raw' in msg:
+                self._db_save_channel(channel_info.short_channel_id, msg['raw'])
         self._update_num_policies_for_chan(channel_info.short_channel_id)
-        if 'raw' in msg:
-            self._db_save_channel(channel_info.short_channel_id, msg['raw'])
+
+    def _add_to_routing_graph(self, channel_info: ChannelInfo) -> None:
+        short_channel_id = channel_info.short_channel_id
+        self.routing_graph.add_channel(channel_info,
+                                       self._policies.get((channel_info.node1_id, short_channel_id)),
+                                       self._policies.get((channel_info.node2_id, short_channel_id)))
 
     def policy_changed(self, old_policy: Policy, new_policy: Policy, verbose: bool) -> bool:
         changed = False
@@ -405,6 +666,14 @@ class ChannelDB(SqlDB):
             self.logger.info(f'policy unchanged: {old_policy.timestamp} -> {new_policy.timestamp}')
         return changed
 
+    def get_start_node_for_channel_update(self, payload) -> Optional[bytes]:
+        channel_info = self._channels.get(ShortChannelID(payload['short_channel_id']))
+        if not channel_info:
+            return None
+        flags = int.from_bytes(payload['channel_flags'], 'big')
+        direction = flags & FLAG_DIRECTION
+        return channel_info.node1_id if direction == 0 else channel_info.node2_id
+
     def add_channel_update(self, payload, max_age=None, verify=False, verbose=True):
         now = int(time.time())
         short_channel_id = ShortChannelID(payload['short_channel_id'])
@@ -413,12 +682,9 @@ class ChannelDB(SqlDB):
             return UpdateStatus.EXPIRED
         if timestamp - now > 60:
             return UpdateStatus.DEPRECATED
-        channel_info = self._channels.get(short_channel_id)
-        if not channel_info:
+        start_node = self.get_start_node_for_channel_update(payload)
+        if start_node is None:
             return UpdateStatus.ORPHANED
-        flags = int.from_bytes(payload['channel_flags'], 'big')
-        direction = flags & FLAG_DIRECTION
-        start_node = channel_info.node1_id if direction == 0 else channel_info.node2_id
         payload['start_node'] = start_node
         # compare updates to existing database entries
         timestamp = payload['timestamp']
@@ -433,9 +699,10 @@ class ChannelDB(SqlDB):
         policy = Policy.from_msg(payload)
         with self.lock:
             self._policies[key] = policy
+            self.routing_graph.update_policy(short_channel_id, start_node, policy)
+            if 'raw' in payload:
+                self._db_save_policy(policy.key, payload['raw'])
         self._update_num_policies_for_chan(short_channel_id)
-        if 'raw' in payload:
-            self._db_save_policy(policy.key, payload['raw'])
         if old_policy and not self.policy_changed(old_policy, policy, verbose):
             return UpdateStatus.UNCHANGED
         else:
@@ -474,36 +741,102 @@ class ChannelDB(SqlDB):
         c.execute(create_address)
         c.execute(create_policy)
         c.execute(create_channel_info)
+        c.execute(create_gossip_delta)
+        c.execute(create_meta)
+        # identifies this database to its snapshot, in case it gets deleted
+        c.execute("""INSERT OR IGNORE INTO meta (key, value) VALUES ('db_id', ?)""", (os.urandom(16),))
+        c.execute("""INSERT OR IGNORE INTO meta (key, value) VALUES ('snapshot_generation', 0)""")
         self.conn.commit()
+        c.execute("""SELECT value FROM meta WHERE key='db_id'""")
+        self._db_id = c.fetchone()[0]
+        c.execute("""SELECT seq FROM sqlite_sequence WHERE name='gossip_delta'""")
+        r = c.fetchone()
+        self._db_generation = r[0] if r else 0
+        c.execute("""SELECT COUNT(*) FROM gossip_delta""")
+        self._num_changes_since_snapshot = c.fetchone()[0]
+
+    def _db_log_change(self, kind: DeltaKind, key: bytes) -> None:
+        # note: runs in the SQL thread, like the write it logs
+        c = self.conn.cursor()
+        c.execute("""INSERT INTO gossip_delta (kind, key) VALUES (?,?)""", (int(kind), key))
+        self._db_generation = c.lastrowid
+        self._num_changes_since_snapshot += 1
+        if (self._num_changes_since_snapshot >= self.SNAPSHOT_INTERVAL and self.data_loaded.is_set()
+                and not self._writing_snapshot):
+            self._write_snapshot()
+
+    def _write_snapshot(self) -> None:
+        # note: runs in the SQL thread, so that no change gets logged meanwhile.
+        #       The in-memory graph is changed under self.lock, which also covers
+        #       queueing the change for the database. So with the lock held, once
+        #       the queued requests have run and been committed, the graph is what
+        #       the database holds at generation, even if we crash right after.
+        self._writing_snapshot = True
+        try:
+            with self.lock:
+                self.run_pending_requests()
+                self.conn.commit()
+                generation = self._db_generation
+                channels = list(self._channels.values())
+                policies = list(self._policies.values())
+                nodes = list(self._nodes.values())
+            data = serialize_graph_snapshot(self._db_id, generation, channels, policies, nodes)
+            tmp_path = self.snapshot_path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.snapshot_path)
+            c = self.conn.cursor()
+            c.execute("""REPLACE INTO meta (key, value) VALUES ('snapshot_generation', ?)""", (generation,))
+            c.execute("""DELETE FROM gossip_delta WHERE generation <= ?""", (generation,))
+            self.conn.commit()
+        except Exception as e:
+            self.logger.warning(f'failed to write graph snapshot: {e!r}')
+            return
+        finally:
+            self._writing_snapshot = False
+        self._num_changes_since_snapshot = 0
+        self.logger.info(f'wrote graph snapshot at generation {generation}: '
+                         f'{len(channels)} channels, {len(policies)} policies, {len(nodes)} nodes')
+
+    def on_close(self):
+        if self.data_loaded.is_set() and self._num_changes_since_snapshot:
+            self._write_snapshot()
 
     @sql
     def _db_save_policy(self, key: bytes, msg: bytes):
         # 'msg' is a 'channel_update' message
         c = self.conn.cursor()
         c.execute("""REPLACE INTO policy (key, msg) VALUES (?,?)""", [key, msg])
+        self._db_log_change(DeltaKind.POLICY, key)
 
     @sql
     def _db_delete_policy(self, node_id: bytes, short_channel_id: ShortChannelID):
         key = short_channel_id + node_id
         c = self.conn.cursor()
         c.execute("""DELETE FROM policy WHERE key=?""", (key,))
+        self._db_log_change(DeltaKind.POLICY, key)
 
     @sql
     def _db_save_channel(self, short_channel_id: ShortChannelID, msg: bytes):
         # 'msg' is a 'channel_announcement' message
         c = self.conn.cursor()
         c.execute("REPLACE INTO channel_info (short_channel_id, msg) VALUES (?,?)", [short_channel_id, msg])
+        self._db_log_change(DeltaKind.CHANNEL, short_channel_id)
 
     @sql
     def _db_delete_channel(self, short_channel_id: ShortChannelID):
         c = self.conn.cursor()
         c.execute("""DELETE FROM channel_info WHERE short_channel_id=?""", (short_channel_id,))
+        self._db_log_change(DeltaKind.CHANNEL, short_channel_id)
 
     @sql
     def _db_save_node_info(self, node_id: bytes, msg: bytes):
         # 'msg' is a 'node_announcement' message
         c = self.conn.cursor()
         c.execute("REPLACE INTO node_info (node_id, msg) VALUES (?,?)", [node_id, msg])
+        self._db_log_change(DeltaKind.NODE, node_id)
 
     @sql
     def _db_save_node_address(self, peer: LNPeerAddr, timestamp: int):
@@ -552,8 +885,8 @@ class ChannelDB(SqlDB):
             # save
             with self.lock:
                 self._nodes[node_id] = node_info
-            if 'raw' in msg_payload:
-                self._db_save_node_info(node_id, msg_payload['raw'])
+                if 'raw' in msg_payload:
+                    self._db_save_node_info(node_id, msg_payload['raw'])
             with self.lock:
                 for addr in node_addresses:
                     self._addresses[node_id].add(NodeAddress(addr.host, addr.port, 0))
@@ -575,7 +908,8 @@ class ChannelDB(SqlDB):
                 node_id, scid = key
                 with self.lock:
                     self._policies.pop(key)
-                self._db_delete_policy(*key)
+                    self.routing_graph.update_policy(scid, node_id, None)
+                    self._db_delete_policy(*key)
                 self._update_num_policies_for_chan(scid)
             self.update_counts()
             self.logger.info(f'Deleting {len(old_policies)} old policies')
@@ -603,9 +937,10 @@ class ChannelDB(SqlDB):
             if channel_info:
                 self._channels_for_node[channel_info.node1_id].remove(channel_info.short_channel_id)
                 self._channels_for_node[channel_info.node2_id].remove(channel_info.short_channel_id)
+            self.routing_graph.remove_channel(short_channel_id)
+            # delete from database
+            self._db_delete_channel(short_channel_id)
         self._update_num_policies_for_chan(short_channel_id)
-        # delete from database
-        self._db_delete_channel(short_channel_id)
 
     def get_node_addresses(self, node_id):
         return self._addresses.get(node_id)
@@ -615,9 +950,9 @@ class ChannelDB(SqlDB):
     def load_data(self):
         if self.data_loaded.is_set():
             return
-        # Note: this method takes several seconds... mostly due to lnmsg.decode_msg being slow.
-        #       I believe lnmsg (and lightning.json) will need a rewrite anyway, so instead of tweaking
-        #       load_data() here, that should be done. see #6006
+        # Note: without a usable graph snapshot, most of the time here is spent decoding the stored
+        #       gossip with lnmsg.decode_msg, which uses plans precompiled from the wire schema
+        #       (see lnmsg.CompiledLNSerializer).
         c = self.conn.cursor()
         c.execute("""SELECT * FROM address""")
         for x in c:
@@ -630,6 +965,88 @@ class ChannelDB(SqlDB):
             return newest_ts
         sorted_node_ids = sorted(self._addresses.keys(), key=newest_ts_for_node_id, reverse=True)
         self._recent_peers = sorted_node_ids[:self.NUM_MAX_RECENT_PEERS]
+        try:
+            self._load_snapshot(c)
+        except Exception as e:
+            self.logger.info(f'not loading graph snapshot: {e!r}')
+            self._channels.clear()
+            self._policies.clear()
+            self._nodes.clear()
+            self._load_gossip(c)
+            self._write_snapshot()
+        for channel_info in self._channels.values():
+            self._channels_for_node[channel_info.node1_id].add(channel_info.short_channel_id)
+            self._channels_for_node[channel_info.node2_id].add(channel_info.short_channel_id)
+            self._add_to_routing_graph(channel_info)
+            self._update_num_policies_for_chan(channel_info.short_channel_id)
+        self.logger.info(f'load data {len(self._channels)} {len(self._policies)} {len(self._channels_for_node)}')
+        self.update_counts()
+        (nchans_with_0p, nchans_with_1p, nchans_with_2p) = self.get_num_channels_partitioned_by_policy_count()
+        self.logger.info(f'num_channels_partitioned_by_policy_count. '
+                         f'0p: {nchans_with_0p}, 1p: {nchans_with_1p}, 2p: {nchans_with_2p}')
+        self.data_loaded.set()
+        util.trigger_callback('gossip_db_loaded')
+
+    def _load_snapshot(self, c: sqlite3.Cursor) -> None:
+        # note: the snapshot does not hold node addresses, nor channels_for_node,
+        #       which is rebuilt from the channels by load_data.
+        c.execute("""SELECT value FROM meta WHERE key='snapshot_generation'""")
+        snapshot_generation = c.fetchone()[0]
+        with open(self.snapshot_path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                raise ValueError('empty graph snapshot')
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                db_id, generation, channels, policies, nodes = parse_graph_snapshot(buf)
+        if db_id != self._db_id:
+            raise ValueError('graph snapshot is for another database')
+        # an older snapshot may be missing changes that were compacted away
+        if not (snapshot_generation <= generation <= self._db_generation):
+            raise ValueError(f'graph snapshot is stale: generation {generation}, '
+                             f'expected {snapshot_generation}..{self._db_generation}')
+        for ci in channels:
+            self._channels[ci.short_channel_id] = ci
+        # share the ShortChannelID instances of the channels, rather than creating one per policy
+        short_channel_ids = {scid: scid for scid in self._channels}
+        for p in policies:
+            scid = p.key[0:8]
+            self._policies[(p.key[8:], short_channel_ids.get(scid) or ShortChannelID(scid))] = p
+        for node_info in nodes:
+            self._nodes[node_info.node_id] = node_info
+        # replay the changes made after the snapshot
+        c.execute("""SELECT DISTINCT kind, key FROM gossip_delta WHERE generation > ?""", (generation,))
+        deltas = c.fetchall()
+        for kind, key in deltas:
+            kind = DeltaKind(kind)
+            if kind == DeltaKind.CHANNEL:
+                short_channel_id = ShortChannelID.normalize(key)
+                c.execute("""SELECT msg FROM channel_info WHERE short_channel_id=?""", (key,))
+                r = c.fetchone()
+                try:
+                    if r is None:
+                        raise IncompatibleOrInsaneFeatures()
+                    self._channels[short_channel_id] = ChannelInfo.from_raw_msg(r[0])
+                except IncompatibleOrInsaneFeatures:
+                    self._channels.pop(short_channel_id, None)
+            elif kind == DeltaKind.POLICY:
+                start_node, short_channel_id = key[8:], ShortChannelID.normalize(key[0:8])
+                c.execute("""SELECT msg FROM policy WHERE key=?""", (key,))
+                r = c.fetchone()
+                if r is None:
+                    self._policies.pop((start_node, short_channel_id), None)
+                else:
+                    self._policies[(start_node, short_channel_id)] = Policy.from_raw_msg(key, r[0])
+            elif kind == DeltaKind.NODE:
+                c.execute("""SELECT msg FROM node_info WHERE node_id=?""", (key,))
+                r = c.fetchone()
+                try:
+                    if r is None:
+                        raise IncompatibleOrInsaneFeatures()
+                    self._nodes[key], _ = NodeInfo.from_raw_msg(r[0])
+                except IncompatibleOrInsaneFeatures:
+                    self._nodes.pop(key, None)
+        self.logger.info(f'loaded graph snapshot at generation {generation}, replayed {len(deltas)} changes')
+
+    def _load_gossip(self, c: sqlite3.Cursor) -> None:
         c.execute("""SELECT * FROM channel_info""")
         for short_channel_id, msg in c:
             try:
@@ -649,17 +1066,6 @@ class ChannelDB(SqlDB):
         for key, msg in c:
             p = Policy.from_raw_msg(key, msg)
             self._policies[(p.start_node, p.short_channel_id)] = p
-        for channel_info in self._channels.values():
-            self._channels_for_node[channel_info.node1_id].add(channel_info.short_channel_id)
-            self._channels_for_node[channel_info.node2_id].add(channel_info.short_channel_id)
-            self._update_num_policies_for_chan(channel_info.short_channel_id)
-        self.logger.info(f'load data {len(self._channels)} {len(self._policies)} {len(self._channels_for_node)}')
-        self.update_counts()
-        (nchans_with_0p, nchans_with_1p, nchans_with_2p) = self.get_num_channels_partitioned_by_policy_count()
-        self.logger.info(f'num_channels_partitioned_by_policy_count. '
-                         f'0p: {nchans_with_0p}, 1p: {nchans_with_1p}, 2p: {nchans_with_2p}')
-        self.data_loaded.set()
-        util.trigger_callback('gossip_db_loaded')
 
     def _update_num_policies_for_chan(self, short_channel_id: ShortChannelID) -> None:
         channel_info = self.get_channel_info(short_channel_id)
@@ -22,9 +22,11 @@
 # ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
+import random
+import time
 from collections import defaultdict
 from math import floor, log10
-from typing import NamedTuple, List, Callable, Sequence, Union, Dict, Tuple
+from typing import NamedTuple, List, Callable, Sequence, Union, Dict, Tuple, Optional
 from decimal import Decimal
 
 from .bitcoin import sha256, COIN, is_address
@@ -122,13 +124,28 @@ class CoinChooserBase(Logger):
         # fee_estimator returns fee to be paid, for given vbytes.
         # guess whether it is just returning a constant as follows.
         constant_fee = fee_estimator_vb(2000) == fee_estimator_vb(200)
+        # coins of the same address and script make inputs of the same size
+        segwit_by_kind = {}  # type: Dict[tuple, bool]
+        weight_by_kind = {}  # type: Dict[tuple, int]
+
+        def input_kind(coin: PartialTxInput) -> tuple:
+            return (coin.address, coin.script_type, coin.script_sig, coin.witness, coin.redeem_script,
+                    coin.witness_script, coin.num_sig, tuple(coin.pubkeys))
 
         def make_Bucket(desc: str, coins: List[PartialTxInput]):
-            witness = any(coin.is_segwit(guess_for_address=True) for coin in coins)
+            kinds = [input_kind(coin) for coin in coins]
+            for kind, coin in zip(kinds, coins):
+                if kind not in segwit_by_kind:
+                    segwit_by_kind[kind] = coin.is_segwit(guess_for_address=True)
+            witness = any(segwit_by_kind[kind] for kind in kinds)
             # note that we're guessing whether the tx uses segwit based
             # on this single bucket
-            weight = sum(Transaction.estimated_input_weight(coin, witness)
-                         for coin in coins)
+            weight = 0
+            for kind, coin in zip(kinds, coins):
+                key = kind + (witness,)
+                if key not in weight_by_kind:
+                    weight_by_kind[key] = Transaction.estimated_input_weight(coin, witness)
+                weight += weight_by_kind[key]
             value = sum(coin.value_sats() for coin in coins)
             min_height = min(coin.block_height for coin in coins)
             assert min_height is not None
@@ -285,6 +302,9 @@ class CoinChooserBase(Logger):
         """
         assert outputs, 'tx outputs cannot be empty'
 
+        if sender:
+            coins = self._add_sender_input(coins=coins, inputs=inputs, outputs=outputs, sender=sender)
+
         # Deterministic randomness from coins
         utxos = [c.prevout.serialize_to_network() for c in coins]
         self.p = PRNG(b''.join(sorted(utxos)))
@@ -329,6 +349,15 @@ class CoinChooserBase(Logger):
                                                             base_weight=base_weight,
                                                             gas_fee=gas_fee)
 
+        # What the chosen buckets have to pay for, net of the fees for their own
+        # inputs, and what a change output that is not dust would add to that.
+        # A selection in between pays the outputs without change.
+        self.target_effective_value = spent_amount + fee_estimator_w(base_weight) + gas_fee - input_value
+        change_addr = change_addrs[0] if change_addrs else (coins[0].address if coins else None)
+        change_weight = 4 * Transaction.estimated_output_size(change_addr) if change_addr else 4 * 34
+        self.cost_of_change = (fee_estimator_w(base_weight + change_weight) - fee_estimator_w(base_weight)
+                               + dust_threshold)
+
         # Collect the coins into buckets
         all_buckets = self.bucketize_coins(coins, fee_estimator_vb=fee_estimator_vb)
         # Filter some buckets out. Only keep those that have positive effective value.
@@ -346,6 +375,22 @@ class CoinChooserBase(Logger):
 
         return tx
 
+    def _add_sender_input(self, *, coins: Sequence[PartialTxInput], inputs: List[PartialTxInput],
+                          outputs: List[PartialTxOutput], sender: str) -> List[PartialTxInput]:
+        """Unless an OP_SENDER output names the sender, a coin of the sender
+        address has to be the first input. Returns the remaining coins."""
+        coins = list(coins)
+        op_sender = any([decode_opsender_script(out.scriptpubkey) is not None for out in outputs])
+        if not op_sender:
+            for index, coin in enumerate(coins):
+                if coin.address == sender:
+                    inputs.insert(0, coin)
+                    del coins[index]
+                    break
+            else:
+                raise SenderNoUTXOException("sender has no UTXOs, maybe you should enable OP_SENDER")
+        return coins
+
     def choose_buckets(self, buckets: List[Bucket],
                        sufficient_funds: Callable,
                        penalty_func: Callable[[List[Bucket]], ScoredCandidate]) -> ScoredCandidate:
@@ -486,34 +531,188 @@ class CoinChooserHtmlcoin(CoinChooserPrivacy):
     def __init__(self):
         super().__init__(enable_output_value_rounding=False)
 
-    def make_tx(self, *, coins: Sequence[PartialTxInput], inputs: List[PartialTxInput],
-                outputs: List[PartialTxOutput], change_addrs: Sequence[str],
-                fee_estimator_vb: Callable, dust_threshold: int, gas_fee=0, sender=None):
-        coins = list(coins)
-        op_sender = any([decode_opsender_script(out.scriptpubkey) is not None for out in outputs])
-        if not op_sender and sender:
-            found = False
-            for index, coin in enumerate(coins):
-                if coin.address == sender:
-                    inputs.insert(0, coin)
-                    del coins[index]
-                    found = True
+
+def branch_and_bound(values: Sequence[int], target: int, upper_bound: int, *,
+                     max_tries: int, deadline: float) -> Optional[List[int]]:
+    """Depth-first search for the subset of values (sorted in descending
+    order, all positive) whose sum is in [target, upper_bound] and closest
+    to target. Returns the indices of the subset, or None.
+    """
+    available = sum(values)
+    if available < target:
+        return None
+    best = None
+    best_excess = upper_bound - target
+    included = []  # type: List[bool]  # decision for each of the first values
+    value = 0
+    for tries in range(max_tries):
+        if tries % 1000 == 0 and time.monotonic() > deadline:
+            break
+        if value + available < target or value > upper_bound:
+            backtrack = True
+        elif value >= target:
+            excess = value - target
+            if excess <= best_excess:
+                best = [i for i, inc in enumerate(included) if inc]
+                best_excess = excess
+                if excess == 0:
                     break
-            if not found:
-                raise SenderNoUTXOException("sender has no UTXOs, maybe you should enable OP_SENDER")
-        return super().make_tx(
-            coins=coins,
-            inputs=inputs,
-            outputs=outputs,
-            change_addrs=change_addrs,
-            fee_estimator_vb=fee_estimator_vb,
-            dust_threshold=dust_threshold,
-            gas_fee=gas_fee,
-            sender=sender)
+            backtrack = True
+        else:
+            backtrack = False
+        if backtrack:
+            # undo omissions, then omit the last value included instead
+            while included and not included[-1]:
+                included.pop()
+                available += values[len(included)]
+            if not included:
+                break  # searched the whole tree
+            included[-1] = False
+            value -= values[len(included) - 1]
+        else:
+            i = len(included)
+            available -= values[i]
+            # including a value equal to one just omitted only repeats that branch
+            if included and not included[-1] and values[i] == values[i - 1]:
+                included.append(False)
+            else:
+                included.append(True)
+                value += values[i]
+    return best
+
+
+def approximate_best_subset(values: Sequence[int], target: int, *, rng: random.Random,
+                            iterations: int, deadline: float) -> Optional[List[int]]:
+    """Knapsack heuristic for the subset of values (sorted in descending order)
+    whose sum is the smallest one that reaches target. Returns the indices of
+    the subset, or None if all values together do not reach it.
+    """
+    lowest_larger = None
+    smaller = []
+    for i, v in enumerate(values):
+        if v == target:
+            return [i]
+        if v < target:
+            smaller.append(i)
+        else:
+            lowest_larger = i
+    total_smaller = sum(values[i] for i in smaller)
+    if total_smaller <= target:
+        if total_smaller == target:
+            return smaller
+        return [lowest_larger] if lowest_larger is not None else None
+    smaller_values = [values[i] for i in smaller]
+    best_included = [True] * len(smaller)
+    best_value = total_smaller
+    for rep in range(iterations):
+        if best_value == target or time.monotonic() > deadline:
+            break
+        included = [False] * len(smaller)
+        total = 0
+        reached_target = False
+        # randomly include values; then, if not there yet, include all the others
+        for npass in range(2):
+            if reached_target:
+                break
+            chosen = rng.choices((False, True), k=len(smaller)) if npass == 0 else [not inc for inc in included]
+            for k, v in enumerate(smaller_values):
+                if chosen[k]:
+                    total += v
+                    included[k] = True
+                    if total >= target:
+                        reached_target = True
+                        if total < best_value:
+                            best_value = total
+                            best_included = included[:]
+                        total -= v
+                        included[k] = False
+    if lowest_larger is not None and values[lowest_larger] <= best_value:
+        return [lowest_larger]
+    return [i for i, inc in zip(smaller, best_included) if inc]
+
+
+class CoinChooserBranchAndBound(CoinChooserBase):
+    """Looks for coins whose value pays the outputs and the fee without
+    leaving enough for a change output, so that none is needed.
+    If there are none, it spends the coins whose value exceeds the
+    amount plus the change output by the least, found by a randomized
+    knapsack search.  Like Privacy, coins of the same address are spent
+    together, and confirmed coins are preferred.
+    The searches are seeded from the coins, like Privacy, and bounded in time.
+    """
+
+    bnb_max_tries = 100000
+    knapsack_iterations = 1000
+    time_budget = 0.5  # seconds, for each of the searches
+
+    def keys(self, coins):
+        # an address stands for its script, and is cheaper to get
+        return [coin.address or coin.scriptpubkey.hex() for coin in coins]
+
+    def penalty_func(self, base_tx, *, tx_from_buckets):
+        def penalty(buckets: List[Bucket]) -> ScoredCandidate:
+            # waste: what is paid beyond the amount and the fee of the tx without
+            # change; that is, the fee of the change output, or the excess
+            # that is too small for one
+            tx, change_outputs = tx_from_buckets(buckets)
+            waste = (sum(bkt.effective_value for bkt in buckets) - self.target_effective_value
+                     - sum(o.value for o in change_outputs))
+            return ScoredCandidate(waste, tx, buckets)
+        return penalty
+
+    def _select_buckets(self, buckets: List[Bucket], sufficient_funds) -> Optional[List[Bucket]]:
+        buckets = sorted(buckets, key=lambda bkt: bkt.effective_value, reverse=True)
+        values = [bkt.effective_value for bkt in buckets]
+        target = self.target_effective_value
+        selection = branch_and_bound(values, target, target + self.cost_of_change,
+                                     max_tries=self.bnb_max_tries,
+                                     deadline=time.monotonic() + self.time_budget)
+        if selection is None:
+            rng = random.Random(self.p.get_bytes(32))
+            selection = approximate_best_subset(values, target + self.cost_of_change, rng=rng,
+                                                iterations=self.knapsack_iterations,
+                                                deadline=time.monotonic() + self.time_budget)
+        if selection is None:
+            selection = range(len(buckets))
+        selected = [buckets[i] for i in selection]
+        bucket_value_sum = sum(bkt.value for bkt in selected)
+        if sufficient_funds(selected, bucket_value_sum=bucket_value_sum):
+            return selected
+        # effective values are estimates; top up with the largest other buckets
+        selection = set(selection)
+        for i, bkt in enumerate(buckets):
+            if i in selection:
+                continue
+            selected.append(bkt)
+            bucket_value_sum += bkt.value
+            if sufficient_funds(selected, bucket_value_sum=bucket_value_sum):
+                return selected
+        return None
+
+    def choose_buckets(self, buckets, sufficient_funds, penalty_func):
+        if sufficient_funds([], bucket_value_sum=0):
+            return penalty_func([])
+        conf_buckets = [bkt for bkt in buckets if bkt.min_height > 0]
+        unconf_buckets = [bkt for bkt in buckets if bkt.min_height == 0]
+        other_buckets = [bkt for bkt in buckets if bkt.min_height < 0]
+        eligible = []
+        for bkts in (conf_buckets, unconf_buckets, other_buckets):
+            if not bkts:
+                continue
+            eligible += bkts
+            selected = self._select_buckets(eligible, sufficient_funds)
+            if selected is not None:
+                break
+        else:
+            raise NotEnoughFunds()
+        winner = penalty_func(selected)
+        self.logger.info(f"Total number of buckets: {len(buckets)}. Waste: {winner.penalty}")
+        return winner
 
 
 COIN_CHOOSERS = {
     'Privacy': CoinChooserPrivacy,
+    'BranchAndBound': CoinChooserBranchAndBound,
 }
 
 def get_name(config):
@@ -522,14 +721,15 @@ def get_name(config):
         kind = 'Privacy'
     return kind
 
-def get_coin_chooser(config):
+def get_coin_chooser(config, *, sender=None):
     klass = COIN_CHOOSERS[get_name(config)]
     # note: we enable enable_output_value_rounding by default as
     #       - for sacrificing a few satoshis
     #       + it gives better privacy for the user re change output
     #       + it also helps the network as a whole as fees will become noisier
     #         (trying to counter the heuristic that "whole integer sat/byte feerates" are common)
+    # note: txs with a sender, e.g. contract calls, are built without rounding
     coinchooser = klass(
-        enable_output_value_rounding=config.get('coin_chooser_output_rounding', True),
+        enable_output_value_rounding=config.get('coin_chooser_output_rounding', True) and not sender,
     )
     return coinchooser
@@ -972,7 +972,7 @@ class Commands:
         """
         if not is_hash256_str(txid):
             raise Exception(f"{repr(txid)} is not a txid")
-        if not wallet.db.get_transaction(txid):
+        if not wallet.db.has_transaction(txid):
             raise Exception("Transaction not in wallet.")
         return {
             "confirmations": wallet.get_tx_height(txid).conf,
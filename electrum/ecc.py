@@ -26,7 +26,7 @@
 import base64
 import hashlib
 import functools
-from typing import Union, Tuple, Optional
+from typing import Union, Tuple, Optional, Sequence, List
 from ctypes import (
     byref, c_byte, c_int, c_uint, c_char_p, c_size_t, c_void_p, create_string_buffer,
     CFUNCTYPE, POINTER, cast
@@ -36,7 +36,7 @@ from .util import bfh, assert_bytes, to_bytes, InvalidPassword, profiler, randra
 from .crypto import (sha256d, aes_encrypt_with_iv, aes_decrypt_with_iv, hmac_oneshot)
 from . import constants
 from .logging import get_logger
-from .ecc_fast import _libsecp256k1, SECP256K1_EC_UNCOMPRESSED
+from .ecc_fast import _libsecp256k1, SECP256K1_EC_UNCOMPRESSED, SECP256K1_EC_COMPRESSED
 
 _logger = get_logger(__name__)
 
@@ -269,6 +269,33 @@ class ECPubkey(object):
             return POINT_AT_INFINITY
         return ECPubkey._from_libsecp256k1_pubkey_ptr(pubkey_sum)
 
+    def add_tweaks(self, tweaks: Sequence[bytes]) -> List[Optional[bytes]]:
+        """Returns self + t*G, as compressed public key bytes, for every 32 byte tweak t.
+        An entry is None if its tweak is not below the curve order, or the sum
+        is the point at infinity.
+        Equivalent to (ECPrivkey(t) + self) for each tweak, but self is only
+        converted to the libsecp256k1 representation once.
+        """
+        if self.is_at_infinity(): raise Exception('point is at infinity')
+        pubkey = self._to_libsecp256k1_pubkey_ptr()
+        parent = pubkey.raw
+        pubkey_serialized = create_string_buffer(33)
+        pubkey_size = c_size_t(33)
+        result = []
+        for tweak in tweaks:
+            assert_bytes(tweak)
+            if len(tweak) != 32: raise Exception('tweak must be 32 bytes')
+            pubkey.raw = parent
+            ret = _libsecp256k1.secp256k1_ec_pubkey_tweak_add(_libsecp256k1.ctx, pubkey, tweak)
+            if not ret:
+                result.append(None)
+                continue
+            pubkey_size.value = 33
+            _libsecp256k1.secp256k1_ec_pubkey_serialize(
+                _libsecp256k1.ctx, pubkey_serialized, byref(pubkey_size), pubkey, SECP256K1_EC_COMPRESSED)
+            result.append(pubkey_serialized.raw)
+        return result
+
     def __eq__(self, other) -> bool:
         if not isinstance(other, ECPubkey):
             return False
@@ -365,6 +392,28 @@ def verify_signature(pubkey: bytes, sig: bytes, h: bytes) -> bool:
         return False
     return True
 
+
+def verify_signatures(checks: Sequence[Tuple[bytes, bytes, bytes]]) -> List[bool]:
+    """Verifies (pubkey, sig_string, msg_hash) triples, like verify_signature.
+    The serialized pubkeys are parsed by libsecp256k1 directly, without going
+    through ECPubkey, and the buffers are reused. Calls into libsecp256k1
+    release the GIL, so this can be run in threads.
+    """
+    ctx = _libsecp256k1.ctx
+    sig = create_string_buffer(64)
+    pubkey = create_string_buffer(64)
+    results = []
+    for pubkey_bytes, sig_string, msg_hash in checks:
+        if len(sig_string) != 64 or len(msg_hash) != 32 \
+                or not _libsecp256k1.secp256k1_ecdsa_signature_parse_compact(ctx, sig, sig_string) \
+                or not _libsecp256k1.secp256k1_ec_pubkey_parse(ctx, pubkey, pubkey_bytes, len(pubkey_bytes)):
+            results.append(False)
+            continue
+        _libsecp256k1.secp256k1_ecdsa_signature_normalize(ctx, sig, sig)
+        results.append(1 == _libsecp256k1.secp256k1_ecdsa_verify(ctx, sig, msg_hash, pubkey))
+    return results
+
+
 def verify_message_with_address(address: str, sig65: bytes, message: bytes, *, net=None):
     from .bitcoin import pubkey_to_address
     assert_bytes(sig65, message)
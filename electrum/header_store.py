@@ -0,0 +1,191 @@
+import threading
+import sqlite3
+from typing import Optional, Callable, List, Tuple, Iterable, Sequence
+
+from .bitcoin import hash_encode
+from .crypto import sha256d
+from .util import LRUCache
+from .logging import Logger
+
+
+HEADER_CACHE_SIZE = 10000
+SYNCHRONOUS_MODES = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
+
+
+class HeaderStore(Logger):
+    """SQLite-backed storage of raw headers for a single chain file.
+
+    A single connection is kept open for the lifetime of the store.
+    Deserialized headers are kept in a bounded LRU keyed by height,
+    together with a (bounded) block hash -> height index.
+
+    The database is in WAL mode. write_many() is committed as one
+    transaction; single-header writes and deletes are committed once
+    every commit_interval operations, or by an explicit commit().
+    The row count is maintained in memory.
+    """
+
+    def __init__(self, path: str, deserialize: Callable[[bytes, int], dict], *,
+                 cache_size: int = HEADER_CACHE_SIZE, synchronous: str = 'NORMAL',
+                 commit_interval: int = 1):
+        Logger.__init__(self)
+        if synchronous not in SYNCHRONOUS_MODES:
+            raise ValueError(f'unexpected synchronous mode: {synchronous}')
+        self.path = path
+        self._deserialize = deserialize
+        self.synchronous = synchronous
+        self.commit_interval = max(1, commit_interval)
+        self._pending = 0  # operations not yet committed
+        self._count = 0
+        self.lock = threading.RLock()
+        # height -> (raw_header, header_dict, header_hash)
+        self._headers = LRUCache(cache_size)
+        # header_hash -> height
+        self._heights = LRUCache(cache_size)
+        self.conn = None  # type: Optional[sqlite3.Connection]
+        self.open()
+
+    def open(self) -> None:
+        with self.lock:
+            self.conn = sqlite3.connect(self.path, check_same_thread=False)
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute(f'PRAGMA synchronous={self.synchronous}')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS header '
+                              '(height INT PRIMARY KEY NOT NULL, data BLOB NOT NULL)')
+            self.conn.commit()
+            self._count = int(self.conn.execute('SELECT COUNT(*) FROM header').fetchone()[0])
+
+    def close(self) -> None:
+        with self.lock:
+            if self.conn:
+                self.commit()
+                self.conn.close()
+            self.conn = None
+            self.clear_cache()
+
+    def clear_cache(self) -> None:
+        with self.lock:
+            self._headers.clear()
+            self._heights.clear()
+
+    def _cache(self, height: int, raw_header: bytes) -> Tuple[bytes, dict, str]:
+        header_hash = hash_encode(sha256d(raw_header))
+        item = (raw_header, self._deserialize(raw_header, height), header_hash)
+        self._headers[height] = item
+        self._heights[header_hash] = height
+        return item
+
+    def _invalidate(self, height: int) -> None:
+        item = self._headers.pop(height)
+        if item:
+            self._heights.pop(item[2])
+
+    def _get(self, height: int) -> Optional[Tuple[bytes, dict, str]]:
+        item = self._headers.get(height)
+        if item is not None:
+            return item
+        row = self.conn.execute('SELECT data FROM header WHERE height=?', (height,)).fetchone()
+        if not row:
+            return None
+        return self._cache(height, bytes(row[0]))
+
+    def read_raw(self, height: int) -> Optional[bytes]:
+        with self.lock:
+            item = self._get(height)
+            return item[0] if item else None
+
+    def read_header(self, height: int) -> Optional[dict]:
+        # return a copy so that callers cannot mutate the cached header
+        with self.lock:
+            item = self._get(height)
+            return dict(item[1]) if item else None
+
+    def get_hash(self, height: int) -> Optional[str]:
+        with self.lock:
+            item = self._get(height)
+            return item[2] if item else None
+
+    def get_height(self, header_hash: str) -> Optional[int]:
+        """Returns the height of a recently seen header with the given hash."""
+        with self.lock:
+            height = self._heights.get(header_hash)
+            if height is None:
+                return None
+            item = self._get(height)
+            if item is None or item[2] != header_hash:
+                self._heights.pop(header_hash)
+                return None
+            return height
+
+    def read_range(self, start: int, count: int) -> List[Tuple[int, bytes]]:
+        """Returns [(height, raw_header)] for the stored headers
+        in [start, start + count), in height order, with one query.
+        """
+        if count <= 0:
+            return []
+        with self.lock:
+            rows = self.conn.execute('SELECT height, data FROM header WHERE height>=? AND height<? '
+                                     'ORDER BY height', (start, start + count)).fetchall()
+            return [(height, bytes(data)) for height, data in rows]
+
+    def commit(self) -> None:
+        with self.lock:
+            if self._pending:
+                self.conn.commit()
+            self._pending = 0
+
+    def _maybe_commit(self, num_ops: int) -> None:
+        self._pending += num_ops
+        if self._pending >= self.commit_interval:
+            self.commit()
+
+    def _num_stored(self, heights: Sequence[int]) -> int:
+        lo, hi = min(heights), max(heights)
+        if hi - lo + 1 == len(heights):
+            return self.conn.execute('SELECT COUNT(*) FROM header WHERE height>=? AND height<=?',
+                                     (lo, hi)).fetchone()[0]
+        return sum(1 for height in heights
+                   if self.conn.execute('SELECT 1 FROM header WHERE height=?', (height,)).fetchone())
+
+    def _replace(self, headers: Sequence[Tuple[int, bytes]]) -> None:
+        heights = [height for height, _ in headers]
+        for height in heights:
+            self._invalidate(height)
+        self._count += len(heights) - self._num_stored(heights)
+        self.conn.executemany('REPLACE INTO header (height, data) VALUES(?,?)', headers)
+
+    def write_many(self, headers: Iterable[Tuple[int, bytes]]) -> None:
+        """Writes the headers, and anything pending, in one transaction."""
+        with self.lock:
+            headers = list(headers)
+            if headers:
+                self._replace(headers)
+            self._pending += 1
+            self.commit()
+
+    def write(self, height: int, raw_header: bytes) -> None:
+        with self.lock:
+            self._replace([(height, raw_header)])
+            self._maybe_commit(1)
+
+    def delete(self, height: int) -> None:
+        with self.lock:
+            self._invalidate(height)
+            cursor = self.conn.execute('DELETE FROM header where height=?', (height,))
+            self._count -= cursor.rowcount
+            self._maybe_commit(1)
+
+    def delete_all(self) -> None:
+        with self.lock:
+            self.clear_cache()
+            self.conn.execute('DELETE FROM header')
+            self._count = 0
+            self._pending += 1
+            self.commit()
+
+    def count(self) -> int:
+        return self._count
+
+    def min_max_height(self) -> Tuple[Optional[int], Optional[int]]:
+        with self.lock:
+            return self.conn.execute('SELECT min(height), max(height) FROM header').fetchone()
@@ -29,7 +29,8 @@ import sys
 import traceback
 import asyncio
 import socket
-from typing import Tuple, Union, List, TYPE_CHECKING, Optional, Set, NamedTuple, Any, Sequence
+import time
+from typing import Tuple, Union, List, TYPE_CHECKING, Optional, Set, NamedTuple, Any, Sequence, Dict
 from collections import defaultdict
 from ipaddress import IPv4Network, IPv6Network, ip_address, IPv6Address, IPv4Address
 import itertools
@@ -70,6 +71,15 @@ BUCKET_NAME_OF_ONION_SERVERS = 'onion'
 
 MAX_INCOMING_MSG_SIZE = 9_000_000  # in bytes
 
+# requests for these methods are sent as JSON-RPC batches, see RequestBatcher
+BATCHED_METHODS = frozenset({
+    'blockchain.transaction.get',
+    'blockchain.transaction.get_merkle',
+    'blochchain.transaction.get_receipt',
+})
+DEFAULT_BATCH_SIZE = 50
+DEFAULT_MAX_INFLIGHT_BATCHES = 10
+
 _KNOWN_NETWORK_PROTOCOLS = {'t', 's'}
 PREFERRED_NETWORK_PROTOCOL = 's'
 assert PREFERRED_NETWORK_PROTOCOL in _KNOWN_NETWORK_PROTOCOLS
@@ -130,6 +140,79 @@ def assert_list_or_tuple(val: Any) -> None:
         raise RequestCorrupted(f'{val!r} should be a list or tuple')
 
 
+class RequestBatcher:
+    """Coalesces the requests made during one iteration of the event loop
+    into JSON-RPC batch requests of at most batch_size requests each, with
+    at most max_inflight batches waiting for a response at any time.
+
+    Every request gets its own future, which is resolved with its result
+    or with its JSON-RPC error, as if it had been sent on its own.
+    """
+
+    def __init__(self, session: 'NotificationSession', *,
+                 batch_size: int = DEFAULT_BATCH_SIZE,
+                 max_inflight: int = DEFAULT_MAX_INFLIGHT_BATCHES):
+        self.session = session
+        self.batch_size = max(1, batch_size)
+        self._inflight = asyncio.Semaphore(max(1, max_inflight))
+        self._pending = []  # type: List[Tuple[str, Sequence, asyncio.Future]]
+        self._flush_scheduled = False
+        self._tasks = set()  # type: Set[asyncio.Task]
+
+    def request(self, method: str, params: Sequence) -> asyncio.Future:
+        loop = asyncio.get_event_loop()
+        fut = loop.create_future()
+        self._pending.append((method, params, fut))
+        if len(self._pending) >= self.batch_size:
+            self._flush()
+        elif not self._flush_scheduled:
+            self._flush_scheduled = True
+            loop.call_soon(self._flush)
+        return fut
+
+    def _flush(self) -> None:
+        self._flush_scheduled = False
+        while self._pending:
+            requests = self._pending[:self.batch_size]
+            del self._pending[:self.batch_size]
+            task = asyncio.ensure_future(self._send(requests))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, requests: List[Tuple[str, Sequence, asyncio.Future]]) -> None:
+        try:
+            async with self._inflight:
+                # skip requests whose caller gave up while we were waiting
+                requests = [r for r in requests if not r[2].done()]
+                if len(requests) == 1:
+                    method, params, fut = requests[0]
+                    results = [await RPCSession.send_request(self.session, method, params)]
+                elif requests:
+                    async with self.session.send_batch() as batch:
+                        for method, params, fut in requests:
+                            batch.add_request(method, params)
+                    results = batch.results
+                else:
+                    results = []
+        except (Exception, TaskTimeout) as e:
+            # note: TaskTimeout is how aiorpcx reports a request timeout
+            for method, params, fut in requests:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+        except BaseException:
+            for method, params, fut in requests:
+                fut.cancel()
+            raise
+        for (method, params, fut), result in zip(requests, results):
+            if fut.done():
+                continue
+            if isinstance(result, Exception):
+                fut.set_exception(result)
+            else:
+                fut.set_result(result)
+
+
 class NotificationSession(RPCSession):
 
     def __init__(self, *args, interface: 'Interface', **kwargs):
@@ -140,6 +223,16 @@ class NotificationSession(RPCSession):
         self._msg_counter = itertools.count(start=1)
         self.interface = interface
         self.cost_hard_limit = 0  # disable aiorpcx resource limits
+        self._batcher = None  # type: Optional[RequestBatcher]
+
+    def get_batcher(self) -> RequestBatcher:
+        if self._batcher is None:
+            config = self.interface.network.config
+            self._batcher = RequestBatcher(
+                self,
+                batch_size=int(config.get('network_batch_size', DEFAULT_BATCH_SIZE)),
+                max_inflight=int(config.get('network_max_inflight_batches', DEFAULT_MAX_INFLIGHT_BATCHES)))
+        return self._batcher
 
     async def handle_request(self, request):
         self.maybe_log(f"--> {request}")
@@ -167,9 +260,11 @@ class NotificationSession(RPCSession):
         try:
             # note: RPCSession.send_request raises TaskTimeout in case of a timeout.
             # TaskTimeout is a subclass of CancelledError, which is *suppressed* in TaskGroups
-            response = await asyncio.wait_for(
-                super().send_request(*args, **kwargs),
-                timeout)
+            if len(args) == 2 and not kwargs and args[0] in BATCHED_METHODS:
+                request = self.get_batcher().request(*args)
+            else:
+                request = super().send_request(*args, **kwargs)
+            response = await asyncio.wait_for(request, timeout)
         except (TaskTimeout, asyncio.TimeoutError) as e:
             raise RequestTimedOut(f'request timed out: {args} (id: {msg_id})') from e
         except CodeMessageError as e:
@@ -596,6 +691,16 @@ class Interface(Logger):
         if tip is not None:
             size = min(size, tip - index * CHUNK_SIZE + 1)
             size = max(size, 0)
+        res = await self.fetch_chunk(index, size)
+        conn = self.blockchain.connect_chunk(index, res['hex'])
+        if not conn:
+            return conn, 0
+        return conn, res['count']
+
+    async def fetch_chunk(self, index: int, size: int) -> dict:
+        """Requests `size` headers starting at chunk `index`.
+        The result is checked for consistency but not verified against any chain.
+        """
         try:
             self._requested_chunks.add(index)
             res = await self.session.send_request('blockchain.block.headers', [index * CHUNK_SIZE, size])
@@ -611,10 +716,65 @@ class Interface(Logger):
         #     raise RequestCorrupted('inconsistent chunk hex and count')
         if res['count'] != size:
             raise RequestCorrupted(f"expected {size} headers but only got {res['count']}")
-        conn = self.blockchain.connect_chunk(index, res['hex'])
-        if not conn:
-            return conn, 0
-        return conn, res['count']
+        return res
+
+    def _get_chunk_sources(self, min_tip: int) -> List['Interface']:
+        """Returns the connected interfaces, self first, that claim to have
+        headers up to min_tip.
+        """
+        with self.network.interfaces_lock: interfaces = list(self.network.interfaces.values())
+        sources = [self]
+        for iface in interfaces:
+            if iface is self or not iface.ready.done() or iface.ready.cancelled():
+                continue
+            if not iface.session or iface.session.is_closing():
+                continue
+            if iface.tip >= min_tip:
+                sources.append(iface)
+        return sources
+
+    async def _sync_chunks_pipelined(self, height: int, next_height: int) -> int:
+        """Downloads the full chunks between height and next_height, keeping up to
+        'header_chunk_pipeline' requests in flight spread over the connected
+        interfaces, and connects them in height order.
+        Returns the number of chunks connected. Stops at the first chunk that
+        cannot be fetched or connected, leaving it and the following ones to
+        the serial code path of sync_until.
+        """
+        window = int(self.network.config.get('header_chunk_pipeline', 4))
+        first_index = height // CHUNK_SIZE
+        last_index = (next_height + 1) // CHUNK_SIZE - 1
+        if window < 2 or last_index <= first_index:
+            return 0
+        sources = self._get_chunk_sources((last_index + 1) * CHUNK_SIZE - 1)
+        self.logger.info(f"pipelined catch-up of chunks {first_index}-{last_index} "
+                         f"using {len(sources)} interfaces, window {window}")
+        tasks = {}  # type: Dict[int, Tuple[Interface, asyncio.Future]]
+        next_request = first_index
+        index = first_index
+        try:
+            while index <= last_index:
+                while next_request <= last_index and len(tasks) < window:
+                    iface = sources[next_request % len(sources)]
+                    tasks[next_request] = iface, asyncio.ensure_future(iface.fetch_chunk(next_request, CHUNK_SIZE))
+                    next_request += 1
+                iface, fut = tasks[index]
+                await asyncio.wait([fut])
+                del tasks[index]
+                if fut.cancelled() or fut.exception():
+                    error = 'cancelled' if fut.cancelled() else repr(fut.exception())
+                    self.logger.info(f"chunk {index} from {iface} failed: {error}")
+                    break
+                res = fut.result()
+                if not self.blockchain.connect_chunk(index, res['hex']):
+                    self.logger.info(f"chunk {index} from {iface} does not connect")
+                    break
+                index += 1
+                util.trigger_callback('network_updated')
+        finally:
+            for _, fut in tasks.values():
+                fut.cancel()
+        return index - first_index
 
     def is_main_server(self) -> bool:
         return self.network.default_server == self.server
@@ -720,15 +880,30 @@ class Interface(Logger):
         if next_height is None:
             next_height = self.tip
         last = None
+        num_chunks = 0
+        try_pipeline = True
+        start_time = time.monotonic()
         while last is None or height <= next_height:
             prev_last, prev_height = last, height
             if next_height > height + 10:
+                pipelined = 0
+                if try_pipeline:
+                    # if a chunk fails, the pipeline is not restarted: the rest
+                    # is synced chunk by chunk, starting with the failed one
+                    try_pipeline = False
+                    pipelined = await self._sync_chunks_pipelined(height, next_height)
+                if pipelined:
+                    num_chunks += pipelined
+                    height = (height // CHUNK_SIZE + pipelined) * CHUNK_SIZE
+                    last = 'catchup'
+                    continue
                 could_connect, num_headers = await self.request_chunk(height, next_height)
                 if not could_connect:
                     if height <= constants.net.max_checkpoint():
                         raise GracefulDisconnect('server chain conflicts with checkpoints or genesis')
                     last, height = await self.step(height)
                     continue
+                num_chunks += 1
                 util.trigger_callback('network_updated')
                 height = (height // CHUNK_SIZE * CHUNK_SIZE) + num_headers
                 assert height <= next_height+1, (height, self.tip)
@@ -736,6 +911,9 @@ class Interface(Logger):
             else:
                 last, height = await self.step(height)
             assert (prev_last, prev_height) != (last, height), 'had to prevent infinite loop in interface.sync_until'
+        if num_chunks:
+            elapsed = max(time.monotonic() - start_time, 1e-6)
+            self.logger.info(f"caught up {num_chunks} chunks in {elapsed:.1f}s ({num_chunks / elapsed:.2f} chunks/s)")
         return last, height
 
     async def step(self, height, header=None):
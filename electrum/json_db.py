@@ -34,6 +34,10 @@ from .logging import Logger
 
 JsonDBJsonEncoder = util.MyEncoder
 
+# appended changes are merged into a full rewrite of the file
+# once they take more space than the last full write
+MIN_COMPACTION_SIZE = 64 * 1024
+
 def modifier(func):
     def wrapper(self, *args, **kwargs):
         with self.lock:
@@ -47,18 +51,70 @@ def locked(func):
             return func(self, *args, **kwargs)
     return wrapper
 
+def replaces_value(func):
+    """For methods that change a stored list or set in place:
+    the whole container is recorded as changed."""
+    def wrapper(self, *args, **kwargs):
+        if not self.db:
+            return func(self, *args, **kwargs)
+        with self.db.lock:
+            r = func(self, *args, **kwargs)
+            self.db.add_patch(['set', self.path, self])
+            return r
+    return wrapper
+
+
+def apply_patch(data: dict, patch: Sequence) -> None:
+    """Applies a change recorded by JsonDB.add_patch to json data."""
+    op, path = patch[0], patch[1]
+    if not path:
+        assert op == 'set', patch
+        data.clear()
+        data.update(patch[2])
+        return
+    parent = reduce(lambda d, key: d[key], path[:-1], data)
+    key = path[-1]
+    if op == 'set':
+        parent[key] = patch[2]
+    elif op == 'del':
+        parent.pop(key, None)
+    elif op == 'append':
+        parent[key].append(patch[2])
+    elif op == 'add':  # sets are stored as lists
+        if patch[2] not in parent[key]:
+            parent[key].append(patch[2])
+    elif op == 'discard':
+        if patch[2] in parent[key]:
+            parent[key].remove(patch[2])
+    else:
+        raise ValueError(f'unknown patch operation: {op}')
+
+
+def set_db(v, db, path) -> None:
+    """Attaches a stored value, and what it contains, to db at path."""
+    if isinstance(v, StoredDict):
+        v.db = db
+        v.lock = db.lock if db else v.lock
+        v.path = path
+        for k, vv in v.items():
+            set_db(vv, db, path + [k])
+    elif isinstance(v, (StoredList, StoredSet, StoredObject)):
+        v.set_db(db, path)
+
 
 class StoredObject:
 
     db = None
+    _path = None
 
     def __setattr__(self, key, value):
-        if self.db:
-            self.db.set_modified(True)
         object.__setattr__(self, key, value)
+        if self.db and not key.startswith('_'):
+            self.db.add_patch(['set', self._path, self])
 
-    def set_db(self, db):
-        self.db = db
+    def set_db(self, db, path):
+        object.__setattr__(self, 'db', db)
+        object.__setattr__(self, '_path', path)
 
     def to_json(self):
         d = dict(vars(self))
@@ -71,6 +127,119 @@ class StoredObject:
 
 _RaiseKeyError = object() # singleton for no-default behavior
 
+
+class StoredList(list):
+    """A list in a JsonDB. In-place changes are recorded by the db."""
+
+    __slots__ = ('db', 'path')
+
+    def __init__(self, data, db, path):
+        list.__init__(self, data)
+        self.set_db(db, path)
+
+    def set_db(self, db, path):
+        self.db = db
+        self.path = path
+
+    def __copy__(self):
+        return list(self)
+
+    def __deepcopy__(self, memo):
+        return copy.deepcopy(list(self), memo)
+
+    def append(self, item):
+        if not self.db:
+            return list.append(self, item)
+        with self.db.lock:
+            list.append(self, item)
+            self.db.add_patch(['append', self.path, item])
+
+    __setitem__ = replaces_value(list.__setitem__)
+    __delitem__ = replaces_value(list.__delitem__)
+    __iadd__ = replaces_value(list.__iadd__)
+    __imul__ = replaces_value(list.__imul__)
+    extend = replaces_value(list.extend)
+    insert = replaces_value(list.insert)
+    remove = replaces_value(list.remove)
+    pop = replaces_value(list.pop)
+    clear = replaces_value(list.clear)
+    sort = replaces_value(list.sort)
+    reverse = replaces_value(list.reverse)
+
+
+class StoredSet(set):
+    """A set in a JsonDB, stored as a list. In-place changes are recorded by the db."""
+
+    __slots__ = ('db', 'path')
+
+    def __init__(self, data, db, path):
+        set.__init__(self, data)
+        self.set_db(db, path)
+
+    def set_db(self, db, path):
+        self.db = db
+        self.path = path
+
+    def __copy__(self):
+        return set(self)
+
+    def __deepcopy__(self, memo):
+        return copy.deepcopy(set(self), memo)
+
+    def add(self, item):
+        if not self.db:
+            return set.add(self, item)
+        with self.db.lock:
+            if item not in self:
+                set.add(self, item)
+                self.db.add_patch(['add', self.path, item])
+
+    def discard(self, item):
+        if not self.db:
+            return set.discard(self, item)
+        with self.db.lock:
+            if item in self:
+                set.discard(self, item)
+                self.db.add_patch(['discard', self.path, item])
+
+    def remove(self, item):
+        if item not in self:
+            raise KeyError(item)
+        self.discard(item)
+
+    def pop(self):
+        if not self.db:
+            return set.pop(self)
+        with self.db.lock:
+            item = set.pop(self)
+            self.db.add_patch(['discard', self.path, item])
+            return item
+
+    def update(self, *others):
+        if not self.db:
+            return set.update(self, *others)
+        with self.db.lock:
+            for other in others:
+                for item in other:
+                    self.add(item)
+
+    def difference_update(self, *others):
+        if not self.db:
+            return set.difference_update(self, *others)
+        with self.db.lock:
+            for other in others:
+                for item in other:
+                    self.discard(item)
+
+    clear = replaces_value(set.clear)
+    intersection_update = replaces_value(set.intersection_update)
+    symmetric_difference_update = replaces_value(set.symmetric_difference_update)
+    __ior__ = replaces_value(set.__ior__)
+    __iand__ = replaces_value(set.__iand__)
+    __isub__ = replaces_value(set.__isub__)
+    __ixor__ = replaces_value(set.__ixor__)
+
+
 class StoredDict(dict):
 
     def __init__(self, data, db, path):
@@ -79,7 +248,7 @@ class StoredDict(dict):
         self.path = path
         # recursively convert dicts to StoredDict
         for k, v in list(data.items()):
-            self.__setitem__(k, v)
+            self._setitem(k, v, add_patch=False)
 
     def convert_key(self, key):
         """Convert int keys to str keys, as only those are allowed in json."""
@@ -90,17 +259,17 @@ class StoredDict(dict):
 
     @locked
     def __setitem__(self, key, v):
+        self._setitem(key, v)
+
+    def _setitem(self, key, v, *, add_patch=True):
         key = self.convert_key(key)
-        is_new = key not in self
+        is_new = not dict.__contains__(self, key)
         # early return to prevent unnecessary disk writes
-        if not is_new and self[key] == v:
+        if not is_new and dict.__getitem__(self, key) == v:
             return
         # recursively set db and path
-        if isinstance(v, StoredDict):
-            v.db = self.db
-            v.path = self.path + [key]
-            for k, vv in v.items():
-                v[k] = vv
+        if isinstance(v, (StoredDict, StoredList, StoredSet)):
+            set_db(v, self.db, self.path + [key])
         # recursively convert dict to StoredDict.
         # _convert_dict is called breadth-first
         elif isinstance(v, dict):
@@ -108,24 +277,29 @@ class StoredDict(dict):
                 v = self.db._convert_dict(self.path, key, v)
             if not self.db or self.db._should_convert_to_stored_dict(key):
                 v = StoredDict(v, self.db, self.path + [key])
+        # convert lists and sets, so that in-place changes get recorded
+        elif isinstance(v, list):
+            v = StoredList(v, self.db, self.path + [key])
+        elif isinstance(v, set):
+            v = StoredSet(v, self.db, self.path + [key])
         # convert_value is called depth-first
         if isinstance(v, dict) or isinstance(v, str):
             if self.db:
                 v = self.db._convert_value(self.path, key, v)
         # set parent of StoredObject
         if isinstance(v, StoredObject):
-            v.set_db(self.db)
+            v.set_db(self.db, self.path + [key])
         # set item
         dict.__setitem__(self, key, v)
-        if self.db:
-            self.db.set_modified(True)
+        if self.db and add_patch:
+            self.db.add_patch(['set', self.path + [key], v])
 
     @locked
     def __delitem__(self, key):
         key = self.convert_key(key)
         dict.__delitem__(self, key)
         if self.db:
-            self.db.set_modified(True)
+            self.db.add_patch(['del', self.path + [key]])
 
     @locked
     def __getitem__(self, key):
@@ -142,12 +316,20 @@ class StoredDict(dict):
         key = self.convert_key(key)
         if v is _RaiseKeyError:
             r = dict.pop(self, key)
+        elif key not in self:
+            return v
         else:
             r = dict.pop(self, key, v)
         if self.db:
-            self.db.set_modified(True)
+            self.db.add_patch(['del', self.path + [key]])
         return r
 
+    @locked
+    def clear(self):
+        dict.clear(self)
+        if self.db:
+            self.db.add_patch(['set', self.path, {}])
+
     @locked
     def get(self, key, default=None):
         key = self.convert_key(key)
@@ -155,20 +337,107 @@ class StoredDict(dict):
 
 
 class JsonDB(Logger):
+    """Json data, written to storage either in full, or incrementally.
+
+    Changes made through StoredDict, StoredList, StoredSet and StoredObject
+    are recorded as patches. Once the db has been written in full to a
+    storage, later writes to it only append the recorded patches, until
+    these take more space than the full write. The file then consists of
+    the full json dump, followed by one line per appended write, each
+    holding a json list of patches; see load_json().
+
+    Changes made in other ways must be flagged with set_modified(True);
+    they make the next write a full one.
+    """
 
     def __init__(self, data):
         Logger.__init__(self)
         self.lock = threading.RLock()
         self.data = data
         self._modified = False
+        # json-encoded patches not yet written to self._storage,
+        # or None if the next write has to be a full one
+        self.pending_changes = None  # type: Optional[List[str]]
+        self._storage = None
+        self._dump_size = 0  # size of the last full write
+        self._log_size = 0  # size appended to it since
 
     def set_modified(self, b):
         with self.lock:
             self._modified = b
+            if b:
+                self.pending_changes = None
 
     def modified(self):
         return self._modified
 
+    def add_patch(self, patch: list) -> None:
+        """Records a change of the data, as ['set', path, value],
+        ['del', path], ['append', path, item], ['add', path, item]
+        or ['discard', path, item].
+        """
+        with self.lock:
+            self._modified = True
+            if self.pending_changes is not None:
+                self.pending_changes.append(json.dumps(patch, cls=JsonDBJsonEncoder))
+
+    def load_json(self, s: str) -> dict:
+        """Parses data written by write_all() and append_pending_changes().
+        A last line that cannot be parsed is assumed to be an interrupted
+        append, and ignored.
+        """
+        decoder = json.JSONDecoder()
+        data, end = decoder.raw_decode(s, json.decoder.WHITESPACE.match(s, 0).end())
+        lines = [line for line in s[end:].split('\n') if line.strip()]
+        if lines and not isinstance(data, dict):
+            raise ValueError('patches to non-dict data')
+        for i, line in enumerate(lines):
+            try:
+                patches = json.loads(line)
+            except ValueError:
+                if i < len(lines) - 1:
+                    raise
+                self.logger.warning('ignoring incomplete appended write')
+                break
+            for patch in patches:
+                apply_patch(data, patch)
+        return data
+
+    def can_append(self, storage) -> bool:
+        with self.lock:
+            return (self.pending_changes is not None
+                    and storage is self._storage
+                    and storage.can_append()
+                    and self._log_size < max(self._dump_size, MIN_COMPACTION_SIZE))
+
+    def write_all(self, storage) -> None:
+        with self.lock:
+            s = self.dump()
+            storage.write(s)
+            self._storage = storage
+            self._dump_size = len(s)
+            self._log_size = 0
+            # patches are only recorded once the data has been converted to StoredDict
+            self.pending_changes = [] if isinstance(self.data, StoredDict) else None
+
+    def append_pending_changes(self, storage) -> None:
+        with self.lock:
+            assert self.can_append(storage)
+            if not self.pending_changes:
+                return
+            s = '[' + ','.join(self.pending_changes) + ']'
+            try:
+                storage.append(s)
+            except BaseException:
+                # the file might end with a partial line now
+                self.pending_changes = None
+                raise
+            self._log_size += len(s) + 1
+            self.pending_changes = []
+
+    def has_appended_changes(self, storage) -> bool:
+        return storage is self._storage and self._log_size > 0
+
     @locked
     def get(self, key, default=None):
         v = self.data.get(key)
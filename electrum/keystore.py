@@ -27,6 +27,7 @@
 from unicodedata import normalize
 import hashlib
 import re
+import threading
 from typing import Tuple, TYPE_CHECKING, Union, Sequence, Optional, Dict, List, NamedTuple
 from functools import lru_cache
 from abc import ABC, abstractmethod
@@ -36,12 +37,13 @@ from .bitcoin import deserialize_privkey, serialize_privkey, BaseDecodeError
 from .transaction import Transaction, PartialTransaction, PartialTxInput, PartialTxOutput, TxInput
 from .bip32 import (convert_bip32_path_to_list_of_uint32, BIP32_PRIME,
                     is_xpub, is_xprv, BIP32Node, normalize_bip32_derivation,
-                    convert_bip32_intpath_to_strpath, is_xkey_consistent_with_key_origin_info)
+                    convert_bip32_intpath_to_strpath, is_xkey_consistent_with_key_origin_info,
+                    derive_child_pubkeys)
 from .ecc import string_to_number
 from .crypto import (pw_decode, pw_encode, sha256, sha256d, PW_HASH_VERSION_LATEST,
                      SUPPORTED_PW_HASH_VERSIONS, UnsupportedPasswordHashVersion, hash_160)
 from .util import (InvalidPassword, WalletFileException,
-                   BitcoinException, bfh, inv_dict, is_hex_str)
+                   BitcoinException, bfh, inv_dict, is_hex_str, LRUCache)
 from .mnemonic import Mnemonic, Wordlist, seed_type, is_seed
 from .plugin import run_hook
 from .logging import Logger
@@ -376,6 +378,10 @@ class MasterPublicKeyMixin(ABC):
     def derive_pubkey(self, for_change: int, n: int) -> bytes:
         pass
 
+    def derive_pubkeys(self, for_change: int, start: int, stop: int, *, num_workers: int = 1) -> List[bytes]:
+        """Returns the pubkeys at indices [start, stop) of the given chain."""
+        return [self.derive_pubkey(for_change, n) for n in range(start, stop)]
+
     def get_pubkey_derivation(self, pubkey: bytes,
                               txinout: Union['PartialTxInput', 'PartialTxOutput'],
                               *, only_der_suffix=True) \
@@ -421,11 +427,15 @@ class MasterPublicKeyMixin(ABC):
 
 class Xpub(MasterPublicKeyMixin):
 
+    DERIVED_PUBKEYS_CACHE_SIZE = 5000
+
     def __init__(self, *, derivation_prefix: str = None, root_fingerprint: str = None):
         self.xpub = None
-        self.xpub_receive = None
-        self.xpub_change = None
         self._xpub_bip32_node = None  # type: Optional[BIP32Node]
+        self._chain_nodes = {}  # type: Dict[int, Tuple[bytes, bytes]]  # for_change -> (pubkey, chaincode)
+        # (for_change, n) -> pubkey
+        self._derived_pubkeys = LRUCache(self.DERIVED_PUBKEYS_CACHE_SIZE)  # note: needs self._derived_pubkeys_lock
+        self._derived_pubkeys_lock = threading.Lock()
 
         # "key origin" info (subclass should persist these):
         self._derivation_prefix = derivation_prefix  # type: Optional[str]
@@ -507,19 +517,33 @@ class Xpub(MasterPublicKeyMixin):
             self._derivation_prefix = derivation_prefix
         self.is_requesting_to_be_rewritten_to_wallet_file = True
 
-    @lru_cache(maxsize=None)
+    def _get_chain_node(self, for_change: int) -> Tuple[bytes, bytes]:
+        node = self._chain_nodes.get(for_change)
+        if node is None:
+            chain_node = self.get_bip32_node_for_xpub().subkey_at_public_derivation((for_change,))
+            node = chain_node.eckey.get_public_key_bytes(compressed=True), chain_node.chaincode
+            self._chain_nodes[for_change] = node
+        return node
+
     def derive_pubkey(self, for_change: int, n: int) -> bytes:
         for_change = int(for_change)
         assert for_change in (0, 1)
-        xpub = self.xpub_change if for_change else self.xpub_receive
-        if xpub is None:
-            rootnode = self.get_bip32_node_for_xpub()
-            xpub = rootnode.subkey_at_public_derivation((for_change,)).to_xpub()
-            if for_change:
-                self.xpub_change = xpub
-            else:
-                self.xpub_receive = xpub
-        return self.get_pubkey_from_xpub(xpub, (n,))
+        with self._derived_pubkeys_lock:
+            pubkey = self._derived_pubkeys.get((for_change, n))
+        if pubkey is None:
+            pubkey, = self.derive_pubkeys(for_change, n, n + 1)
+        return pubkey
+
+    def derive_pubkeys(self, for_change: int, start: int, stop: int, *, num_workers: int = 1) -> List[bytes]:
+        for_change = int(for_change)
+        assert for_change in (0, 1)
+        pubkey, chaincode = self._get_chain_node(for_change)
+        pubkeys = derive_child_pubkeys(pubkey, chaincode, start, stop, num_workers=num_workers)
+        with self._derived_pubkeys_lock:
+            # only the last ones, if there are more than the cache holds
+            for n in range(max(start, stop - self.DERIVED_PUBKEYS_CACHE_SIZE), stop):
+                self._derived_pubkeys[(for_change, n)] = pubkeys[n - start]
+        return pubkeys
 
     @classmethod
     def get_pubkey_from_xpub(self, xpub: str, sequence) -> bytes:
@@ -635,6 +659,9 @@ class Mobile_KeyStore(BIP32_KeyStore):
         node = BIP32Node.from_xkey(master_xprv).subkey_at_private_derivation([n+BIP32_PRIME])
         return self.get_pubkey_from_xpub(node.to_xpub(), ())
 
+    # children are derived from the private key, one at a time
+    derive_pubkeys = MasterPublicKeyMixin.derive_pubkeys
+
     def derive_privkey(self, sequence, password):
         master_xprv = self.get_master_private_key(password)
         node = BIP32Node.from_xkey(master_xprv).subkey_at_private_derivation([sequence[1] + BIP32_PRIME])
@@ -701,6 +728,9 @@ class Qt_Core_Keystore(BIP32_KeyStore):
         node = BIP32Node.from_xkey(master_xprv).subkey_at_private_derivation([n + BIP32_PRIME])
         return self.get_pubkey_from_xpub(node.to_xpub(), ())
 
+    # children are derived from the private key, one at a time
+    derive_pubkeys = MasterPublicKeyMixin.derive_pubkeys
+
     def get_private_key(self, sequence, password):
         master_xprv = self.get_master_private_key(password)
         node = BIP32Node.from_xkey(master_xprv).subkey_at_private_derivation([sequence[1]+BIP32_PRIME])
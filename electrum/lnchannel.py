@@ -679,11 +679,9 @@ class Channel(AbstractChannel):
 
     def get_settled_payments(self):
         out = defaultdict(list)
-        for direction, htlc in self.hm.all_htlcs_ever():
-            htlc_proposer = LOCAL if direction is SENT else REMOTE
-            if self.hm.was_htlc_preimage_released(htlc_id=htlc.htlc_id, htlc_proposer=htlc_proposer):
-                rhash = htlc.payment_hash.hex()
-                out[rhash].append((self.channel_id, htlc, direction))
+        for direction, htlc in self.hm.all_htlcs_with_preimage_released():
+            rhash = htlc.payment_hash.hex()
+            out[rhash].append((self.channel_id, htlc, direction))
         return out
 
     def open_with_first_pcp(self, remote_pcp: bytes, remote_sig: bytes) -> None:
@@ -1,5 +1,7 @@
+from bisect import bisect_right
+from collections import defaultdict
 from copy import deepcopy
-from typing import Optional, Sequence, Tuple, List, Dict, TYPE_CHECKING, Set
+from typing import Optional, Sequence, Tuple, List, Dict, TYPE_CHECKING, Set, NamedTuple, Iterable, FrozenSet
 import threading
 
 from .lnutil import SENT, RECEIVED, LOCAL, REMOTE, HTLCOwner, UpdateAddHtlc, Direction, FeeUpdate
@@ -9,6 +11,37 @@ if TYPE_CHECKING:
     from .json_db import StoredDict
 
 
+# the active htlcs of old ctxs are indexed every that many ctns
+HTLC_INDEX_CHECKPOINT_INTERVAL = 100
+
+
+class ArchivedHtlc(NamedTuple):
+    """An htlc that was removed, and whose removal was revoked in the ctxs of
+    both parties. It replaces the entries of the htlc in 'adds', 'locked_in',
+    and 'settles' or 'fails'. The ctns are kept, as old ctxs may still get
+    broadcast."""
+    htlc: UpdateAddHtlc
+    locked_in_local: int
+    locked_in_remote: int
+    removed_local: int
+    removed_remote: int
+    settled: bool
+
+    @classmethod
+    def from_json(cls, x) -> 'ArchivedHtlc':
+        htlc, *ctns, settled = x
+        return cls(UpdateAddHtlc.from_tuple(*htlc), *ctns, settled)
+
+    def locked_in(self, ctx_owner: HTLCOwner) -> int:
+        return self.locked_in_local if ctx_owner == LOCAL else self.locked_in_remote
+
+    def removed(self, ctx_owner: HTLCOwner) -> int:
+        return self.removed_local if ctx_owner == LOCAL else self.removed_remote
+
+    def is_active_at_ctn(self, ctx_owner: HTLCOwner, ctn: int) -> bool:
+        return self.locked_in(ctx_owner) <= ctn < self.removed(ctx_owner)
+
+
 class HTLCManager:
 
     def __init__(self, log:'StoredDict', *, initial_feerate=None):
@@ -19,6 +52,7 @@ class HTLCManager:
                 'locked_in': {},         # "side who offered htlc" -> action -> htlc_id -> whose ctx -> ctn
                 'settles': {},           # "side who offered htlc" -> action -> htlc_id -> whose ctx -> ctn
                 'fails': {},             # "side who offered htlc" -> action -> htlc_id -> whose ctx -> ctn
+                'archived_htlcs': {},    # "side who offered htlc" -> htlc_id -> ArchivedHtlc
                 'fee_updates': {},       # "side who initiated fee update" -> action -> list of FeeUpdates
                 'revack_pending': False,
                 'next_htlc_id': 0,
@@ -43,6 +77,11 @@ class HTLCManager:
         self.log = log
         self.lock = threading.RLock()
         self._init_maybe_active_htlc_ids()
+        self._init_settled_htlcs_ledger()
+        # index of the htlcs in old ctxs, built on first use. see _get_htlc_ids_maybe_active_at_old_ctn
+        self._locked_in_at = None  # type: Optional[Dict[HTLCOwner, Dict[HTLCOwner, Dict[int, List[int]]]]]
+        self._active_at_checkpoint = None  # type: Optional[Dict[HTLCOwner, Dict[HTLCOwner, Dict[int, FrozenSet[int]]]]]
+        self._removed_at = None  # type: Optional[Dict[HTLCOwner, Dict[HTLCOwner, Dict[str, Dict[int, List[int]]]]]]
 
     def with_lock(func):
         def func_wrapper(self, *args, **kwargs):
@@ -90,6 +129,7 @@ class HTLCManager:
         self.log[LOCAL]['locked_in'][htlc_id] = {LOCAL: None, REMOTE: self.ctn_latest(REMOTE)+1}
         self.log[LOCAL]['next_htlc_id'] += 1
         self._maybe_active_htlc_ids[LOCAL].add(htlc_id)
+        self._index_locked_in(ctx_owner=REMOTE, htlc_proposer=LOCAL, htlc_id=htlc_id)
         return htlc
 
     @with_lock
@@ -102,6 +142,7 @@ class HTLCManager:
         self.log[REMOTE]['locked_in'][htlc_id] = {LOCAL: self.ctn_latest(LOCAL)+1, REMOTE: None}
         self.log[REMOTE]['next_htlc_id'] += 1
         self._maybe_active_htlc_ids[REMOTE].add(htlc_id)
+        self._index_locked_in(ctx_owner=LOCAL, htlc_proposer=REMOTE, htlc_id=htlc_id)
 
     @with_lock
     def send_settle(self, htlc_id: int) -> None:
@@ -170,11 +211,13 @@ class HTLCManager:
     def send_rev(self) -> None:
         self.log[LOCAL]['ctn'] += 1
         self._set_revack_pending(LOCAL, False)
+        self._on_ctx_revoked(LOCAL)
         # htlcs
         for htlc_id in self._maybe_active_htlc_ids[REMOTE]:
             ctns = self.log[REMOTE]['locked_in'][htlc_id]
             if ctns[REMOTE] is None and ctns[LOCAL] <= self.ctn_latest(LOCAL):
                 ctns[REMOTE] = self.ctn_latest(REMOTE) + 1
+                self._index_locked_in(ctx_owner=REMOTE, htlc_proposer=REMOTE, htlc_id=htlc_id)
         for log_action in ('settles', 'fails'):
             for htlc_id in self._maybe_active_htlc_ids[LOCAL]:
                 ctns = self.log[LOCAL][log_action].get(htlc_id, None)
@@ -191,11 +234,13 @@ class HTLCManager:
     def recv_rev(self) -> None:
         self.log[REMOTE]['ctn'] += 1
         self._set_revack_pending(REMOTE, False)
+        self._on_ctx_revoked(REMOTE)
         # htlcs
         for htlc_id in self._maybe_active_htlc_ids[LOCAL]:
             ctns = self.log[LOCAL]['locked_in'][htlc_id]
             if ctns[LOCAL] is None and ctns[REMOTE] <= self.ctn_latest(REMOTE):
                 ctns[LOCAL] = self.ctn_latest(LOCAL) + 1
+                self._index_locked_in(ctx_owner=LOCAL, htlc_proposer=LOCAL, htlc_id=htlc_id)
         for log_action in ('settles', 'fails'):
             for htlc_id in self._maybe_active_htlc_ids[REMOTE]:
                 ctns = self.log[REMOTE][log_action].get(htlc_id, None)
@@ -219,6 +264,7 @@ class HTLCManager:
         #   there is a sanity margin of 1 ctn -- this relaxes the care needed re order of method calls.
         # - balance_delta is in sync with maybe_active_htlc_ids. When htlcs are removed from the latter,
         #   balance_delta is updated to reflect that htlc.
+        # - htlcs removed from maybe_active_htlc_ids are fully resolved, and get archived.
         sanity_margin = 1
         for htlc_proposer in (LOCAL, REMOTE):
             for log_action in ('settles', 'fails'):
@@ -233,6 +279,25 @@ class HTLCManager:
                         if log_action == 'settles':
                             htlc = self.log[htlc_proposer]['adds'][htlc_id]  # type: UpdateAddHtlc
                             self._balance_delta -= htlc.amount_msat * htlc_proposer
+                        self._archive_htlc(htlc_proposer, htlc_id, log_action)
+
+    def _archive_htlc(self, htlc_proposer: HTLCOwner, htlc_id: int, log_action: str) -> None:
+        # Replaces the 3 log entries of the htlc with a single ArchivedHtlc. This bounds
+        # the size of the dicts that are looked up for pending htlcs, and saves memory
+        # and space in the wallet file. The ctns are kept for old ctxs.
+        log = self.log[htlc_proposer]
+        locked_in = log['locked_in'][htlc_id]
+        removed = log[log_action][htlc_id]
+        log['archived_htlcs'][htlc_id] = ArchivedHtlc(
+            htlc=log['adds'][htlc_id],
+            locked_in_local=locked_in[LOCAL],
+            locked_in_remote=locked_in[REMOTE],
+            removed_local=removed[LOCAL],
+            removed_remote=removed[REMOTE],
+            settled=(log_action == 'settles'))
+        del log['adds'][htlc_id]
+        del log['locked_in'][htlc_id]
+        del log[log_action][htlc_id]
 
     @with_lock
     def _init_maybe_active_htlc_ids(self):
@@ -243,24 +308,137 @@ class HTLCManager:
         for htlc_proposer in (LOCAL, REMOTE):
             for htlc_id in self.log[htlc_proposer]['adds']:
                 self._maybe_active_htlc_ids[htlc_proposer].add(htlc_id)
+            for archived in self.log[htlc_proposer]['archived_htlcs'].values():
+                if archived.settled:
+                    self._balance_delta -= archived.htlc.amount_msat * htlc_proposer
         # remove old htlcs
         self._update_maybe_active_htlc_ids()
 
+    def _init_settled_htlcs_ledger(self):
+        # The ledger has the htlcs settled in the ctxs of subject, up to its oldest unrevoked ctn,
+        # sorted by the ctn of the settlement. It is extended as the ctxs of subject get revoked.
+        # subject -> "side who offered htlc" -> ctns, htlc_ids, running totals of the amounts (computed lazily)
+        self._settled_ctns = {LOCAL: {LOCAL: [], REMOTE: []}, REMOTE: {LOCAL: [], REMOTE: []}}  # type: Dict[HTLCOwner, Dict[HTLCOwner, List[int]]]
+        self._settled_htlc_ids = {LOCAL: {LOCAL: [], REMOTE: []}, REMOTE: {LOCAL: [], REMOTE: []}}  # type: Dict[HTLCOwner, Dict[HTLCOwner, List[int]]]
+        self._settled_totals_msat = {LOCAL: {LOCAL: [], REMOTE: []}, REMOTE: {LOCAL: [], REMOTE: []}}  # type: Dict[HTLCOwner, Dict[HTLCOwner, List[int]]]
+        for subject in (LOCAL, REMOTE):
+            oldest_ctn = self.ctn_oldest_unrevoked(subject)
+            for htlc_proposer in (LOCAL, REMOTE):
+                settled = [(ctns[subject], int(htlc_id))
+                           for htlc_id, ctns in self.log[htlc_proposer]['settles'].items()
+                           if ctns[subject] is not None and ctns[subject] <= oldest_ctn]
+                settled += [(archived.removed(subject), int(htlc_id))
+                            for htlc_id, archived in self.log[htlc_proposer]['archived_htlcs'].items()
+                            if archived.settled]
+                settled.sort()
+                self._settled_ctns[subject][htlc_proposer] = [ctn for ctn, htlc_id in settled]
+                self._settled_htlc_ids[subject][htlc_proposer] = [htlc_id for ctn, htlc_id in settled]
+
+    def _on_ctx_revoked(self, subject: HTLCOwner) -> None:
+        """Called when the oldest unrevoked ctn of subject has been incremented."""
+        ctn = self.ctn_oldest_unrevoked(subject)
+        for htlc_proposer in (LOCAL, REMOTE):
+            for htlc_id in self._get_htlc_ids_removed_exactly_at_ctn(
+                    ctn, ctx_owner=subject, htlc_proposer=htlc_proposer, log_action='settles'):
+                self._settled_ctns[subject][htlc_proposer].append(ctn)
+                self._settled_htlc_ids[subject][htlc_proposer].append(htlc_id)
+            if self._removed_at is not None:
+                for log_action in ('settles', 'fails'):
+                    htlc_ids = self._get_htlc_ids_removed_exactly_at_ctn(
+                        ctn, ctx_owner=subject, htlc_proposer=htlc_proposer, log_action=log_action)
+                    if htlc_ids:
+                        self._removed_at[subject][htlc_proposer][log_action][ctn] = htlc_ids
+        # the htlcs of the ctx that just got revoked will not change anymore
+        revoked_ctn = ctn - 1
+        if self._active_at_checkpoint is not None and revoked_ctn % HTLC_INDEX_CHECKPOINT_INTERVAL == 0:
+            for htlc_proposer in (LOCAL, REMOTE):
+                active = frozenset(
+                    htlc_id for htlc_id in self._maybe_active_htlc_ids[htlc_proposer]
+                    if self.is_htlc_active_at_ctn(ctx_owner=subject, ctn=revoked_ctn,
+                                                  htlc_proposer=htlc_proposer, htlc_id=htlc_id))
+                if active:
+                    self._active_at_checkpoint[subject][htlc_proposer][revoked_ctn] = active
+
+    def _index_locked_in(self, *, ctx_owner: HTLCOwner, htlc_proposer: HTLCOwner, htlc_id: int) -> None:
+        if self._locked_in_at is None:
+            return
+        ctn = self.log[htlc_proposer]['locked_in'][htlc_id][ctx_owner]
+        self._locked_in_at[ctx_owner][htlc_proposer][ctn].append(int(htlc_id))
+
+    def _build_old_ctn_index(self) -> None:
+        # For each ctx_owner and htlc_proposer, we index
+        #  - the htlc_ids by the ctn they got locked in at,
+        #  - the htlc_ids that are active at every HTLC_INDEX_CHECKPOINT_INTERVAL-th ctn,
+        #    for revoked ctns. Those sets are final: new ctns are assigned after the latest ctn.
+        #  - the htlc_ids by the ctn they got settled or failed at, up to the oldest unrevoked ctn.
+        #    Those are final too, and extended as ctxs get revoked.
+        interval = HTLC_INDEX_CHECKPOINT_INTERVAL
+        self._locked_in_at = {sub: {p: defaultdict(list) for p in (LOCAL, REMOTE)} for sub in (LOCAL, REMOTE)}
+        self._removed_at = {sub: {p: {'settles': defaultdict(list), 'fails': defaultdict(list)}
+                                  for p in (LOCAL, REMOTE)}
+                            for sub in (LOCAL, REMOTE)}
+        active_at_checkpoint = {sub: {p: defaultdict(set) for p in (LOCAL, REMOTE)} for sub in (LOCAL, REMOTE)}
+        for htlc_proposer in (LOCAL, REMOTE):
+            log = self.log[htlc_proposer]
+            htlcs = []
+            for htlc_id, locked_in in log['locked_in'].items():
+                log_action = 'fails' if htlc_id in log['fails'] else 'settles'
+                removed = log[log_action].get(htlc_id) or {LOCAL: None, REMOTE: None}
+                htlcs.append((int(htlc_id), locked_in[LOCAL], locked_in[REMOTE], removed[LOCAL], removed[REMOTE],
+                              log_action))
+            for htlc_id, a in log['archived_htlcs'].items():
+                htlcs.append((int(htlc_id), a.locked_in_local, a.locked_in_remote, a.removed_local, a.removed_remote,
+                              'settles' if a.settled else 'fails'))
+            for htlc_id, locked_in_local, locked_in_remote, removed_local, removed_remote, log_action in htlcs:
+                for ctx_owner, locked_in, removed in ((LOCAL, locked_in_local, removed_local),
+                                                      (REMOTE, locked_in_remote, removed_remote)):
+                    if removed is not None and removed <= self.ctn_oldest_unrevoked(ctx_owner):
+                        self._removed_at[ctx_owner][htlc_proposer][log_action][removed].append(htlc_id)
+                    if locked_in is None:
+                        continue
+                    self._locked_in_at[ctx_owner][htlc_proposer][locked_in].append(htlc_id)
+                    end = self.ctn_oldest_unrevoked(ctx_owner)
+                    if removed is not None:
+                        end = min(end, removed)
+                    first_checkpoint = -(-locked_in // interval) * interval
+                    for checkpoint in range(first_checkpoint, end, interval):
+                        active_at_checkpoint[ctx_owner][htlc_proposer][checkpoint].add(htlc_id)
+        self._active_at_checkpoint = {
+            sub: {p: {ctn: frozenset(ids) for ctn, ids in active_at_checkpoint[sub][p].items()}
+                  for p in (LOCAL, REMOTE)}
+            for sub in (LOCAL, REMOTE)}
+
+    def _get_htlc_ids_maybe_active_at_old_ctn(self, *, ctx_owner: HTLCOwner, ctn: int,
+                                              htlc_proposer: HTLCOwner) -> Iterable[int]:
+        """Returns a superset of the htlcs active in ctx_owner's revoked ctx at ctn:
+        those active at the previous checkpoint, and those locked in since."""
+        if self._active_at_checkpoint is None:
+            self._build_old_ctn_index()
+        checkpoint = ctn // HTLC_INDEX_CHECKPOINT_INTERVAL * HTLC_INDEX_CHECKPOINT_INTERVAL
+        htlc_ids = set(self._active_at_checkpoint[ctx_owner][htlc_proposer].get(checkpoint, ()))
+        locked_in_at = self._locked_in_at[ctx_owner][htlc_proposer]
+        for locked_in_ctn in range(checkpoint + 1, ctn + 1):
+            htlc_ids.update(locked_in_at.get(locked_in_ctn, ()))
+        return htlc_ids
+
     @with_lock
     def discard_unsigned_remote_updates(self):
         """Discard updates sent by the remote, that the remote itself
         did not yet sign (i.e. there was no corresponding commitment_signed msg)
         """
         # htlcs added
+        discarded_htlc_ids = []
         for htlc_id, ctns in list(self.log[REMOTE]['locked_in'].items()):
             if ctns[LOCAL] > self.ctn_latest(LOCAL):
+                if self._locked_in_at is not None:
+                    self._locked_in_at[LOCAL][REMOTE][ctns[LOCAL]].remove(int(htlc_id))
                 del self.log[REMOTE]['locked_in'][htlc_id]
                 del self.log[REMOTE]['adds'][htlc_id]
                 self._maybe_active_htlc_ids[REMOTE].discard(htlc_id)
-        if self.log[REMOTE]['locked_in']:
-            self.log[REMOTE]['next_htlc_id'] = max([int(x) for x in self.log[REMOTE]['locked_in'].keys()]) + 1
-        else:
-            self.log[REMOTE]['next_htlc_id'] = 0
+                discarded_htlc_ids.append(int(htlc_id))
+        # the discarded htlcs are the newest ones. note: older ones might have been archived
+        if discarded_htlc_ids:
+            self.log[REMOTE]['next_htlc_id'] = min(discarded_htlc_ids)
         # htlcs removed
         for log_action in ('settles', 'fails'):
             for htlc_id, ctns in list(self.log[LOCAL][log_action].items()):
@@ -295,7 +473,10 @@ class HTLCManager:
     ##### Queries re HTLCs:
 
     def get_htlc_by_id(self, htlc_proposer: HTLCOwner, htlc_id: int) -> UpdateAddHtlc:
-        return self.log[htlc_proposer]['adds'][htlc_id]
+        htlc = self.log[htlc_proposer]['adds'].get(htlc_id)
+        if htlc is None:
+            return self.log[htlc_proposer]['archived_htlcs'][htlc_id].htlc
+        return htlc
 
     @with_lock
     def is_htlc_active_at_ctn(self, *, ctx_owner: HTLCOwner, ctn: int,
@@ -305,7 +486,9 @@ class HTLCManager:
             return False
         settles = self.log[htlc_proposer]['settles']
         fails = self.log[htlc_proposer]['fails']
-        ctns = self.log[htlc_proposer]['locked_in'][htlc_id]
+        ctns = self.log[htlc_proposer]['locked_in'].get(htlc_id)
+        if ctns is None:
+            return self.log[htlc_proposer]['archived_htlcs'][htlc_id].is_active_at_ctn(ctx_owner, ctn)
         if ctns[ctx_owner] is not None and ctns[ctx_owner] <= ctn:
             not_settled = htlc_id not in settles or settles[htlc_id][ctx_owner] is None or settles[htlc_id][ctx_owner] > ctn
             not_failed = htlc_id not in fails or fails[htlc_id][ctx_owner] is None or fails[htlc_id][ctx_owner] > ctn
@@ -331,12 +514,13 @@ class HTLCManager:
         party = subject if direction == SENT else subject.inverted()
         if ctn >= self.ctn_oldest_unrevoked(subject):
             considered_htlc_ids = self._maybe_active_htlc_ids[party]
-        else:  # ctn is too old; need to consider full log (slow...)
-            considered_htlc_ids = self.log[party]['locked_in']
+        else:  # ctn is too old; use the index
+            considered_htlc_ids = sorted(self._get_htlc_ids_maybe_active_at_old_ctn(
+                ctx_owner=subject, ctn=ctn, htlc_proposer=party))
         for htlc_id in considered_htlc_ids:
             htlc_id = int(htlc_id)
             if self.is_htlc_active_at_ctn(ctx_owner=subject, ctn=ctn, htlc_proposer=party, htlc_id=htlc_id):
-                d[htlc_id] = self.log[party]['adds'][htlc_id]
+                d[htlc_id] = self.get_htlc_by_id(party, htlc_id)
         return d
 
     @with_lock
@@ -371,16 +555,46 @@ class HTLCManager:
     def was_htlc_preimage_released(self, *, htlc_id: int, htlc_proposer: HTLCOwner) -> bool:
         settles = self.log[htlc_proposer]['settles']
         if htlc_id not in settles:
-            return False
+            archived = self.log[htlc_proposer]['archived_htlcs'].get(htlc_id)
+            return archived is not None and archived.settled
         return settles[htlc_id][htlc_proposer] is not None
 
     def was_htlc_failed(self, *, htlc_id: int, htlc_proposer: HTLCOwner) -> bool:
         """Returns whether an HTLC has been (or will be if we already know) failed."""
         fails = self.log[htlc_proposer]['fails']
         if htlc_id not in fails:
-            return False
+            archived = self.log[htlc_proposer]['archived_htlcs'].get(htlc_id)
+            return archived is not None and not archived.settled
         return fails[htlc_id][htlc_proposer] is not None
 
+    def _get_settled_htlc_ids(self, subject: HTLCOwner, htlc_proposer: HTLCOwner,
+                              ctn: Optional[int]) -> Sequence[int]:
+        """Returns the htlcs settled in subject's ctx up to ctn, or at any ctn if ctn is None."""
+        if ctn is not None and ctn < self.ctn_oldest_unrevoked(subject):
+            i = bisect_right(self._settled_ctns[subject][htlc_proposer], ctn)
+            return self._settled_htlc_ids[subject][htlc_proposer][:i]
+        htlc_ids = list(self._settled_htlc_ids[subject][htlc_proposer])
+        # settlements after the oldest unrevoked ctn are not in the ledger yet
+        settles = self.log[htlc_proposer]['settles']
+        oldest_ctn = self.ctn_oldest_unrevoked(subject)
+        for htlc_id in self._maybe_active_htlc_ids[htlc_proposer]:
+            ctns = settles.get(htlc_id, None)
+            if ctns is None or ctns[subject] is None:
+                continue
+            if oldest_ctn < ctns[subject] and (ctn is None or ctns[subject] <= ctn):
+                htlc_ids.append(int(htlc_id))
+        return htlc_ids
+
+    def _get_settled_total_msat(self, subject: HTLCOwner, htlc_proposer: HTLCOwner, ctn: int) -> int:
+        """Returns the amount of the htlcs settled in subject's ctx up to ctn, which must be revoked."""
+        i = bisect_right(self._settled_ctns[subject][htlc_proposer], ctn)
+        totals = self._settled_totals_msat[subject][htlc_proposer]
+        total = totals[-1] if totals else 0
+        for htlc_id in self._settled_htlc_ids[subject][htlc_proposer][len(totals):i]:
+            total += self.get_htlc_by_id(htlc_proposer, htlc_id).amount_msat
+            totals.append(total)
+        return totals[i - 1] if i > 0 else 0
+
     @with_lock
     def all_settled_htlcs_ever_by_direction(self, subject: HTLCOwner, direction: Direction,
                                             ctn: int = None) -> Sequence[UpdateAddHtlc]:
@@ -393,11 +607,7 @@ class HTLCManager:
         # subject's ctx
         # party is the proposer of the HTLCs
         party = subject if direction == SENT else subject.inverted()
-        d = []
-        for htlc_id, ctns in self.log[party]['settles'].items():
-            if ctns[subject] is not None and ctns[subject] <= ctn:
-                d.append(self.log[party]['adds'][htlc_id])
-        return d
+        return [self.get_htlc_by_id(party, htlc_id) for htlc_id in self._get_settled_htlc_ids(subject, party, ctn)]
 
     @with_lock
     def all_settled_htlcs_ever(self, subject: HTLCOwner, ctn: int = None) \
@@ -415,7 +625,19 @@ class HTLCManager:
     @with_lock
     def all_htlcs_ever(self) -> Sequence[Tuple[Direction, UpdateAddHtlc]]:
         sent = [(SENT, htlc) for htlc in self.log[LOCAL]['adds'].values()]
+        sent += [(SENT, archived.htlc) for archived in self.log[LOCAL]['archived_htlcs'].values()]
         received = [(RECEIVED, htlc) for htlc in self.log[REMOTE]['adds'].values()]
+        received += [(RECEIVED, archived.htlc) for archived in self.log[REMOTE]['archived_htlcs'].values()]
+        return sent + received
+
+    @with_lock
+    def all_htlcs_with_preimage_released(self) -> Sequence[Tuple[Direction, UpdateAddHtlc]]:
+        """Return the list of all HTLCs for which was_htlc_preimage_released."""
+        # the preimage is released when the settlement is in the ctx of the htlc proposer
+        sent = [(SENT, self.get_htlc_by_id(LOCAL, htlc_id))
+                for htlc_id in self._get_settled_htlc_ids(LOCAL, LOCAL, None)]
+        received = [(RECEIVED, self.get_htlc_by_id(REMOTE, htlc_id))
+                    for htlc_id in self._get_settled_htlc_ids(REMOTE, REMOTE, None)]
         return sent + received
 
     @with_lock
@@ -427,13 +649,13 @@ class HTLCManager:
         if ctn is None:
             ctn = self.ctn_oldest_unrevoked(ctx_owner)
         balance = initial_balance_msat
-        if ctn >= self.ctn_oldest_unrevoked(ctx_owner):
-            balance += self._balance_delta * whose
-            considered_sent_htlc_ids = self._maybe_active_htlc_ids[whose]
-            considered_recv_htlc_ids = self._maybe_active_htlc_ids[-whose]
-        else:  # ctn is too old; need to consider full log (slow...)
-            considered_sent_htlc_ids = self.log[whose]['settles']
-            considered_recv_htlc_ids = self.log[-whose]['settles']
+        if ctn < self.ctn_oldest_unrevoked(ctx_owner):  # ctn is too old; use the ledger
+            balance -= self._get_settled_total_msat(ctx_owner, whose, ctn)
+            balance += self._get_settled_total_msat(ctx_owner, -whose, ctn)
+            return balance
+        balance += self._balance_delta * whose
+        considered_sent_htlc_ids = self._maybe_active_htlc_ids[whose]
+        considered_recv_htlc_ids = self._maybe_active_htlc_ids[-whose]
         # sent htlcs
         for htlc_id in considered_sent_htlc_ids:
             ctns = self.log[whose]['settles'].get(htlc_id, None)
@@ -451,20 +673,27 @@ class HTLCManager:
         return balance
 
     @with_lock
-    def _get_htlcs_that_got_removed_exactly_at_ctn(
+    def _get_htlc_ids_removed_exactly_at_ctn(
             self, ctn: int, *, ctx_owner: HTLCOwner, htlc_proposer: HTLCOwner, log_action: str,
-    ) -> Sequence[UpdateAddHtlc]:
-        if ctn >= self.ctn_oldest_unrevoked(ctx_owner):
-            considered_htlc_ids = self._maybe_active_htlc_ids[htlc_proposer]
-        else:  # ctn is too old; need to consider full log (slow...)
-            considered_htlc_ids = self.log[htlc_proposer][log_action]
-        htlcs = []
-        for htlc_id in considered_htlc_ids:
+    ) -> Sequence[int]:
+        if ctn < self.ctn_oldest_unrevoked(ctx_owner):  # ctn is too old; use the index
+            if self._removed_at is None:
+                self._build_old_ctn_index()
+            return sorted(self._removed_at[ctx_owner][htlc_proposer][log_action].get(ctn, ()))
+        htlc_ids = []
+        for htlc_id in self._maybe_active_htlc_ids[htlc_proposer]:
             ctns = self.log[htlc_proposer][log_action].get(htlc_id, None)
             if ctns is None: continue
             if ctns[ctx_owner] == ctn:
-                htlcs.append(self.log[htlc_proposer]['adds'][htlc_id])
-        return htlcs
+                htlc_ids.append(int(htlc_id))
+        return htlc_ids
+
+    def _get_htlcs_that_got_removed_exactly_at_ctn(
+            self, ctn: int, *, ctx_owner: HTLCOwner, htlc_proposer: HTLCOwner, log_action: str,
+    ) -> Sequence[UpdateAddHtlc]:
+        return [self.get_htlc_by_id(htlc_proposer, htlc_id)
+                for htlc_id in self._get_htlc_ids_removed_exactly_at_ctn(
+                    ctn, ctx_owner=ctx_owner, htlc_proposer=htlc_proposer, log_action=log_action)]
 
     def received_in_ctn(self, local_ctn: int) -> Sequence[UpdateAddHtlc]:
         """
@@ -1,6 +1,7 @@
 import os
 import csv
 import io
+import struct
 from typing import Callable, Tuple, Any, Dict, List, Sequence, Union, Optional
 from collections import OrderedDict
 
@@ -505,9 +506,344 @@ class LNSerializer:
         return msg_type_name, parsed
 
 
-_inst = LNSerializer()
+# Fixed-size field types, as understood by _read_field and _write_field.
+_INT_TYPE_LEN = {'u8': 1, 'u16': 2, 'u32': 4, 'u64': 8}
+_BYTES_TYPE_LEN = {'byte': 1, 'chain_hash': 32, 'channel_id': 32, 'sha256': 32, 'signature': 64,
+                   'point': 33, 'short_channel_id': 8}
+_TRUNCATED_INT_TYPE_LEN = {'tu16': 2, 'tu32': 4, 'tu64': 8}
+_STRUCT_FORMAT_FROM_INT_LEN = {1: 'B', 2: 'H', 4: 'I', 8: 'Q'}
+
+# Steps of compiled plans, see _compile_fields. Decode steps:
+#   (_OP_STRUCT, struct.Struct, field_names)
+#   (_OP_BYTES, field_name, optional, type_len, count)
+#   (_OP_INT, field_name, optional, type_len)
+#   (_OP_TU, field_name, optional, type_len)
+#   (_OP_VARINT, field_name, optional)
+#   (_OP_TLVS, tlv_stream_name)
+#   (_OP_GENERIC, field_name, optional, field_type, field_count_str, allow_any)
+# Encode steps, one per field:
+#   (_OP_BYTES, field_name, optional, type_len, count, field_type)
+#   (_OP_TLVS, tlv_stream_name)
+#   (_OP_GENERIC, field_name, optional, field_type, field_count_str, allow_any)
+# where count is an int, the name of a previous field, or "..." (TLV records only).
+_OP_STRUCT = 0
+_OP_BYTES = 1
+_OP_TU = 2
+_OP_VARINT = 3
+_OP_TLVS = 4
+_OP_GENERIC = 5
+_OP_INT = 6
+
+
+def _compile_fields(rows: Sequence[Sequence[str]], *, in_tlv: bool) -> Tuple[list, list]:
+    """Turns the msgdata/tlvdata rows of a message or TLV record into a
+    decode plan and an encode plan for CompiledLNSerializer. Runs of
+    mandatory fixed-size fields are decoded with a single struct layout.
+    Fields without a fast path fall back to _read_field/_write_field, so
+    that the behaviour matches LNSerializer.
+    """
+    decode_plan = []
+    encode_plan = []
+    struct_fmt, struct_names = '', []
+
+    def flush_struct():
+        nonlocal struct_fmt, struct_names
+        if struct_names:
+            decode_plan.append((_OP_STRUCT, struct.Struct('>' + struct_fmt), tuple(struct_names)))
+        struct_fmt, struct_names = '', []
+
+    for row in rows:
+        if in_tlv:
+            # tlvdata,<tlvstreamname>,<tlvname>,<fieldname>,<typename>,[<count>][,<option>]
+            field_name, field_type, field_count_str = row[3], row[4], row[5]
+            optional = False
+        else:
+            # msgdata,<msgname>,<fieldname>,<typename>,[<count>][,<option>]
+            field_name, field_type, field_count_str = row[2], row[3], row[4]
+            optional = len(row) > 5
+            if field_name == "tlvs":
+                flush_struct()
+                decode_plan.append((_OP_TLVS, field_type))
+                encode_plan.append((_OP_TLVS, field_type))
+                continue
+        generic_step = (_OP_GENERIC, field_name, optional, field_type, field_count_str, in_tlv)
+        if field_count_str == "":
+            count = 1
+        elif field_count_str == "...":
+            if not in_tlv:
+                # _resolve_field_count raises
+                flush_struct()
+                decode_plan.append(generic_step)
+                encode_plan.append(generic_step)
+                continue
+            count = "..."
+        else:
+            try:
+                count = int(field_count_str)
+            except ValueError:
+                count = field_count_str  # name of a previous field
+        # encoding
+        type_len = _INT_TYPE_LEN.get(field_type) or _BYTES_TYPE_LEN.get(field_type)
+        if type_len is not None:
+            encode_plan.append((_OP_BYTES, field_name, optional, type_len, count, field_type))
+        else:
+            encode_plan.append(generic_step)
+        # decoding
+        if isinstance(count, int) and count > 0 and not optional and (
+                (field_type in _INT_TYPE_LEN and count == 1) or field_type in _BYTES_TYPE_LEN):
+            if field_type in _INT_TYPE_LEN:
+                struct_fmt += _STRUCT_FORMAT_FROM_INT_LEN[type_len]
+            else:
+                struct_fmt += '%ds' % (count * type_len)
+            struct_names.append(field_name)
+            continue
+        flush_struct()
+        if field_type in _BYTES_TYPE_LEN:
+            decode_plan.append((_OP_BYTES, field_name, optional, type_len, count))
+        elif field_type in _INT_TYPE_LEN and count == 1:
+            decode_plan.append((_OP_INT, field_name, optional, type_len))
+        elif field_type in _TRUNCATED_INT_TYPE_LEN and count == 1:
+            decode_plan.append((_OP_TU, field_name, optional, _TRUNCATED_INT_TYPE_LEN[field_type]))
+        elif field_type == 'varint' and count == 1:
+            decode_plan.append((_OP_VARINT, field_name, optional))
+        else:
+            decode_plan.append(generic_step)
+    flush_struct()
+    return decode_plan, encode_plan
+
+
+def _read_bigsize_int_from(buf: memoryview, offset: int, end: int) -> Tuple[Optional[int], int]:
+    """Like read_bigsize_int, on buf[offset:end]. Returns the int (None at the
+    end of the buffer) and the offset after it.
+    """
+    if offset >= end:
+        return None, offset
+    first = buf[offset]
+    offset += 1
+    if first < 0xfd:
+        return first, offset
+    if first == 0xfd:
+        n, min_val = 2, 0xfd
+    elif first == 0xfe:
+        n, min_val = 4, 0x1_0000
+    else:
+        n, min_val = 8, 0x1_0000_0000
+    if end - offset < n:
+        raise UnexpectedEndOfStream()
+    val = int.from_bytes(buf[offset:offset + n], byteorder="big", signed=False)
+    if val < min_val:
+        raise FieldEncodingNotMinimal()
+    return val, offset + n
+
+
+def _resolve_compiled_field_count(count: Union[int, str], vars_dict: dict) -> Union[int, str]:
+    if isinstance(count, int) or count == "...":
+        return count
+    field_count = vars_dict[count]
+    if isinstance(field_count, (bytes, bytearray)):
+        field_count = int.from_bytes(field_count, byteorder="big")
+    assert isinstance(field_count, int)
+    return field_count
+
+
+class CompiledLNSerializer(LNSerializer):
+    """LNSerializer that decodes and encodes with plans compiled once from
+    the CSV schema (see _compile_fields), reading fields at precomputed
+    offsets of a memoryview instead of interpreting the schema row by row
+    over a BytesIO. LNSerializer stays the reference implementation.
+    """
+
+    def __init__(self, *, for_onion_wire: bool = False):
+        LNSerializer.__init__(self, for_onion_wire=for_onion_wire)
+        self.decode_plan_from_type = {}  # type: Dict[bytes, Tuple[str, list]]
+        self.encode_plan_from_name = {}  # type: Dict[str, list]
+        for msg_type_bytes, scheme in self.msg_scheme_from_type.items():
+            msg_type_name = scheme[0][1]
+            decode_plan, encode_plan = _compile_fields(scheme[1:], in_tlv=False)
+            self.decode_plan_from_type[msg_type_bytes] = msg_type_name, decode_plan
+            self.encode_plan_from_name[msg_type_name] = encode_plan
+        # tlv_stream_name -> tlv_record_type -> (tlv_record_name, decode_plan, encode_plan)
+        self.tlv_plans = {}  # type: Dict[str, Dict[int, Tuple[str, list, list]]]
+        for tlv_stream_name, scheme_map in self.in_tlv_stream_get_tlv_record_scheme_from_type.items():
+            names = self.in_tlv_stream_get_record_name_from_type[tlv_stream_name]
+            self.tlv_plans[tlv_stream_name] = OrderedDict(
+                (tlv_record_type, (names[tlv_record_type], *_compile_fields(scheme[1:], in_tlv=True)))
+                for tlv_record_type, scheme in scheme_map.items())  # note: monotonically increasing
+
+    def _decode_fields(self, plan: list, buf: memoryview, offset: int, end: int, parsed: dict) -> int:
+        """Decodes buf[offset:end] into parsed. Returns the offset after the last field read."""
+        for step in plan:
+            op = step[0]
+            if op == _OP_STRUCT:
+                layout = step[1]
+                if end - offset < layout.size:
+                    raise UnexpectedEndOfStream()
+                parsed.update(zip(step[2], layout.unpack_from(buf, offset)))
+                offset += layout.size
+            elif op == _OP_BYTES:
+                count = _resolve_compiled_field_count(step[4], parsed)
+                if count == "...":
+                    value_end = end
+                else:
+                    value_end = offset + count * step[3]
+                    if value_end > end:
+                        if step[2]:
+                            break  # optional feature field not present
+                        raise UnexpectedEndOfStream()
+                parsed[step[1]] = bytes(buf[offset:value_end])
+                offset = value_end
+            elif op == _OP_INT:
+                value_end = offset + step[3]
+                if value_end > end:
+                    if step[2]:
+                        break  # optional feature field not present
+                    raise UnexpectedEndOfStream()
+                parsed[step[1]] = int.from_bytes(buf[offset:value_end], byteorder="big", signed=False)
+                offset = value_end
+            elif op == _OP_TU:
+                value_end = min(offset + step[3], end)
+                if value_end > offset and buf[offset] == 0x00:
+                    raise FieldEncodingNotMinimal()
+                parsed[step[1]] = int.from_bytes(buf[offset:value_end], byteorder="big", signed=False)
+                offset = value_end
+            elif op == _OP_VARINT:
+                val, offset = _read_bigsize_int_from(buf, offset, end)
+                if val is None:
+                    if step[2]:
+                        break  # optional feature field not present
+                    raise UnexpectedEndOfStream()
+                parsed[step[1]] = val
+            elif op == _OP_TLVS:
+                parsed[step[1]] = self._decode_tlv_stream(buf, offset, end, step[1])
+                offset = end
+            else:
+                __, field_name, optional, field_type, field_count_str, allow_any = step
+                field_count = _resolve_field_count(field_count_str, vars_dict=parsed, allow_any=allow_any)
+                with io.BytesIO(buf[offset:end]) as fd:
+                    try:
+                        parsed[field_name] = _read_field(fd=fd, field_type=field_type, count=field_count)
+                    except UnexpectedEndOfStream:
+                        if optional:
+                            break  # optional feature field not present
+                        raise
+                    offset += fd.tell()
+        return offset
+
+    def _decode_tlv_stream(self, buf: memoryview, offset: int, end: int,
+                           tlv_stream_name: str) -> Dict[str, Dict[str, Any]]:
+        parsed = {}  # type: Dict[str, Dict[str, Any]]
+        plans = self.tlv_plans[tlv_stream_name]
+        last_seen_tlv_record_type = -1  # type: int
+        while offset < end:
+            tlv_record_type, offset = _read_bigsize_int_from(buf, offset, end)
+            tlv_record_len, offset = _read_bigsize_int_from(buf, offset, end)
+            if tlv_record_len is None or offset + tlv_record_len > end:
+                raise UnexpectedEndOfStream()
+            record_end = offset + tlv_record_len
+            if not (tlv_record_type > last_seen_tlv_record_type):
+                raise MsgInvalidFieldOrder(f"TLV records must be monotonically increasing by type. "
+                                           f"cur: {tlv_record_type}. prev: {last_seen_tlv_record_type}")
+            last_seen_tlv_record_type = tlv_record_type
+            try:
+                tlv_record_name, plan, __ = plans[tlv_record_type]
+            except KeyError:
+                if tlv_record_type % 2 == 0:
+                    # unknown "even" type: hard fail
+                    raise UnknownMandatoryTLVRecordType(f"{tlv_stream_name}/{tlv_record_type}") from None
+                else:
+                    # unknown "odd" type: skip it
+                    offset = record_end
+                    continue
+            parsed[tlv_record_name] = {}
+            if self._decode_fields(plan, buf, offset, record_end, parsed[tlv_record_name]) < record_end:
+                raise MsgTrailingGarbage(f"TLV record ({tlv_stream_name}/{tlv_record_name}) has extra trailing garbage")
+            offset = record_end
+        return parsed
+
+    def _encode_fields(self, plan: list, kwargs: dict, out: List[bytes], *, in_tlv: bool) -> None:
+        for step in plan:
+            op = step[0]
+            if op == _OP_TLVS:
+                if step[1] in kwargs:
+                    out.append(self._encode_tlv_stream(step[1], kwargs[step[1]]))
+                continue
+            field_name, optional = step[1], step[2]
+            if op == _OP_BYTES:
+                field_count = _resolve_compiled_field_count(step[4], kwargs)
+            else:
+                field_count = _resolve_field_count(step[4], vars_dict=kwargs, allow_any=step[5])
+            try:
+                field_value = kwargs[field_name]
+            except KeyError:
+                if in_tlv:
+                    raise
+                if optional:
+                    break  # optional feature field not present
+                field_value = 0  # default mandatory fields to zero
+            if op == _OP_GENERIC:
+                with io.BytesIO() as fd:
+                    _write_field(fd=fd, field_type=step[3], count=field_count, value=field_value)
+                    out.append(fd.getvalue())
+                continue
+            if field_count == 0:
+                continue
+            if field_count == "...":
+                total_len = -1
+            else:
+                total_len = field_count * step[3]
+                if isinstance(field_value, int) and (field_count == 1 or step[5] == 'byte'):
+                    field_value = int.to_bytes(field_value, length=total_len, byteorder="big", signed=False)
+            if not isinstance(field_value, (bytes, bytearray)):
+                raise Exception(f"can only write bytes into fd. got: {field_value!r}")
+            if total_len >= 0 and total_len != len(field_value):
+                raise UnexpectedFieldSizeForEncoder(f"expected: {total_len}, got {len(field_value)}")
+            out.append(field_value)
+
+    def _encode_tlv_stream(self, tlv_stream_name: str, kwargs: dict) -> bytes:
+        out = []
+        for tlv_record_type, (tlv_record_name, __, plan) in self.tlv_plans[tlv_stream_name].items():
+            if tlv_record_name not in kwargs:
+                continue
+            record = []
+            self._encode_fields(plan, kwargs[tlv_record_name], record, in_tlv=True)
+            tlv_val = b"".join(record)
+            out.append(write_bigsize_int(tlv_record_type))
+            out.append(write_bigsize_int(len(tlv_val)))
+            out.append(tlv_val)
+        return b"".join(out)
+
+    def write_tlv_stream(self, *, fd: io.BytesIO, tlv_stream_name: str, **kwargs) -> None:
+        fd.write(self._encode_tlv_stream(tlv_stream_name, kwargs))
+
+    def read_tlv_stream(self, *, fd: io.BytesIO, tlv_stream_name: str) -> Dict[str, Dict[str, Any]]:
+        data = fd.read()
+        return self._decode_tlv_stream(memoryview(data), 0, len(data), tlv_stream_name)
+
+    def encode_msg(self, msg_type: str, **kwargs) -> bytes:
+        """
+        Encode kwargs into a Lightning message (bytes)
+        of the type given in the msg_type string
+        """
+        out = [self.msg_type_from_name[msg_type]]
+        self._encode_fields(self.encode_plan_from_name[msg_type], kwargs, out, in_tlv=False)
+        return b"".join(out)
+
+    def decode_msg(self, data: bytes) -> Tuple[str, dict]:
+        """
+        Decode Lightning message by reading the first
+        two bytes to determine message type.
+
+        Returns message type string and parsed message contents dict
+        """
+        assert len(data) >= 2
+        msg_type_name, plan = self.decode_plan_from_type[data[:2]]
+        parsed = {}
+        self._decode_fields(plan, memoryview(data), 2, len(data), parsed)
+        return msg_type_name, parsed
+
+_inst = CompiledLNSerializer()
 encode_msg = _inst.encode_msg
 decode_msg = _inst.decode_msg
 
 
-OnionWireSerializer = LNSerializer(for_onion_wire=True)
+OnionWireSerializer = CompiledLNSerializer(for_onion_wire=True)
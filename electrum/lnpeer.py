@@ -60,6 +60,7 @@ if TYPE_CHECKING:
 
 
 LN_P2P_NETWORK_TIMEOUT = 20
+GOSSIP_QUEUE_MAX_SIZE = 2000  # messages
 
 
 class Peer(Logger):
@@ -87,8 +88,10 @@ class Peer(Logger):
         self.channel_db = lnworker.network.channel_db
         self.ping_time = 0
         self.reply_channel_range = asyncio.Queue()
-        # gossip uses a single queue to preserve message order
-        self.gossip_queue = asyncio.Queue()
+        # gossip uses a single queue to preserve message order.
+        # when it is full, further gossip is dropped (see _queue_gossip)
+        self.gossip_queue = asyncio.Queue(maxsize=GOSSIP_QUEUE_MAX_SIZE)
+        self.num_dropped_gossip = 0
         self.ordered_messages = ['accept_channel', 'funding_signed', 'funding_created', 'accept_channel', 'channel_reestablish', 'closing_signed']
         self.ordered_message_queues = defaultdict(asyncio.Queue) # for messsage that are ordered
         self.temp_id_to_id = {}   # to forward error messages
@@ -247,14 +250,24 @@ class Peer(Logger):
         self.maybe_set_initialized()
 
     def on_node_announcement(self, payload):
-        self.gossip_queue.put_nowait(('node_announcement', payload))
+        self._queue_gossip('node_announcement', payload)
 
     def on_channel_announcement(self, payload):
-        self.gossip_queue.put_nowait(('channel_announcement', payload))
+        self._queue_gossip('channel_announcement', payload)
 
     def on_channel_update(self, payload):
         self.maybe_save_remote_update(payload)
-        self.gossip_queue.put_nowait(('channel_update', payload))
+        self._queue_gossip('channel_update', payload)
+
+    def _queue_gossip(self, name, payload):
+        # Backpressure only applies to gossip: the other messages of the peer
+        # must not wait for process_gossip. query_gossip does not ask for more
+        # while the queue is filling up, and the channels we miss because of
+        # gossip dropped here are found again when we query channel ranges.
+        try:
+            self.gossip_queue.put_nowait((name, payload))
+        except asyncio.QueueFull:
+            self.num_dropped_gossip += 1
 
     def maybe_save_remote_update(self, payload):
         for chan in self.channels.values():
@@ -295,7 +308,11 @@ class Peer(Logger):
         await self.channel_db.data_loaded.wait()
         # verify in peer's TaskGroup so that we fail the connection
         while True:
-            await asyncio.sleep(5)
+            # collect gossip for a while, unless the queue is full
+            for i in range(50):
+                if self.gossip_queue.full():
+                    break
+                await asyncio.sleep(.1)
             chan_anns = []
             chan_upds = []
             node_anns = []
@@ -312,17 +329,21 @@ class Peer(Logger):
                 if self.gossip_queue.empty():
                     break
             self.logger.debug(f'process_gossip {len(chan_anns)} {len(node_anns)} {len(chan_upds)}')
+            if self.num_dropped_gossip:
+                self.logger.info(f'dropped {self.num_dropped_gossip} gossip messages, queue was full')
+                self.num_dropped_gossip = 0
             # note: data processed in chunks to avoid taking sql lock for too long
             # channel announcements
             for chan_anns_chunk in chunks(chan_anns, 300):
-                self.verify_channel_announcements(chan_anns_chunk)
+                await self.verify_channel_announcements(chan_anns_chunk)
                 self.channel_db.add_channel_announcement(chan_anns_chunk)
             # node announcements
             for node_anns_chunk in chunks(node_anns, 100):
-                self.verify_node_announcements(node_anns_chunk)
+                await self.verify_node_announcements(node_anns_chunk)
                 self.channel_db.add_node_announcement(node_anns_chunk)
             # channel updates
             for chan_upds_chunk in chunks(chan_upds, 1000):
+                chan_upds_chunk = await self.verify_channel_updates(chan_upds_chunk)
                 categorized_chan_upds = self.channel_db.add_channel_updates(
                     chan_upds_chunk, max_age=self.network.lngossip.max_age)
                 orphaned = categorized_chan_upds.orphaned
@@ -341,22 +362,35 @@ class Peer(Logger):
                 if categorized_chan_upds.good:
                     self.logger.debug(f'on_channel_update: {len(categorized_chan_upds.good)}/{len(chan_upds_chunk)}')
 
-    def verify_channel_announcements(self, chan_anns):
-        for payload in chan_anns:
-            h = sha256d(payload['raw'][2+256:])
-            pubkeys = [payload['node_id_1'], payload['node_id_2'], payload['bitcoin_key_1'], payload['bitcoin_key_2']]
-            sigs = [payload['node_signature_1'], payload['node_signature_2'], payload['bitcoin_signature_1'], payload['bitcoin_signature_2']]
-            for pubkey, sig in zip(pubkeys, sigs):
-                if not ecc.verify_signature(pubkey, sig, h):
-                    raise Exception('signature failed')
-
-    def verify_node_announcements(self, node_anns):
-        for payload in node_anns:
-            pubkey = payload['node_id']
-            signature = payload['signature']
-            h = sha256d(payload['raw'][66:])
-            if not ecc.verify_signature(pubkey, signature, h):
-                raise Exception('signature failed')
+    # note: signatures are verified in the thread pool of network.gossip_verifier,
+    # so that the event loop keeps running
+
+    async def verify_channel_announcements(self, chan_anns):
+        accepted = await self.network.gossip_verifier.verify_channel_announcements(chan_anns)
+        if len(accepted) != len(chan_anns):
+            raise Exception('signature failed')
+
+    async def verify_node_announcements(self, node_anns):
+        accepted = await self.network.gossip_verifier.verify_node_announcements(node_anns)
+        if len(accepted) != len(node_anns):
+            raise Exception('signature failed')
+
+    async def verify_channel_updates(self, chan_upds) -> List[dict]:
+        """Returns the channel updates that are for our chain.
+        Updates for unknown channels cannot be verified yet; they are not saved.
+        """
+        chan_upds = [payload for payload in chan_upds
+                     if payload['chain_hash'] == constants.net.rev_genesis_bytes()]
+        known = []
+        for payload in chan_upds:
+            start_node = self.channel_db.get_start_node_for_channel_update(payload)
+            if start_node is not None:
+                payload['start_node'] = start_node
+                known.append(payload)
+        accepted = await self.network.gossip_verifier.verify_channel_updates(known)
+        if len(accepted) != len(known):
+            raise Exception('signature failed')
+        return chan_upds
 
     async def query_gossip(self):
         try:
@@ -375,6 +409,9 @@ class Peer(Logger):
                 if not todo:
                     await asyncio.sleep(1)
                     continue
+                # do not ask for more gossip than process_gossip keeps up with
+                while self.gossip_queue.qsize() > GOSSIP_QUEUE_MAX_SIZE // 2:
+                    await asyncio.sleep(.1)
                 await self.get_short_channel_ids(todo)
 
     async def get_channel_range(self):
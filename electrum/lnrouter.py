@@ -23,7 +23,7 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-import queue
+import heapq
 from collections import defaultdict
 from typing import Sequence, List, Tuple, Optional, Dict, NamedTuple, TYPE_CHECKING, Set
 import time
@@ -33,7 +33,7 @@ from .util import bh2u, profiler
 from .logging import Logger
 from .lnutil import (NUM_MAX_EDGES_IN_PAYMENT_PATH, ShortChannelID, LnFeatures,
                      NBLOCK_CLTV_EXPIRY_TOO_FAR_INTO_FUTURE)
-from .channel_db import ChannelDB, Policy, NodeInfo
+from .channel_db import ChannelDB, Policy, NodeInfo, RoutingPolicy
 
 if TYPE_CHECKING:
     from .lnchannel import Channel
@@ -86,14 +86,7 @@ class RouteEdge(PathEdge):
                          node_features=node_info.features if node_info else 0)
 
     def is_sane_to_use(self, amount_msat: int) -> bool:
-        # TODO revise ad-hoc heuristics
-        # cltv cannot be more than 2 weeks
-        if self.cltv_expiry_delta > 14 * 144:
-            return False
-        total_fee = self.fee_for_edge(amount_msat)
-        if not is_fee_sane(total_fee, payment_amount_msat=amount_msat):
-            return False
-        return True
+        return is_edge_sane_to_use(self.cltv_expiry_delta, self.fee_for_edge(amount_msat), amount_msat)
 
     def has_feature_varonion(self) -> bool:
         features = self.node_features
@@ -125,6 +118,20 @@ def is_route_sane_to_use(route: LNPaymentRoute, invoice_amount_msat: int, min_fi
     return True
 
 
+MAX_CLTV_EXPIRY_DELTA = 14 * 144
+EDGE_BASE_COST = 500  # one more edge ~ paying 500 msat more fees
+
+
+def is_edge_sane_to_use(cltv_expiry_delta: int, fee_msat: int, amount_msat: int) -> bool:
+    # TODO revise ad-hoc heuristics
+    # cltv cannot be more than 2 weeks
+    if cltv_expiry_delta > MAX_CLTV_EXPIRY_DELTA:
+        return False
+    if not is_fee_sane(fee_msat, payment_amount_msat=amount_msat):
+        return False
+    return True
+
+
 def is_fee_sane(fee_msat: int, *, payment_amount_msat: int) -> bool:
     # fees <= 5 sat are fine
     if fee_msat <= 5_000:
@@ -135,6 +142,40 @@ def is_fee_sane(fee_msat: int, *, payment_amount_msat: int) -> bool:
     return False
 
 
+def edge_cost_for_policy(channel_policy: RoutingPolicy, capacity_sat: Optional[int],
+                         payment_amt_msat: int, ignore_costs: bool) -> Tuple[float, int]:
+    """Heuristic cost (distance metric) of going through a channel, given the
+    policy of the node forwarding the payment. Returns (heuristic_cost, fee_for_edge_msat).
+    """
+    (fee_base_msat, fee_proportional_millionths, cltv_expiry_delta,
+     htlc_minimum_msat, htlc_maximum_msat, is_disabled) = channel_policy
+    if is_disabled:
+        return float('inf'), 0
+    if payment_amt_msat < htlc_minimum_msat:
+        return float('inf'), 0  # payment amount too little
+    if capacity_sat is not None and \
+            payment_amt_msat // 1000 > capacity_sat:
+        return float('inf'), 0  # payment amount too large
+    if htlc_maximum_msat is not None and \
+            payment_amt_msat > htlc_maximum_msat:
+        return float('inf'), 0  # payment amount too large
+    fee_msat = fee_for_edge_msat(payment_amt_msat, fee_base_msat, fee_proportional_millionths)
+    if not is_edge_sane_to_use(cltv_expiry_delta, fee_msat, payment_amt_msat):
+        return float('inf'), 0  # thanks but no thanks
+
+    # Distance metric notes:  # TODO constants are ad-hoc
+    # ( somewhat based on https://github.com/lightningnetwork/lnd/pull/1358 )
+    # - Edges have a base cost. (more edges -> less likely none will fail)
+    # - The larger the payment amount, and the longer the CLTV,
+    #   the more irritating it is if the HTLC gets stuck.
+    # - Paying lower fees is better. :)
+    if ignore_costs:
+        return EDGE_BASE_COST, 0
+    cltv_cost = cltv_expiry_delta * payment_amt_msat * 15 / 1_000_000_000
+    overall_cost = EDGE_BASE_COST + fee_msat + cltv_cost
+    return overall_cost, fee_msat
+
+
 BLACKLIST_DURATION = 3600
 
 class LNPathFinder(Logger):
@@ -170,95 +211,139 @@ class LNPathFinder(Logger):
         if self.channel_db.get_policy_for_node(short_channel_id, end_node, my_channels=my_channels) is None \
                 and not is_mine:
             return float('inf'), 0
-        if channel_policy.is_disabled():
-            return float('inf'), 0
-        if payment_amt_msat < channel_policy.htlc_minimum_msat:
-            return float('inf'), 0  # payment amount too little
-        if channel_info.capacity_sat is not None and \
-                payment_amt_msat // 1000 > channel_info.capacity_sat:
-            return float('inf'), 0  # payment amount too large
-        if channel_policy.htlc_maximum_msat is not None and \
-                payment_amt_msat > channel_policy.htlc_maximum_msat:
-            return float('inf'), 0  # payment amount too large
-        node_info = self.channel_db.get_node_info_for_node_id(node_id=end_node)
-        route_edge = RouteEdge.from_channel_policy(channel_policy, short_channel_id, end_node,
-                                                   node_info=node_info)
-        if not route_edge.is_sane_to_use(payment_amt_msat):
-            return float('inf'), 0  # thanks but no thanks
-
-        # Distance metric notes:  # TODO constants are ad-hoc
-        # ( somewhat based on https://github.com/lightningnetwork/lnd/pull/1358 )
-        # - Edges have a base cost. (more edges -> less likely none will fail)
-        # - The larger the payment amount, and the longer the CLTV,
-        #   the more irritating it is if the HTLC gets stuck.
-        # - Paying lower fees is better. :)
-        base_cost = 500  # one more edge ~ paying 500 msat more fees
-        if ignore_costs:
-            return base_cost, 0
-        fee_msat = route_edge.fee_for_edge(payment_amt_msat)
-        cltv_cost = route_edge.cltv_expiry_delta * payment_amt_msat * 15 / 1_000_000_000
-        overall_cost = base_cost + fee_msat + cltv_cost
-        return overall_cost, fee_msat
-
-    def get_distances(self, nodeA: bytes, nodeB: bytes,
-                      invoice_amount_msat: int, *,
-                      my_channels: Dict[ShortChannelID, 'Channel'] = None
-                      ) -> Dict[bytes, PathEdge]:
+        return edge_cost_for_policy(RoutingPolicy.from_policy(channel_policy), channel_info.capacity_sat,
+                                    payment_amt_msat, ignore_costs)
+
+    def _search(self, nodeA: bytes, nodeB: bytes, invoice_amount_msat: int, *,
+                my_channels: Dict[ShortChannelID, 'Channel']
+                ) -> Tuple[List[bytes], int, Dict[int, Tuple[int, bytes]]]:
+        """Runs Dijkstra over channel_db.routing_graph, with our own channels
+        overlaid on it. Nodes are numbered as in the routing graph, followed by
+        the nodes only known from our channels.
+        Returns (node_ids, number of nodeA, prev_edge), where prev_edge maps the
+        number of a node to (number of the next node towards nodeB, short_channel_id).
+        """
+        if not self.channel_db.data_loaded.is_set():
+            raise Exception("channelDB data not loaded yet!")
         # note: we don't lock self.channel_db, so while the path finding runs,
         #       the underlying graph could potentially change... (not good but maybe ~OK?)
+        graph_node_ids, node_index, incoming, short_channel_ids, slot_for_channel = \
+            self.channel_db.routing_graph.layout
+        node_ids = graph_node_ids[:]
+        num_graph_nodes = len(node_ids)
+        extra_node_index = {}  # type: Dict[bytes, int]
+        def get_node_index(node_id: bytes) -> int:
+            n = node_index.get(node_id)
+            if n is not None and n < num_graph_nodes:
+                return n
+            n = extra_node_index.get(node_id)
+            if n is None:
+                n = extra_node_index[node_id] = len(node_ids)
+                node_ids.append(node_id)
+            return n
+        # slots of the graph that the search skips
+        skipped_slots = set()
+        for short_channel_id in list(self.blacklist):
+            if self.is_blacklisted(short_channel_id):
+                slot = slot_for_channel.get(short_channel_id)
+                if slot is not None:
+                    skipped_slots.add(slot)
+        # our own channels are looked up in channel_db, as they might be private.
+        # end node -> [(start node, short_channel_id)]
+        my_incoming = defaultdict(list)  # type: Dict[int, List[Tuple[int, ShortChannelID]]]
+        for short_channel_id, chan in my_channels.items():
+            slot = slot_for_channel.get(short_channel_id)
+            if slot is not None:
+                skipped_slots.add(slot)
+            if self.is_blacklisted(short_channel_id):
+                continue
+            local_node = get_node_index(chan.get_local_pubkey())
+            remote_node = get_node_index(chan.node_id)
+            my_incoming[remote_node].append((local_node, short_channel_id))
+            my_incoming[local_node].append((remote_node, short_channel_id))
 
         # run Dijkstra
         # The search is run in the REVERSE direction, from nodeB to nodeA,
         # to properly calculate compound routing fees.
-        distance_from_start = defaultdict(lambda: float('inf'))
-        distance_from_start[nodeB] = 0
-        prev_node = {}  # type: Dict[bytes, PathEdge]
-        nodes_to_explore = queue.PriorityQueue()
-        nodes_to_explore.put((0, invoice_amount_msat, nodeB))  # order of fields (in tuple) matters!
-
+        node_a = get_node_index(nodeA)
+        node_b = get_node_index(nodeB)
+        inf = float('inf')
+        distance_from_start = [inf] * len(node_ids)
+        distance_from_start[node_b] = 0
+        prev_edge = {}  # type: Dict[int, Tuple[int, bytes]]
+        nodes_to_explore = [(0, invoice_amount_msat, node_b)]  # order of fields (in tuple) matters!
+        heappush = heapq.heappush
+        max_cltv_expiry_delta, edge_base_cost = MAX_CLTV_EXPIRY_DELTA, EDGE_BASE_COST
 
         # main loop of search
-        while nodes_to_explore.qsize() > 0:
-            dist_to_edge_endnode, amount_msat, edge_endnode = nodes_to_explore.get()
-            if edge_endnode == nodeA:
+        while nodes_to_explore:
+            dist_to_edge_endnode, amount_msat, edge_endnode = heapq.heappop(nodes_to_explore)
+            if edge_endnode == node_a:
                 break
             if dist_to_edge_endnode != distance_from_start[edge_endnode]:
-                # queue.PriorityQueue does not implement decrease_priority,
+                # heapq does not implement decrease_priority,
                 # so instead of decreasing priorities, we add items again into the queue.
                 # so there are duplicates in the queue, that we discard now:
                 continue
-            for edge_channel_id in self.channel_db.get_channels_for_node(edge_endnode, my_channels=my_channels):
-                assert isinstance(edge_channel_id, bytes)
-                if self.is_blacklisted(edge_channel_id):
-                    continue
-                channel_info = self.channel_db.get_channel_info(edge_channel_id, my_channels=my_channels)
-                edge_startnode = channel_info.node2_id if channel_info.node1_id == edge_endnode else channel_info.node1_id
-                is_mine = edge_channel_id in my_channels
-                if is_mine:
-                    if edge_startnode == nodeA:  # payment outgoing, on our channel
-                        if not my_channels[edge_channel_id].can_pay(amount_msat, check_frozen=True):
-                            continue
-                    else:  # payment incoming, on our channel. (funny business, cycle weirdness)
-                        assert edge_endnode == nodeA, (bh2u(edge_startnode), bh2u(edge_endnode))
-                        if not my_channels[edge_channel_id].can_receive(amount_msat, check_frozen=True):
-                            continue
+            if edge_endnode < num_graph_nodes:
+                for (edge_startnode, slot, fee_base_msat, fee_proportional_millionths, cltv_expiry_delta,
+                     htlc_minimum_msat, max_amount_msat) in incoming[edge_endnode]:
+                    if edge_startnode >= num_graph_nodes:
+                        continue
+                    # as edge costs are positive, this edge cannot get us closer to edge_startnode
+                    if distance_from_start[edge_startnode] <= dist_to_edge_endnode:
+                        continue
+                    # note: this is edge_cost_for_policy, inlined as it dominates the search.
+                    #       Unusable edges are skipped rather than given an infinite cost.
+                    if not htlc_minimum_msat <= amount_msat <= max_amount_msat:
+                        continue
+                    fee_for_edge_msat = fee_base_msat + (amount_msat * fee_proportional_millionths // 1_000_000)
+                    if cltv_expiry_delta > max_cltv_expiry_delta or \
+                            (fee_for_edge_msat > 5_000 and 100 * fee_for_edge_msat > amount_msat):  # is_fee_sane
+                        continue
+                    if edge_startnode == node_a:
+                        edge_cost, fee_for_edge_msat = edge_base_cost, 0
+                    else:
+                        edge_cost = (edge_base_cost + fee_for_edge_msat
+                                     + cltv_expiry_delta * amount_msat * 15 / 1_000_000_000)
+                    alt_dist_to_neighbour = dist_to_edge_endnode + edge_cost
+                    if alt_dist_to_neighbour < distance_from_start[edge_startnode] and slot not in skipped_slots:
+                        distance_from_start[edge_startnode] = alt_dist_to_neighbour
+                        prev_edge[edge_startnode] = (edge_endnode, short_channel_ids[slot])
+                        amount_to_forward_msat = amount_msat + fee_for_edge_msat
+                        heappush(nodes_to_explore, (alt_dist_to_neighbour, amount_to_forward_msat, edge_startnode))
+            for edge_startnode, edge_channel_id in my_incoming.get(edge_endnode, ()):
+                chan = my_channels[edge_channel_id]
+                if edge_startnode == node_a:  # payment outgoing, on our channel
+                    if not chan.can_pay(amount_msat, check_frozen=True):
+                        continue
+                else:  # payment incoming, on our channel. (funny business, cycle weirdness)
+                    assert edge_endnode == node_a, (bh2u(node_ids[edge_startnode]), bh2u(node_ids[edge_endnode]))
+                    if not chan.can_receive(amount_msat, check_frozen=True):
+                        continue
                 edge_cost, fee_for_edge_msat = self._edge_cost(
                     edge_channel_id,
-                    start_node=edge_startnode,
-                    end_node=edge_endnode,
+                    start_node=node_ids[edge_startnode],
+                    end_node=node_ids[edge_endnode],
                     payment_amt_msat=amount_msat,
-                    ignore_costs=(edge_startnode == nodeA),
-                    is_mine=is_mine,
+                    ignore_costs=(edge_startnode == node_a),
+                    is_mine=True,
                     my_channels=my_channels)
-                alt_dist_to_neighbour = distance_from_start[edge_endnode] + edge_cost
+                alt_dist_to_neighbour = dist_to_edge_endnode + edge_cost
                 if alt_dist_to_neighbour < distance_from_start[edge_startnode]:
                     distance_from_start[edge_startnode] = alt_dist_to_neighbour
-                    prev_node[edge_startnode] = PathEdge(node_id=edge_endnode,
-                                                         short_channel_id=ShortChannelID(edge_channel_id))
+                    prev_edge[edge_startnode] = (edge_endnode, edge_channel_id)
                     amount_to_forward_msat = amount_msat + fee_for_edge_msat
-                    nodes_to_explore.put((alt_dist_to_neighbour, amount_to_forward_msat, edge_startnode))
+                    heappush(nodes_to_explore, (alt_dist_to_neighbour, amount_to_forward_msat, edge_startnode))
+        return node_ids, node_a, prev_edge
 
-        return prev_node
+    def get_distances(self, nodeA: bytes, nodeB: bytes,
+                      invoice_amount_msat: int, *,
+                      my_channels: Dict[ShortChannelID, 'Channel'] = None
+                      ) -> Dict[bytes, PathEdge]:
+        node_ids, node_a, prev_edge = self._search(nodeA, nodeB, invoice_amount_msat, my_channels=my_channels or {})
+        return {node_ids[start]: PathEdge(node_id=node_ids[end], short_channel_id=ShortChannelID(short_channel_id))
+                for start, (end, short_channel_id) in prev_edge.items()}
 
     @profiler
     def find_path_for_payment(self, nodeA: bytes, nodeB: bytes,
@@ -272,19 +357,19 @@ class LNPathFinder(Logger):
         if my_channels is None:
             my_channels = {}
 
-        prev_node = self.get_distances(nodeA, nodeB, invoice_amount_msat, my_channels=my_channels)
+        node_ids, node_a, prev_edge = self._search(nodeA, nodeB, invoice_amount_msat, my_channels=my_channels)
 
-        if nodeA not in prev_node:
+        if node_a not in prev_edge:
             return None  # no path found
 
         # backtrack from search_end (nodeA) to search_start (nodeB)
         # FIXME paths cannot be longer than 20 edges (onion packet)...
-        edge_startnode = nodeA
+        edge_startnode = node_a
         path = []
-        while edge_startnode != nodeB:
-            edge = prev_node[edge_startnode]
-            path += [edge]
-            edge_startnode = edge.node_id
+        while node_ids[edge_startnode] != nodeB:
+            edge_endnode, short_channel_id = prev_edge[edge_startnode]
+            path += [PathEdge(node_id=node_ids[edge_endnode], short_channel_id=ShortChannelID(short_channel_id))]
+            edge_startnode = edge_endnode
         return path
 
     def create_route_from_path(self, path: Optional[LNPaymentPath], from_node_id: bytes, *,
@@ -24,21 +24,24 @@
 # SOFTWARE.
 
 import asyncio
+import os
 import threading
-from typing import TYPE_CHECKING, Dict, Set
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Dict, Set, Sequence, Tuple, List
 
 import aiorpcx
 
 from . import bitcoin
 from . import ecc
 from . import constants
-from .util import bh2u, bfh, NetworkJobOnDefaultServer
+from .util import bh2u, bfh, NetworkJobOnDefaultServer, chunks
 from .lnutil import funding_output_script_from_keys, ShortChannelID
 from .verifier import verify_tx_is_in_block, MerkleVerificationFailure
 from .transaction import Transaction
 from .interface import GracefulDisconnect
 from .crypto import sha256d
 from .lnmsg import decode_msg, encode_msg
+from .logging import Logger
 
 if TYPE_CHECKING:
     from .network import Network
@@ -183,3 +186,73 @@ def verify_sig_for_channel_update(chan_upd: dict, node_id: bytes) -> bool:
     if not ecc.verify_signature(node_id, sig, h):
         return False
     return True
+
+
+def signature_checks_for_channel_announcement(chan_ann: dict) -> Sequence[Tuple[bytes, bytes, bytes]]:
+    h = sha256d(chan_ann['raw'][2+256:])
+    return [(chan_ann['node_id_1'], chan_ann['node_signature_1'], h),
+            (chan_ann['node_id_2'], chan_ann['node_signature_2'], h),
+            (chan_ann['bitcoin_key_1'], chan_ann['bitcoin_signature_1'], h),
+            (chan_ann['bitcoin_key_2'], chan_ann['bitcoin_signature_2'], h)]
+
+
+def signature_checks_for_node_announcement(node_ann: dict) -> Sequence[Tuple[bytes, bytes, bytes]]:
+    return [(node_ann['node_id'], node_ann['signature'], sha256d(node_ann['raw'][66:]))]
+
+
+def signature_checks_for_channel_update(chan_upd: dict) -> Sequence[Tuple[bytes, bytes, bytes]]:
+    # the start node is looked up in the channel db, see ChannelDB.get_start_node_for_channel_update
+    return [(chan_upd['start_node'], chan_upd['signature'], sha256d(chan_upd['raw'][2+64:]))]
+
+
+class GossipSignatureVerifier(Logger):
+    """ Verify the signatures of gossip messages in a thread pool.
+
+    Messages are verified in chunks, off the event loop. libsecp256k1 is
+    called through ctypes, which releases the GIL, so chunks get verified
+    in parallel when there are several cores.
+    """
+
+    CHUNK_SIZE = 100  # messages per job
+
+    def __init__(self, *, max_workers: int = None):
+        Logger.__init__(self)
+        if max_workers is None:
+            max_workers = min(4, os.cpu_count() or 1)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='gossip_verifier')
+
+    @staticmethod
+    def _verify_chunk(payloads: Sequence[dict], get_checks) -> List[dict]:
+        checks = [get_checks(payload) for payload in payloads]
+        results = ecc.verify_signatures([check for c in checks for check in c])
+        accepted = []
+        i = 0
+        for payload, c in zip(payloads, checks):
+            # all the signatures of a message must be valid
+            if all(results[i:i+len(c)]):
+                accepted.append(payload)
+            i += len(c)
+        return accepted
+
+    async def _verify(self, payloads: Sequence[dict], get_checks) -> List[dict]:
+        loop = asyncio.get_event_loop()
+        jobs = [loop.run_in_executor(self.executor, self._verify_chunk, chunk, get_checks)
+                for chunk in chunks(payloads, self.CHUNK_SIZE)]
+        accepted = []
+        for result in await asyncio.gather(*jobs):
+            accepted += result
+        return accepted
+
+    async def verify_channel_announcements(self, chan_anns: Sequence[dict]) -> List[dict]:
+        """Returns the channel announcements with four valid signatures, in order."""
+        return await self._verify(chan_anns, signature_checks_for_channel_announcement)
+
+    async def verify_node_announcements(self, node_anns: Sequence[dict]) -> List[dict]:
+        return await self._verify(node_anns, signature_checks_for_node_announcement)
+
+    async def verify_channel_updates(self, chan_upds: Sequence[dict]) -> List[dict]:
+        """Channel updates must have a 'start_node'."""
+        return await self._verify(chan_upds, signature_checks_for_channel_update)
+
+    def stop(self):
+        self.executor.shutdown(wait=False)
@@ -63,6 +63,7 @@ from .logging import get_logger, Logger
 
 if TYPE_CHECKING:
     from .channel_db import ChannelDB
+    from .lnverifier import GossipSignatureVerifier
     from .lnworker import LNGossip
     from .lnwatcher import WatchTower
     from .daemon import Daemon
@@ -333,6 +334,7 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
 
         # lightning network
         self.channel_db = None  # type: Optional[ChannelDB]
+        self.gossip_verifier = None  # type: Optional[GossipSignatureVerifier]
         self.lngossip = None  # type: Optional[LNGossip]
         self.local_watchtower = None  # type: Optional[WatchTower]
         if self.config.get('run_local_watchtower', False):
@@ -352,8 +354,10 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
         if self.channel_db is None:
             from . import lnrouter
             from . import channel_db
+            from . import lnverifier
             self.channel_db = channel_db.ChannelDB(self)
             self.path_finder = lnrouter.LNPathFinder(self.channel_db)
+            self.gossip_verifier = lnverifier.GossipSignatureVerifier()
             self.channel_db.load_data()
 
     def start_gossip(self):
@@ -1209,7 +1213,11 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
         self.interface = None
         self.interfaces = {}
         self._connecting.clear()
-        if not full_shutdown:
+        if full_shutdown:
+            blockchain.flush_blockchains()
+            if self.gossip_verifier:
+                self.gossip_verifier.stop()
+        else:
             util.trigger_callback('network_updated')
 
     def stop(self):
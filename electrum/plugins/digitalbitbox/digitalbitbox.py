@@ -23,10 +23,10 @@ from electrum import ecc
 from electrum.ecc import msg_magic
 from electrum.wallet import Standard_Wallet
 from electrum import constants
-from electrum.transaction import Transaction, PartialTransaction, PartialTxInput
+from electrum.transaction import Transaction, PartialTransaction, PartialTxInput, SighashCache
 from electrum.i18n import _
 from electrum.keystore import Hardware_KeyStore
-from electrum.util import to_string, UserCancelled, UserFacingException, bfh
+from electrum.util import to_string, UserCancelled, UserFacingException
 from electrum.base_wizard import ScriptTypeNotSupported, HWD_SETUP_NEW_WALLET
 from electrum.network import Network
 from electrum.logging import get_logger
@@ -526,6 +526,7 @@ class DigitalBitbox_KeyStore(Hardware_KeyStore):
             pubkeyarray = []
 
             # Build hasharray from inputs
+            sighash_cache = SighashCache(tx)
             for i, txin in enumerate(tx.inputs()):
                 if txin.is_coinbase_input():
                     self.give_error("Coinbase not supported") # should never happen
@@ -537,7 +538,7 @@ class DigitalBitbox_KeyStore(Hardware_KeyStore):
                 if not inputPath:
                     self.give_error("No matching pubkey for sign_transaction")  # should never happen
                 inputPath = convert_bip32_intpath_to_strpath(inputPath)
-                inputHash = sha256d(bfh(tx.serialize_preimage(i)))
+                inputHash = sighash_cache.get_sighash(i)
                 hasharray_i = {'hash': to_hexstr(inputHash), 'keypath': inputPath}
                 hasharray.append(hasharray_i)
                 inputhasharray.append(inputHash)
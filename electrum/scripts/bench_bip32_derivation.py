@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+#
+# Benchmarks deriving the receiving addresses of a watch-only wallet,
+# against the previous approach of re-parsing the chain xpub and doing
+# a full CKD_pub (parse, point multiplication, point addition) for
+# every index, one address at a time.
+#
+# usage: bench_bip32_derivation.py [num_addresses] [num_workers]
+
+import os
+import sys
+import time
+
+from electrum import bitcoin
+from electrum.bip32 import BIP32Node, derive_child_pubkeys
+
+
+NUM_ADDRESSES = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+NUM_WORKERS = int(sys.argv[2]) if len(sys.argv) > 2 else (os.cpu_count() or 1)
+
+
+def legacy(chain_xpub: str, n: int) -> list:
+    pubkeys = []
+    for i in range(n):
+        node = BIP32Node.from_xkey(chain_xpub).subkey_at_public_derivation((i,))
+        pubkeys.append(node.eckey.get_public_key_bytes(compressed=True))
+    return pubkeys
+
+
+def bulk(chain_node: BIP32Node, n: int, num_workers: int) -> list:
+    pubkey = chain_node.eckey.get_public_key_bytes(compressed=True)
+    return derive_child_pubkeys(pubkey, chain_node.chaincode, 0, n, num_workers=num_workers)
+
+
+def bench(name, func, n):
+    t0 = time.perf_counter()
+    pubkeys = func()
+    addresses = [bitcoin.pubkey_to_address('p2pkh', pubkey.hex()) for pubkey in pubkeys]
+    dt = time.perf_counter() - t0
+    print(f'{name:<30} {dt:8.3f} s  {n / dt:10.0f} addresses/s')
+    return addresses
+
+
+def main():
+    root = BIP32Node.from_rootseed(os.urandom(32), xtype='standard')
+    chain_node = root.subkey_at_private_derivation("m/44'/0'/0'").subkey_at_public_derivation("0")
+    chain_xpub = chain_node.to_xpub()
+    print(f'{NUM_ADDRESSES} addresses')
+    expected = bench('one CKD_pub per index', lambda: legacy(chain_xpub, NUM_ADDRESSES), NUM_ADDRESSES)
+    result = bench('bulk', lambda: bulk(chain_node, NUM_ADDRESSES, 1), NUM_ADDRESSES)
+    assert result == expected
+    if NUM_WORKERS > 1:
+        result = bench(f'bulk, {NUM_WORKERS} processes',
+                       lambda: bulk(chain_node, NUM_ADDRESSES, NUM_WORKERS), NUM_ADDRESSES)
+        assert result == expected
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+#
+# Benchmarks choosing coins from a wallet of many small staking outputs,
+# with the BranchAndBound coin chooser against Privacy: the time to build
+# the tx, and the fee waste, i.e. what the tx pays beyond the fee of the
+# same tx without change outputs (the fee for the change, or the excess
+# that was too small for a change output).
+#
+# usage: bench_coinchooser.py [num_coins] [num_payments] [coins_per_address]
+
+import os
+import random
+import sys
+import time
+
+from electrum import constants
+from electrum.bitcoin import pubkey_to_address, COIN
+from electrum.coinchooser import CoinChooserPrivacy, CoinChooserBranchAndBound
+from electrum.ecc import ECPrivkey
+from electrum.transaction import PartialTransaction, PartialTxInput, PartialTxOutput, TxOutpoint
+
+
+NUM_COINS = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+NUM_PAYMENTS = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+COINS_PER_ADDRESS = int(sys.argv[3]) if len(sys.argv) > 3 else 2
+FEE_PER_VBYTE = 4
+
+
+def fee_estimator_vb(size):
+    return int(size * FEE_PER_VBYTE)
+
+
+def new_address() -> str:
+    return pubkey_to_address('p2pkh', ECPrivkey(os.urandom(32)).get_public_key_hex())
+
+
+def make_coins(rng: random.Random, num_coins: int) -> list:
+    addresses = [new_address() for i in range(max(1, num_coins // COINS_PER_ADDRESS))]
+    coins = []
+    for i in range(num_coins):
+        coin = PartialTxInput(prevout=TxOutpoint(txid=os.urandom(32), out_idx=1))
+        coin._trusted_address = rng.choice(addresses)
+        coin._trusted_value_sats = rng.randint(COIN // 2, 40 * COIN)
+        coin.block_height = rng.randint(1, 10000)
+        coins.append(coin)
+    return coins
+
+
+def waste(tx: PartialTransaction, change_addr: str) -> int:
+    outputs = [o for o in tx.outputs() if o.address != change_addr]
+    tx_without_change = PartialTransaction.from_io(tx.inputs(), outputs)
+    return tx.get_fee() - fee_estimator_vb(tx_without_change.estimated_size())
+
+
+def bench(name, chooser_class, coins, payments, change_addr):
+    result = []
+    t0 = time.perf_counter()
+    for amount, address in payments:
+        chooser = chooser_class(enable_output_value_rounding=False)
+        tx = chooser.make_tx(coins=coins,
+                             inputs=[],
+                             outputs=[PartialTxOutput.from_address_and_value(address, amount)],
+                             change_addrs=[change_addr],
+                             fee_estimator_vb=fee_estimator_vb,
+                             dust_threshold=546)
+        result.append(tx)
+    dt = time.perf_counter() - t0
+    total_waste = sum(waste(tx, change_addr) for tx in result)
+    num_inputs = sum(len(tx.inputs()) for tx in result)
+    num_change = sum(len(tx.outputs()) - 1 for tx in result)
+    print(f'{name:<16} {dt / len(payments):8.3f} s/tx  waste {total_waste / len(payments):10.0f} sat/tx  '
+          f'{num_inputs / len(payments):6.1f} inputs/tx  {num_change} change outputs')
+
+
+def main():
+    constants.set_mainnet()
+    rng = random.Random(0)
+    coins = make_coins(rng, NUM_COINS)
+    change_addr = new_address()
+    payments = [(rng.randint(COIN, 200 * COIN), new_address()) for i in range(NUM_PAYMENTS)]
+    print(f'{NUM_COINS} coins, {NUM_PAYMENTS} payments')
+    bench('Privacy', CoinChooserPrivacy, coins, payments, change_addr)
+    bench('BranchAndBound', CoinChooserBranchAndBound, coins, payments, change_addr)
+
+
+if __name__ == '__main__':
+    main()
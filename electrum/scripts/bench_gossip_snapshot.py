@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+#
+# Benchmarks the time it takes ChannelDB to load a gossip graph until
+# 'gossip_db_loaded', decoding every stored gossip message, against
+# loading the graph snapshot and replaying the changes logged after it.
+# The gossip_db is generated in a temporary directory, with random
+# channels between num_nodes nodes, two policies per channel.
+#
+# usage: bench_gossip_snapshot.py [num_channels] [num_nodes] [num_changes]
+
+import asyncio
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+from electrum import constants, util
+from electrum.channel_db import (ChannelDB, create_channel_info, create_policy, create_node_info,
+                                 create_address, create_gossip_delta, create_meta)
+from electrum.lnmsg import encode_msg
+from electrum.simple_config import SimpleConfig
+from electrum.util import create_and_start_event_loop
+
+
+NUM_CHANNELS = int(sys.argv[1]) if len(sys.argv) > 1 else 40000
+NUM_NODES = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+NUM_CHANGES = int(sys.argv[3]) if len(sys.argv) > 3 else 1000
+
+
+def channel_announcement(scid: bytes, node1: bytes, node2: bytes) -> bytes:
+    return encode_msg('channel_announcement',
+                      node_signature_1=bytes(64), node_signature_2=bytes(64),
+                      bitcoin_signature_1=bytes(64), bitcoin_signature_2=bytes(64),
+                      len=0, features=b'', chain_hash=constants.net.rev_genesis_bytes(),
+                      short_channel_id=scid, node_id_1=node1, node_id_2=node2,
+                      bitcoin_key_1=node1, bitcoin_key_2=node2)
+
+
+def channel_update(rng: random.Random, scid: bytes, direction: int) -> bytes:
+    return encode_msg('channel_update',
+                      signature=bytes(64), chain_hash=constants.net.rev_genesis_bytes(),
+                      short_channel_id=scid, timestamp=rng.randint(1, 2**31),
+                      message_flags=b'\x01', channel_flags=bytes([direction]),
+                      cltv_expiry_delta=rng.randint(10, 200), htlc_minimum_msat=1000,
+                      htlc_maximum_msat=rng.randint(10**6, 10**10), fee_base_msat=rng.randint(0, 2000),
+                      fee_proportional_millionths=rng.randint(0, 5000))
+
+
+def node_announcement(rng: random.Random, node_id: bytes) -> bytes:
+    return encode_msg('node_announcement',
+                      signature=bytes(64), flen=0, features=b'', timestamp=rng.randint(1, 2**31),
+                      node_id=node_id, rgb_color=b'\x00\x00\x00',
+                      alias=f'node{rng.randint(0, 10**6)}'.encode('ascii').ljust(32, b'\x00'),
+                      addrlen=0, addresses=b'')
+
+
+def make_gossip_db(path: str, rng: random.Random) -> None:
+    node_ids = sorted(b'\x02' + rng.getrandbits(256).to_bytes(32, 'big') for i in range(NUM_NODES))
+    conn = sqlite3.connect(path)
+    c = conn.cursor()
+    for create in (create_node_info, create_address, create_policy, create_channel_info,
+                   create_gossip_delta, create_meta):
+        c.execute(create)
+    for i in range(NUM_CHANNELS):
+        scid = (i + 1).to_bytes(8, 'big')
+        node1, node2 = sorted(rng.sample(node_ids, 2))
+        c.execute("INSERT INTO channel_info (short_channel_id, msg) VALUES (?,?)",
+                  (scid, channel_announcement(scid, node1, node2)))
+        for direction, node_id in enumerate((node1, node2)):
+            c.execute("INSERT INTO policy (key, msg) VALUES (?,?)",
+                      (scid + node_id, channel_update(rng, scid, direction)))
+    for node_id in node_ids:
+        c.execute("INSERT INTO node_info (node_id, msg) VALUES (?,?)", (node_id, node_announcement(rng, node_id)))
+    conn.commit()
+    conn.close()
+
+
+class FakeNetwork:
+
+    def __init__(self, config, asyncio_loop):
+        self.config = config
+        self.asyncio_loop = asyncio_loop
+        self.interface = None
+
+
+def open_channel_db(config):
+    loop, stopping_fut, loop_thread = create_and_start_event_loop()
+    util.callback_mgr.asyncio_loop = loop
+    cdb = ChannelDB(FakeNetwork(config, loop))
+    loaded = threading.Event()
+    def on_loaded(*args):
+        loaded.set()
+    util.register_callback(on_loaded, ['gossip_db_loaded'])
+    t0 = time.perf_counter()
+    loop.call_soon_threadsafe(cdb.load_data)
+    loaded.wait()
+    dt = time.perf_counter() - t0
+    util.unregister_callback(on_loaded)
+    return cdb, dt, (loop, stopping_fut, loop_thread)
+
+
+def close_channel_db(cdb, loop_info):
+    loop, stopping_fut, loop_thread = loop_info
+    loop.call_soon_threadsafe(stopping_fut.set_result, 1)
+    loop_thread.join()
+    cdb.sql_thread.join()
+
+
+def graph(cdb):
+    return cdb._channels, cdb._policies, cdb._nodes, cdb._channels_for_node
+
+
+def bench(name, config):
+    cdb, dt, loop_info = open_channel_db(config)
+    print(f'{name:<28} {dt:8.3f} s')
+    return cdb, loop_info
+
+
+def main():
+    constants.set_testnet()
+    rng = random.Random(0)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        config = SimpleConfig({'electrum_path': tmpdir})
+        path = os.path.join(util.get_headers_dir(config), 'gossip_db')
+        make_gossip_db(path, rng)
+        print(f'{NUM_CHANNELS} channels, {2 * NUM_CHANNELS} policies, {NUM_NODES} nodes, {NUM_CHANGES} changes')
+        # the first load decodes the gossip, and writes the snapshot
+        cdb, loop_info = bench('decode gossip', config)
+        # change some policies, so that they get replayed on load
+        with cdb.lock:
+            keys = rng.sample(list(cdb._policies), min(NUM_CHANGES, len(cdb._policies)))
+        async def save_policies():
+            for i, (node_id, scid) in enumerate(keys):
+                await cdb._db_save_policy(scid + node_id, channel_update(rng, scid, i % 2))
+        asyncio.run_coroutine_threadsafe(save_policies(), loop_info[0]).result()
+        cdb._num_changes_since_snapshot = 0  # don't write a new snapshot on close
+        close_channel_db(cdb, loop_info)
+        cdb, loop_info = bench('snapshot + replay', config)
+        close_channel_db(cdb, loop_info)
+        expected = graph(cdb)
+        os.remove(cdb.snapshot_path)
+        cdb, loop_info = bench('decode gossip', config)
+        close_channel_db(cdb, loop_info)
+        assert graph(cdb) == expected
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+#
+# Benchmarks verifying the signatures of channel announcements, as during
+# the initial gossip sync, with GossipSignatureVerifier against the
+# previous approach of calling ecc.verify_signature for every signature,
+# on the event loop. Besides the time it takes, the longest time the
+# event loop could not run other coroutines is measured.
+#
+# usage: bench_gossip_verify.py [num_chan_anns] [chunk_size]
+
+import asyncio
+import os
+import sys
+import time
+
+from electrum import constants, ecc
+from electrum.crypto import sha256d
+from electrum.lnmsg import encode_msg, decode_msg
+from electrum.lnverifier import GossipSignatureVerifier
+
+
+NUM_CHAN_ANNS = int(sys.argv[1]) if len(sys.argv) > 1 else 3000
+CHUNK_SIZE = int(sys.argv[2]) if len(sys.argv) > 2 else 300  # as in Peer.process_gossip
+
+
+def make_chan_ann(i: int) -> dict:
+    keys = [ecc.ECPrivkey(os.urandom(32)) for j in range(4)]
+    node1, node2, bitcoin1, bitcoin2 = [k.get_public_key_bytes() for k in keys]
+    fields = dict(len=0, features=b'', chain_hash=constants.net.rev_genesis_bytes(),
+                  short_channel_id=(i + 1).to_bytes(8, 'big'), node_id_1=node1, node_id_2=node2,
+                  bitcoin_key_1=bitcoin1, bitcoin_key_2=bitcoin2)
+    h = sha256d(encode_msg('channel_announcement', node_signature_1=bytes(64), node_signature_2=bytes(64),
+                           bitcoin_signature_1=bytes(64), bitcoin_signature_2=bytes(64), **fields)[2+256:])
+    sigs = [k.sign(h, ecc.sig_string_from_r_and_s) for k in keys]
+    raw = encode_msg('channel_announcement', node_signature_1=sigs[0], node_signature_2=sigs[1],
+                     bitcoin_signature_1=sigs[2], bitcoin_signature_2=sigs[3], **fields)
+    payload = decode_msg(raw)[1]
+    payload['raw'] = raw
+    return payload
+
+
+async def legacy(chan_anns) -> list:
+    accepted = []
+    for chunk_start in range(0, len(chan_anns), CHUNK_SIZE):
+        for payload in chan_anns[chunk_start:chunk_start + CHUNK_SIZE]:
+            h = sha256d(payload['raw'][2+256:])
+            pubkeys = [payload['node_id_1'], payload['node_id_2'], payload['bitcoin_key_1'], payload['bitcoin_key_2']]
+            sigs = [payload['node_signature_1'], payload['node_signature_2'], payload['bitcoin_signature_1'], payload['bitcoin_signature_2']]
+            if all(ecc.verify_signature(pubkey, sig, h) for pubkey, sig in zip(pubkeys, sigs)):
+                accepted.append(payload)
+        await asyncio.sleep(0)
+    return accepted
+
+
+async def batched(chan_anns) -> list:
+    verifier = GossipSignatureVerifier()
+    accepted = []
+    for chunk_start in range(0, len(chan_anns), CHUNK_SIZE):
+        accepted += await verifier.verify_channel_announcements(chan_anns[chunk_start:chunk_start + CHUNK_SIZE])
+    verifier.stop()
+    return accepted
+
+
+async def bench(name, func, chan_anns):
+    max_stall = 0
+    done = False
+    async def heartbeat():
+        nonlocal max_stall
+        while not done:
+            t = time.perf_counter()
+            await asyncio.sleep(0.001)
+            max_stall = max(max_stall, time.perf_counter() - t)
+    heartbeat_task = asyncio.ensure_future(heartbeat())
+    await asyncio.sleep(0.01)
+    t0 = time.perf_counter()
+    accepted = await func(chan_anns)
+    dt = time.perf_counter() - t0
+    done = True
+    await heartbeat_task
+    print(f'{name:<28} {dt:8.3f} s  {4 * len(chan_anns) / dt:8.0f} sigs/s  longest stall {max_stall * 1000:8.1f} ms')
+    return accepted
+
+
+def main():
+    constants.set_testnet()
+    chan_anns = [make_chan_ann(i) for i in range(NUM_CHAN_ANNS)]
+    # invalidate some of them
+    for payload in chan_anns[::50]:
+        payload['node_signature_2'] = payload['node_signature_1']
+    print(f'{NUM_CHAN_ANNS} channel announcements, {os.cpu_count()} cpus')
+    loop = asyncio.get_event_loop()
+    expected = loop.run_until_complete(bench('verify_signature on loop', legacy, chan_anns))
+    result = loop.run_until_complete(bench('GossipSignatureVerifier', batched, chan_anns))
+    assert result == expected
+    print(f'{len(result)} accepted')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+#
+# Benchmarks header reads and writes through HeaderStore against the
+# previous approach of opening a new sqlite connection for every read,
+# and of committing and re-counting rows after every write.
+#
+# usage: bench_header_store.py [num_headers]
+
+import os
+import sys
+import time
+import random
+import sqlite3
+import tempfile
+import shutil
+
+from electrum.blockchain import deserialize_header
+from electrum.header_store import HeaderStore
+
+
+NUM_HEADERS = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+NUM_READS = 20000
+RANGE_SIZE = 2016
+
+
+def make_raw_header(height: int) -> bytes:
+    sig = os.urandom(72)
+    return (height.to_bytes(4, 'little') + os.urandom(176)
+            + bytes([len(sig)]) + sig)
+
+
+def legacy_read_header(path: str, height: int) -> dict:
+    conn = sqlite3.connect(path, check_same_thread=False)
+    cursor = conn.cursor()
+    cursor.execute('SELECT data FROM header WHERE height=?', (height,))
+    result = cursor.fetchone()
+    cursor.close()
+    conn.close()
+    return deserialize_header(result[0], height)
+
+
+def legacy_write_header(conn: sqlite3.Connection, height: int, raw_header: bytes) -> int:
+    conn.execute('REPLACE INTO header (height, data) VALUES(?,?)', (height, raw_header))
+    conn.commit()
+    return conn.execute('SELECT COUNT(*) FROM header').fetchone()[0]
+
+
+def bench_writes(tmpdir):
+    num_chunks = 20
+    chunks = [[(i * RANGE_SIZE + j, make_raw_header(i * RANGE_SIZE + j)) for j in range(RANGE_SIZE)]
+              for i in range(num_chunks)]
+    tip_headers = [make_raw_header(h) for h in range(NUM_READS // 10)]
+
+    path = os.path.join(tmpdir, 'legacy_headers')
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE header (height INT PRIMARY KEY NOT NULL, data BLOB NOT NULL)')
+    def legacy_chunks():
+        for chunk in chunks:
+            conn.executemany('REPLACE INTO header (height, data) VALUES(?,?)', chunk)
+            conn.commit()
+            conn.execute('SELECT COUNT(*) FROM header').fetchone()
+    bench('legacy save_chunk', legacy_chunks, num_chunks * RANGE_SIZE)
+    offset = num_chunks * RANGE_SIZE
+    bench('legacy write (tip)',
+          lambda: [legacy_write_header(conn, offset + h, raw) for h, raw in enumerate(tip_headers)],
+          len(tip_headers))
+    conn.close()
+
+    for synchronous in ('FULL', 'NORMAL'):
+        path = os.path.join(tmpdir, f'headers_{synchronous}')
+        store = HeaderStore(path, deserialize_header, synchronous=synchronous, commit_interval=10)
+        bench(f'HeaderStore.write_many ({synchronous})',
+              lambda: [store.write_many(chunk) for chunk in chunks], num_chunks * RANGE_SIZE)
+        bench(f'HeaderStore.write (tip, {synchronous})',
+              lambda: [store.write(offset + h, raw) for h, raw in enumerate(tip_headers)],
+              len(tip_headers))
+        store.close()
+
+
+def bench(name, func, n):
+    t0 = time.perf_counter()
+    func()
+    dt = time.perf_counter() - t0
+    print(f'{name:<40} {dt:8.3f} s  {n / dt:12.0f} headers/s')
+
+
+def main():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, 'blockchain_headers')
+        store = HeaderStore(path, deserialize_header)
+        store.write_many((h, make_raw_header(h)) for h in range(NUM_HEADERS))
+        # tip processing reads the same few headers over and over,
+        # catch-up sync reads scattered heights
+        tip_heights = [NUM_HEADERS - 1 - random.randrange(10) for _ in range(NUM_READS)]
+        random_heights = [random.randrange(NUM_HEADERS) for _ in range(NUM_READS)]
+        range_starts = [random.randrange(NUM_HEADERS - RANGE_SIZE) for _ in range(20)]
+        print(f'{NUM_HEADERS} headers in db')
+
+        bench('legacy read_header (tip)',
+              lambda: [legacy_read_header(path, h) for h in tip_heights], NUM_READS)
+        bench('HeaderStore.read_header (tip)',
+              lambda: [store.read_header(h) for h in tip_heights], NUM_READS)
+        bench('legacy read_header (random)',
+              lambda: [legacy_read_header(path, h) for h in random_heights], NUM_READS)
+        store.clear_cache()
+        bench('HeaderStore.read_header (random)',
+              lambda: [store.read_header(h) for h in random_heights], NUM_READS)
+        bench('legacy read_header (range)',
+              lambda: [legacy_read_header(path, h)
+                       for start in range_starts for h in range(start, start + RANGE_SIZE)],
+              RANGE_SIZE * len(range_starts))
+        bench('HeaderStore.read_range (range)',
+              lambda: [deserialize_header(raw, h)
+                       for start in range_starts for h, raw in store.read_range(start, RANGE_SIZE)],
+              RANGE_SIZE * len(range_starts))
+        store.close()
+        bench_writes(tmpdir)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
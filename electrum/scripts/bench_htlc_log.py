@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+#
+# Benchmarks the queries that lnchannel and lnsweep make about old ctns
+# (balances, htlcs in a revoked ctx, htlcs removed at a revoked ctn, settled
+# htlcs), on the HTLCManager of a long-lived channel, with resolved htlcs
+# archived and the settled ledger and index of old ctns, against the previous
+# approach of scanning the full log. The channel forwards num_payments htlcs in each direction, one
+# commitment round per payment, with some of them failing.
+#
+# usage: bench_htlc_log.py [num_payments] [num_queries]
+
+import json
+import random
+import sys
+import time
+
+from electrum.json_db import StoredDict
+from electrum.lnhtlc import HTLCManager
+from electrum.lnutil import SENT, RECEIVED, LOCAL, REMOTE, UpdateAddHtlc
+from electrum.util import MyEncoder
+
+
+NUM_PAYMENTS = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+NUM_QUERIES = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+
+
+class LegacyHTLCManager(HTLCManager):
+    """Keeps every htlc in the log, and scans it for ctns that are too old."""
+
+    def _archive_htlc(self, htlc_proposer, htlc_id, log_action):
+        pass
+
+    def htlcs_by_direction(self, subject, direction, ctn=None):
+        if ctn is None:
+            ctn = self.ctn_oldest_unrevoked(subject)
+        party = subject if direction == SENT else subject.inverted()
+        if ctn >= self.ctn_oldest_unrevoked(subject):
+            considered_htlc_ids = self._maybe_active_htlc_ids[party]
+        else:
+            considered_htlc_ids = self.log[party]['locked_in']
+        d = {}
+        for htlc_id in considered_htlc_ids:
+            htlc_id = int(htlc_id)
+            if self.is_htlc_active_at_ctn(ctx_owner=subject, ctn=ctn, htlc_proposer=party, htlc_id=htlc_id):
+                d[htlc_id] = self.log[party]['adds'][htlc_id]
+        return d
+
+    def _get_htlc_ids_removed_exactly_at_ctn(self, ctn, *, ctx_owner, htlc_proposer, log_action):
+        if ctn >= self.ctn_oldest_unrevoked(ctx_owner):
+            considered_htlc_ids = self._maybe_active_htlc_ids[htlc_proposer]
+        else:
+            considered_htlc_ids = self.log[htlc_proposer][log_action]
+        htlc_ids = []
+        for htlc_id in considered_htlc_ids:
+            ctns = self.log[htlc_proposer][log_action].get(htlc_id, None)
+            if ctns is None: continue
+            if ctns[ctx_owner] == ctn:
+                htlc_ids.append(int(htlc_id))
+        return htlc_ids
+
+    def all_settled_htlcs_ever_by_direction(self, subject, direction, ctn=None):
+        if ctn is None:
+            ctn = self.ctn_oldest_unrevoked(subject)
+        party = subject if direction == SENT else subject.inverted()
+        d = []
+        for htlc_id, ctns in self.log[party]['settles'].items():
+            if ctns[subject] is not None and ctns[subject] <= ctn:
+                d.append(self.log[party]['adds'][htlc_id])
+        return d
+
+    def get_balance_msat(self, whose, *, ctx_owner=LOCAL, ctn=None, initial_balance_msat):
+        if ctn is None:
+            ctn = self.ctn_oldest_unrevoked(ctx_owner)
+        if ctn >= self.ctn_oldest_unrevoked(ctx_owner):
+            return super().get_balance_msat(whose, ctx_owner=ctx_owner, ctn=ctn,
+                                            initial_balance_msat=initial_balance_msat)
+        balance = initial_balance_msat
+        for htlc_id, ctns in self.log[whose]['settles'].items():
+            if ctns[ctx_owner] is not None and ctns[ctx_owner] <= ctn:
+                balance -= self.log[whose]['adds'][htlc_id].amount_msat
+        for htlc_id, ctns in self.log[-whose]['settles'].items():
+            if ctns[ctx_owner] is not None and ctns[ctx_owner] <= ctn:
+                balance += self.log[-whose]['adds'][htlc_id].amount_msat
+        return balance
+
+
+def make_channel(cls, rng: random.Random):
+    A = cls(StoredDict({}, None, []))
+    B = cls(StoredDict({}, None, []))
+    A.channel_open_finished()
+    B.channel_open_finished()
+    def commit(X, Y):
+        X.send_ctx()
+        Y.recv_ctx()
+        Y.send_rev()
+        X.recv_rev()
+    for i in range(NUM_PAYMENTS):
+        amount_msat = rng.randint(1000, 10**7)
+        B.recv_htlc(A.send_htlc(UpdateAddHtlc(amount_msat=amount_msat, payment_hash=bytes(32),
+                                              cltv_expiry=500, timestamp=0, htlc_id=i)))
+        A.recv_htlc(B.send_htlc(UpdateAddHtlc(amount_msat=amount_msat, payment_hash=bytes(32),
+                                              cltv_expiry=500, timestamp=0, htlc_id=i)))
+        if i >= 1:
+            # the receiver of the previous htlc settles or fails it
+            for X, Y in ((B, A), (A, B)):
+                if rng.random() < 0.8:
+                    X.send_settle(i - 1)
+                    Y.recv_settle(i - 1)
+                else:
+                    X.send_fail(i - 1)
+                    Y.recv_fail(i - 1)
+        commit(A, B)
+        commit(B, A)
+    return A
+
+
+def queries(hm, ctns):
+    out = []
+    for ctn in ctns:
+        for subject in (LOCAL, REMOTE):
+            out.append(hm.get_balance_msat(subject, ctx_owner=subject, ctn=ctn, initial_balance_msat=10**12))
+            out.append(hm.htlcs_by_direction(subject, SENT, ctn))
+            out.append(hm.htlcs_by_direction(subject, RECEIVED, ctn))
+        out.append(hm.received_in_ctn(ctn))
+        out.append(hm.sent_in_ctn(ctn))
+        out.append(hm.failed_in_ctn(ctn))
+    out.append(hm.all_settled_htlcs_ever_by_direction(LOCAL, SENT))
+    out.append(hm.all_settled_htlcs_ever_by_direction(LOCAL, RECEIVED))
+    return out
+
+
+def bench(name, cls, ctns):
+    t0 = time.perf_counter()
+    hm = make_channel(cls, random.Random(0))
+    dt_build = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    result = queries(hm, ctns)
+    dt_queries = time.perf_counter() - t0
+    size = len(json.dumps(hm.log, cls=MyEncoder))
+    print(f'{name:<28} build {dt_build:8.3f} s  queries {dt_queries / len(ctns) * 1000:8.3f} ms/ctn  '
+          f'log {size / 1000:8.0f} kB')
+    return result
+
+
+def main():
+    rng = random.Random(1)
+    ctns = [rng.randrange(2 * NUM_PAYMENTS - 1) for i in range(NUM_QUERIES)]
+    print(f'{NUM_PAYMENTS} payments each way, {NUM_QUERIES} old ctns')
+    expected = bench('scan full log', LegacyHTLCManager, ctns)
+    result = bench('archive + ledger + index', HTLCManager, ctns)
+    assert result == expected
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+#
+# Benchmarks decoding and encoding gossip (channel_announcement and
+# channel_update messages, as stored by ChannelDB), with the compiled
+# lnmsg codec against the reference LNSerializer that interprets the
+# wire schema field by field.
+#
+# usage: bench_lnmsg.py [num_msgs]
+
+import os
+import random
+import sys
+import time
+
+from electrum.lnmsg import LNSerializer, CompiledLNSerializer
+
+
+NUM_MSGS = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+
+
+def make_msgs(lnser: LNSerializer, num_msgs: int) -> list:
+    rng = random.Random(0)
+    chain_hash = os.urandom(32)
+    msgs = []
+    for i in range(num_msgs):
+        short_channel_id = rng.getrandbits(64).to_bytes(8, 'big')
+        if i % 2 == 0:
+            features = os.urandom(rng.randint(0, 4))
+            msgs.append(lnser.encode_msg(
+                'channel_announcement',
+                node_signature_1=os.urandom(64),
+                node_signature_2=os.urandom(64),
+                bitcoin_signature_1=os.urandom(64),
+                bitcoin_signature_2=os.urandom(64),
+                len=len(features),
+                features=features,
+                chain_hash=chain_hash,
+                short_channel_id=short_channel_id,
+                node_id_1=os.urandom(33),
+                node_id_2=os.urandom(33),
+                bitcoin_key_1=os.urandom(33),
+                bitcoin_key_2=os.urandom(33)))
+        else:
+            payload = dict(
+                signature=os.urandom(64),
+                chain_hash=chain_hash,
+                short_channel_id=short_channel_id,
+                timestamp=rng.getrandbits(32),
+                message_flags=b'\x01',
+                channel_flags=bytes([rng.getrandbits(1)]),
+                cltv_expiry_delta=rng.randint(1, 2016),
+                htlc_minimum_msat=rng.randint(0, 10**6),
+                fee_base_msat=rng.randint(0, 10**4),
+                fee_proportional_millionths=rng.randint(0, 10**4))
+            if rng.random() < 0.9:
+                payload['htlc_maximum_msat'] = rng.randint(10**6, 10**10)
+            else:
+                payload['message_flags'] = b'\x00'
+            msgs.append(lnser.encode_msg('channel_update', **payload))
+    return msgs
+
+
+def bench(name, func, items):
+    t0 = time.perf_counter()
+    result = [func(item) for item in items]
+    dt = time.perf_counter() - t0
+    print(f'{name:<32} {dt:8.3f} s  {len(items) / dt:10.0f} msgs/s')
+    return result
+
+
+def main():
+    reference = LNSerializer()
+    compiled = CompiledLNSerializer()
+    msgs = make_msgs(compiled, NUM_MSGS)
+    print(f'{NUM_MSGS} messages')
+    expected = bench('decode_msg LNSerializer', reference.decode_msg, msgs)
+    decoded = bench('decode_msg CompiledLNSerializer', compiled.decode_msg, msgs)
+    assert decoded == expected
+    expected = bench('encode_msg LNSerializer', lambda msg: reference.encode_msg(msg[0], **msg[1]), decoded)
+    result = bench('encode_msg CompiledLNSerializer', lambda msg: compiled.encode_msg(msg[0], **msg[1]), decoded)
+    assert result == expected == msgs
+
+
+if __name__ == '__main__':
+    main()
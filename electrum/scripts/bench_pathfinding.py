@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+#
+# Benchmarks finding payment paths on a synthetic graph of mainnet size,
+# with the reverse Dijkstra over ChannelDB.routing_graph, against the
+# previous approach: a queue.PriorityQueue, and looking up the channel,
+# both policies and the end node in ChannelDB for every edge explored.
+# Channels are attached preferentially to well-connected nodes, and some
+# of them are blacklisted.
+#
+# usage: bench_pathfinding.py [num_nodes] [num_channels] [num_payments]
+
+import asyncio
+import queue
+import random
+import shutil
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from typing import Dict
+
+from electrum import constants
+from electrum.channel_db import ChannelDB
+from electrum.lnrouter import LNPathFinder, PathEdge, RouteEdge
+from electrum.lnutil import ShortChannelID
+from electrum.simple_config import SimpleConfig
+
+
+NUM_NODES = int(sys.argv[1]) if len(sys.argv) > 1 else 15000
+NUM_CHANNELS = int(sys.argv[2]) if len(sys.argv) > 2 else 70000
+NUM_PAYMENTS = int(sys.argv[3]) if len(sys.argv) > 3 else 20
+
+
+class LegacyPathFinder(LNPathFinder):
+
+    def _edge_cost(self, short_channel_id, start_node, end_node, payment_amt_msat,
+                   ignore_costs=False, is_mine=False, *, my_channels=None):
+        channel_info = self.channel_db.get_channel_info(short_channel_id, my_channels=my_channels)
+        if channel_info is None:
+            return float('inf'), 0
+        channel_policy = self.channel_db.get_policy_for_node(short_channel_id, start_node, my_channels=my_channels)
+        if channel_policy is None:
+            return float('inf'), 0
+        if self.channel_db.get_policy_for_node(short_channel_id, end_node, my_channels=my_channels) is None \
+                and not is_mine:
+            return float('inf'), 0
+        if channel_policy.is_disabled():
+            return float('inf'), 0
+        if payment_amt_msat < channel_policy.htlc_minimum_msat:
+            return float('inf'), 0
+        if channel_info.capacity_sat is not None and \
+                payment_amt_msat // 1000 > channel_info.capacity_sat:
+            return float('inf'), 0
+        if channel_policy.htlc_maximum_msat is not None and \
+                payment_amt_msat > channel_policy.htlc_maximum_msat:
+            return float('inf'), 0
+        node_info = self.channel_db.get_node_info_for_node_id(node_id=end_node)
+        route_edge = RouteEdge.from_channel_policy(channel_policy, short_channel_id, end_node,
+                                                   node_info=node_info)
+        if not route_edge.is_sane_to_use(payment_amt_msat):
+            return float('inf'), 0
+        base_cost = 500
+        if ignore_costs:
+            return base_cost, 0
+        fee_msat = route_edge.fee_for_edge(payment_amt_msat)
+        cltv_cost = route_edge.cltv_expiry_delta * payment_amt_msat * 15 / 1_000_000_000
+        return base_cost + fee_msat + cltv_cost, fee_msat
+
+    def get_distances(self, nodeA, nodeB, invoice_amount_msat, *, my_channels=None) -> Dict[bytes, PathEdge]:
+        distance_from_start = defaultdict(lambda: float('inf'))
+        distance_from_start[nodeB] = 0
+        prev_node = {}
+        nodes_to_explore = queue.PriorityQueue()
+        nodes_to_explore.put((0, invoice_amount_msat, nodeB))
+        while nodes_to_explore.qsize() > 0:
+            dist_to_edge_endnode, amount_msat, edge_endnode = nodes_to_explore.get()
+            if edge_endnode == nodeA:
+                break
+            if dist_to_edge_endnode != distance_from_start[edge_endnode]:
+                continue
+            for edge_channel_id in self.channel_db.get_channels_for_node(edge_endnode, my_channels=my_channels):
+                assert isinstance(edge_channel_id, bytes)
+                if self.is_blacklisted(edge_channel_id):
+                    continue
+                channel_info = self.channel_db.get_channel_info(edge_channel_id, my_channels=my_channels)
+                edge_startnode = channel_info.node2_id if channel_info.node1_id == edge_endnode else channel_info.node1_id
+                is_mine = edge_channel_id in my_channels
+                edge_cost, fee_for_edge_msat = self._edge_cost(
+                    edge_channel_id, start_node=edge_startnode, end_node=edge_endnode,
+                    payment_amt_msat=amount_msat, ignore_costs=(edge_startnode == nodeA),
+                    is_mine=is_mine, my_channels=my_channels)
+                alt_dist_to_neighbour = distance_from_start[edge_endnode] + edge_cost
+                if alt_dist_to_neighbour < distance_from_start[edge_startnode]:
+                    distance_from_start[edge_startnode] = alt_dist_to_neighbour
+                    prev_node[edge_startnode] = PathEdge(node_id=edge_endnode,
+                                                         short_channel_id=ShortChannelID(edge_channel_id))
+                    nodes_to_explore.put((alt_dist_to_neighbour, amount_msat + fee_for_edge_msat, edge_startnode))
+        return prev_node
+
+    def find_path_for_payment(self, nodeA, nodeB, invoice_amount_msat, *, my_channels=None):
+        prev_node = self.get_distances(nodeA, nodeB, invoice_amount_msat, my_channels=my_channels or {})
+        if nodeA not in prev_node:
+            return None
+        edge_startnode = nodeA
+        path = []
+        while edge_startnode != nodeB:
+            edge = prev_node[edge_startnode]
+            path += [edge]
+            edge_startnode = edge.node_id
+        return path
+
+
+class FakeNetwork:
+
+    def __init__(self, config):
+        self.config = config
+        self.asyncio_loop = asyncio.get_event_loop()  # not running: the SQL thread exits right away
+        self.interface = None
+
+
+def make_graph(cdb: ChannelDB, rng: random.Random) -> list:
+    node_ids = [bytes([2 + i % 2]) + rng.getrandbits(256).to_bytes(32, 'big') for i in range(NUM_NODES)]
+    # each endpoint of a new channel is a node picked uniformly, or one picked
+    # in proportion to its number of channels
+    endpoints = list(node_ids)
+    channels = set()
+    while len(channels) < NUM_CHANNELS:
+        a = rng.choice(endpoints) if rng.random() < 0.7 else rng.choice(node_ids)
+        b = rng.choice(endpoints) if rng.random() < 0.7 else rng.choice(node_ids)
+        if a == b or (min(a, b), max(a, b)) in channels:
+            continue
+        channels.add((min(a, b), max(a, b)))
+        endpoints += [a, b]
+    for i, (node1, node2) in enumerate(sorted(channels)):
+        scid = ShortChannelID((i + 1).to_bytes(8, 'big'))
+        cdb.add_verified_channel_info({'short_channel_id': scid, 'node_id_1': node1, 'node_id_2': node2,
+                                       'features': b''}, capacity_sat=rng.randint(20_000, 10_000_000))
+        for direction in (0, 1):
+            if rng.random() < 0.05:
+                continue  # unpublished policy
+            cdb.add_channel_update({'short_channel_id': scid, 'message_flags': b'\x01',
+                                    'channel_flags': bytes([direction | (2 if rng.random() < 0.03 else 0)]),
+                                    'cltv_expiry_delta': rng.choice([14, 40, 144]), 'htlc_minimum_msat': 1000,
+                                    'htlc_maximum_msat': rng.randint(10**7, 10**10),
+                                    'fee_base_msat': rng.randint(0, 1000),
+                                    'fee_proportional_millionths': rng.randint(1, 2000),
+                                    'timestamp': int(time.time())}, verbose=False)
+    return node_ids
+
+
+def bench(name, path_finder, payments):
+    t0 = time.perf_counter()
+    paths = [path_finder.find_path_for_payment(a, b, amount) for a, b, amount in payments]
+    dt = time.perf_counter() - t0
+    print(f'{name:<28} {dt:8.3f} s  {dt / len(payments) * 1000:8.1f} ms/path')
+    return paths
+
+
+def main():
+    constants.set_testnet()
+    rng = random.Random(0)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        cdb = ChannelDB(FakeNetwork(SimpleConfig({'electrum_path': tmpdir})))
+        cdb.data_loaded.set()
+        node_ids = make_graph(cdb, rng)
+        cdb.sql_thread.join()
+        payments = [(*rng.sample(node_ids, 2), rng.randint(10**5, 10**9)) for i in range(NUM_PAYMENTS)]
+        legacy, fast = LegacyPathFinder(cdb), LNPathFinder(cdb)
+        with cdb.lock:
+            blacklisted = rng.sample(list(cdb._channels), NUM_CHANNELS // 100)
+        for short_channel_id in blacklisted:
+            legacy.blacklist[short_channel_id] = fast.blacklist[short_channel_id] = int(time.time())
+        print(f'{NUM_NODES} nodes, {NUM_CHANNELS} channels, {NUM_PAYMENTS} payments')
+        expected = bench('PriorityQueue + ChannelDB', legacy, payments)
+        result = bench('heapq + routing_graph', fast, payments)
+        assert result == expected
+        print(f'{sum(p is not None for p in result)} paths found')
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
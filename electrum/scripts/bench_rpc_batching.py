@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+#
+# Benchmarks fetching the transactions of a wallet restore from a local
+# mock server, with every blockchain.transaction.get request sent on its
+# own (as before) and with requests coalesced into JSON-RPC batches.
+# The mock server waits `latency` seconds before answering each request
+# (the requests of a batch concurrently), to stand in for the round trip
+# to a remote server.
+#
+# usage: bench_rpc_batching.py [num_txs] [latency]
+
+import sys
+import time
+import asyncio
+
+from aiorpcx import RPCSession, serve_rs, connect_rs, Request
+
+from electrum.interface import NotificationSession, BATCHED_METHODS
+
+
+NUM_TXS = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+LATENCY = float(sys.argv[2]) if len(sys.argv) > 2 else 0.02
+RAW_TX = '02000000' + '01' + '11' * 32 + '00000000' + '00' + 'ffffffff' + '01' + '00' * 8 + '00' + '00000000'
+
+
+class MockServerSession(RPCSession):
+    # do not let server side limits be the bottleneck
+    initial_concurrent = 1000
+    cost_hard_limit = 0
+
+    async def handle_request(self, request):
+        if isinstance(request, Request) and request.method in BATCHED_METHODS:
+            # the requests of a batch are handled concurrently
+            await asyncio.sleep(LATENCY)
+            return RAW_TX
+        raise Exception(f'unexpected request {request}')
+
+
+class FakeNetwork:
+    debug = False
+
+    def __init__(self, config):
+        self.config = config
+
+
+class FakeInterface:
+    debug = False
+
+    def __init__(self, config):
+        self.network = FakeNetwork(config)
+
+
+async def fetch_all(port: int, config: dict, batched: bool) -> float:
+    interface = FakeInterface(config)
+    factory = lambda *args, **kwargs: NotificationSession(*args, interface=interface, **kwargs)
+    async with connect_rs('127.0.0.1', port, session_factory=factory) as session:
+        if not batched:
+            # send every request on its own, like send_request did before
+            send = lambda method, params: RPCSession.send_request(session, method, params)
+        else:
+            send = session.send_request
+        t0 = time.perf_counter()
+        await asyncio.gather(*[send('blockchain.transaction.get', ['%064x' % i])
+                               for i in range(NUM_TXS)])
+        return time.perf_counter() - t0
+
+
+async def main():
+    server = await serve_rs(MockServerSession, '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+    print(f'{NUM_TXS} transactions, {LATENCY * 1000:.0f} ms server latency')
+    for name, batched, options in (
+            ('one request per tx', False, {}),
+            ('batched (defaults)', True, {}),
+            ('batched (size 20, 10 in flight)', True,
+             {'network_batch_size': 20, 'network_max_inflight_batches': 10}),
+            ('batched (size 100, 20 in flight)', True,
+             {'network_batch_size': 100, 'network_max_inflight_batches': 20})):
+        dt = await fetch_all(port, options, batched)
+        print(f'{name:<34} {dt:8.3f} s  {NUM_TXS / dt:10.0f} requests/s')
+    server.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
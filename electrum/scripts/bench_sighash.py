@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+#
+# Benchmarks signing a consolidation tx spending many p2pkh coins, against
+# the previous approach of serializing the whole preimage as hex for every
+# input signed, which is quadratic in the number of inputs.
+#
+# usage: bench_sighash.py [num_inputs]
+
+import os
+import sys
+import time
+
+from electrum.crypto import sha256d
+from electrum.ecc import ECPrivkey
+from electrum.transaction import (PartialTransaction, PartialTxInput, PartialTxOutput, TxOutpoint,
+                                  SighashCache)
+
+
+NUM_INPUTS = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+
+
+def make_tx(pubkey: bytes, num_inputs: int) -> PartialTransaction:
+    inputs = []
+    for i in range(num_inputs):
+        txin = PartialTxInput(prevout=TxOutpoint(txid=os.urandom(32), out_idx=i % 4))
+        txin.nsequence = 0xfffffffd
+        txin.script_type = 'p2pkh'
+        txin.pubkeys = [pubkey]
+        txin.num_sig = 1
+        inputs.append(txin)
+    outputs = [PartialTxOutput(scriptpubkey=b'\x76\xa9\x14' + os.urandom(20) + b'\x88\xac', value=10**8 * num_inputs)]
+    return PartialTransaction.from_io(inputs, outputs, locktime=0, version=2)
+
+
+def legacy(tx: PartialTransaction) -> list:
+    return [sha256d(bytes.fromhex(tx.serialize_preimage(i))) for i in range(len(tx.inputs()))]
+
+
+def cached(tx: PartialTransaction) -> list:
+    sighash_cache = SighashCache(tx)
+    return [sighash_cache.get_sighash(i) for i in range(len(tx.inputs()))]
+
+
+def bench(name, func, tx, privkey):
+    t0 = time.perf_counter()
+    sigs = [privkey.sign_transaction(sighash) for sighash in func(tx)]
+    dt = time.perf_counter() - t0
+    print(f'{name:<28} {dt:8.3f} s  {len(sigs) / dt:10.0f} inputs/s')
+    return sigs
+
+
+def main():
+    privkey = ECPrivkey(os.urandom(32))
+    tx = make_tx(privkey.get_public_key_bytes(compressed=True), NUM_INPUTS)
+    print(f'{NUM_INPUTS} inputs')
+    expected = bench('serialize_preimage', legacy, tx, privkey)
+    result = bench('SighashCache', cached, tx, privkey)
+    assert result == expected
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+#
+# Benchmarks verifying synthetic merkle proofs of wallet txs that share
+# blocks, and storing them as verified, against the previous approach
+# of verifying every proof on its own and storing it with its own db
+# modification.
+#
+# usage: bench_spv_verify.py [num_blocks] [txs_per_block] [wallet_txs_per_block]
+
+import os
+import sys
+import time
+import random
+
+from electrum.bitcoin import hash_encode, hash_decode
+from electrum.crypto import sha256d
+from electrum.util import TxMinedInfo
+from electrum.verifier import verify_tx_is_in_block, verify_txs_in_block
+from electrum.wallet_db import WalletDB
+
+
+NUM_BLOCKS = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+TXS_PER_BLOCK = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+WALLET_TXS_PER_BLOCK = int(sys.argv[3]) if len(sys.argv) > 3 else 50
+
+
+def make_block(num_txs: int, wallet_positions):
+    tx_hashes = [os.urandom(32).hex() for _ in range(num_txs)]
+    level = [hash_decode(tx_hash) for tx_hash in tx_hashes]
+    branches = {pos: [] for pos in wallet_positions}
+    while len(level) > 1:
+        if len(level) % 2:
+            level.append(level[-1])
+        for pos, branch in branches.items():
+            branch.append(hash_encode(level[(pos >> len(branch)) ^ 1]))
+        level = [sha256d(level[j] + level[j + 1]) for j in range(0, len(level), 2)]
+    header = {'merkle_root': hash_encode(level[0]), 'timestamp': 0}
+    return header, [(tx_hashes[pos], branch, pos) for pos, branch in branches.items()]
+
+
+def legacy(blocks) -> None:
+    db = WalletDB('', manual_upgrades=True)
+    for height, (header, proofs) in blocks.items():
+        for tx_hash, branch, pos in proofs:
+            verify_tx_is_in_block(tx_hash, branch, pos, header, height)
+            db.add_verified_tx(tx_hash, TxMinedInfo(height=height, timestamp=0, txpos=pos, header_hash='00'))
+
+
+def batched(blocks) -> None:
+    db = WalletDB('', manual_upgrades=True)
+    verified = {}
+    for height, (header, proofs) in blocks.items():
+        assert not verify_txs_in_block(proofs, header, height, known_nodes={})
+        for tx_hash, branch, pos in proofs:
+            verified[tx_hash] = TxMinedInfo(height=height, timestamp=0, txpos=pos, header_hash='00')
+    db.add_verified_txs(verified)
+
+
+def bench(name, func, n):
+    t0 = time.perf_counter()
+    func()
+    dt = time.perf_counter() - t0
+    print(f'{name:<24} {dt:8.3f} s  {n / dt:10.0f} proofs/s')
+
+
+def main():
+    blocks = {}
+    for height in range(1, NUM_BLOCKS + 1):
+        positions = random.sample(range(TXS_PER_BLOCK), WALLET_TXS_PER_BLOCK)
+        blocks[height] = make_block(TXS_PER_BLOCK, positions)
+    n = NUM_BLOCKS * WALLET_TXS_PER_BLOCK
+    print(f'{n} proofs in {NUM_BLOCKS} blocks of {TXS_PER_BLOCK} txs')
+    bench('per-tx verification', lambda: legacy(blocks), n)
+    bench('per-block verification', lambda: batched(blocks), n)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+#
+# Benchmarks deserializing transactions, computing their txid and the
+# addresses of their outputs, against the previous approach: parsing
+# through BCDataStream, re-serializing the tx to hash its txid, and
+# decoding every output script with the generic template matcher.
+# The corpus is read from a file of raw txs (hex, one per line), e.g.
+# dumped from a wallet or a node; without one, coinstake and contract
+# (OP_CALL, OP_CREATE, OP_SENDER) txs shaped like HTMLCOIN's are generated.
+#
+# usage: bench_tx_parser.py [corpus_file | num_txs]
+
+import os
+import sys
+import time
+
+from electrum import constants
+from electrum.crypto import sha256d
+from electrum.transaction import (Transaction, BCDataStream, parse_input, parse_output, parse_witness,
+                                  get_address_from_output_script, _get_address_from_decoded_output_script)
+
+
+def push(data: bytes) -> bytes:
+    assert len(data) < 0x4c
+    return bytes([len(data)]) + data
+
+
+def make_input(*, p2pk_spend: bool = False) -> bytes:
+    script_sig = push(os.urandom(71))
+    if not p2pk_spend:
+        script_sig += push(b'\x02' + os.urandom(32))
+    return os.urandom(32) + os.urandom(4) + bytes([len(script_sig)]) + script_sig + b'\xff\xff\xff\xff'
+
+
+def make_output(value: int, script: bytes) -> bytes:
+    return value.to_bytes(8, 'little') + bytes([len(script)]) + script
+
+
+def p2pkh() -> bytes:
+    return b'\x76\xa9\x14' + os.urandom(20) + b'\x88\xac'
+
+
+def p2pk() -> bytes:
+    return push(b'\x02' + os.urandom(32)) + b'\xac'
+
+
+def opcall() -> bytes:
+    return (b'\x01\x04' + push((250000).to_bytes(3, 'little')) + push(bytes([40]))
+            + push(os.urandom(68)) + push(os.urandom(20)) + b'\xc2')
+
+
+def opcreate() -> bytes:
+    return b'\x01\x04' + push((2500000).to_bytes(3, 'little')) + push(bytes([40])) + push(os.urandom(70)) + b'\xc1'
+
+
+def opsender() -> bytes:
+    return b'\x01\x01' + push(os.urandom(20)) + push(os.urandom(72)) + b'\xc4' + opcall()
+
+
+def make_tx(inputs, outputs) -> str:
+    return ('02000000' + bytes([len(inputs)]).hex() + b''.join(inputs).hex()
+            + bytes([len(outputs)]).hex() + b''.join(outputs).hex() + '00000000')
+
+
+def make_corpus(num_txs: int) -> list:
+    txs = []
+    for i in range(num_txs):
+        kind = i % 4
+        if kind == 0:  # coinstake
+            txs.append(make_tx([make_input(p2pk_spend=True)], [make_output(0, b''), make_output(4 * 10**8, p2pk()),
+                                                  make_output(4 * 10**8, p2pk())]))
+        elif kind == 1:
+            txs.append(make_tx([make_input(), make_input()], [make_output(10**8, opcall()),
+                                                              make_output(3 * 10**8, p2pkh())]))
+        elif kind == 2:
+            txs.append(make_tx([make_input()], [make_output(0, opcreate()), make_output(10**8, p2pkh())]))
+        else:
+            txs.append(make_tx([make_input()], [make_output(0, opsender()), make_output(10**8, p2pkh())]))
+    return txs
+
+
+def legacy(raw_tx: str):
+    tx = Transaction(None)
+    vds = BCDataStream()
+    vds.write(bytes.fromhex(raw_tx))
+    tx._version = vds.read_int32()
+    n_vin = vds.read_compact_size()
+    is_segwit = (n_vin == 0)
+    if is_segwit:
+        vds.read_bytes(1)
+        n_vin = vds.read_compact_size()
+    tx._inputs = [parse_input(vds) for i in range(n_vin)]
+    tx._outputs = [parse_output(vds) for i in range(vds.read_compact_size())]
+    if is_segwit:
+        for txin in tx._inputs:
+            parse_witness(vds, txin)
+    tx._locktime = vds.read_uint32()
+    txid = sha256d(bytes.fromhex(tx.serialize_to_network(force_legacy=True)))[::-1].hex()
+    addresses = [_get_address_from_decoded_output_script(o.scriptpubkey) for o in tx._outputs]
+    return txid, addresses
+
+
+def fast(raw_tx: str):
+    tx = Transaction(raw_tx)
+    txid = tx.txid()
+    addresses = [get_address_from_output_script(o.scriptpubkey) for o in tx.outputs()]
+    return txid, addresses
+
+
+def bench(name, func, corpus):
+    t0 = time.perf_counter()
+    result = [func(raw_tx) for raw_tx in corpus]
+    dt = time.perf_counter() - t0
+    print(f'{name:<28} {dt:8.3f} s  {len(corpus) / dt:10.0f} txs/s')
+    return result
+
+
+def main():
+    constants.set_mainnet()
+    if len(sys.argv) > 1 and os.path.exists(sys.argv[1]):
+        with open(sys.argv[1]) as f:
+            corpus = [line.strip() for line in f if line.strip()]
+    else:
+        corpus = make_corpus(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
+    print(f'{len(corpus)} transactions')
+    expected = bench('BCDataStream + re-serialize', legacy, corpus)
+    result = bench('parse_network_tx', fast, corpus)
+    assert result == expected
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+#
+# Benchmarks Blockchain.verify_chunk on synthetic PoS chunks, against
+# the previous implementation that deserialized every header into a
+# dict and re-serialized it to compute its hash.
+#
+# usage: bench_verify_chunk.py [num_chunks]
+
+import os
+import sys
+import time
+import tempfile
+import shutil
+
+from electrum import blockchain
+from electrum.blockchain import (Blockchain, deserialize_header, hash_header, CHUNK_SIZE,
+                                 POW_BLOCK_COUNT)
+from electrum.crypto import sha256d
+from electrum import constants
+from electrum.simple_config import SimpleConfig
+from electrum.util import make_dir
+
+
+NUM_CHUNKS = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+FIRST_INDEX = POW_BLOCK_COUNT // CHUNK_SIZE + 1
+
+
+def make_chunks(num_chunks: int) -> list:
+    prev_hash = bytes(32)
+    timestamp = 1600000000
+    chunks = []
+    for index in range(num_chunks):
+        chunk = []
+        for i in range(CHUNK_SIZE):
+            sig = os.urandom(72)
+            raw = (b'\x00\x00\x00\x20' + prev_hash + os.urandom(32)
+                   + timestamp.to_bytes(4, 'little') + (0x1a0fffff).to_bytes(4, 'little') + bytes(4)
+                   + os.urandom(96) + (1).to_bytes(4, 'little')
+                   + bytes([len(sig)]) + sig)
+            chunk.append(raw)
+            prev_hash = sha256d(raw)
+            timestamp += 32
+        chunks.append(chunk)
+    return chunks
+
+
+def legacy_verify_chunk(chain: Blockchain, index: int, raw_headers: list) -> None:
+    prev_header = None
+    pprev_header = None
+    if index != 0:
+        prev_header = chain.read_header(index * CHUNK_SIZE - 1)
+        pprev_header = chain.read_header(index * CHUNK_SIZE - 2)
+    for i, raw_header in enumerate(raw_headers):
+        height = index * CHUNK_SIZE + i
+        header = deserialize_header(raw_header, height)
+        target = chain.get_target(height, is_pos=chain.is_pos(header), prev_header=prev_header, pprev_header=pprev_header)
+        chain.verify_header(header, hash_header(prev_header), target)
+        pprev_header = prev_header
+        prev_header = header
+
+
+def bench(name, func, num_chunks):
+    t0 = time.perf_counter()
+    func()
+    dt = time.perf_counter() - t0
+    print(f'{name:<30} {dt:8.3f} s  {num_chunks / dt:8.2f} chunks/s  {num_chunks * CHUNK_SIZE / dt:10.0f} headers/s')
+
+
+def main():
+    constants.set_mainnet()
+    tmpdir = tempfile.mkdtemp()
+    try:
+        make_dir(os.path.join(tmpdir, 'forks'))
+        config = SimpleConfig({'electrum_path': tmpdir})
+        chain = Blockchain(config=config, forkpoint=0, parent=None,
+                           forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        blockchain.blockchains[constants.net.GENESIS] = chain
+        chunks = make_chunks(FIRST_INDEX + NUM_CHUNKS)
+        for index, chunk in enumerate(chunks):
+            chain.save_chunk(index, chunk)
+        indexes = range(FIRST_INDEX, FIRST_INDEX + NUM_CHUNKS)
+        bench('legacy verify_chunk',
+              lambda: [legacy_verify_chunk(chain, i, chunks[i]) for i in indexes], NUM_CHUNKS)
+        bench('Blockchain.verify_chunk',
+              lambda: [chain.verify_chunk(i, chunks[i]) for i in indexes], NUM_CHUNKS)
+        chain.store.close()
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
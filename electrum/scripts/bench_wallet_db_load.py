@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+#
+# Benchmarks opening a wallet db with many transactions, and reading
+# all of them once, against the previous implementation that converted
+# every stored tx to a Transaction object at load time and kept it
+# (deserialized, once used) for the lifetime of the db.
+# Each variant runs in its own process, and reports its peak RSS and
+# the memory still allocated by Python once all txs have been read.
+#
+# usage: bench_wallet_db_load.py [num_txs]
+
+import gc
+import os
+import sys
+import json
+import time
+import resource
+import tracemalloc
+import subprocess
+
+from electrum.wallet_db import WalletDB, FINAL_SEED_VERSION
+from electrum.transaction import tx_from_any
+
+
+NUM_TXS = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+
+
+class LegacyWalletDB(WalletDB):
+
+    def _convert_dict(self, path, key, v):
+        if key == 'transactions':
+            v = dict((k, tx_from_any(x, deserialize=False)) for k, x in v.items())
+        return super()._convert_dict(path, key, v)
+
+    def get_transaction(self, tx_hash):
+        return self.transactions.get(tx_hash)
+
+
+def make_raw_tx() -> str:
+    p2pkh = '1976a914' + os.urandom(20).hex() + '88ac'
+    return ('02000000'
+            + '01' + os.urandom(32).hex() + '00000000' + '00' + 'ffffffff'
+            + '02' + (100000).to_bytes(8, 'little').hex() + p2pkh
+            + (200000).to_bytes(8, 'little').hex() + p2pkh
+            + '00000000')
+
+
+def make_wallet_json(num_txs: int) -> str:
+    transactions = {}
+    txo = {}
+    for i in range(num_txs):
+        tx = tx_from_any(make_raw_tx())
+        txid = tx.txid()
+        transactions[txid] = tx.serialize()
+        txo[txid] = {'addr%d' % (i % 1000): {'0': [100000, False]}}
+    return json.dumps({'seed_version': FINAL_SEED_VERSION,
+                       'transactions': transactions,
+                       'txo': txo})
+
+
+def run(db_class, path: str) -> None:
+    with open(path) as f:
+        raw = f.read()
+    t0 = time.perf_counter()
+    db = db_class(raw, manual_upgrades=False)
+    t_load = time.perf_counter() - t0
+    del raw
+    t0 = time.perf_counter()
+    for txid in db.list_transactions():
+        db.get_transaction(txid).outputs()
+    t_read = time.perf_counter() - t0
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    # measured separately, as tracing slows down allocations
+    gc.collect()
+    tracemalloc.start()
+    db = db_class(db.dump(), manual_upgrades=False)
+    for txid in db.list_transactions():
+        db.get_transaction(txid).outputs()
+    gc.collect()
+    retained = tracemalloc.get_traced_memory()[0] / 2**20
+    print(f'{db_class.__name__:<16} load {t_load:7.3f} s  read all {t_read:7.3f} s  '
+          f'peak rss {maxrss:7.1f} MiB  retained {retained:7.1f} MiB')
+
+
+def main():
+    if len(sys.argv) > 2:
+        path, name = sys.argv[2], sys.argv[3]
+        run({'WalletDB': WalletDB, 'LegacyWalletDB': LegacyWalletDB}[name], path)
+        return
+    path = os.path.abspath('bench_wallet_db_load.json')
+    with open(path, 'w') as f:
+        f.write(make_wallet_json(NUM_TXS))
+    try:
+        print(f'{NUM_TXS} transactions, {os.path.getsize(path) / 2**20:.1f} MiB of json')
+        for name in ('LegacyWalletDB', 'WalletDB'):
+            subprocess.run([sys.executable, __file__, str(NUM_TXS), path, name], check=True)
+    finally:
+        os.unlink(path)
+
+
+if __name__ == '__main__':
+    main()
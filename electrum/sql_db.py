@@ -42,26 +42,54 @@ class SqlDB(Logger):
         i = 0
         while self.asyncio_loop.is_running():
             try:
-                future, func, args, kwargs = self.db_requests.get(timeout=0.1)
+                request = self.db_requests.get(timeout=0.1)
             except queue.Empty:
                 continue
-            try:
-                result = func(self, *args, **kwargs)
-            except BaseException as e:
-                self.asyncio_loop.call_soon_threadsafe(future.set_exception, e)
+            if not self._run_request(*request):
                 continue
-            if not future.cancelled():
-                self.asyncio_loop.call_soon_threadsafe(future.set_result, result)
             # note: in sweepstore session.commit() is called inside
             # the sql-decorated methods, so commiting to disk is awaited
             if self.commit_interval:
                 i = (i + 1) % self.commit_interval
                 if i == 0:
                     self.conn.commit()
+        # do not drop the writes that were queued before the event loop stopped
+        self.run_pending_requests()
+        self.on_close()
         # write
         self.conn.commit()
         self.conn.close()
         self.logger.info("SQL thread terminated")
 
+    def _run_request(self, future, func, args, kwargs) -> bool:
+        try:
+            result = func(self, *args, **kwargs)
+        except BaseException as e:
+            self._call_soon_threadsafe(future.set_exception, e)
+            return False
+        if not future.cancelled():
+            self._call_soon_threadsafe(future.set_result, result)
+        return True
+
+    def _call_soon_threadsafe(self, callback, arg):
+        try:
+            self.asyncio_loop.call_soon_threadsafe(callback, arg)
+        except RuntimeError:
+            pass  # the event loop is closed, so nobody awaits the result
+
+    def run_pending_requests(self):
+        """Runs the requests queued so far, in the SQL thread."""
+        assert threading.currentThread() == self.sql_thread
+        while True:
+            try:
+                request = self.db_requests.get_nowait()
+            except queue.Empty:
+                return
+            self._run_request(*request)
+
     def create_database(self):
         raise NotImplementedError()
+
+    def on_close(self):
+        """Called in the SQL thread before the database is closed."""
+        pass
@@ -64,6 +64,7 @@ class WalletStorage(Logger):
         self.logger.info(f"wallet path {self.path}")
         self.pubkey = None
         self.decrypted = ''
+        self._appendable_with = ()  # pubkey of the last write(); () if there was none
         try:
             test_read_write_permissions(self.path)
         except IOError as e:
@@ -99,8 +100,24 @@ class WalletStorage(Logger):
         os.replace(temp_path, self.path)
         os.chmod(self.path, mode)
         self._file_exists = True
+        self._appendable_with = self.pubkey
         self.logger.info(f"saved {self.path}")
 
+    def append(self, data: str) -> None:
+        """Appends data as a new line of the file.
+        With encryption, each line is encrypted separately.
+        """
+        assert self.can_append()
+        s = self.encrypt_before_writing(data)
+        with open(self.path, "a", encoding='utf-8') as f:
+            f.write('\n' + s)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def can_append(self) -> bool:
+        """Return if the file was last written by this storage, with the current encryption."""
+        return self.file_exists() and self._appendable_with == self.pubkey
+
     def file_exists(self) -> bool:
         return self._file_exists
 
@@ -136,7 +153,8 @@ class WalletStorage(Logger):
 
     def _init_encryption_version(self):
         try:
-            magic = base64.b64decode(self.raw)[0:4]
+            # an encrypted file has one encrypted blob per line
+            magic = base64.b64decode(self.raw.split('\n', 1)[0])[0:4]
             if magic == b'BIE1':
                 return StorageEncryptionVersion.USER_PASSWORD
             elif magic == b'BIE2':
@@ -167,8 +185,17 @@ class WalletStorage(Logger):
         ec_key = self.get_eckey_from_password(password)
         if self.raw:
             enc_magic = self._get_encryption_magic()
-            s = zlib.decompress(ec_key.decrypt_message(self.raw, enc_magic))
-            s = s.decode('utf8')
+            lines = [line for line in self.raw.split('\n') if line.strip()]
+            parts = [zlib.decompress(ec_key.decrypt_message(lines[0], enc_magic))]
+            # the following lines hold appended writes
+            for i, line in enumerate(lines[1:], start=2):
+                try:
+                    parts.append(zlib.decompress(ec_key.decrypt_message(line, enc_magic)))
+                except Exception:
+                    if i < len(lines):
+                        raise
+                    self.logger.warning('ignoring incomplete appended write')
+            s = b'\n'.join(parts).decode('utf8')
         else:
             s = ''
         self.pubkey = ec_key.get_public_key_hex()
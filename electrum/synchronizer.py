@@ -25,7 +25,8 @@
 import asyncio
 import hashlib
 import binascii
-from typing import Dict, List, TYPE_CHECKING, Tuple
+import itertools
+from typing import Dict, List, TYPE_CHECKING, Tuple, NamedTuple
 from collections import defaultdict
 import logging
 from concurrent.futures import CancelledError
@@ -70,10 +71,27 @@ def token_history_status(h):
     return hashlib.sha256(status.encode('ascii')).digest().hex()
 
 
+class SubscriptionProgress(NamedTuple):
+    subscribed_addrs: int
+    pending_addrs: int  # queued or in flight
+    subscribed_delegations: int  # addresses subscribed to delegation events
+    pending_delegations: int  # queued or in flight
+    in_flight: int  # subscription requests
+
+
 class SynchronizerBase(NetworkJobOnDefaultServer):
     """Subscribe over the network to a set of addresses, and monitor their statuses.
     Every time a status changes, run a coroutine provided by the subclass.
+
+    At most `subscription_window` subscriptions are in flight at a time,
+    so that subscribing to a large wallet does not trip the rate limiting
+    of the server. Addresses are subscribed in the order of
+    _get_subscription_priority. The delegation events of P2PKH addresses
+    are subscribed to last, at DELEGATION_SUBSCRIPTION_PRIORITY.
     """
+    DEFAULT_SUBSCRIPTION_WINDOW = 50
+    DELEGATION_SUBSCRIPTION_PRIORITY = float('inf')
+
     def __init__(self, network: 'Network'):
         self.asyncio_loop = network.asyncio_loop
         self._reset_request_counters()
@@ -86,8 +104,14 @@ class SynchronizerBase(NetworkJobOnDefaultServer):
         self.scripthash_to_address = {}
         self._processed_some_notifications = False  # so that we don't miss them
         self._reset_request_counters()
+        self._subscription_window = asyncio.Semaphore(self.get_subscription_window())
+        self._subscriptions_in_flight = 0
+        self._num_subscribed_addrs = 0
+        self._num_subscribed_delegations = 0
+        self.requested_delegations = set()  # addresses
+        self._add_queue_counter = itertools.count()  # FIFO among addresses of the same priority
         # Queues
-        self.add_queue = asyncio.Queue()
+        self.add_queue = asyncio.PriorityQueue()  # (priority, counter, addr, is_delegation)
         self.status_queue = asyncio.Queue()
         self.token_add_queue = asyncio.Queue()
         self.token_status_queue = asyncio.Queue()
@@ -122,11 +146,24 @@ class SynchronizerBase(NetworkJobOnDefaultServer):
     def add_token(self, token: 'Token'):
         asyncio.run_coroutine_threadsafe(self._add_token_key(token.get_key()), self.asyncio_loop)
 
+    def get_subscription_window(self) -> int:
+        return max(1, int(self.network.config.get('subscription_window', self.DEFAULT_SUBSCRIPTION_WINDOW)))
+
+    def _get_subscription_priority(self, addr: str) -> int:
+        """Addresses with lower values are subscribed to first."""
+        return 0
+
     async def _add_address(self, addr: str):
         if not is_address(addr): raise ValueError(f"invalid Htmlcoin address {addr}")
         if addr in self.requested_addrs: return
         self.requested_addrs.add(addr)
-        await self.add_queue.put(addr)
+        priority = self._get_subscription_priority(addr)
+        await self.add_queue.put((priority, next(self._add_queue_counter), addr, False))
+        # an address without history can still add a delegation, with an
+        # OP_SENDER output, so this does not depend on its status
+        if is_p2pkh_address(addr) and addr not in self.requested_delegations:
+            self.requested_delegations.add(addr)
+            await self.add_queue.put((self.DELEGATION_SUBSCRIPTION_PRIORITY, next(self._add_queue_counter), addr, True))
 
     async def _add_token_key(self, key: str):
         if key in self.requested_tokens: return
@@ -144,43 +181,53 @@ class SynchronizerBase(NetworkJobOnDefaultServer):
     async def _on_delegation_status(self, addr, status):
         raise NotImplementedError()  # implemented by subclasses
 
+    async def _subscribe(self, method: str, params: List, queue: asyncio.Queue):
+        # the caller holds a slot of self._subscription_window
+        self._subscriptions_in_flight += 1
+        try:
+            await self.session.subscribe(method, params, queue)
+        except RPCError as e:
+            if e.message == 'history too large':  # no unique error code
+                raise GracefulDisconnect(e, log_level=logging.ERROR) from e
+            raise
+        finally:
+            self._subscriptions_in_flight -= 1
+
     async def send_subscriptions(self):
         async def subscribe_to_address(addr):
             h = address_to_scripthash(addr)
             self.scripthash_to_address[h] = addr
             self._requests_sent += 1
             try:
-                await self.session.subscribe('blockchain.scripthash.subscribe', [h], self.status_queue)
-            except RPCError as e:
-                if e.message == 'history too large':  # no unique error code
-                    raise GracefulDisconnect(e, log_level=logging.ERROR) from e
-                raise
+                await self._subscribe('blockchain.scripthash.subscribe', [h], self.status_queue)
+            finally:
+                self._subscription_window.release()
             self._requests_answered += 1
+            self._num_subscribed_addrs += 1
             self.requested_addrs.remove(addr)
 
         async def subscribe_to_delegation(addr):
-            if not is_p2pkh_address(addr):
-                return
+            h160 = b58_address_to_hash160(addr)[1].hex()
             self._delegation_requests_sent += 2
             try:
-                await self.session.subscribe('blockchain.contract.event.subscribe',
-                                             [b58_address_to_hash160(addr)[1].hex(), DELEGATION_CONTRACT,
-                                              ADD_DELEGATION_TOPIC],
-                                             self.delegation_status_queue)
-                await self.session.subscribe('blockchain.contract.event.subscribe',
-                                             [b58_address_to_hash160(addr)[1].hex(), DELEGATION_CONTRACT,
-                                              RM_DELEGATION_TOPIC],
-                                             self.delegation_status_queue)
-            except RPCError as e:
-                if e.message == 'history too large':  # no unique error code
-                    raise GracefulDisconnect(e, log_level=logging.ERROR) from e
-                raise
+                for topic in (ADD_DELEGATION_TOPIC, RM_DELEGATION_TOPIC):
+                    await self._subscribe('blockchain.contract.event.subscribe',
+                                          [h160, DELEGATION_CONTRACT, topic],
+                                          self.delegation_status_queue)
+            finally:
+                self._subscription_window.release()
             self._delegation_requests_answered += 2
+            self._num_subscribed_delegations += 1
 
         while True:
-            addr = await self.add_queue.get()
-            await self.taskgroup.spawn(subscribe_to_address, addr)
-            await self.taskgroup.spawn(subscribe_to_delegation, addr)
+            priority, __, addr, is_delegation = await self.add_queue.get()
+            # wait for room in the window before taking the address off the
+            # queue, rather than spawning a task per queued address
+            await self._subscription_window.acquire()
+            if is_delegation:
+                await self.taskgroup.spawn(subscribe_to_delegation, addr)
+            else:
+                await self.taskgroup.spawn(subscribe_to_address, addr)
 
     async def send_token_subscriptions(self):
         async def subscribe_to_token(key):
@@ -226,6 +273,13 @@ class SynchronizerBase(NetworkJobOnDefaultServer):
         requests_answered = self._requests_answered + self._token_requests_answered + self._delegation_requests_answered
         return requests_sent, requests_answered
 
+    def get_subscription_progress(self) -> SubscriptionProgress:
+        return SubscriptionProgress(subscribed_addrs=self._num_subscribed_addrs,
+                                    pending_addrs=len(self.requested_addrs),
+                                    subscribed_delegations=self._num_subscribed_delegations,
+                                    pending_delegations=len(self.requested_delegations) - self._num_subscribed_delegations,
+                                    in_flight=self._subscriptions_in_flight)
+
     async def main(self):
         raise NotImplementedError()  # implemented by subclasses
 
@@ -253,6 +307,10 @@ class Synchronizer(SynchronizerBase):
     def diagnostic_name(self):
         return self.wallet.diagnostic_name()
 
+    def _get_subscription_priority(self, addr):
+        # addresses with a history first, then the gap window
+        return 0 if self.wallet.db.get_addr_history(addr) else 1
+
     def is_up_to_date(self):
         return (not self.requested_addrs
                 and not self.requested_histories
@@ -262,8 +320,7 @@ class Synchronizer(SynchronizerBase):
                 and not self.requested_token_txs)
 
     async def _on_address_status(self, addr, status):
-        history = self.wallet.db.get_addr_history(addr)
-        if history_status(history) == status:
+        if self.wallet.get_addr_status(addr) == status:
             return
         if (addr, status) in self.requested_histories:
             return
@@ -1,5 +1,6 @@
 import base64
 import sys
+from unittest import mock
 
 from electrum.bitcoin import (public_key_to_p2pkh, address_from_private_key,
                               is_address, is_private_key,
@@ -18,7 +19,8 @@ from electrum.crypto import sha256d, SUPPORTED_PW_HASH_VERSIONS
 from electrum import ecc, crypto, constants
 from electrum.util import bfh, bh2u, InvalidPassword, randrange
 from electrum.storage import WalletStorage
-from electrum.keystore import xtype_from_derivation
+from electrum import keystore
+from electrum.keystore import xtype_from_derivation, Xpub
 
 from electrum import ecc_fast
 
@@ -494,6 +496,47 @@ class Test_xprv_xpub(ElectrumTestCase):
         self.assertEqual("xpub6FnCn6nSzZAw5Tw7cgR9bi15UV96gLZhjDstkXXxvCLsUXBGXPdSnLFbdpq8p9HmGsApME5hQTZ3emM2rnY5agb9rXpVGyy3bdW6EEgAtqt", xpub)
         self.assertEqual("xprvA2nrNbFZABcdryreWet9Ea4LvTJcGsqrMzxHx98MMrotbir7yrKCEXw7nadnHM8Dq38EGfSh6dqA9QWTyefMLEcBYJUuekgW4BYPJcr9E7j", xprv)
 
+    def test_derive_child_pubkeys(self):
+        node = BIP32Node.from_rootseed(bfh("000102030405060708090a0b0c0d0e0f"), xtype='standard')
+        node = node.subkey_at_public_derivation("m/0")
+        pubkey = node.eckey.get_public_key_bytes(compressed=True)
+        expected = [bip32.CKD_pub(pubkey, node.chaincode, i)[0] for i in range(95, 120)]
+        self.assertEqual(expected, bip32.derive_child_pubkeys(pubkey, node.chaincode, 95, 120))
+        self.assertEqual([], bip32.derive_child_pubkeys(pubkey, node.chaincode, 10, 10))
+        with self.assertRaises(Exception):
+            bip32.derive_child_pubkeys(pubkey, node.chaincode, 0, bip32.BIP32_PRIME + 1)
+        # split across worker processes
+        start, stop = 7, 7 + 2 * bip32.MIN_KEYS_PER_WORKER + 1
+        pubkeys = bip32.derive_child_pubkeys(pubkey, node.chaincode, start, stop, num_workers=2)
+        self.assertEqual(stop - start, len(pubkeys))
+        for i in (start, start + bip32.MIN_KEYS_PER_WORKER + 1, stop - 1):
+            self.assertEqual(bip32.CKD_pub(pubkey, node.chaincode, i)[0], pubkeys[i - start])
+        # the worker processes are kept for the next call
+        executor = bip32._executor
+        self.assertEqual(pubkeys, bip32.derive_child_pubkeys(pubkey, node.chaincode, start, stop, num_workers=2))
+        self.assertIs(executor, bip32._executor)
+
+    @mock.patch.object(keystore.Xpub, 'DERIVED_PUBKEYS_CACHE_SIZE', 10)
+    def test_xpub_keystore_caches_few_derived_pubkeys(self):
+        xpub = BIP32Node.from_rootseed(bfh("000102030405060708090a0b0c0d0e0f"), xtype='standard').to_xpub()
+        ks = keystore.from_xpub(xpub)
+        pubkeys = ks.derive_pubkeys(0, 0, 25)
+        self.assertEqual(10, len(ks._derived_pubkeys))
+        self.assertEqual(pubkeys, [ks.derive_pubkey(0, n) for n in range(25)])
+        self.assertEqual(10, len(ks._derived_pubkeys))
+        self.assertEqual(Xpub.get_pubkey_from_xpub(xpub, (1, 3)), ks.derive_pubkey(1, 3))
+
+    def test_add_tweaks(self):
+        pubkey = ecc.ECPrivkey(bytes([1] * 32)).get_public_key_bytes(compressed=True)
+        tweaks = [bytes([2] * 32), ecc.CURVE_ORDER.to_bytes(32, 'big'), bytes([3] * 32)]
+        self.assertEqual([(ecc.ECPrivkey(tweaks[0]) + ecc.ECPubkey(pubkey)).get_public_key_bytes(),
+                          None,
+                          (ecc.ECPrivkey(tweaks[2]) + ecc.ECPubkey(pubkey)).get_public_key_bytes()],
+                         ecc.ECPubkey(pubkey).add_tweaks(tweaks))
+        # the sum is the point at infinity
+        minus_one = (ecc.CURVE_ORDER - 1).to_bytes(32, 'big')
+        self.assertEqual([None], ecc.GENERATOR.add_tweaks([minus_one]))
+
     def test_xpub_from_xprv(self):
         """We can derive the xpub key from a xprv."""
         for xprv_details in self.xprv_xpub:
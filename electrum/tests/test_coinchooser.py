@@ -1,4 +1,9 @@
-from electrum.coinchooser import CoinChooserPrivacy
+import random
+
+from electrum import coinchooser
+from electrum.bitcoin import hash160_to_p2pkh
+from electrum.coinchooser import CoinChooserPrivacy, CoinChooserBranchAndBound, SenderNoUTXOException
+from electrum.transaction import PartialTxInput, PartialTxOutput, TxOutpoint
 from electrum.util import NotEnoughFunds
 
 from . import ElectrumTestCase
@@ -18,3 +23,84 @@ class TestCoinChooser(ElectrumTestCase):
             coin_chooser.bucket_candidates_any([], sufficient_funds)
         with self.assertRaises(NotEnoughFunds):
             coin_chooser.bucket_candidates_prefer_confirmed([], sufficient_funds)
+
+
+class TestCoinChooserBranchAndBound(ElectrumTestCase):
+
+    addresses = [hash160_to_p2pkh(bytes([i]) * 20) for i in range(3)]
+
+    def make_coin(self, value: int, address: str, *, height=100) -> PartialTxInput:
+        coin = PartialTxInput(prevout=TxOutpoint(txid=bytes([value % 256]) * 32, out_idx=value // 256))
+        coin._trusted_address = address
+        coin._trusted_value_sats = value
+        coin.block_height = height
+        return coin
+
+    def make_tx(self, coins, amount, *, sender=None, fee=1000):
+        chooser = CoinChooserBranchAndBound(enable_output_value_rounding=False)
+        return chooser.make_tx(coins=coins,
+                               inputs=[],
+                               outputs=[PartialTxOutput.from_address_and_value(self.addresses[2], amount)],
+                               change_addrs=[self.addresses[2]],
+                               fee_estimator_vb=lambda size: fee,
+                               dust_threshold=546,
+                               sender=sender)
+
+    def test_branch_and_bound(self):
+        values = [90, 70, 50, 40, 25, 10]
+        selection = coinchooser.branch_and_bound(values, 85, 85, max_tries=1000, deadline=float('inf'))
+        self.assertEqual(85, sum(values[i] for i in selection))
+        selection = coinchooser.branch_and_bound(values, 84, 86, max_tries=1000, deadline=float('inf'))
+        self.assertEqual(85, sum(values[i] for i in selection))
+        self.assertIsNone(coinchooser.branch_and_bound(values, 81, 84, max_tries=1000, deadline=float('inf')))
+        self.assertIsNone(coinchooser.branch_and_bound(values, 300, 400, max_tries=1000, deadline=float('inf')))
+        # many equal values
+        values = [10] * 100 + [1]
+        selection = coinchooser.branch_and_bound(values, 501, 501, max_tries=10000, deadline=float('inf'))
+        self.assertEqual(501, sum(values[i] for i in selection))
+
+    def test_approximate_best_subset(self):
+        rng = random.Random(0)
+        values = [90, 70, 50, 40, 25, 10]
+        selection = coinchooser.approximate_best_subset(values, 86, rng=rng, iterations=1000, deadline=float('inf'))
+        self.assertEqual(90, sum(values[i] for i in selection))
+        selection = coinchooser.approximate_best_subset(values, 130, rng=rng, iterations=1000, deadline=float('inf'))
+        self.assertEqual(130, sum(values[i] for i in selection))
+        selection = coinchooser.approximate_best_subset(values, 91, rng=rng, iterations=1000, deadline=float('inf'))
+        self.assertEqual(95, sum(values[i] for i in selection))
+        self.assertEqual([0], coinchooser.approximate_best_subset(values, 88, rng=rng, iterations=1000,
+                                                                  deadline=float('inf')))
+        self.assertIsNone(coinchooser.approximate_best_subset(values, 300, rng=rng, iterations=1000,
+                                                              deadline=float('inf')))
+
+    def test_make_tx_without_change(self):
+        coins = [self.make_coin(value, address)
+                 for value, address in ((500000, self.addresses[0]), (300000, self.addresses[1]),
+                                        (100000, self.addresses[1]), (1200000, self.addresses[0]))]
+        # coins of an address are spent together
+        tx = self.make_tx(coins, 399000)
+        self.assertEqual([(400000, self.addresses[1])], [(sum(c.value_sats() for c in tx.inputs()), a)
+                                                         for a in {c.address for c in tx.inputs()}])
+        self.assertEqual(1, len(tx.outputs()))
+        self.assertEqual(1000, tx.get_fee())
+        # nothing adds up without change
+        tx = self.make_tx(coins, 1000000)
+        self.assertEqual(2, len(tx.outputs()))
+        self.assertEqual(1000, tx.get_fee())
+        self.assertEqual({self.addresses[0]}, {c.address for c in tx.inputs()})
+        with self.assertRaises(NotEnoughFunds):
+            self.make_tx(coins, 2100000)
+
+    def test_make_tx_prefers_confirmed_coins(self):
+        coins = [self.make_coin(400000, self.addresses[0], height=0),
+                 self.make_coin(600000, self.addresses[1])]
+        tx = self.make_tx(coins, 399000)
+        self.assertEqual({self.addresses[1]}, {c.address for c in tx.inputs()})
+
+    def test_make_tx_with_sender(self):
+        coins = [self.make_coin(500000, self.addresses[0]), self.make_coin(200000, self.addresses[1])]
+        # the coin of the sender is spent, even if not needed
+        tx = self.make_tx(coins, 399000, sender=self.addresses[1])
+        self.assertEqual({self.addresses[0], self.addresses[1]}, {c.address for c in tx.inputs()})
+        with self.assertRaises(SenderNoUTXOException):
+            self.make_tx(coins, 399000, sender=self.addresses[2])
@@ -0,0 +1,393 @@
+import os
+import math
+import sqlite3
+
+from electrum import constants, blockchain
+from electrum.blockchain import (Blockchain, BlockHeader, InvalidHeader, deserialize_header, hash_header,
+                                 hash_raw_header, serialize_header, mul_exp, POW_BLOCK_COUNT, CHUNK_SIZE)
+from electrum.header_store import HeaderStore
+from electrum.crypto import sha256d
+from electrum.simple_config import SimpleConfig
+from electrum.util import bh2u, make_dir
+
+from . import ElectrumTestCase
+
+
+def make_raw_header(height: int) -> bytes:
+    sig = bytes([height % 256]) * 65
+    return (height.to_bytes(4, 'little')
+            + bytes(32) * 2
+            + bytes(12)
+            + bytes(32) * 3
+            + (0xffffffff).to_bytes(4, 'little')
+            + bytes([len(sig)]) + sig)
+
+
+class TestHeaderStore(ElectrumTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.path = os.path.join(self.electrum_path, 'blockchain_headers')
+        self.store = HeaderStore(self.path, deserialize_header, cache_size=4)
+        self.store.write_many((h, make_raw_header(h)) for h in range(10))
+
+    def tearDown(self):
+        self.store.close()
+        super().tearDown()
+
+    def test_raw_header_roundtrip(self):
+        raw = make_raw_header(7)
+        self.assertEqual(bh2u(raw), serialize_header(deserialize_header(raw, 7)))
+
+    def test_read(self):
+        self.assertEqual(10, self.store.count())
+        self.assertEqual((0, 9), tuple(self.store.min_max_height()))
+        self.assertEqual(make_raw_header(3), self.store.read_raw(3))
+        self.assertEqual(deserialize_header(make_raw_header(3), 3), self.store.read_header(3))
+        self.assertEqual(hash_raw_header(bh2u(make_raw_header(3))), self.store.get_hash(3))
+        self.assertIsNone(self.store.read_raw(10))
+        self.assertIsNone(self.store.read_header(10))
+
+    def test_read_header_returns_copy(self):
+        self.store.read_header(3)['bits'] = 42
+        self.assertEqual(0, self.store.read_header(3)['bits'])
+
+    def test_cache_is_bounded(self):
+        for h in range(10):
+            self.store.read_header(h)
+        self.assertEqual(4, len(self.store._headers))
+        self.assertEqual(4, len(self.store._heights))
+
+    def test_get_height(self):
+        header_hash = self.store.get_hash(5)
+        self.assertEqual(5, self.store.get_height(header_hash))
+        self.store.write(5, make_raw_header(50))
+        self.assertIsNone(self.store.get_height(header_hash))
+        self.assertIsNone(self.store.get_height('00' * 32))
+
+    def test_write_invalidates_cache(self):
+        self.store.read_header(5)
+        self.store.write(5, make_raw_header(50))
+        self.assertEqual(make_raw_header(50), self.store.read_raw(5))
+        self.store.delete(5)
+        self.assertIsNone(self.store.read_header(5))
+        self.store.delete_all()
+        self.assertIsNone(self.store.read_header(6))
+        self.assertEqual(0, self.store.count())
+
+    def test_read_range(self):
+        self.store.delete(5)
+        rows = self.store.read_range(3, 5)
+        self.assertEqual([3, 4, 6, 7], [height for height, _ in rows])
+        self.assertEqual(make_raw_header(6), rows[2][1])
+        self.assertEqual([], self.store.read_range(20, 5))
+        self.assertEqual([], self.store.read_range(3, 0))
+
+    def test_count_is_tracked(self):
+        self.store.write_many((h, make_raw_header(h)) for h in range(5, 15))
+        self.assertEqual(15, self.store.count())
+        self.store.write(3, make_raw_header(30))
+        self.store.write(15, make_raw_header(15))
+        self.assertEqual(16, self.store.count())
+        self.store.write_many([(1, make_raw_header(1)), (20, make_raw_header(20))])
+        self.assertEqual(17, self.store.count())
+        self.store.delete(15)
+        self.store.delete(15)
+        self.assertEqual(16, self.store.count())
+        self.store.commit()
+        self.assertEqual(16, self.store.conn.execute('SELECT COUNT(*) FROM header').fetchone()[0])
+
+    def test_wal_mode(self):
+        self.assertEqual('wal', self.store.conn.execute('PRAGMA journal_mode').fetchone()[0])
+
+    def test_single_writes_are_committed_in_batches(self):
+        self.store.commit_interval = 3
+        other = sqlite3.connect(self.path)
+        count = lambda: other.execute('SELECT COUNT(*) FROM header').fetchone()[0]
+        self.store.write(10, make_raw_header(10))
+        self.store.write(11, make_raw_header(11))
+        self.assertEqual(10, count())
+        self.assertEqual(12, self.store.count())
+        self.store.write(12, make_raw_header(12))
+        self.assertEqual(13, count())
+        self.store.write(13, make_raw_header(13))
+        self.store.write_many([(14, make_raw_header(14))])
+        self.assertEqual(15, count())
+        self.store.delete(14)
+        self.store.commit()
+        self.assertEqual(14, count())
+        other.close()
+
+    def test_reopen(self):
+        self.store.close()
+        self.store = HeaderStore(self.path, deserialize_header)
+        self.assertEqual(10, self.store.count())
+        self.assertEqual(make_raw_header(9), self.store.read_raw(9))
+
+
+class TestBlockchainHeaderReads(ElectrumTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        constants.set_regtest()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        constants.set_mainnet()
+
+    def setUp(self):
+        super().setUp()
+        make_dir(os.path.join(self.electrum_path, 'forks'))
+        self.config = SimpleConfig({'electrum_path': self.electrum_path})
+        blockchain.blockchains = {}
+        self.raw_headers = [make_raw_header(h) for h in range(30)]
+        self.chain = Blockchain(config=self.config, forkpoint=0, parent=None,
+                                forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        self.chain.save_chunk(0, self.raw_headers)
+
+    def test_read_headers(self):
+        self.assertEqual(29, self.chain.height())
+        self.assertEqual(self.raw_headers[25:], self.chain.read_headers(25, 10, deserialize=False))
+        self.assertEqual([deserialize_header(self.raw_headers[h], h) for h in range(3, 6)],
+                         self.chain.read_headers(3, 3))
+        self.assertEqual(hash_raw_header(bh2u(self.raw_headers[5])), self.chain.get_hash(5))
+
+    def test_read_headers_spans_parent(self):
+        fork = Blockchain(config=self.config, forkpoint=20, parent=self.chain,
+                          forkpoint_hash=hash_raw_header(bh2u(make_raw_header(120))),
+                          prev_hash=self.chain.get_hash(19))
+        fork.write(make_raw_header(120), 20)
+        self.assertEqual(20, fork.height())
+        self.assertEqual(self.raw_headers[18:20] + [make_raw_header(120)],
+                         fork.read_headers(18, 4, deserialize=False))
+        self.assertEqual(self.chain.get_hash(10), fork.get_hash(10))
+        fork.store.close()
+
+    def test_verify_chunk(self):
+        raw_headers = []
+        prev_hash = bytes(32)
+        for height in range(10):
+            raw = bytearray(make_raw_header(height))
+            raw[4:36] = prev_hash
+            raw_headers.append(bytes(raw))
+            prev_hash = sha256d(raw)
+        self.chain.verify_chunk(0, raw_headers)
+        raw_headers[5] = make_raw_header(5)
+        with self.assertRaises(Exception):
+            self.chain.verify_chunk(0, raw_headers)
+
+
+class TestHashIndex(ElectrumTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        constants.set_regtest()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        constants.set_mainnet()
+
+    def setUp(self):
+        super().setUp()
+        make_dir(os.path.join(self.electrum_path, 'forks'))
+        self.config = SimpleConfig({'electrum_path': self.electrum_path})
+        blockchain.blockchains = {}
+        self.raw_headers = [make_raw_header(h) for h in range(30)]
+        self.chain = self._add_chain(forkpoint=0, parent=None, forkpoint_hash=constants.net.GENESIS)
+        self.chain.save_chunk(0, self.raw_headers)
+
+    def tearDown(self):
+        for chain in blockchain.blockchains.values():
+            chain.store.close()
+        super().tearDown()
+
+    def _add_chain(self, forkpoint, parent, forkpoint_hash):
+        chain = Blockchain(config=self.config, forkpoint=forkpoint, parent=parent,
+                           forkpoint_hash=forkpoint_hash,
+                           prev_hash=parent.get_hash(forkpoint - 1) if parent else None)
+        blockchain.blockchains[chain.get_id()] = chain
+        return chain
+
+    def _header(self, raw_header, height):
+        return deserialize_header(raw_header, height)
+
+    def test_check_header(self):
+        self.assertIs(self.chain, blockchain.check_header(self._header(self.raw_headers[7], 7)))
+        self.assertIsNone(blockchain.check_header(self._header(self.raw_headers[7], 8)))
+        self.assertIsNone(blockchain.check_header(self._header(make_raw_header(100), 7)))
+
+    def test_chains_that_contain_header(self):
+        fork = self._add_chain(forkpoint=20, parent=self.chain,
+                               forkpoint_hash=hash_raw_header(bh2u(make_raw_header(120))))
+        fork.write(make_raw_header(120), 20)
+        fork.write(make_raw_header(121), 21)
+        below_fork = hash_raw_header(bh2u(self.raw_headers[15]))
+        self.assertEqual({self.chain, fork},
+                         set(blockchain.get_chains_that_contain_header(15, below_fork)))
+        on_fork = hash_raw_header(bh2u(make_raw_header(121)))
+        self.assertEqual([fork], blockchain.get_chains_that_contain_header(21, on_fork))
+        self.assertIs(fork, blockchain.check_header(self._header(make_raw_header(121), 21)))
+        fork.delete(21)
+        self.assertEqual([], blockchain.get_chains_that_contain_header(21, on_fork))
+        self.assertIsNone(blockchain.check_header(self._header(make_raw_header(121), 21)))
+
+    def test_overwritten_header(self):
+        self.chain.write(make_raw_header(110), 10)
+        self.assertIsNone(blockchain.check_header(self._header(self.raw_headers[10], 10)))
+        self.assertIs(self.chain, blockchain.check_header(self._header(make_raw_header(110), 10)))
+
+    def test_removed_chain_is_ignored(self):
+        blockchain.blockchains = {}
+        self.assertIsNone(blockchain.check_header(self._header(self.raw_headers[7], 7)))
+        blockchain.blockchains[self.chain.get_id()] = self.chain
+
+    def test_headers_below_index_window(self):
+        window = blockchain.HASH_INDEX_WINDOW
+        blockchain.HASH_INDEX_WINDOW = 5
+        try:
+            self.chain.store.close()
+            chain = self._add_chain(forkpoint=0, parent=None, forkpoint_hash=constants.net.GENESIS)
+            self.assertEqual(25, chain._index_start)
+            self.assertEqual(list(range(25, 30)), sorted(chain._hashes))
+            # headers below the indexed window are still found
+            self.assertIs(chain, blockchain.check_header(self._header(self.raw_headers[3], 3)))
+            self.assertIs(chain, blockchain.check_header(self._header(self.raw_headers[27], 27)))
+            # the index stays bounded as the chain grows
+            for height in range(30, 45):
+                chain.write(make_raw_header(height), height)
+            self.assertLessEqual(len(chain._hashes), 2 * blockchain.HASH_INDEX_WINDOW)
+            self.assertIs(chain, blockchain.check_header(self._header(make_raw_header(44), 44)))
+            self.assertIs(chain, blockchain.check_header(self._header(make_raw_header(31), 31)))
+        finally:
+            blockchain.HASH_INDEX_WINDOW = window
+
+
+class TestBlockHeader(ElectrumTestCase):
+
+    def test_fields_match_dict(self):
+        raw = bytes(range(180)) + bytes([65]) + bytes(range(65))
+        header = BlockHeader(raw, 1234)
+        d = deserialize_header(raw, 1234)
+        self.assertEqual(d, header.to_dict())
+        for key, value in d.items():
+            self.assertEqual(value, header[key])
+            self.assertEqual(value, header.get(key))
+        self.assertEqual(hash_header(d), header.hash)
+        self.assertEqual(hash_header(d), hash_header(header))
+        self.assertIsNone(header.get('raw'))
+        self.assertNotIn('raw', header)
+        with self.assertRaises(KeyError):
+            header['raw']
+
+    def test_is_pos(self):
+        pow_header = BlockHeader(make_raw_header(3), 3)
+        self.assertFalse(pow_header.is_pos())
+        self.assertEqual(Blockchain.is_pos(pow_header.to_dict()), pow_header.is_pos())
+        raw = bytearray(make_raw_header(3))
+        raw[150] = 1
+        pos_header = BlockHeader(bytes(raw), 3)
+        self.assertTrue(pos_header.is_pos())
+        self.assertTrue(Blockchain.is_pos(pos_header.to_dict()))
+
+    def test_invalid_header(self):
+        with self.assertRaises(InvalidHeader):
+            BlockHeader(bytes(80), 0)
+
+
+class TestTargets(ElectrumTestCase):
+
+    BITS = (0x1a0fffff, 0x1d00ffff, 0x1b0404cb, 0x1a008000)
+
+    def _check_integer_path(self, heights, max_spacing):
+        for bits in self.BITS:
+            for spacing in range(max_spacing):
+                prev_header = {'bits': bits, 'timestamp': 1000 + spacing}
+                pprev_header = {'bits': bits, 'timestamp': 1000}
+                for height in heights:
+                    self.assertEqual(
+                        Blockchain.calculate_target(height, True, prev_header, pprev_header),
+                        Blockchain.calculate_target_integer(height, True, prev_header, pprev_header),
+                        (hex(bits), spacing, height))
+
+    def test_integer_path_matches_float_path(self):
+        net = constants.net
+        self._check_integer_path([net.REDUCE_BLOCK_TIME_HEIGHT + 10, POW_BLOCK_COUNT + 10], 700)
+
+    def test_integer_path_matches_float_path_qip9(self):
+        class Qip9Net(constants.net):
+            QIP9_FORK_HEIGHT = 100
+            REDUCE_BLOCK_TIME_HEIGHT = 10 ** 9
+        mainnet, constants.net = constants.net, Qip9Net
+        try:
+            self._check_integer_path([500], 2500)
+        finally:
+            constants.net = mainnet
+
+    def test_mul_exp(self):
+        target = 1 << 220
+        for n, d in ((0, 5), (1, 5), (-1, 5), (37, 3), (-37, 3), (-250, 62), (600, 62)):
+            self.assertAlmostEqual(target * math.exp(n / d) / mul_exp(target, n, d), 1, places=12)
+
+
+class TestTargetCache(ElectrumTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        constants.set_mainnet()
+
+    def setUp(self):
+        super().setUp()
+        make_dir(os.path.join(self.electrum_path, 'forks'))
+        self.config = SimpleConfig({'electrum_path': self.electrum_path})
+        blockchain.blockchains = {}
+        self.chain = Blockchain(config=self.config, forkpoint=0, parent=None,
+                                forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        self.height = POW_BLOCK_COUNT + 10
+        self.chain.save_chunk(0, [self._raw_header(h, 32 * h) for h in range(self.height)])
+        self.reads = 0
+        read_header = self.chain.read_header
+        def counting_read_header(*args, **kwargs):
+            self.reads += 1
+            return read_header(*args, **kwargs)
+        self.chain.read_header = counting_read_header
+
+    def tearDown(self):
+        self.chain.store.close()
+        super().tearDown()
+
+    def _raw_header(self, height, timestamp):
+        raw = bytearray(make_raw_header(height))
+        raw[68:72] = (1600000000 + timestamp).to_bytes(4, 'little')
+        raw[72:76] = (0x1a0fffff).to_bytes(4, 'little')
+        return bytes(raw)
+
+    def test_targets_are_cached(self):
+        target = self.chain.get_target(self.height, is_pos=True)
+        self.assertEqual(2, self.reads)
+        self.assertEqual(target, self.chain.get_target(self.height, is_pos=True))
+        self.assertEqual(2, self.reads)
+
+    def test_write_invalidates(self):
+        target = self.chain.get_target(self.height, is_pos=True)
+        self.chain.write(self._raw_header(self.height - 1, 32 * self.height + 300), self.height - 1)
+        new_target = self.chain.get_target(self.height, is_pos=True)
+        self.assertEqual(4, self.reads)
+        self.assertNotEqual(target, new_target)
+        self.chain.delete(self.height - 1)
+        with self.assertRaises(Exception):
+            self.chain.get_target(self.height, is_pos=True)
+
+    def test_verified_chunk_fills_cache(self):
+        index = self.height // CHUNK_SIZE
+        raw_headers = [self._raw_header(h, 32 * h) for h in range(index * CHUNK_SIZE, self.height + 5)]
+        targets = {(h, True): 42 for h in range(self.height, self.height + 5)}
+        self.chain.save_chunk(index, raw_headers, targets=targets)
+        self.assertEqual(42, self.chain.get_target(self.height + 2, is_pos=True))
+        self.assertEqual(0, self.reads)
+        self.chain.clear_target_cache()
+        self.assertNotEqual(42, self.chain.get_target(self.height + 2, is_pos=True))
@@ -1,10 +1,14 @@
 from pprint import pprint
+import json
 import unittest
+from unittest import mock
 from typing import NamedTuple
 
-from electrum.lnutil import RECEIVED, LOCAL, REMOTE, SENT, HTLCOwner, Direction
+from electrum import lnhtlc
+from electrum.lnutil import RECEIVED, LOCAL, REMOTE, SENT, HTLCOwner, Direction, UpdateAddHtlc
 from electrum.lnhtlc import HTLCManager
 from electrum.json_db import StoredDict
+from electrum.util import MyEncoder
 
 from . import ElectrumTestCase
 
@@ -246,3 +250,80 @@ class TestHTLCManager(ElectrumTestCase):
         B.send_rev()
         A.recv_rev()
         self.assertEqual({2: [b"upd_msg2"]}, A.get_unacked_local_updates())
+
+    @mock.patch.object(lnhtlc, 'HTLC_INDEX_CHECKPOINT_INTERVAL', 3)
+    def test_archived_htlcs(self):
+        A = HTLCManager(StoredDict({}, None, []))
+        B = HTLCManager(StoredDict({}, None, []))
+        A.channel_open_finished()
+        B.channel_open_finished()
+        def htlc(htlc_id):
+            return UpdateAddHtlc(amount_msat=1000 * (htlc_id + 1), payment_hash=bytes(32), cltv_expiry=500,
+                                 timestamp=0, htlc_id=htlc_id)
+        def commit(X, Y):
+            X.send_ctx()
+            Y.recv_ctx()
+            Y.send_rev()
+            X.recv_rev()
+        def expected_htlcs(hm, subject, direction, ctn):
+            party = subject if direction == SENT else subject.inverted()
+            return {htlc_id: hm.get_htlc_by_id(party, htlc_id)
+                    for htlc_id in range(hm.get_next_htlc_id(party))
+                    if hm.is_htlc_active_at_ctn(ctx_owner=subject, ctn=ctn, htlc_proposer=party, htlc_id=htlc_id)}
+        def expected_removed(hm, subject, party, log_action, ctn):
+            removed = [int(htlc_id) for htlc_id, ctns in hm.log[party][log_action].items() if ctns[subject] == ctn]
+            removed += [int(htlc_id) for htlc_id, archived in hm.log[party]['archived_htlcs'].items()
+                        if archived.settled == (log_action == 'settles') and archived.removed(subject) == ctn]
+            return sorted(removed)
+        # A offers htlc i, B offers htlc i; two rounds later, A's gets settled and B's gets failed
+        for i in range(12):
+            B.recv_htlc(A.send_htlc(htlc(i)))
+            A.recv_htlc(B.send_htlc(htlc(i)))
+            if i >= 2:
+                B.send_settle(i - 2)
+                A.recv_settle(i - 2)
+                A.send_fail(i - 2)
+                B.recv_fail(i - 2)
+            commit(A, B)
+            commit(B, A)
+            if i == 5:  # build the index of old ctns halfway
+                self.assertEqual(expected_htlcs(A, REMOTE, RECEIVED, 3), A.htlcs_by_direction(REMOTE, RECEIVED, 3))
+        for i in range(2):
+            commit(A, B)
+            commit(B, A)
+        # resolved htlcs are archived
+        for hm in (A, B):
+            self.assertEqual(10, len(hm.log[LOCAL]['archived_htlcs']))
+            self.assertEqual(10, len(hm.log[REMOTE]['archived_htlcs']))
+            self.assertEqual(2, len(hm.log[LOCAL]['adds']))
+            self.assertEqual(2, len(hm.log[REMOTE]['adds']))
+            self.assertEqual(0, len(hm.log[LOCAL]['fails']) + len(hm.log[LOCAL]['settles']))
+        self.assertTrue(A.was_htlc_preimage_released(htlc_id=0, htlc_proposer=LOCAL))
+        self.assertFalse(A.was_htlc_failed(htlc_id=0, htlc_proposer=LOCAL))
+        self.assertTrue(A.was_htlc_failed(htlc_id=0, htlc_proposer=REMOTE))
+        self.assertEqual([(SENT, htlc(i)) for i in range(10)], A.all_htlcs_with_preimage_released())
+        self.assertEqual([(RECEIVED, htlc(i)) for i in range(10)], B.all_htlcs_with_preimage_released())
+        # queries at old ctns, incrementally indexed, and indexed from the log
+        for hm, settled_direction in ((A, SENT), (B, RECEIVED), (HTLCManager(A.log), SENT), (HTLCManager(B.log), RECEIVED)):
+            for subject in (LOCAL, REMOTE):
+                for ctn in range(hm.ctn_latest(subject) + 2):
+                    for direction in (SENT, RECEIVED):
+                        self.assertEqual(expected_htlcs(hm, subject, direction, ctn),
+                                         hm.htlcs_by_direction(subject, direction, ctn))
+                    for party in (LOCAL, REMOTE):
+                        for log_action in ('settles', 'fails'):
+                            self.assertEqual(expected_removed(hm, subject, party, log_action, ctn),
+                                             sorted(hm._get_htlc_ids_removed_exactly_at_ctn(
+                                                 ctn, ctx_owner=subject, htlc_proposer=party, log_action=log_action)))
+                    settled_sent = sum(htlc.amount_msat for htlc in hm.all_settled_htlcs_ever_by_direction(subject, SENT, ctn))
+                    settled_received = sum(htlc.amount_msat for htlc in hm.all_settled_htlcs_ever_by_direction(subject, RECEIVED, ctn))
+                    self.assertEqual(10**9 - settled_sent + settled_received,
+                                     hm.get_balance_msat(subject, ctx_owner=subject, ctn=ctn, initial_balance_msat=10**9))
+            self.assertEqual(sum(1000 * (i + 1) for i in range(10)),
+                             sum(htlc.amount_msat for htlc in hm.all_settled_htlcs_ever_by_direction(LOCAL, settled_direction)))
+        # htlcs removed at an old ctn
+        archived = A.log[LOCAL]['archived_htlcs'][0]
+        self.assertEqual([htlc(0)], A.sent_in_ctn(archived.removed_remote))
+        self.assertEqual([htlc(0)], B.failed_in_ctn(B.log[LOCAL]['archived_htlcs'][0].removed_remote))
+        archived = A.log[LOCAL]['archived_htlcs'][0]
+        self.assertEqual(archived, lnhtlc.ArchivedHtlc.from_json(json.loads(json.dumps(archived, cls=MyEncoder))))
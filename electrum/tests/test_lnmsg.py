@@ -3,7 +3,7 @@ import io
 from electrum.lnmsg import (read_bigsize_int, write_bigsize_int, FieldEncodingNotMinimal,
                             UnexpectedEndOfStream, LNSerializer, UnknownMandatoryTLVRecordType,
                             MalformedMsg, MsgTrailingGarbage, MsgInvalidFieldOrder, encode_msg,
-                            decode_msg, UnexpectedFieldSizeForEncoder)
+                            decode_msg, UnexpectedFieldSizeForEncoder, CompiledLNSerializer)
 from electrum.util import bfh
 from electrum.lnutil import ShortChannelID, LnFeatures
 from electrum import constants
@@ -383,3 +383,137 @@ class TestLNMsg(TestCaseForTestnet):
                                   {'chains': b'CI\x7f\xd7\xf8&\x95q\x08\xf4\xa3\x0f\xd9\xce\xc3\xae\xbay\x97 \x84\xe9\x0e\xad\x01\xea3\t\x00\x00\x00\x00'}
                           }}),
                          decode_msg(bfh("001000022200000302aaa2012043497fd7f826957108f4a30fd9cec3aeba79972084e90ead01ea330900000000")))
+
+
+class TestCompiledLNSerializer(TestCaseForTestnet):
+    # the test vectors of TestLNMsg, to check CompiledLNSerializer against LNSerializer
+    TLV_STREAM_VECTORS = [
+        "fd",
+        "fd01",
+        "fd000100",
+        "fd0101",
+        "0ffd",
+        "0ffd26",
+        "0ffd2602",
+        "0ffd000100",
+        "0ffd0201000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000",
+        "1200",
+        "fd010200",
+        "fe0100000200",
+        "ff010000000000000200",
+        "0109ffffffffffffffffff",
+        "010100",
+        "01020001",
+        "0103000100",
+        "010400010000",
+        "01050001000000",
+        "0106000100000000",
+        "010700010000000000",
+        "01080001000000000000",
+        "020701010101010101",
+        "0209010101010101010101",
+        "0321023da092f6980e58d2c037173180e9a465476026ee50f96695963e8efe436f54eb",
+        "0329023da092f6980e58d2c037173180e9a465476026ee50f96695963e8efe436f54eb0000000000000001",
+        "0330023da092f6980e58d2c037173180e9a465476026ee50f96695963e8efe436f54eb000000000000000100000000000001",
+        "0331043da092f6980e58d2c037173180e9a465476026ee50f96695963e8efe436f54eb00000000000000010000000000000002",
+        "0332023da092f6980e58d2c037173180e9a465476026ee50f96695963e8efe436f54eb0000000000000001000000000000000001",
+        "fd00fe00",
+        "fd00fe0101",
+        "fd00fe03010101",
+        "0000",
+        "",
+        "2100",
+        "fd020100",
+        "fd00fd00",
+        "fd00ff00",
+        "fe0200000100",
+        "ff020000000000000100",
+        "0100",
+        "010101",
+        "01020100",
+        "0103010000",
+        "010401000000",
+        "01050100000000",
+        "0106010000000000",
+        "010701000000000000",
+        "01080100000000000000",
+        "02080000000000000226",
+        "023da092f6980e58d2c037173180e9a465476026ee50f96695963e8efe436f54eb",
+        "0331023da092f6980e58d2c037173180e9a465476026ee50f96695963e8efe436f54eb00000000000000010000000000000002",
+        "fd00fe020226",
+        "0208000000000000022601012a",
+        "0208000000000000023102080000000000000451",
+        "1f000f012a",
+        "1f001f012a",
+        "ffffffffffffffffff000000",
+    ]
+    MSG_VECTORS = [
+        "01020000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000043497fd7f826957108f4a30fd9cec3aeba79972084e90ead01ea33090000000000d43100006f00025e6ed0830100009000000000000000c8000001f400000023000000003b9aca00",
+        "01020000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000043497fd7f826957108f4a30fd9cec3aeba79972084e90ead01ea33090000000000d43100006f00025e6ed0830100009000000000000000c8000001f400000023",
+        "0084010101010101010101010101010101010101010101010101010101010101010106112951d0a6d7fc1dbca3bd1cdbda9acfee7f668b3c0a36bd944f7e2f305b274ba46a61279e15163b2d376c664bb3481d7c5e107a5b268301e39aebbda27d2d00056548bd093a2bd2f4f053f0c6eb2c5f541d55eb8a2ede4d35fe974e5d3cd0eec3138bfd4115f4483c3b14e7988b48811d2da75f29f5e6eee691251fb4fba5a2610ba8fe7007117fe1c9fa1a6b01805c84cfffbb0eba674b64342c7cac567dea50728c1bb1aadc6d23fc2f4145027eafca82d6072cc9ce6529542099f728a0521e4b2044df5d02f7f2cdf84404762b1979528aa689a3e060a2a90ba8ef9a83d24d31ffb0d95c71d9fb9049b24ecf2c949c1486e7eb3ae160d70d54e441dc785dc57f7f3c9901b9537398c66f546cfc1d65e0748895d14699342c407fe119ac17db079b103720124a5ba22d4ba14c12832324dea9cb60c61ee74376ee7dcffdd1836e354aa8838ce3b37854fa91465cc40c73b702915e3580bfebaace805d52373b57ac755ebe4a8fe97e5fc21669bea124b809c79968479148f7174f39b8014542",
+        "008401010101010101010101010101010101010101010101010101010101010101013b14af0c549dfb1fb287ff57c012371b3932996db5929eda5f251704751fb49d0dc2dcb88e5021575cb572fb71693758543f97d89e9165f913bfb7488d7cc26500012d31103b9f6e71131e4fee86fdfbdeba90e52b43fcfd11e8e53811cd4d59b2575ae6c3c82f85bea144c88cc35e568f1e6bdd0c57337e86de0b5da7cd9994067a",
+        "008401010101010101010101010101010101010101010101010101010101010101014e206ecf904d9237b1c5b4e08513555e9a5932c45b5f68be8764ce998df635ae04f6ce7bbcd3b4fd08e2daab7f9059b287ecab4155367b834682633497173f450000",
+        "001000022200000302a2a1",
+        "001000022200000302aaa2012043497fd7f826957108f4a30fd9cec3aeba79972084e90ead01ea330900000000",
+    ]
+
+
+    def setUp(self):
+        super().setUp()
+        self.reference = LNSerializer()
+        self.compiled = CompiledLNSerializer()
+
+    def assert_same_result(self, func):
+        try:
+            expected = func(self.reference)
+        except Exception as e:
+            with self.assertRaises(type(e)):
+                func(self.compiled)
+        else:
+            self.assertEqual(expected, func(self.compiled))
+
+    def test_read_tlv_stream(self):
+        for tlv_stream_name in ("n1", "n2"):
+            for hex_data in self.TLV_STREAM_VECTORS:
+                with self.subTest(tlv_stream_name=tlv_stream_name, data=hex_data[:40]):
+                    self.assert_same_result(lambda lnser: lnser.read_tlv_stream(fd=io.BytesIO(bfh(hex_data)),
+                                                                                tlv_stream_name=tlv_stream_name))
+
+    def test_decode_msg(self):
+        for hex_data in self.MSG_VECTORS:
+            data = bfh(hex_data)
+            # and every truncation, for the handling of optional fields and of errors
+            for i in range(2, len(data) + 1):
+                with self.subTest(data=hex_data[:40], length=i):
+                    self.assert_same_result(lambda lnser: lnser.decode_msg(data[:i]))
+
+    def test_encode_msg(self):
+        for hex_data in self.MSG_VECTORS:
+            with self.subTest(data=hex_data[:40]):
+                msg_type, payload = self.reference.decode_msg(bfh(hex_data))
+                self.assertEqual(self.reference.encode_msg(msg_type, **payload),
+                                 self.compiled.encode_msg(msg_type, **payload))
+                for field in payload:
+                    # missing fields are set to zeroes, or end the msg if optional
+                    partial_payload = {k: v for k, v in payload.items() if k != field}
+                    self.assert_same_result(lambda lnser: lnser.encode_msg(msg_type, **partial_payload))
+        kwargs = dict(gflen=0, flen=2, features=(LnFeatures.OPTION_STATIC_REMOTEKEY_OPT |
+                                                 LnFeatures.GOSSIP_QUERIES_OPT),
+                      init_tlvs={'networks': {'chains': bytes(32)}})
+        self.assert_same_result(lambda lnser: lnser.encode_msg("init", **kwargs))
+        kwargs['flen'] = 3
+        self.assert_same_result(lambda lnser: lnser.encode_msg("init", **kwargs))
+        self.assert_same_result(lambda lnser: lnser.encode_msg("update_fee", channel_id=bytes(31), feerate_per_kw=1))
+        self.assert_same_result(lambda lnser: lnser.encode_msg("update_fee", channel_id=bytes(32), feerate_per_kw='1'))
+
+    def test_write_tlv_stream(self):
+        for kwargs in ({}, {'tlv1': {'amount_msat': 1}}, {'tlv1': {'amount_msat': 0}},
+                       {'tlv1': {'amount_msat': 2**40}, 'tlv4': {'cltv_delta': 550}},
+                       {'tlv2': {'scid': bytes(8)}, 'tlv3': {'node_id': bytes(33), 'amount_msat_1': 1, 'amount_msat_2': 2}},
+                       {'tlv3': {'node_id': bytes(33)}}):
+            with self.subTest(kwargs=kwargs):
+                def write(lnser):
+                    with io.BytesIO() as fd:
+                        lnser.write_tlv_stream(fd=fd, tlv_stream_name="n1", **kwargs)
+                        return fd.getvalue()
+                self.assert_same_result(write)
@@ -2,15 +2,24 @@ import unittest
 import tempfile
 import shutil
 import asyncio
+import os
+import threading
+import time
+from unittest import mock
 
 from electrum.util import bfh, create_and_start_event_loop
 from electrum.lnonion import (OnionHopsDataSingle, new_onion_packet,
                               process_onion_packet, _decode_onion_error, decode_onion_error,
                               OnionFailureCode, OnionPacket)
-from electrum import bitcoin, lnrouter
+from electrum import bitcoin, lnrouter, lnverifier, ecc, constants, util
+from electrum.crypto import sha256d
+from electrum.lnmsg import encode_msg, decode_msg
 from electrum.constants import HtmlcoinTestnet
 from electrum.simple_config import SimpleConfig
 from electrum.lnrouter import PathEdge
+from electrum.lnutil import ShortChannelID
+from electrum.channel_db import (ChannelInfo, Policy, NodeInfo, serialize_graph_snapshot,
+                                 parse_graph_snapshot, RoutingGraph)
 
 from . import TestCaseForTestnet
 from .test_bitcoin import needs_test_with_all_chacha20_implementations
@@ -99,6 +108,95 @@ class Test_LNRouter(TestCaseForTestnet):
         cdb.sql_thread.join(timeout=1)
 
     @needs_test_with_all_chacha20_implementations
+    def test_find_path_over_routing_graph(self):
+        class fake_network:
+            config = self.config
+            asyncio_loop = asyncio.get_event_loop()
+            interface = None
+        cdb = lnrouter.ChannelDB(fake_network())
+        cdb.data_loaded.set()
+        path_finder = lnrouter.LNPathFinder(cdb)
+        node = lambda c: b'\x02' + 32 * c
+        scid = lambda i: ShortChannelID(i.to_bytes(8, 'big'))
+        now = int(time.time())
+        def add_channel(i, node1, node2, fee_base_msat):
+            cdb.add_verified_channel_info({'short_channel_id': scid(i), 'node_id_1': node1, 'node_id_2': node2,
+                                           'features': b''}, capacity_sat=10**6)
+            for direction in (0, 1):
+                cdb.add_channel_update({'short_channel_id': scid(i), 'message_flags': b'\x00',
+                                        'channel_flags': bytes([direction]), 'cltv_expiry_delta': 40,
+                                        'htlc_minimum_msat': 1000, 'fee_base_msat': fee_base_msat,
+                                        'fee_proportional_millionths': 100, 'timestamp': now - 3600})
+        A, B, C, D, E = node(b'a'), node(b'b'), node(b'c'), node(b'd'), node(b'e')
+        add_channel(1, A, B, 1000)
+        add_channel(2, B, E, 1000)
+        add_channel(3, A, D, 1000)
+        add_channel(4, D, E, 2000)
+        add_channel(5, C, E, 0)  # C has no other channel
+        self.assertEqual([PathEdge(node_id=B, short_channel_id=scid(1)), PathEdge(node_id=E, short_channel_id=scid(2))],
+                         path_finder.find_path_for_payment(A, E, 100000))
+        self.assertIsNone(path_finder.find_path_for_payment(A, C, 10**10))  # exceeds capacity
+        # blacklist
+        path_finder.add_to_blacklist(scid(2))
+        self.assertEqual([PathEdge(node_id=D, short_channel_id=scid(3)), PathEdge(node_id=E, short_channel_id=scid(4))],
+                         path_finder.find_path_for_payment(A, E, 100000))
+        path_finder.blacklist.clear()
+        # the graph follows the changes of policies and channels
+        cdb.add_channel_update({'short_channel_id': scid(4), 'message_flags': b'\x00', 'channel_flags': b'\x00',
+                                'cltv_expiry_delta': 40, 'htlc_minimum_msat': 1000, 'fee_base_msat': 0,
+                                'fee_proportional_millionths': 0, 'timestamp': now})
+        self.assertEqual([PathEdge(node_id=D, short_channel_id=scid(3)), PathEdge(node_id=E, short_channel_id=scid(4))],
+                         path_finder.find_path_for_payment(A, E, 100000))
+        cdb.remove_channel(scid(3))
+        self.assertEqual([PathEdge(node_id=B, short_channel_id=scid(1)), PathEdge(node_id=E, short_channel_id=scid(2))],
+                         path_finder.find_path_for_payment(A, E, 100000))
+        cdb.add_channel_update({'short_channel_id': scid(2), 'message_flags': b'\x00', 'channel_flags': b'\x02',
+                                'cltv_expiry_delta': 40, 'htlc_minimum_msat': 1000, 'fee_base_msat': 1000,
+                                'fee_proportional_millionths': 100, 'timestamp': now})  # disabled
+        self.assertIsNone(path_finder.find_path_for_payment(A, E, 100000))
+        self.assertNotIn(scid(3), cdb.routing_graph.slot_for_channel)
+        cdb.sql_thread.join(timeout=1)
+
+    @mock.patch.object(RoutingGraph, 'MIN_EMPTY_SLOTS_TO_REBUILD', 3)
+    def test_routing_graph_is_rebuilt_after_removals(self):
+        class fake_network:
+            config = self.config
+            asyncio_loop = asyncio.get_event_loop()
+            interface = None
+        cdb = lnrouter.ChannelDB(fake_network())
+        cdb.data_loaded.set()
+        path_finder = lnrouter.LNPathFinder(cdb)
+        node = lambda i: b'\x02' + 32 * bytes([i])
+        scid = lambda i: ShortChannelID(i.to_bytes(8, 'big'))
+        now = int(time.time())
+        # a path 0 - 1 - 2 - 3, and channels 4 - 5, ..., 18 - 19 that get closed
+        for i in [0, 1, 2] + list(range(4, 19, 2)):
+            cdb.add_verified_channel_info({'short_channel_id': scid(i), 'node_id_1': node(i), 'node_id_2': node(i + 1),
+                                           'features': b''}, capacity_sat=10**6)
+            for direction in (0, 1):
+                cdb.add_channel_update({'short_channel_id': scid(i), 'message_flags': b'\x00',
+                                        'channel_flags': bytes([direction]), 'cltv_expiry_delta': 40,
+                                        'htlc_minimum_msat': 1000, 'fee_base_msat': 1000,
+                                        'fee_proportional_millionths': 100, 'timestamp': now - 3600})
+        graph = cdb.routing_graph
+        expected_path = [PathEdge(node_id=node(i + 1), short_channel_id=scid(i)) for i in range(3)]
+        self.assertEqual(expected_path, path_finder.find_path_for_payment(node(0), node(3), 100000))
+        old_layout = graph.layout
+        for i in range(4, 19, 2):
+            cdb.remove_channel(scid(i))
+            if i == 8:  # 3 empty slots out of 11
+                self.assertIs(old_layout, graph.layout)
+                self.assertEqual(11, len(graph.short_channel_ids))
+        # the slots and node numbers were rebuilt, once there were too many empty slots
+        self.assertIsNot(old_layout, graph.layout)
+        self.assertEqual(11, len(old_layout[3]))
+        self.assertLess(len(graph.short_channel_ids), 11)
+        self.assertEqual(graph._num_empty_slots, graph.short_channel_ids.count(None))
+        self.assertEqual([scid(i) for i in range(3)], [x for x in graph.short_channel_ids if x is not None])
+        self.assertEqual(set(node(i) for i in range(4)), set(graph.node_ids))
+        self.assertEqual(expected_path, path_finder.find_path_for_payment(node(0), node(3), 100000))
+        cdb.sql_thread.join(timeout=1)
+
     def test_new_onion_packet_legacy(self):
         # test vector from bolt-04
         payment_path_pubkeys = [
@@ -307,3 +405,206 @@ class Test_LNRouter(TestCaseForTestnet):
         self.assertEqual(4, index_of_sender)
         self.assertEqual(OnionFailureCode.TEMPORARY_NODE_FAILURE, failure_msg.code)
         self.assertEqual(b'', failure_msg.data)
+
+    def test_graph_snapshot(self):
+        channels = [ChannelInfo(short_channel_id=ShortChannelID.normalize('0000010000020001'),
+                                node1_id=b'\x02' + bytes(32), node2_id=b'\x03' + bytes(32), capacity_sat=None)]
+        policies = [Policy(key=bfh('0000010000020001') + b'\x02' + bytes(32), cltv_expiry_delta=144,
+                           htlc_minimum_msat=1000, htlc_maximum_msat=None, fee_base_msat=1000,
+                           fee_proportional_millionths=1, channel_flags=0, message_flags=0, timestamp=1600000000),
+                    Policy(key=bfh('0000010000020001') + b'\x03' + bytes(32), cltv_expiry_delta=40,
+                           htlc_minimum_msat=1, htlc_maximum_msat=10**10, fee_base_msat=0,
+                           fee_proportional_millionths=500, channel_flags=1, message_flags=1, timestamp=1600000001)]
+        nodes = [NodeInfo(node_id=b'\x02' + bytes(32), features=1 << 17, timestamp=1600000000, alias='htmlcoin ⚡'),
+                 NodeInfo(node_id=b'\x03' + bytes(32), features=0, timestamp=1600000001, alias='')]
+        db_id = bytes(range(16))
+        snapshot = serialize_graph_snapshot(db_id, 42, channels, policies, nodes)
+        self.assertEqual((db_id, 42, channels, policies, nodes), parse_graph_snapshot(snapshot))
+        # keys in ChannelDB are ShortChannelIDs
+        self.assertIsInstance(parse_graph_snapshot(snapshot)[2][0].short_channel_id, ShortChannelID)
+        with self.assertRaises(ValueError):
+            parse_graph_snapshot(snapshot[:-1])
+        with self.assertRaises(ValueError):
+            parse_graph_snapshot(snapshot[:100])
+        with self.assertRaises(ValueError):
+            parse_graph_snapshot(snapshot + b'\x00')
+        with self.assertRaises(ValueError):
+            parse_graph_snapshot(b'\x00' + snapshot[1:])
+
+    def _open_channel_db(self) -> lnrouter.ChannelDB:
+        class fake_network:
+            config = self.config
+            asyncio_loop = self.asyncio_loop
+            interface = None
+        # load_data triggers callbacks from the SQL thread
+        patcher = mock.patch.object(util.callback_mgr, 'asyncio_loop', self.asyncio_loop)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        cdb = lnrouter.ChannelDB(fake_network())
+        self._sql_result(cdb.load_data())
+        return cdb
+
+    def _sql_result(self, fut):
+        async def wait():
+            return await fut
+        return asyncio.run_coroutine_threadsafe(wait(), self.asyncio_loop).result(timeout=10)
+
+    def _close_channel_db(self, cdb: lnrouter.ChannelDB):
+        # the SQL thread stops with the event loop, which we start again for the next one
+        self.asyncio_loop.call_soon_threadsafe(self._stop_loop.set_result, 1)
+        self._loop_thread.join(timeout=1)
+        cdb.sql_thread.join(timeout=10)
+        self.assertFalse(cdb.sql_thread.is_alive())
+        self.asyncio_loop, self._stop_loop, self._loop_thread = create_and_start_event_loop()
+
+    def _add_gossip(self, cdb: lnrouter.ChannelDB, i: int, *, fee_base_msat=1000, timestamp=None):
+        """Adds channel i between nodes i and i+1, its policies, and announces node i."""
+        node = lambda i: b'\x02' + 32 * bytes([i])
+        scid = i.to_bytes(8, 'big')
+        timestamp = timestamp or int(time.time()) - 3600
+        def payload(msg_type, **fields):
+            raw = encode_msg(msg_type, **fields)
+            payload = decode_msg(raw)[1]
+            payload['raw'] = raw
+            return payload
+        cdb.add_channel_announcement(payload(
+            'channel_announcement', node_signature_1=bytes(64), node_signature_2=bytes(64),
+            bitcoin_signature_1=bytes(64), bitcoin_signature_2=bytes(64), len=0, features=b'',
+            chain_hash=constants.net.rev_genesis_bytes(), short_channel_id=scid,
+            node_id_1=node(i), node_id_2=node(i + 1), bitcoin_key_1=node(i), bitcoin_key_2=node(i + 1)))
+        for direction in (0, 1):
+            cdb.add_channel_update(payload(
+                'channel_update', signature=bytes(64), chain_hash=constants.net.rev_genesis_bytes(),
+                short_channel_id=scid, timestamp=timestamp, message_flags=b'\x00',
+                channel_flags=bytes([direction]), cltv_expiry_delta=40, htlc_minimum_msat=1000,
+                fee_base_msat=fee_base_msat, fee_proportional_millionths=100))
+        cdb.add_node_announcement(payload(
+            'node_announcement', signature=bytes(64), flen=0, features=b'', timestamp=timestamp,
+            node_id=node(i), rgb_color=bytes(3), alias=f'node {i}'.encode().ljust(32, b'\x00'),
+            addrlen=0, addresses=b''))
+
+    def _assert_same_graph(self, expected: lnrouter.ChannelDB, cdb: lnrouter.ChannelDB):
+        self.assertEqual(expected._channels, cdb._channels)
+        self.assertEqual(expected._policies, cdb._policies)
+        self.assertEqual(expected._nodes, cdb._nodes)
+        self.assertEqual(expected._channels_for_node, cdb._channels_for_node)
+        self.assertEqual(expected.get_num_channels_partitioned_by_policy_count(),
+                         cdb.get_num_channels_partitioned_by_policy_count())
+        self.assertEqual(set(expected.routing_graph.slot_for_channel), set(cdb.routing_graph.slot_for_channel))
+
+    def _load_from_sql(self, snapshot_path: str) -> lnrouter.ChannelDB:
+        # without the snapshot, the graph is decoded from the stored gossip
+        os.remove(snapshot_path)
+        with mock.patch.object(lnrouter.ChannelDB, '_load_snapshot', side_effect=AssertionError) as load_snapshot:
+            cdb = self._open_channel_db()
+        load_snapshot.assert_called_once()
+        return cdb
+
+    def test_graph_snapshot_replays_changes(self):
+        cdb = self._open_channel_db()
+        for i in range(5):
+            self._add_gossip(cdb, i)
+        self._close_channel_db(cdb)
+        cdb = self._open_channel_db()
+        self.assertEqual(5, len(cdb._channels))
+        # changes after the snapshot: an update, a removal and a new channel
+        self._add_gossip(cdb, 0, fee_base_msat=0, timestamp=int(time.time()))
+        cdb.remove_channel(ShortChannelID((3).to_bytes(8, 'big')))
+        self._add_gossip(cdb, 10)
+        self._sql_result(cdb.load_data())  # wait until they are written
+        self.assertEqual(8, cdb._num_changes_since_snapshot)
+        # as if we crashed: no snapshot on close
+        cdb.on_close = lambda: None
+        self._close_channel_db(cdb)
+        with mock.patch.object(lnrouter.ChannelDB, '_load_gossip', side_effect=AssertionError):
+            cdb2 = self._open_channel_db()
+        self._close_channel_db(cdb2)
+        self.assertEqual(5, len(cdb2._channels))
+        self.assertEqual(0, cdb2._policies[(b'\x02' + 32 * b'\x00', ShortChannelID(bytes(8)))].fee_base_msat)
+        self.assertNotIn(ShortChannelID((3).to_bytes(8, 'big')), cdb2._channels)
+        self._assert_same_graph(self._load_from_sql(cdb.snapshot_path), cdb2)
+
+    def test_graph_snapshot_has_the_writes_queued_on_shutdown(self):
+        cdb = self._open_channel_db()
+        for i in range(3):
+            self._add_gossip(cdb, i)
+        # queue changes behind a request that blocks the SQL thread, and stop the event loop meanwhile
+        unblock = threading.Event()
+        cdb.db_requests.put((asyncio.Future(), lambda db: unblock.wait(), (), {}))
+        self._add_gossip(cdb, 5)
+        cdb.remove_channel(ShortChannelID((1).to_bytes(8, 'big')))
+        self.assertLess(1, cdb.db_requests.qsize())
+        self.asyncio_loop.call_soon_threadsafe(self._stop_loop.set_result, 1)
+        self._loop_thread.join(timeout=1)
+        unblock.set()
+        cdb.sql_thread.join(timeout=10)
+        self.assertFalse(cdb.sql_thread.is_alive())
+        self.assertTrue(cdb.db_requests.empty())
+        self.asyncio_loop, self._stop_loop, self._loop_thread = create_and_start_event_loop()
+        with mock.patch.object(lnrouter.ChannelDB, '_load_gossip', side_effect=AssertionError):
+            cdb2 = self._open_channel_db()
+        self._close_channel_db(cdb2)
+        self.assertEqual({ShortChannelID(i.to_bytes(8, 'big')) for i in (0, 2, 5)}, set(cdb2._channels))
+        self._assert_same_graph(cdb, cdb2)
+        self._assert_same_graph(self._load_from_sql(cdb.snapshot_path), cdb2)
+
+    def test_graph_snapshot_is_rejected(self):
+        cdb = self._open_channel_db()
+        for i in range(3):
+            self._add_gossip(cdb, i)
+        self._close_channel_db(cdb)
+        snapshot_path = cdb.snapshot_path
+        with open(snapshot_path, 'rb') as f:
+            snapshot = f.read()
+        db_id, generation, channels, policies, nodes = parse_graph_snapshot(snapshot)
+        self.assertEqual(3, len(channels))
+        def load_with_snapshot(data):
+            with open(snapshot_path, 'wb') as f:
+                f.write(data)
+            with mock.patch.object(lnrouter.ChannelDB, '_load_gossip', autospec=True,
+                                   side_effect=lnrouter.ChannelDB._load_gossip) as load_gossip:
+                cdb = self._open_channel_db()
+            self._close_channel_db(cdb)
+            self._assert_same_graph(self._load_from_sql(cdb.snapshot_path), cdb)
+            return load_gossip.call_count
+        # the snapshot is used as is
+        self.assertEqual(0, load_with_snapshot(snapshot))
+        # a snapshot of another database
+        self.assertEqual(1, load_with_snapshot(serialize_graph_snapshot(
+            bytes(16), generation, channels[:1], policies[:1], nodes[:1])))
+        # a stale snapshot, that misses changes which have been compacted away
+        self.assertEqual(1, load_with_snapshot(serialize_graph_snapshot(
+            db_id, generation - 1, channels[:1], policies[:1], nodes[:1])))
+        # a snapshot from the future
+        self.assertEqual(1, load_with_snapshot(serialize_graph_snapshot(
+            db_id, generation + 1, channels[:1], policies[:1], nodes[:1])))
+        # not a snapshot
+        self.assertEqual(1, load_with_snapshot(snapshot[:-1]))
+        self.assertEqual(1, load_with_snapshot(b''))
+
+    def test_gossip_signature_verifier(self):
+        node_keys = [ecc.ECPrivkey(bytes([i]) * 32) for i in range(1, 5)]
+        node1, node2, bitcoin1, bitcoin2 = [k.get_public_key_bytes() for k in node_keys]
+        fields = dict(len=0, features=b'', chain_hash=constants.net.rev_genesis_bytes(),
+                      short_channel_id=bfh('0000010000020001'), node_id_1=node1, node_id_2=node2,
+                      bitcoin_key_1=bitcoin1, bitcoin_key_2=bitcoin2)
+        h = sha256d(encode_msg('channel_announcement', node_signature_1=bytes(64), node_signature_2=bytes(64),
+                               bitcoin_signature_1=bytes(64), bitcoin_signature_2=bytes(64), **fields)[2+256:])
+        sigs = [k.sign(h, ecc.sig_string_from_r_and_s) for k in node_keys]
+        def chan_ann(sigs):
+            raw = encode_msg('channel_announcement', node_signature_1=sigs[0], node_signature_2=sigs[1],
+                             bitcoin_signature_1=sigs[2], bitcoin_signature_2=sigs[3], **fields)
+            payload = decode_msg(raw)[1]
+            payload['raw'] = raw
+            return payload
+        good = chan_ann(sigs)
+        bad = [chan_ann(sigs[:i] + [sigs[(i + 1) % 4]] + sigs[i+1:]) for i in range(4)]
+        verifier = lnverifier.GossipSignatureVerifier(max_workers=2)
+        verifier.CHUNK_SIZE = 2
+        payloads = [bad[0], good, bad[1], bad[2], good, bad[3]]
+        accepted = asyncio.run_coroutine_threadsafe(
+            verifier.verify_channel_announcements(payloads), self.asyncio_loop).result()
+        self.assertEqual([good, good], accepted)
+        self.assertEqual([], asyncio.run_coroutine_threadsafe(
+            verifier.verify_channel_announcements([]), self.asyncio_loop).result())
+        verifier.stop()
@@ -1,13 +1,20 @@
 import asyncio
 import tempfile
+import threading
 import unittest
+from unittest import mock
+
+from aiorpcx import RPCError
 
 from electrum import constants
 from electrum.simple_config import SimpleConfig
 from electrum import blockchain
-from electrum.interface import Interface, ServerAddr
+from electrum.interface import Interface, ServerAddr, RequestBatcher, RequestCorrupted
+from electrum.blockchain import CHUNK_SIZE
 from electrum.crypto import sha256
 from electrum.util import bh2u
+from electrum.bitcoin import address_to_scripthash, hash160_to_p2pkh, DELEGATION_CONTRACT
+from electrum.synchronizer import SynchronizerBase
 
 from . import ElectrumTestCase
 
@@ -116,6 +123,177 @@ class TestNetwork(ElectrumTestCase):
         self.assertEqual(('catchup', 7), asyncio.get_event_loop().run_until_complete(ifa.sync_until(8, next_height=6)))
         self.assertEqual(self.interface.q.qsize(), 0)
 
+    def test_sync_chunks_pipelined(self):
+        ifa = self.interface
+        other = MockInterface(self.config)
+        ifa.network.interfaces = {ifa.server: ifa, other.server: other}
+        ifa.network.interfaces_lock = threading.Lock()
+        other.ready.set_result(1)
+        other.session = MockSession()
+        other.tip = 10 * CHUNK_SIZE
+        fetched = []
+        def mock_fetch_chunk(iface):
+            async def fetch_chunk(index, size):
+                fetched.append((iface, index))
+                await asyncio.sleep(0.001 * (index % 3))
+                return {'hex': str(index), 'count': size}
+            return fetch_chunk
+        ifa.fetch_chunk = mock_fetch_chunk(ifa)
+        other.fetch_chunk = mock_fetch_chunk(other)
+        connected = []
+        def connect_chunk(index, hexdata):
+            self.assertEqual(str(index), hexdata)
+            connected.append(index)
+            return index != 4
+        ifa.blockchain.connect_chunk = connect_chunk
+        num_chunks = asyncio.get_event_loop().run_until_complete(ifa._sync_chunks_pipelined(10, 8 * CHUNK_SIZE + 10))
+        self.assertEqual(4, num_chunks)
+        self.assertEqual([0, 1, 2, 3, 4], connected)
+        self.assertEqual({ifa, other}, {iface for iface, _ in fetched})
+        self.assertLessEqual(len(fetched), 5 + 4)
+
+    def test_sync_until_does_not_restart_pipeline(self):
+        ifa = self.interface
+        ifa.network.interfaces = {ifa.server: ifa}
+        ifa.network.interfaces_lock = threading.Lock()
+        ifa.tip = 8 * CHUNK_SIZE + 20
+        fetched = []
+        async def fetch_chunk(index, size):
+            fetched.append(index)
+            if index == 4 and fetched.count(4) == 1:
+                raise RequestCorrupted('bad chunk')
+            return {'hex': str(index), 'count': size}
+        ifa.fetch_chunk = fetch_chunk
+        connected = []
+        def connect_chunk(index, hexdata):
+            connected.append(index)
+            return True
+        ifa.blockchain.connect_chunk = connect_chunk
+        with mock.patch.object(ifa, '_sync_chunks_pipelined', wraps=ifa._sync_chunks_pipelined) as pipeline:
+            self.assertEqual(('catchup', 8 * CHUNK_SIZE + 21),
+                             asyncio.get_event_loop().run_until_complete(ifa.sync_until(10)))
+        pipeline.assert_called_once()
+        self.assertEqual(list(range(9)), connected)
+        # chunks 0-3 and the requests in flight when 4 failed, then 4-8 one by one
+        self.assertEqual(list(range(8)), fetched[:8])
+        self.assertEqual(list(range(4, 9)), fetched[8:])
+
+
+class MockSession:
+    def is_closing(self): return False
+
+
+class MockBatch:
+    def __init__(self, session):
+        self.session = session
+        self.requests = []
+        self.results = None
+    def add_request(self, method, args=()):
+        self.requests.append((method, args))
+    async def __aenter__(self):
+        return self
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.session.batches.append(self.requests)
+        self.results = [RPCError(1, 'not found') if args[0] == 'missing' else method + args[0]
+                        for method, args in self.requests]
+
+class MockBatchSession:
+    def __init__(self):
+        self.batches = []
+    def send_batch(self):
+        return MockBatch(self)
+
+class TestRequestBatcher(ElectrumTestCase):
+
+    def test_requests_are_batched(self):
+        session = MockBatchSession()
+        async def run():
+            batcher = RequestBatcher(session, batch_size=3, max_inflight=1)
+            futs = [batcher.request('get', [str(i)]) for i in range(5)]
+            futs.append(batcher.request('get', ['missing']))
+            return await asyncio.gather(*futs, return_exceptions=True)
+        results = asyncio.get_event_loop().run_until_complete(run())
+        self.assertEqual(['get0', 'get1', 'get2', 'get3', 'get4'], results[:5])
+        self.assertIsInstance(results[5], RPCError)
+        self.assertEqual([3, 3], [len(batch) for batch in session.batches])
+
+    def test_cancelled_requests_are_not_sent(self):
+        session = MockBatchSession()
+        async def run():
+            batcher = RequestBatcher(session, batch_size=10)
+            futs = [batcher.request('get', [str(i)]) for i in range(3)]
+            futs[1].cancel()
+            return await asyncio.gather(futs[0], futs[2])
+        self.assertEqual(['get0', 'get2'], asyncio.get_event_loop().run_until_complete(run()))
+        self.assertEqual([[('get', ['0']), ('get', ['2'])]], session.batches)
+
+
+class MockSubscribeSession:
+    def __init__(self, statuses):
+        self.statuses = statuses  # scripthash -> status
+        self.subscriptions = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+    async def subscribe(self, method, params, queue):
+        self.subscriptions.append((method, params))
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        await asyncio.sleep(0.001)
+        self.in_flight -= 1
+        if method == 'blockchain.scripthash.subscribe':
+            await queue.put(params + [self.statuses.get(params[0])])
+
+class MockSynchronizer(SynchronizerBase):
+    def __init__(self, config, session, funded):
+        # no NetworkJobOnDefaultServer.__init__: nothing to restart
+        self.network = MockNetwork()
+        self.network.config = config
+        self.interface = MockNetwork()
+        self.interface.session = session
+        self.funded = funded
+        self.statuses = []
+        self._reset()
+    def _get_subscription_priority(self, addr):
+        return 0 if addr in self.funded else 1
+    async def _on_address_status(self, addr, status):
+        self.statuses.append((addr, status))
+
+class TestSubscriptionWindow(ElectrumTestCase):
+
+    def test_subscriptions_are_windowed_and_prioritized(self):
+        config = SimpleConfig({'electrum_path': self.electrum_path, 'subscription_window': 3})
+        addrs = [hash160_to_p2pkh(bytes([i]) * 20) for i in range(20)]
+        funded = set(addrs[10:15])
+        session = MockSubscribeSession({address_to_scripthash(addr): 'ab' * 32 for addr in funded})
+        sync = MockSynchronizer(config, session, funded)
+        async def run():
+            for addr in addrs:
+                await sync._add_address(addr)
+            self.assertEqual((0, 20, 0, 20, 0), sync.get_subscription_progress())
+            await sync.taskgroup.spawn(sync.send_subscriptions())
+            await sync.taskgroup.spawn(sync.handle_status())
+            while sync.requested_addrs or len(sync.statuses) < len(addrs) or session.in_flight \
+                    or len(session.subscriptions) < 3 * len(addrs):
+                await asyncio.sleep(0.01)
+            await sync.taskgroup.cancel_remaining()
+        asyncio.get_event_loop().run_until_complete(run())
+        self.assertEqual(3, session.max_in_flight)
+        subscribed = [params[0] for method, params in session.subscriptions
+                      if method == 'blockchain.scripthash.subscribe']
+        self.assertEqual([address_to_scripthash(addr) for addr in addrs[10:15] + addrs[:10] + addrs[15:]],
+                         subscribed)
+        # any address can be a delegator, even without a history; their
+        # delegation events are subscribed to after all the addresses
+        methods = [method for method, params in session.subscriptions]
+        self.assertEqual(['blockchain.scripthash.subscribe'] * 20 + ['blockchain.contract.event.subscribe'] * 40,
+                         methods)
+        delegations = [params[0] for method, params in session.subscriptions
+                       if method == 'blockchain.contract.event.subscribe']
+        self.assertEqual([bytes([i]).hex() * 20 for i in range(20) for topic in range(2)], sorted(delegations))
+        self.assertTrue(all(params[1] == DELEGATION_CONTRACT for method, params in session.subscriptions
+                            if method == 'blockchain.contract.event.subscribe'))
+        self.assertEqual((20, 0, 20, 0, 0), sync.get_subscription_progress())
+
 
 if __name__=="__main__":
     constants.set_regtest()
@@ -8,6 +8,7 @@ from electrum.util import bh2u, bfh
 from electrum.bitcoin import (deserialize_privkey, opcodes,
                               construct_script, construct_witness)
 from electrum.ecc import ECPrivkey
+from electrum.crypto import sha256d
 
 from . import ElectrumTestCase, TestCaseForTestnet
 
@@ -186,6 +187,87 @@ class TestTransaction(ElectrumTestCase):
         self.assertEqual(None, addr_from_script('200289e14468d94537493c62e2168318b568912dec0fb95609afd56f2527c2751cac'))
         self.assertEqual(None, addr_from_script('210589e14468d94537493c62e2168318b568912dec0fb95609afd56f2527c2751c8bac'))
 
+    def test_get_address_from_output_script_fast_path(self):
+        pubkey = '0289e14468d94537493c62e2168318b568912dec0fb95609afd56f2527c2751c8b'
+        opcall = '0104' + '0390d003' + '0128' + '04a9059cbb' + '14' + '11' * 20 + 'c2'
+        scripts = [
+            '76a91428662c67561b95c79d2257d2a93d9d151c977e9188ac',
+            '76a91428662c67561b95c79d2257d2a93d9d151c977e9188ab',
+            'a9142a84cf00d47f699ee7bbc1dea5ec1bdecb4ac15487',
+            'a9142a84cf00d47f699ee7bbc1dea5ec1bdecb4ac15488',
+            '21' + pubkey + 'ac',
+            '20' + pubkey[:-2] + 'ac',
+            '41' + '04' + '22' * 64 + 'ac',
+            '0014751e76e8199196d454941c45d1b3a323f1433bd6',
+            '0014751e76e8199196d454941c45d1b3a323f1433bc2',
+            '5202c2c1',
+            opcall,
+            '0104' + '0390d003' + '0128' + '0100' + 'c1',
+            '01' + '21' + pubkey + '00' + 'c4' + opcall,
+            'c2',
+            '4c',
+            '',
+        ]
+        for script in scripts:
+            self.assertEqual(transaction._get_address_from_decoded_output_script(bfh(script)),
+                             transaction.get_address_from_output_script(bfh(script)), script)
+
+    def test_parse_network_tx(self):
+        for raw_tx in (signed_blob, v2_blob, signed_segwit_blob):
+            raw = bfh(raw_tx)
+            version, inputs, outputs, locktime, txid = transaction.parse_network_tx(raw)
+            vds = transaction.BCDataStream()
+            vds.write(raw)
+            self.assertEqual(vds.read_int32(), version)
+            n_vin = vds.read_compact_size()
+            if n_vin == 0:
+                vds.read_bytes(1)
+                n_vin = vds.read_compact_size()
+            for txin in inputs:
+                expected = transaction.parse_input(vds)
+                self.assertEqual((expected.prevout, expected.script_sig, expected.nsequence),
+                                 (txin.prevout, txin.script_sig, txin.nsequence))
+            self.assertEqual([transaction.parse_output(vds) for i in range(vds.read_compact_size())], outputs)
+            if raw_tx == signed_segwit_blob:
+                for txin in inputs:
+                    witness = txin.witness
+                    transaction.parse_witness(vds, txin)
+                    self.assertEqual(txin.witness, witness)
+            self.assertEqual(vds.read_uint32(), locktime)
+            self.assertEqual(sha256d(bfh(Transaction(raw_tx).serialize_to_network(force_legacy=True)))[::-1].hex(),
+                             txid)
+            with self.assertRaises(transaction.SerializationError):
+                transaction.parse_network_tx(raw[:-1])
+            with self.assertRaises(transaction.SerializationError):
+                transaction.parse_network_tx(raw + b'\x00')
+
+    def test_sighash_cache(self):
+        privkey = bfh('22' * 32)
+        pubkey = ECPrivkey(privkey).get_public_key_bytes(compressed=True)
+        inputs = []
+        for i in range(4):
+            txin = PartialTxInput(prevout=TxOutpoint(txid=bytes([i + 1]) * 32, out_idx=i))
+            txin.nsequence = 0xffffffff - i
+            txin.script_type = 'p2wpkh' if i == 2 else 'p2pkh'
+            txin.pubkeys = [pubkey]
+            txin.num_sig = 1
+            txin._trusted_value_sats = 10**8
+            inputs.append(txin)
+        opcall = '0104' + '0390d003' + '0128' + '04a9059cbb' + '14' + '11' * 20 + 'c2'
+        opsender = '0101' + '14' + bitcoin.hash_160(pubkey).hex() + '0100' + 'c4' + opcall
+        outputs = [PartialTxOutput(scriptpubkey=bfh(opsender), value=0),
+                   PartialTxOutput(scriptpubkey=bfh('76a91428662c67561b95c79d2257d2a93d9d151c977e9188ac'), value=10**8)]
+        tx = PartialTransaction.from_io(inputs, outputs, locktime=1234, version=2)
+        sighash_cache = transaction.SighashCache(tx)
+        for i in range(len(inputs)):
+            self.assertEqual(sha256d(bfh(tx.serialize_preimage(i))), sighash_cache.get_sighash(i))
+        self.assertEqual(tx.opsender_preimage(0), tx.opsender_preimage(0, sighash_cache=sighash_cache))
+        tx.sign({pubkey.hex(): (privkey, True)})
+        self.assertTrue(tx.is_complete())
+        # input signatures commit to the signed OP_SENDER output
+        for i in range(len(inputs)):
+            self.assertIn(tx.sign_txin(i, privkey), tx.serialize_to_network())
+
     def test_tx_serialize_methods_for_psbt(self):
         raw_hex = "70736274ff01009a020000000258e87a21b56daf0c23be8e7070456c336f7cbaa5c8757924f545887bb2abdd750000000000ffffffff838d0427d0ec650a68aa46bb0b098aea4422c071b2ca78352a077959d07cea1d0100000000ffffffff0270aaf00800000000160014d85c2b71d0060b09c9886aeb815e50991dda124d00e1f5050000000016001400aea9a2e5f0f876a588df5546e8742d1d87008f00000000000100bb0200000001aad73931018bd25f84ae400b68848be09db706eac2ac18298babee71ab656f8b0000000048473044022058f6fc7c6a33e1b31548d481c826c015bd30135aad42cd67790dab66d2ad243b02204a1ced2604c6735b6393e5b41691dd78b00f0c5942fb9f751856faa938157dba01feffffff0280f0fa020000000017a9140fb9463421696b82c833af241c78c17ddbde493487d0f20a270100000017a91429ca74f8a08f81999428185c97b5d852e4063f618765000000010304010000000104475221029583bf39ae0a609747ad199addd634fa6108559d6c5cd39b4c2183f1ab96e07f2102dab61ff49a14db6a7d02b0cd1fbb78fc4b18312b5b4e54dae4dba2fbfef536d752ae2206029583bf39ae0a609747ad199addd634fa6108559d6c5cd39b4c2183f1ab96e07f10d90c6a4f000000800000008000000080220602dab61ff49a14db6a7d02b0cd1fbb78fc4b18312b5b4e54dae4dba2fbfef536d710d90c6a4f0000008000000080010000800001012000c2eb0b0000000017a914b7f5faf40e3d40a5a459b1db3535f2b72fa921e8870103040100000001042200208c2353173743b595dfb4a07b72ba8e42e3797da74e87fe7d9d7497e3b2028903010547522103089dc10c7ac6db54f91329af617333db388cead0c231f723379d1b99030b02dc21023add904f3d6dcf59ddb906b0dee23529b7ffb9ed50e5e86151926860221f0e7352ae2206023add904f3d6dcf59ddb906b0dee23529b7ffb9ed50e5e86151926860221f0e7310d90c6a4f000000800000008003000080220603089dc10c7ac6db54f91329af617333db388cead0c231f723379d1b99030b02dc10d90c6a4f00000080000000800200008000220203a9a4c37f5996d3aa25dbac6b570af0650394492942460b354753ed9eeca5877110d90c6a4f000000800000008004000080002202027f6399757d2eff55a136ad02c684b1838b6556e5f1b6b34282a94b6b5005109610d90c6a4f00000080000000800500008000"
         raw_base64 = "cHNidP8BAJoCAAAAAljoeiG1ba8MI76OcHBFbDNvfLqlyHV5JPVFiHuyq911AAAAAAD/////g40EJ9DsZQpoqka7CwmK6kQiwHGyyng1Kgd5WdB86h0BAAAAAP////8CcKrwCAAAAAAWABTYXCtx0AYLCcmIauuBXlCZHdoSTQDh9QUAAAAAFgAUAK6pouXw+HaliN9VRuh0LR2HAI8AAAAAAAEAuwIAAAABqtc5MQGL0l+ErkALaISL4J23BurCrBgpi6vucatlb4sAAAAASEcwRAIgWPb8fGoz4bMVSNSByCbAFb0wE1qtQs1neQ2rZtKtJDsCIEoc7SYExnNbY5PltBaR3XiwDwxZQvufdRhW+qk4FX26Af7///8CgPD6AgAAAAAXqRQPuUY0IWlrgsgzryQceMF9295JNIfQ8gonAQAAABepFCnKdPigj4GZlCgYXJe12FLkBj9hh2UAAAABAwQBAAAAAQRHUiEClYO/Oa4KYJdHrRma3dY0+mEIVZ1sXNObTCGD8auW4H8hAtq2H/SaFNtqfQKwzR+7ePxLGDErW05U2uTbovv+9TbXUq4iBgKVg785rgpgl0etGZrd1jT6YQhVnWxc05tMIYPxq5bgfxDZDGpPAAAAgAAAAIAAAACAIgYC2rYf9JoU22p9ArDNH7t4/EsYMStbTlTa5Nui+/71NtcQ2QxqTwAAAIAAAACAAQAAgAABASAAwusLAAAAABepFLf1+vQOPUClpFmx2zU18rcvqSHohwEDBAEAAAABBCIAIIwjUxc3Q7WV37Sge3K6jkLjeX2nTof+fZ10l+OyAokDAQVHUiEDCJ3BDHrG21T5EymvYXMz2ziM6tDCMfcjN50bmQMLAtwhAjrdkE89bc9Z3bkGsN7iNSm3/7ntUOXoYVGSaGAiHw5zUq4iBgI63ZBPPW3PWd25BrDe4jUpt/+57VDl6GFRkmhgIh8OcxDZDGpPAAAAgAAAAIADAACAIgYDCJ3BDHrG21T5EymvYXMz2ziM6tDCMfcjN50bmQMLAtwQ2QxqTwAAAIAAAACAAgAAgAAiAgOppMN/WZbTqiXbrGtXCvBlA5RJKUJGCzVHU+2e7KWHcRDZDGpPAAAAgAAAAIAEAACAACICAn9jmXV9Lv9VoTatAsaEsYOLZVbl8bazQoKpS2tQBRCWENkMak8AAACAAAAAgAUAAIAA"
@@ -4,7 +4,7 @@ from electrum.util import (format_satoshis, format_fee_satoshis, parse_URI,
                            is_hash256_str, chunks, is_ip_address, list_enabled_bits,
                            format_satoshis_plain, is_private_netaddress, is_hex_str,
                            is_integer, is_non_negative_integer, is_int_or_float,
-                           is_non_negative_int_or_float)
+                           is_non_negative_int_or_float, LRUCache)
 
 from . import ElectrumTestCase
 
@@ -246,3 +246,15 @@ class TestUtil(ElectrumTestCase):
         self.assertFalse(is_private_netaddress("[2a00:1450:400e:80d::200e]"))
         self.assertFalse(is_private_netaddress("8.8.8.8"))
         self.assertFalse(is_private_netaddress("example.com"))
+
+    def test_lru_cache(self):
+        cache = LRUCache(2)
+        cache['a'] = 1
+        cache['b'] = 2
+        self.assertEqual(1, cache.get('a'))
+        cache['c'] = 3
+        self.assertNotIn('b', cache)
+        self.assertEqual(['a', 'c'], list(cache.keys()))
+        self.assertEqual(3, cache.pop('c'))
+        self.assertIsNone(cache.get('c'))
+        self.assertEqual(1, len(cache))
@@ -1,9 +1,13 @@
 # -*- coding: utf-8 -*-
 
-from electrum.bitcoin import hash_encode
+import os
+
+from electrum.bitcoin import hash_encode, hash_decode
+from electrum.crypto import sha256d
 from electrum.transaction import Transaction
 from electrum.util import bfh
-from electrum.verifier import SPV, InnerNodeOfSpvProofIsValidTx
+from electrum.verifier import (SPV, InnerNodeOfSpvProofIsValidTx, MerkleRootMismatch,
+                               MissingBlockHeader, verify_txs_in_block)
 
 from . import TestCaseForTestnet
 
@@ -48,3 +52,67 @@ class VerifierTestCase(TestCaseForTestnet):
         f_tx_hash = hash_encode(bfh(VALID_64_BYTE_TX[:64]))
         with self.assertRaises(InnerNodeOfSpvProofIsValidTx):
             SPV.hash_merkle_root(fake_mbranch, f_tx_hash, 6)
+
+
+def make_merkle_proofs(tx_hashes):
+    """Returns the merkle root of a block with tx_hashes,
+    and the merkle branch of each tx."""
+    level = [hash_decode(tx_hash) for tx_hash in tx_hashes]
+    branches = [[] for _ in tx_hashes]
+    positions = list(range(len(tx_hashes)))
+    while len(level) > 1:
+        if len(level) % 2:
+            level.append(level[-1])
+        for i, pos in enumerate(positions):
+            branches[i].append(hash_encode(level[pos ^ 1]))
+            positions[i] = pos >> 1
+        level = [sha256d(level[j] + level[j + 1]) for j in range(0, len(level), 2)]
+    return hash_encode(level[0]), branches
+
+
+class VerifyTxsInBlockTestCase(TestCaseForTestnet):
+
+    def setUp(self):
+        super().setUp()
+        self.tx_hashes = [os.urandom(32).hex() for _ in range(11)]
+        merkle_root, self.branches = make_merkle_proofs(self.tx_hashes)
+        self.header = {'merkle_root': merkle_root}
+        self.proofs = [(tx_hash, branch, pos)
+                       for pos, (tx_hash, branch) in enumerate(zip(self.tx_hashes, self.branches))]
+
+    def test_verify_ok(self):
+        known_nodes = {}
+        self.assertEqual({}, verify_txs_in_block(self.proofs, self.header, 10, known_nodes=known_nodes))
+        # the branches of the txs share the upper nodes of the tree
+        self.assertEqual(self.header['merkle_root'],
+                         hash_encode(sha256d(known_nodes[(3, 0)] + known_nodes[(3, 1)])))
+        self.assertEqual(len(self.tx_hashes), len([key for key in known_nodes if key[0] == 0]))
+        # and a proof checked against known nodes gives the same answer
+        self.assertEqual({}, verify_txs_in_block(self.proofs[3:4], self.header, 10, known_nodes=known_nodes))
+
+    def test_verify_fail(self):
+        known_nodes = {}
+        verify_txs_in_block(self.proofs[:5], self.header, 10, known_nodes=known_nodes)
+        bad_tx = os.urandom(32).hex()
+        wrong_pos = (self.tx_hashes[6], self.branches[6], 7)
+        failures = verify_txs_in_block([(bad_tx, self.branches[4], 4), wrong_pos, self.proofs[6]],
+                                       self.header, 10, known_nodes=known_nodes)
+        self.assertEqual({bad_tx, self.tx_hashes[6]}, set(failures))
+        self.assertIsInstance(failures[bad_tx], MerkleRootMismatch)
+        # the failed proofs were not added to the known nodes
+        self.assertNotIn(hash_decode(bad_tx), known_nodes.values())
+        failures = verify_txs_in_block(self.proofs[:1], None, 10)
+        self.assertIsInstance(failures[self.tx_hashes[0]], MissingBlockHeader)
+
+    def test_verify_fail_f_tx(self):
+        """Raise if inner node of merkle branch is valid tx, even with known nodes."""
+        known_nodes = {}
+        header = {'merkle_root': MERKLE_ROOT}
+        t_tx_hash = Transaction(VALID_64_BYTE_TX).txid()
+        self.assertEqual({}, verify_txs_in_block([(t_tx_hash, MERKLE_BRANCH, 3)], header, 10,
+                                                 known_nodes=known_nodes))
+        fake_branch_node = hash_encode(bfh(VALID_64_BYTE_TX[:64]))
+        f_tx_hash = hash_encode(bfh(VALID_64_BYTE_TX[64:]))
+        failures = verify_txs_in_block([(f_tx_hash, [fake_branch_node] + MERKLE_BRANCH, 7)], header, 10,
+                                       known_nodes=known_nodes)
+        self.assertIsInstance(failures[f_tx_hash], InnerNodeOfSpvProofIsValidTx)
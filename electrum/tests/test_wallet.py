@@ -7,15 +7,19 @@ from decimal import Decimal
 import time
 
 from io import StringIO
-from electrum.storage import WalletStorage
+from electrum.storage import WalletStorage, StorageEncryptionVersion
 from electrum.wallet_db import FINAL_SEED_VERSION
 from electrum.wallet import (Abstract_Wallet, Standard_Wallet, create_new_wallet,
                              restore_wallet_from_text, Imported_Wallet, Wallet)
 from electrum.exchange_rate import ExchangeBase, FxThread
-from electrum.util import TxMinedInfo, InvalidPassword
-from electrum.bitcoin import COIN
+from electrum.util import TxMinedInfo, InvalidPassword, LRUCache, create_and_start_event_loop
+from electrum.transaction import Transaction, tx_from_any
+from electrum.address_synchronizer import AddressSynchronizer, TX_HEIGHT_LOCAL, TX_HEIGHT_UNCONFIRMED
+from electrum.bitcoin import COIN, TOKEN_TRANSFER_TOPIC, Token, hash160_to_p2pkh
 from electrum.wallet_db import WalletDB
 from electrum.simple_config import SimpleConfig
+from electrum.bip32 import BIP32Node
+from electrum import keystore, constants
 
 from . import ElectrumTestCase
 
@@ -83,6 +87,408 @@ class TestWalletStorage(WalletTestCase):
         for key, value in some_dict.items():
             self.assertEqual(d[key], value)
 
+    def _write_changes(self, storage, db):
+        db.put('a', 'b')
+        db.write(storage)
+        d = db.get_dict('d')
+        d['list'] = []
+        d['list'].append(1)
+        d['set'] = set()
+        d['set'].add(('x', 1))
+        d['set'].add(('y', 2))
+        d[3] = {'inner': [1]}
+        d['3']['inner'].append(2)
+        db.write(storage)
+        db.put('a', None)
+        d.pop('list')
+        d['set'].discard(('y', 2))
+        d['set'].discard(('z', 3))
+        db.write(storage)
+
+    def test_write_appends_changes(self):
+        storage = WalletStorage(self.wallet_path)
+        db = WalletDB('', manual_upgrades=True)
+        self._write_changes(storage, db)
+        with open(self.wallet_path, "r") as f:
+            contents = f.read()
+        # a full write, followed by one line per incremental write
+        appended = contents[contents.rindex('\n}') + 2:].split('\n')[1:]
+        self.assertEqual(2, len(appended))
+        self.assertEqual('[["del", ["a"]],["del", ["d", "list"]],["discard", ["d", "set"], ["y", 2]]]', appended[-1])
+        db2 = WalletDB(WalletStorage(self.wallet_path).read(), manual_upgrades=True)
+        self.assertEqual(db.dump(), db2.dump())
+        self.assertEqual({'set': [['x', 1]], '3': {'inner': [1, 2]}}, db2.get('d'))
+        # compacting rewrites the file in full
+        db.write(storage, compact=True)
+        with open(self.wallet_path, "r") as f:
+            self.assertEqual(json.loads(db.dump()), json.loads(f.read()))
+
+    def test_write_appends_encrypted_changes(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.set_password('secret', StorageEncryptionVersion.USER_PASSWORD)
+        db = WalletDB('', manual_upgrades=True)
+        self._write_changes(storage, db)
+        with open(self.wallet_path, "r") as f:
+            self.assertEqual(3, len(f.read().split('\n')))
+        storage2 = WalletStorage(self.wallet_path)
+        self.assertTrue(storage2.is_encrypted_with_user_pw())
+        with self.assertRaises(InvalidPassword):
+            storage2.check_password('wrong')
+        storage2.decrypt('secret')
+        db2 = WalletDB(storage2.read(), manual_upgrades=True)
+        self.assertEqual(db.dump(), db2.dump())
+
+    def test_incomplete_appended_write_is_ignored(self):
+        storage = WalletStorage(self.wallet_path)
+        db = WalletDB('', manual_upgrades=True)
+        self._write_changes(storage, db)
+        with open(self.wallet_path, "a") as f:
+            f.write('\n[["set", ["a"], "interrup')
+        db2 = WalletDB(WalletStorage(self.wallet_path).read(), manual_upgrades=True)
+        self.assertEqual(db.dump(), db2.dump())
+
+    def test_untracked_change_writes_in_full(self):
+        storage = WalletStorage(self.wallet_path)
+        db = WalletDB('', manual_upgrades=True)
+        db.put('a', 'b')
+        db.write(storage)
+        db.set_modified(True)
+        db.write(storage)
+        with open(self.wallet_path, "r") as f:
+            self.assertEqual(json.loads(db.dump()), json.loads(f.read()))
+        # a new storage object does not know what the file holds
+        db.put('a', 'c')
+        storage2 = WalletStorage(self.wallet_path)
+        db.write(storage2)
+        with open(self.wallet_path, "r") as f:
+            self.assertEqual('c', json.loads(f.read())['a'])
+
+class TestWalletDBTransactions(WalletTestCase):
+
+    raw_tx = ('01000000012a5c9a94fcde98f5581cd00162c60a13936ceb75389ea65bf38633b424eb4031000000006c493046022100a82b'
+              'bc57a0136751e5433f41cf000b3f1a99c6744775e76ec764fb78c54ee100022100f9e80b7de89de861dc6fb0c1429d5da72c'
+              '2b6b2ee2406bc9bfb1beedd729d985012102e61d176da16edd1d258a200ad9759ef63adf8e14cd97f53227bae35cdb84d2f6'
+              'ffffffff0140420f00000000001976a914230ac37834073a42146f11ef8414ae929feaafc388ac00000000')
+
+    def test_transactions_are_loaded_on_demand(self):
+        txid = Transaction(self.raw_tx).txid()
+        raw_db = json.dumps({'seed_version': FINAL_SEED_VERSION,
+                             'transactions': {txid: self.raw_tx},
+                             'txo': {txid: {'addr': {'0': [1000000, False]}}}})
+        db = WalletDB(raw_db, manual_upgrades=False)
+        self.assertEqual(self.raw_tx, db.transactions[txid])
+        self.assertEqual(0, len(db._tx_cache))
+        self.assertTrue(db.has_transaction(txid))
+        tx = db.get_transaction(txid)
+        self.assertEqual(txid, tx.txid())
+        self.assertIs(tx, db.get_transaction(txid))
+        self.assertIs(tx, db.remove_transaction(txid))
+        self.assertIsNone(db.get_transaction(txid))
+        self.assertFalse(db.has_transaction(txid))
+
+    def test_transaction_cache_is_bounded(self):
+        db = WalletDB('', manual_upgrades=True)
+        db._tx_cache = LRUCache(2)
+        txs = []
+        for locktime in range(3):
+            tx = tx_from_any(self.raw_tx)
+            tx.locktime = locktime
+            db.add_transaction(tx.txid(), tx)
+            txs.append(tx)
+        self.assertEqual(2, len(db._tx_cache))
+        # evicted transactions are deserialized again from the stored raw tx
+        tx = db.get_transaction(txs[0].txid())
+        self.assertIsNot(txs[0], tx)
+        self.assertEqual(txs[0].serialize(), tx.serialize())
+        self.assertEqual(txs[0].serialize(), json.loads(db.dump())['transactions'][tx.txid()])
+
+
+
+class TestHistoryIndex(ElectrumTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.asyncio_loop, self._stop_loop, self._loop_thread = create_and_start_event_loop()
+        self.adb = AddressSynchronizer(WalletDB('', manual_upgrades=True))
+
+    def tearDown(self):
+        super().tearDown()
+        self.asyncio_loop.call_soon_threadsafe(self._stop_loop.set_result, 1)
+        self._loop_thread.join(timeout=1)
+
+    @staticmethod
+    def make_tx(prevout_txid: str, prevout_n: int, values) -> Transaction:
+        outputs = ''.join(v.to_bytes(8, 'little').hex() + '1976a914' + os.urandom(20).hex() + '88ac'
+                          for v in values)
+        return Transaction('02000000' + '01' + bytes.fromhex(prevout_txid)[::-1].hex()
+                           + prevout_n.to_bytes(4, 'little').hex() + '00' + 'ffffffff'
+                           + '%02x' % len(values) + outputs + '00000000')
+
+    def add_tx(self, tx, *mine_outputs) -> str:
+        for n in mine_outputs:
+            self.adb.db.set_addr_history(tx.outputs()[n].address, [])
+        self.assertTrue(self.adb.add_transaction(tx))
+        return tx.txid()
+
+    def get_history(self, domain=None):
+        return [(item.txid, item.delta, item.balance) for item in self.adb.get_history(domain=domain)]
+
+    def test_history_is_updated_incrementally(self):
+        tx1 = self.make_tx(os.urandom(32).hex(), 0, [100000, 5000])
+        tx2 = self.make_tx(tx1.txid(), 0, [60000, 30000])
+        tx3 = self.make_tx(os.urandom(32).hex(), 1, [7000])
+        addr_a = tx1.outputs()[0].address
+        addr_b = tx2.outputs()[0].address
+        for addr in (addr_a, addr_b):
+            self.adb.db.set_addr_history(addr, [])
+        # the spending tx is added first
+        txid2 = self.add_tx(tx2)
+        self.assertEqual([(txid2, 60000, 60000)], self.get_history())
+        txid1 = self.add_tx(tx1)
+        self.assertEqual({(txid1, 100000), (txid2, -40000)},
+                         {(txid, delta) for txid, delta, balance in self.get_history()})
+        self.assertEqual(60000, self.get_history()[-1][2])
+        self.assertFalse(self.adb._history_dirty)
+
+        self.adb.add_verified_tx(txid2, TxMinedInfo(height=20, conf=1, timestamp=0, txpos=0, header_hash='00'))
+        self.adb.add_verified_tx(txid1, TxMinedInfo(height=10, conf=1, timestamp=0, txpos=3, header_hash='00'))
+        txid3 = self.add_tx(tx3, 0)
+        self.adb.add_unverified_tx(txid3, TX_HEIGHT_UNCONFIRMED)
+        self.assertEqual([(txid1, 100000, 100000), (txid2, -40000, 60000), (txid3, 7000, 67000)],
+                         self.get_history())
+        self.assertEqual([(txid1, 100000, 100000), (txid2, -100000, 0)], self.get_history(domain=[addr_a]))
+        self.assertEqual([(txid2, 60000, 60000)], self.get_history(domain=[addr_b]))
+
+        # reorg
+        class FakeBlockchain:
+            def read_header(self, height):
+                return None
+        self.assertEqual({txid2}, self.adb.undo_verifications(FakeBlockchain(), 15))
+        self.adb.add_verified_tx(txid2, TxMinedInfo(height=30, conf=1, timestamp=0, txpos=0, header_hash='00'))
+        self.adb.add_unverified_tx(txid3, 25)
+        self.assertEqual([txid1, txid3, txid2], [txid for txid, delta, balance in self.get_history()])
+        self.assertEqual([100000, 107000, 67000], [balance for txid, delta, balance in self.get_history()])
+
+        self.adb.remove_transaction(txid2)
+        self.assertEqual([(txid1, 100000, 100000), (txid3, 7000, 107000)], self.get_history())
+        self.assertEqual(TX_HEIGHT_LOCAL, self.adb.get_tx_height(txid2).height)
+
+        # the index matches one built from scratch
+        history = self.adb.get_history()
+        self.adb._reset_history_index()
+        self.assertEqual(history, self.adb.get_history())
+
+    def get_utxos(self, **kwargs):
+        return {(utxo.prevout.to_str(), utxo.block_height) for utxo in self.adb.get_utxos(**kwargs)}
+
+    def test_utxos_are_updated_incrementally(self):
+        tx1 = self.make_tx(os.urandom(32).hex(), 0, [100000, 5000])
+        tx2 = self.make_tx(tx1.txid(), 0, [60000])
+        # coinstake: the first output is empty
+        coinstake = self.make_tx(os.urandom(32).hex(), 1, [0, 7000])
+        coinstake = Transaction(coinstake.serialize().replace(coinstake.outputs()[0].serialize_to_network().hex(),
+                                                              '0000000000000000' + '00'))
+        self.assertTrue(coinstake.is_coinstake())
+        for addr in (tx1.outputs()[0].address, tx2.outputs()[0].address):
+            self.adb.db.set_addr_history(addr, [])
+        # the spending tx is added first
+        txid2 = self.add_tx(tx2)
+        self.assertEqual({(txid2 + ':0', TX_HEIGHT_LOCAL)}, self.get_utxos())
+        txid1 = self.add_tx(tx1, 1)
+        self.assertEqual({(txid1 + ':1', TX_HEIGHT_LOCAL), (txid2 + ':0', TX_HEIGHT_LOCAL)}, self.get_utxos())
+
+        self.adb.add_verified_tx(txid1, TxMinedInfo(height=10, conf=1, timestamp=0, txpos=0, header_hash='00'))
+        self.assertEqual({(txid1 + ':1', 10)}, self.get_utxos(confirmed_only=True))
+        self.assertEqual({(txid1 + ':1', 10)}, self.get_utxos(nonlocal_only=True))
+        self.adb.add_unverified_tx(txid2, TX_HEIGHT_UNCONFIRMED)
+        self.assertEqual({(txid1 + ':1', 10), (txid2 + ':0', TX_HEIGHT_UNCONFIRMED)},
+                         self.get_utxos(nonlocal_only=True))
+        self.assertEqual({(txid2 + ':0', TX_HEIGHT_UNCONFIRMED)},
+                         self.get_utxos(domain=[tx2.outputs()[0].address]))
+
+        # maturity of coinstake outputs follows the local height
+        txid3 = self.add_tx(coinstake, 1)
+        self.adb.add_verified_tx(txid3, TxMinedInfo(height=100, conf=1, timestamp=0, txpos=1, header_hash='00'))
+        self.adb.db.put('stored_height', 100)
+        self.assertIn((txid3 + ':1', 100), self.get_utxos())
+        self.assertNotIn((txid3 + ':1', 100), self.get_utxos(mature_only=True))
+        self.adb.db.put('stored_height', 99 + constants.net.coinbase_maturity(100))
+        self.assertIn((txid3 + ':1', 100), self.get_utxos(mature_only=True))
+        self.assertEqual({txid3 + ':1'}, {prevout.to_str() for prevout in
+                                          self.adb.get_addr_utxo(coinstake.outputs()[1].address)})
+
+        self.adb.remove_transaction(txid2)
+        utxos = self.get_utxos()
+        self.assertEqual({(txid1 + ':0', 10), (txid1 + ':1', 10), (txid3 + ':1', 100)}, utxos)
+        self.assertFalse(self.adb._utxos_dirty)
+
+        # the index matches one built from scratch, and the outputs of each address
+        self.assertEqual(utxos, {(prevout.to_str(), utxo.block_height)
+                                 for addr in self.adb.get_addresses()
+                                 for prevout, utxo in self.adb.get_addr_outputs(addr).items()
+                                 if utxo.spent_height is None})
+        self.adb._reset_utxo_index()
+        self.assertEqual(utxos, self.get_utxos())
+
+    def legacy_addr_balance(self, addr, excluded_coins=()):
+        received, sent = self.adb.get_addr_io(addr)
+        c = u = x = 0
+        mempool_height = self.adb.get_local_height() + 1
+        for txo, (tx_height, v, is_cb) in received.items():
+            if txo in excluded_coins:
+                continue
+            if is_cb and tx_height + constants.net.coinbase_maturity(mempool_height) > mempool_height:
+                x += v
+            elif tx_height > 0:
+                c += v
+            else:
+                u += v
+            if txo in sent:
+                if sent[txo] > 0:
+                    c -= v
+                else:
+                    u -= v
+        return c, u, x
+
+    def assert_balances(self, excluded_coins=()):
+        addrs = self.adb.get_addresses()
+        for addr in addrs:
+            self.assertEqual(self.legacy_addr_balance(addr, excluded_coins),
+                             self.adb.get_addr_balance(addr, excluded_coins=set(excluded_coins)))
+        self.assertEqual(tuple(map(sum, zip(*(self.legacy_addr_balance(addr, excluded_coins) for addr in addrs)))),
+                         self.adb.get_balance(excluded_coins=set(excluded_coins)))
+
+    def test_balances_are_updated_incrementally(self):
+        tx1 = self.make_tx(os.urandom(32).hex(), 0, [100000, 5000])
+        tx2 = self.make_tx(tx1.txid(), 0, [60000])
+        coinstake = self.make_tx(os.urandom(32).hex(), 1, [0, 7000])
+        coinstake = Transaction(coinstake.serialize().replace(coinstake.outputs()[0].serialize_to_network().hex(),
+                                                              '0000000000000000' + '00'))
+        addr_a = tx1.outputs()[0].address
+        addr_b = tx2.outputs()[0].address
+        addr_c = coinstake.outputs()[1].address
+        for addr in (addr_a, addr_b, addr_c):
+            self.adb.db.set_addr_history(addr, [])
+        self.adb.db.put('stored_height', 100)
+        self.assertEqual((0, 0, 0), self.adb.get_balance())
+        txid2 = self.add_tx(tx2)
+        self.assertEqual((0, 60000, 0), self.adb.get_balance())
+        txid1 = self.add_tx(tx1)
+        self.assertEqual((0, 60000, 0), self.adb.get_balance())
+        self.assert_balances()
+        self.adb.add_verified_tx(txid1, TxMinedInfo(height=10, conf=1, timestamp=0, txpos=0, header_hash='00'))
+        self.assertEqual((100000, -40000, 0), self.adb.get_balance())
+        self.assertEqual((100000, -100000, 0), self.adb.get_addr_balance(addr_a))
+        self.adb.add_verified_tx(txid2, TxMinedInfo(height=20, conf=1, timestamp=0, txpos=0, header_hash='00'))
+        self.assertEqual((60000, 0, 0), self.adb.get_balance())
+        self.assertEqual((0, 0, 0), self.adb.get_balance(excluded_addresses={addr_b}))
+        self.assert_balances(excluded_coins=[txid2 + ':0'])
+
+        # coinstake outputs mature with new blocks
+        txid3 = self.add_tx(coinstake)
+        self.adb.add_verified_tx(txid3, TxMinedInfo(height=100, conf=1, timestamp=0, txpos=1, header_hash='00'))
+        self.assertEqual((60000, 0, 7000), self.adb.get_balance())
+        self.assert_balances()
+        self.adb.db.put('stored_height', 99 + constants.net.coinbase_maturity(100))
+        self.assertEqual((67000, 0, 0), self.adb.get_balance())
+        self.assertEqual((60000, 0, 0), self.adb.get_balance(excluded_coins={txid3 + ':1'}))
+        # a reorg below the tip
+        self.adb.db.put('stored_height', 150)
+        self.assertEqual((60000, 0, 7000), self.adb.get_balance())
+        self.assert_balances()
+
+        self.adb.remove_transaction(txid2)
+        self.assertEqual((100000, 0, 7000), self.adb.get_balance())
+        self.assert_balances()
+        self.assertFalse(self.adb._balance_dirty)
+        balances = dict(self.adb._addr_balances)
+        self.adb._reset_balance_index()
+        self.adb.get_balance()
+        self.assertEqual(balances, self.adb._addr_balances)
+
+    def test_clear_history(self):
+        txid = self.add_tx(self.make_tx(os.urandom(32).hex(), 0, [1000]), 0)
+        self.assertEqual([(txid, 1000, 1000)], self.get_history())
+        self.adb.clear_history()
+        self.assertEqual([], self.get_history())
+
+
+
+class TestTokenTransfers(ElectrumTestCase):
+
+    contract_addr = 'ab' * 20
+
+    def make_log(self, from_h160: bytes, to_h160: bytes, amount: int, *, topic=TOKEN_TRANSFER_TOPIC) -> dict:
+        return {'address': self.contract_addr,
+                'topics': [topic, from_h160.hex().zfill(64), to_h160.hex().zfill(64)],
+                'data': '%064x' % amount}
+
+    def test_transfers_are_indexed_by_token_key(self):
+        adb = AddressSynchronizer(WalletDB('', manual_upgrades=True))
+        mine, other = os.urandom(20), os.urandom(20)
+        key = Token(self.contract_addr, hash160_to_p2pkh(mine), 'name', 'SYM', 8, 0).get_key()
+        txid1, txid2 = os.urandom(32).hex(), os.urandom(32).hex()
+        adb.add_tx_receipt(txid1, [{'transactionHash': txid1,
+                                    'log': [self.make_log(other, other, 1, topic='00' * 32),
+                                            self.make_log(other, mine, 500)]}])
+        adb.add_tx_receipt(txid2, [{'transactionHash': txid2, 'log': [self.make_log(mine, other, 200)]}])
+        self.assertEqual([], adb.get_token_transfers(key))
+        adb.receive_token_history_callback(key, [[txid1, 100, 1], [txid2, 101, 0]])
+        transfers = adb.get_token_transfers(key)
+        self.assertEqual([(txid1, 100, 500, 1), (txid2, 101, 200, 0)],
+                         [(txid, height, t.amount, t.log_index) for txid, height, t in transfers])
+        self.assertEqual((hash160_to_p2pkh(other), hash160_to_p2pkh(mine)),
+                         (transfers[0][2].from_addr, transfers[0][2].to_addr))
+        # an updated receipt replaces the transfers of the tx
+        adb.add_tx_receipt(txid1, [{'transactionHash': txid1, 'log': [self.make_log(other, other, 1)]}])
+        self.assertEqual([txid2], [txid for txid, height, t in adb.get_token_transfers(key)])
+        # and the index is rebuilt when the wallet is loaded
+        adb2 = AddressSynchronizer(WalletDB(adb.db.dump(), manual_upgrades=False))
+        self.assertEqual(adb.get_token_transfers(key), adb2.get_token_transfers(key))
+
+
+class TestGapLimit(WalletTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.asyncio_loop, self._stop_loop, self._loop_thread = create_and_start_event_loop()
+        self.config.set_key('skipmerklecheck', True)
+        db = WalletDB('', manual_upgrades=False)
+        node = BIP32Node.from_rootseed(os.urandom(32), xtype='standard')
+        db.put('keystore', keystore.from_xpub(node.to_xpub()).dump())
+        db.put('stored_height', 100)
+        self.wallet = Standard_Wallet(db, None, config=self.config)
+
+    def tearDown(self):
+        super().tearDown()
+        self.asyncio_loop.call_soon_threadsafe(self._stop_loop.set_result, 1)
+        self._loop_thread.join(timeout=1)
+
+    def receive_history(self, n: int, height: int) -> None:
+        address = self.wallet.get_receiving_addresses()[n]
+        self.wallet.receive_history_callback(address, [(os.urandom(32).hex(), height)], {})
+
+    def test_addresses_are_derived_past_the_last_old_address(self):
+        wallet = self.wallet
+        self.assertEqual(20, len(wallet.get_receiving_addresses()))
+        self.assertEqual(10, len(wallet.get_change_addresses()))
+        self.receive_history(5, 90)
+        wallet.synchronize()
+        self.assertEqual(26, len(wallet.get_receiving_addresses()))
+        # not old yet: 2 confirmations
+        self.receive_history(24, 99)
+        wallet.synchronize()
+        self.assertEqual(26, len(wallet.get_receiving_addresses()))
+        wallet.db.put('stored_height', 101)
+        wallet.synchronize()
+        self.assertEqual(45, len(wallet.get_receiving_addresses()))
+        self.assertEqual(10, len(wallet.get_change_addresses()))
+        # a larger gap limit applies to the same old addresses
+        self.assertTrue(wallet.change_gap_limit(30))
+        self.assertEqual(55, len(wallet.get_receiving_addresses()))
+        self.assertEqual(wallet.derive_address(0, 54), wallet.get_receiving_addresses()[54])
+
+
 class FakeExchange(ExchangeBase):
     def __init__(self, rate):
         super().__init__(lambda self: None, lambda self: None)
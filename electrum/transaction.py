@@ -38,6 +38,7 @@ from enum import IntEnum
 import itertools
 import binascii
 import copy
+import hashlib
 
 from . import ecc, bitcoin, constants, segwit_addr, bip32
 from .bip32 import BIP32Node
@@ -477,6 +478,26 @@ def match_script_against_template(script, template) -> bool:
 
 
 def get_address_from_output_script(_bytes: bytes, *, net=None) -> Optional[str]:
+    # fast path: recognize the common scripts by their bytes, without decoding them
+    script_len = len(_bytes)
+    if script_len == 25 and _bytes[0:3] == b'\x76\xa9\x14' and _bytes[23:25] == b'\x88\xac':
+        return hash160_to_p2pkh(_bytes[3:23], net=net)
+    if script_len == 23 and _bytes[0:2] == b'\xa9\x14' and _bytes[22] == opcodes.OP_EQUAL:
+        return hash160_to_p2sh(_bytes[2:22], net=net)
+    if script_len in (35, 67) and _bytes[0] == script_len - 2 and _bytes[-1] == opcodes.OP_CHECKSIG:
+        return public_key_to_p2pkh(_bytes[1:-1], net=net)
+    if script_len == 0:
+        return None  # coinstake marker output
+    if _bytes[-1] in (opcodes.OP_CALL, opcodes.OP_CREATE):
+        # contract outputs (incl. OP_SENDER ones) have no address. Of the
+        # templates below, only a witness program can end with these bytes.
+        if not (2 <= script_len - 2 <= 40 and _bytes[1] == script_len - 2
+                and (_bytes[0] == opcodes.OP_0 or opcodes.OP_1 <= _bytes[0] <= opcodes.OP_16)):
+            return None
+    return _get_address_from_decoded_output_script(_bytes, net=net)
+
+
+def _get_address_from_decoded_output_script(_bytes: bytes, *, net=None) -> Optional[str]:
     try:
         decoded = [x for x in script_GetOp(_bytes)]
     except MalformedBitcoinScript:
@@ -535,6 +556,99 @@ def parse_witness(vds: BCDataStream, txin: TxInput) -> None:
     txin.witness = bfh(construct_witness(witness_elements))
 
 
+_unpack_int32 = struct.Struct('<i').unpack_from
+_unpack_uint16 = struct.Struct('<H').unpack_from
+_unpack_uint32 = struct.Struct('<I').unpack_from
+_unpack_int64 = struct.Struct('<q').unpack_from
+_unpack_uint64 = struct.Struct('<Q').unpack_from
+
+
+def _read_compact_size(raw: bytes, pos: int) -> Tuple[int, int]:
+    """Returns the compact size at raw[pos], and the position after it."""
+    size = raw[pos]
+    if size < 253:
+        return size, pos + 1
+    if size == 253:
+        return _unpack_uint16(raw, pos + 1)[0], pos + 3
+    if size == 254:
+        return _unpack_uint32(raw, pos + 1)[0], pos + 5
+    return _unpack_uint64(raw, pos + 1)[0], pos + 9
+
+
+def _read_slice(raw: bytes, pos: int, length: int) -> bytes:
+    end = pos + length
+    if end > len(raw):
+        raise SerializationError('attempt to read past end of buffer')
+    return raw[pos:end]
+
+
+def parse_network_tx(raw: bytes) -> Tuple[int, List[TxInput], List[TxOutput], int, str]:
+    """Parses a network serialized transaction in a single pass.
+    Returns (version, inputs, outputs, locktime, txid).
+    Fields are read in place with struct.unpack_from, and each script is
+    copied out of `raw` once. The txid is hashed from the original bytes,
+    rather than from a re-serialization of the parsed tx.
+    """
+    try:
+        version, = _unpack_int32(raw, 0)
+        n_vin, pos = _read_compact_size(raw, 4)
+        is_segwit = (n_vin == 0)
+        if is_segwit:
+            marker = raw[pos:pos + 1]
+            if marker != b'\x01':
+                raise ValueError('invalid txn marker byte: {}'.format(marker))
+            n_vin, pos = _read_compact_size(raw, pos + 1)
+        if n_vin < 1:
+            raise SerializationError('tx needs to have at least 1 input')
+        inputs = []
+        for i in range(n_vin):
+            prevout_hash = _read_slice(raw, pos, 32)[::-1]
+            prevout_n, = _unpack_uint32(raw, pos + 32)
+            script_len, pos = _read_compact_size(raw, pos + 36)
+            script_sig = _read_slice(raw, pos, script_len)
+            nsequence, = _unpack_uint32(raw, pos + script_len)
+            pos += script_len + 4
+            inputs.append(TxInput(prevout=TxOutpoint(txid=prevout_hash, out_idx=prevout_n),
+                                  script_sig=script_sig, nsequence=nsequence))
+        n_vout, pos = _read_compact_size(raw, pos)
+        if n_vout < 1:
+            raise SerializationError('tx needs to have at least 1 output')
+        outputs = []
+        for i in range(n_vout):
+            value, = _unpack_int64(raw, pos)
+            if value > 90000000000 * COIN:
+                raise SerializationError('invalid output amount (too large)')
+            if value < 0:
+                raise SerializationError('invalid output amount (negative)')
+            script_len, pos = _read_compact_size(raw, pos + 8)
+            outputs.append(TxOutput(value=value, scriptpubkey=_read_slice(raw, pos, script_len)))
+            pos += script_len
+        outputs_end = pos
+        if is_segwit:
+            for txin in inputs:
+                witness_start = pos
+                n, pos = _read_compact_size(raw, pos)
+                for j in range(n):
+                    item_len, pos = _read_compact_size(raw, pos)
+                    pos += item_len
+                txin.witness = _read_slice(raw, witness_start, pos - witness_start)
+        locktime, = _unpack_uint32(raw, pos)
+    except (IndexError, struct.error) as e:
+        raise SerializationError('attempt to read past end of buffer') from e
+    if pos + 4 != len(raw):
+        raise SerializationError('extra junk at the end')
+    if is_segwit:
+        # the txid commits to the tx without marker, flag and witnesses
+        buf = memoryview(raw)
+        h = hashlib.sha256(buf[0:4])
+        h.update(buf[6:outputs_end])
+        h.update(buf[pos:pos + 4])
+        txid = hashlib.sha256(h.digest()).digest()
+    else:
+        txid = sha256d(raw)
+    return version, inputs, outputs, locktime, txid[::-1].hex()
+
+
 def parse_output(vds: BCDataStream) -> TxOutput:
     value = vds.read_int64()
     if value > 90000000000 * COIN:
@@ -623,29 +737,12 @@ class Transaction:
             return
 
         raw_bytes = bfh(self._cached_network_ser)
-        vds = BCDataStream()
-        vds.write(raw_bytes)
-        self._version = vds.read_int32()
-        n_vin = vds.read_compact_size()
-        is_segwit = (n_vin == 0)
-        if is_segwit:
-            marker = vds.read_bytes(1)
-            if marker != b'\x01':
-                raise ValueError('invalid txn marker byte: {}'.format(marker))
-            n_vin = vds.read_compact_size()
-        if n_vin < 1:
-            raise SerializationError('tx needs to have at least 1 input')
-        self._inputs = [parse_input(vds) for i in range(n_vin)]
-        n_vout = vds.read_compact_size()
-        if n_vout < 1:
-            raise SerializationError('tx needs to have at least 1 output')
-        self._outputs = [parse_output(vds) for i in range(n_vout)]
-        if is_segwit:
-            for txin in self._inputs:
-                parse_witness(vds, txin)
-        self._locktime = vds.read_uint32()
-        if vds.can_read_more():
-            raise SerializationError('extra junk at the end')
+        version, inputs, outputs, locktime, txid = parse_network_tx(raw_bytes)
+        self._version = version
+        self._inputs = inputs
+        self._outputs = outputs
+        self._locktime = locktime
+        self._cached_txid = txid
 
     @classmethod
     def get_siglist(self, txin: 'PartialTxInput', *, estimate_size=False):
@@ -863,7 +960,9 @@ class Transaction:
 
     def txid(self) -> Optional[str]:
         if self._cached_txid is None:
+            # parsing a network serialized tx also hashes its txid
             self.deserialize()
+        if self._cached_txid is None:
             all_segwit = all(txin.is_segwit() for txin in self.inputs())
             if not all_segwit and not self.is_complete():
                 return None
@@ -1625,6 +1724,83 @@ class PartialTxOutput(TxOutput, PSBTSection):
         return bool(decoded[3][1])
 
 
+class SighashCache:
+    """The parts of a tx that the signature hashes of all its inputs (and
+    OP_SENDER outputs) have in common, serialized and hashed once.
+
+    With it, signing all inputs of a legacy tx is linear in the size of the
+    tx, rather than quadratic: the preimage of each input only differs in
+    the script spliced in at that input, so the hash state of the preimage
+    up to that input is kept, and the rest is fed from one buffer.
+    Only valid while the tx is not modified, apart from adding input signatures.
+    """
+
+    def __init__(self, tx: 'PartialTransaction'):
+        self.tx = tx
+        self._bip143_shared_txdigest_fields = None  # type: Optional[BIP143SharedTxDigestFields]
+        self._opsender_hash_outputs = None  # type: Optional[bytes]
+        self._midstates = None  # type: Optional[List]  # hash state of the preimage before each input
+        self._input_offsets = None  # type: Optional[List[int]]
+        self._inputs_blob = None  # type: Optional[memoryview]  # inputs, serialized with empty scripts
+        self._preimage_tail = None  # type: Optional[bytes]  # outputs, locktime, hash type
+
+    @property
+    def bip143_shared_txdigest_fields(self) -> BIP143SharedTxDigestFields:
+        if self._bip143_shared_txdigest_fields is None:
+            self._bip143_shared_txdigest_fields = self.tx._calc_bip143_shared_txdigest_fields()
+        return self._bip143_shared_txdigest_fields
+
+    @property
+    def opsender_hash_outputs(self) -> bytes:
+        # OP_SENDER signatures commit to the outputs without their signatures,
+        # so this does not change while they are added
+        if self._opsender_hash_outputs is None:
+            self._opsender_hash_outputs = sha256d(b''.join(o.serialize_to_network(without_opsender_sig=True)
+                                                           for o in self.tx.outputs()))
+        return self._opsender_hash_outputs
+
+    def _init_legacy(self) -> None:
+        tx = self.tx
+        inputs = tx.inputs()
+        outputs = tx.outputs()
+        h = hashlib.sha256(int.to_bytes(tx.version, 4, byteorder='little', signed=True)
+                           + bfh(var_int(len(inputs))))
+        self._midstates = []
+        self._input_offsets = [0]
+        blobs = []
+        for txin in inputs:
+            blob = txin.prevout.serialize_to_network() + b'\x00' + int.to_bytes(txin.nsequence, 4, byteorder='little')
+            self._midstates.append(h.copy())
+            h.update(blob)
+            blobs.append(blob)
+            self._input_offsets.append(self._input_offsets[-1] + len(blob))
+        self._inputs_blob = memoryview(b''.join(blobs))
+        self._preimage_tail = (bfh(var_int(len(outputs)))
+                               + b''.join(o.serialize_to_network() for o in outputs)
+                               + int.to_bytes(tx.locktime, 4, byteorder='little')
+                               + int.to_bytes(SIGHASH_ALL, 4, byteorder='little'))
+
+    def get_sighash(self, txin_index: int) -> bytes:
+        """Returns the double-SHA256 of serialize_preimage(txin_index)."""
+        txin = self.tx.inputs()[txin_index]
+        if txin.is_segwit():
+            return sha256d(bfh(self.tx.serialize_preimage(
+                txin_index, bip143_shared_txdigest_fields=self.bip143_shared_txdigest_fields)))
+        sighash = txin.sighash if txin.sighash is not None else SIGHASH_ALL
+        if sighash != SIGHASH_ALL:
+            raise Exception("only SIGHASH_ALL signing is supported!")
+        preimage_script = bfh(self.tx.get_preimage_script(txin))
+        if self._midstates is None:
+            self._init_legacy()
+        h = self._midstates[txin_index].copy()
+        h.update(txin.prevout.serialize_to_network()
+                 + bfh(var_int(len(preimage_script))) + preimage_script
+                 + int.to_bytes(txin.nsequence, 4, byteorder='little'))
+        h.update(self._inputs_blob[self._input_offsets[txin_index + 1]:])
+        h.update(self._preimage_tail)
+        return hashlib.sha256(h.digest()).digest()
+
+
 class PartialTransaction(Transaction):
 
     def __init__(self):
@@ -1903,6 +2079,7 @@ class PartialTransaction(Transaction):
 
     def sign(self, keypairs: dict) -> None:
         # sign op_sender
+        opsender_sighash_cache = SighashCache(self)
         for i, txout in enumerate(self.outputs()):
             decoded = decode_opsender_script(txout.scriptpubkey)
             if (decoded is not None) and (not decoded[3][1]):
@@ -1911,13 +2088,14 @@ class PartialTransaction(Transaction):
                 for pubkey, (priv, compressed) in keypairs.items():
                     if hash_160(bfh(pubkey)) == h160:
                         found = True
-                        self.sign_opsender(i, priv)
+                        self.sign_opsender(i, priv, sighash_cache=opsender_sighash_cache)
                         break
                 if not found:
                     raise Exception("Failed to find privkey for op_sender")
 
         # keypairs:  pubkey_hex -> (secret_bytes, is_compressed)
-        bip143_shared_txdigest_fields = self._calc_bip143_shared_txdigest_fields()
+        # note: created after the OP_SENDER signatures are in the outputs
+        sighash_cache = SighashCache(self)
         for i, txin in enumerate(self.inputs()):
             pubkeys = [pk.hex() for pk in txin.pubkeys]
             for pubkey in pubkeys:
@@ -1927,24 +2105,25 @@ class PartialTransaction(Transaction):
                     continue
                 _logger.info(f"adding signature for {pubkey}")
                 sec, compressed = keypairs[pubkey]
-                sig = self.sign_txin(i, sec, bip143_shared_txdigest_fields=bip143_shared_txdigest_fields)
+                sig = self.sign_txin(i, sec, sighash_cache=sighash_cache)
                 self.add_signature_to_txin(txin_idx=i, signing_pubkey=pubkey, sig=sig)
 
         _logger.debug(f"is_complete {self.is_complete()}")
         self.invalidate_ser_cache()
 
-    def opsender_preimage(self, out_index: int) -> str:
+    def opsender_preimage(self, out_index: int, *, sighash_cache: SighashCache = None) -> str:
         nVersion = int_to_hex(self.version, 4)
         nLocktime = int_to_hex(self.locktime, 4)
         nHashType = int_to_hex(SIGHASH_ALL, 4)
 
-        inputs = self.inputs()
         outputs = self.outputs()
         txout = outputs[out_index]
 
-        hashPrevouts = sha256d(b''.join(txin.prevout.serialize_to_network() for txin in inputs)).hex()
-        hashSequence = sha256d(bfh(''.join(int_to_hex(txin.nsequence, 4) for txin in inputs))).hex()
-        hashOutputs = sha256d(b''.join(txout.serialize_to_network(without_opsender_sig=True) for txout in outputs)).hex()
+        if sighash_cache is None:
+            sighash_cache = SighashCache(self)
+        hashPrevouts = sighash_cache.bip143_shared_txdigest_fields.hashPrevouts
+        hashSequence = sighash_cache.bip143_shared_txdigest_fields.hashSequence
+        hashOutputs = sighash_cache.opsender_hash_outputs.hex()
 
         outpoint = txout.serialize_to_network().hex()
         preimage_script = pubkeyhash_to_p2pkh_script(h160_from_opsender_script(txout.scriptpubkey).hex())
@@ -1955,8 +2134,8 @@ class PartialTransaction(Transaction):
                    + amount + hashOutputs + nLocktime + nHashType
         return preimage
 
-    def sign_opsender(self, out_index: int, privkey: bytes):
-        sig_hash = sha256d(bfh(self.opsender_preimage(out_index)))
+    def sign_opsender(self, out_index: int, privkey: bytes, *, sighash_cache: SighashCache = None):
+        sig_hash = sha256d(bfh(self.opsender_preimage(out_index, sighash_cache=sighash_cache)))
         privkey = ecc.ECPrivkey(privkey)
 
         sig = bfh(push_data((privkey.sign_transaction(sig_hash) + b'\x01').hex()))
@@ -1967,11 +2146,15 @@ class PartialTransaction(Transaction):
         script = update_opsender_sig(script, sig)
         self._outputs[out_index].scriptpubkey = script
 
-    def sign_txin(self, txin_index, privkey_bytes, *, bip143_shared_txdigest_fields=None) -> str:
+    def sign_txin(self, txin_index, privkey_bytes, *, bip143_shared_txdigest_fields=None,
+                  sighash_cache: SighashCache = None) -> str:
         txin = self.inputs()[txin_index]
         txin.validate_data(for_signing=True)
-        pre_hash = sha256d(bfh(self.serialize_preimage(txin_index,
-                                                       bip143_shared_txdigest_fields=bip143_shared_txdigest_fields)))
+        if sighash_cache is not None:
+            pre_hash = sighash_cache.get_sighash(txin_index)
+        else:
+            pre_hash = sha256d(bfh(self.serialize_preimage(txin_index,
+                                                           bip143_shared_txdigest_fields=bip143_shared_txdigest_fields)))
         privkey = ecc.ECPrivkey(privkey_bytes)
         sig = privkey.sign_transaction(pre_hash)
         sig = sig.hex() + '01'  # SIGHASH_ALL
@@ -2023,12 +2206,13 @@ class PartialTransaction(Transaction):
             return
         if len(self.inputs()) != len(signatures):
             raise Exception('expected {} signatures; got {}'.format(len(self.inputs()), len(signatures)))
+        sighash_cache = SighashCache(self)
         for i, txin in enumerate(self.inputs()):
             pubkeys = [pk.hex() for pk in txin.pubkeys]
             sig = signatures[i]
             if bfh(sig) in list(txin.part_sigs.values()):
                 continue
-            pre_hash = sha256d(bfh(self.serialize_preimage(i)))
+            pre_hash = sighash_cache.get_sighash(i)
             sig_string = ecc.sig_string_from_der_sig(bfh(sig[:-2]))
             for recid in range(4):
                 try:
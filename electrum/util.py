@@ -1285,6 +1285,52 @@ class OrderedDictWithIndex(OrderedDict):
         return ret
 
 
+class LRUCache:
+    """A bounded mapping that evicts the least recently used key.
+
+    Note: not thread-safe; callers are expected to hold their own lock.
+    """
+
+    def __init__(self, maxsize: int):
+        assert maxsize > 0, maxsize
+        self.maxsize = maxsize
+        self._d = OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            value = self._d[key]
+        except KeyError:
+            return default
+        self._d.move_to_end(key)
+        return value
+
+    def __getitem__(self, key):
+        value = self._d[key]
+        self._d.move_to_end(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self._d[key] = value
+        self._d.move_to_end(key)
+        while len(self._d) > self.maxsize:
+            self._d.popitem(last=False)
+
+    def __contains__(self, key):
+        return key in self._d
+
+    def __len__(self):
+        return len(self._d)
+
+    def pop(self, key, default=None):
+        return self._d.pop(key, default)
+
+    def clear(self):
+        self._d.clear()
+
+    def keys(self):
+        return self._d.keys()
+
+
 def multisig_type(wallet_type):
     '''If wallet_type is mofn multi-sig, return [m, n],
     otherwise return None.'''
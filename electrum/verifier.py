@@ -22,11 +22,13 @@
 # SOFTWARE.
 
 import asyncio
-from typing import Sequence, Optional, TYPE_CHECKING
+from collections import defaultdict
+from typing import Sequence, Optional, TYPE_CHECKING, Dict, Tuple, List
 
 import aiorpcx
+from aiorpcx import run_in_thread
 
-from .util import TxMinedInfo, NetworkJobOnDefaultServer
+from .util import TxMinedInfo, NetworkJobOnDefaultServer, LRUCache
 from .crypto import sha256d
 from .bitcoin import hash_decode, hash_encode
 from .transaction import Transaction
@@ -46,6 +48,12 @@ class MerkleRootMismatch(MerkleVerificationFailure): pass
 class InnerNodeOfSpvProofIsValidTx(MerkleVerificationFailure): pass
 
 
+# max number of merkle proofs verified, and of txs added to the wallet, at once
+PROOF_BATCH_SIZE = 500
+# number of blocks for which the verified nodes of the merkle tree are kept
+MERKLE_NODE_CACHE_SIZE = 100
+
+
 class SPV(NetworkJobOnDefaultServer):
     """ Simple Payment Verification """
 
@@ -57,10 +65,14 @@ class SPV(NetworkJobOnDefaultServer):
         super()._reset()
         self.merkle_roots = {}  # txid -> merkle root (once it has been verified)
         self.requested_merkle = set()  # txid set of pending requests
+        self._proofs = asyncio.Queue()  # (tx_hash, tx_height, merkle) received, not yet verified
+        # merkle root -> verified nodes of the merkle tree of the block
+        self._merkle_nodes = LRUCache(MERKLE_NODE_CACHE_SIZE)
 
     async def _start_tasks(self):
         async with self.taskgroup as group:
             await group.spawn(self.main)
+            await group.spawn(self._verify_proofs)
 
     def diagnostic_name(self):
         return self.wallet.diagnostic_name()
@@ -75,6 +87,7 @@ class SPV(NetworkJobOnDefaultServer):
     async def _request_proofs(self):
         local_height = self.blockchain.height()
         unverified = self.wallet.get_unverified_txs()
+        headers = {}  # height -> header, read once per block
 
         for tx_hash, tx_height in unverified.items():
             # do not request merkle branch if we already requested it
@@ -84,17 +97,18 @@ class SPV(NetworkJobOnDefaultServer):
             if tx_height <= 0 or tx_height > local_height:
                 continue
             # if it's in the checkpoint region, we still might not have the header
-            header = self.blockchain.read_header(tx_height)
-            if header is None:
+            if tx_height not in headers:
+                headers[tx_height] = self.blockchain.read_header(tx_height)
+            if headers[tx_height] is None:
                 if tx_height < constants.net.max_checkpoint():
                     await self.taskgroup.spawn(self.network.request_chunk(tx_height, None, can_return_early=True))
                 continue
             # request now
             self.logger.info(f'requested merkle {tx_hash}')
             self.requested_merkle.add(tx_hash)
-            await self.taskgroup.spawn(self._request_and_verify_single_proof, tx_hash, tx_height)
+            await self.taskgroup.spawn(self._request_proof, tx_hash, tx_height)
 
-    async def _request_and_verify_single_proof(self, tx_hash, tx_height):
+    async def _request_proof(self, tx_hash, tx_height):
         try:
             merkle = await self.network.get_merkle_for_transaction(tx_hash, tx_height)
         except UntrustedServerReturnedError as e:
@@ -104,35 +118,64 @@ class SPV(NetworkJobOnDefaultServer):
             self.wallet.remove_unverified_tx(tx_hash, tx_height)
             self.requested_merkle.discard(tx_hash)
             return
-        # Verify the hash of the server-provided merkle branch to a
-        # transaction matches the merkle root of its block
-        if tx_height != merkle.get('block_height'):
-            self.logger.info('requested tx_height {} differs from received tx_height {} for txid {}'
-                             .format(tx_height, merkle.get('block_height'), tx_hash))
-        tx_height = merkle.get('block_height')
-        pos = merkle.get('pos')
-        merkle_branch = merkle.get('merkle')
+        await self._proofs.put((tx_hash, tx_height, merkle))
+
+    async def _verify_proofs(self):
+        # proofs that arrive while a batch is being verified make up the next batch
+        while True:
+            proofs = [await self._proofs.get()]
+            while not self._proofs.empty() and len(proofs) < PROOF_BATCH_SIZE:
+                proofs.append(self._proofs.get_nowait())
+            await self._verify_proof_batch(proofs)
+
+    async def _verify_proof_batch(self, proofs: Sequence[Tuple[str, int, dict]]) -> None:
+        proofs_by_height = defaultdict(list)  # type: Dict[int, List[Tuple[str, Sequence[str], int]]]
+        for tx_hash, tx_height, merkle in proofs:
+            # Verify the hash of the server-provided merkle branch to a
+            # transaction matches the merkle root of its block
+            if tx_height != merkle.get('block_height'):
+                self.logger.info('requested tx_height {} differs from received tx_height {} for txid {}'
+                                 .format(tx_height, merkle.get('block_height'), tx_hash))
+            proofs_by_height[merkle.get('block_height')].append((tx_hash, merkle.get('merkle'), merkle.get('pos')))
         # we need to wait if header sync/reorg is still ongoing, hence lock:
         async with self.network.bhi_lock:
-            header = self.network.blockchain().read_header(tx_height)
-        try:
-            verify_tx_is_in_block(tx_hash, merkle_branch, pos, header, tx_height)
-        except MerkleVerificationFailure as e:
-            if self.network.config.get("skipmerklecheck"):
-                self.logger.info(f"skipping merkle proof check {tx_hash}")
-            else:
-                self.logger.info(repr(e))
-                raise GracefulDisconnect(e) from e
-        # we passed all the tests
-        self.merkle_roots[tx_hash] = header.get('merkle_root')
-        self.requested_merkle.discard(tx_hash)
-        self.logger.info(f"verified {tx_hash}")
-        header_hash = hash_header(header)
-        tx_info = TxMinedInfo(height=tx_height,
-                              timestamp=header.get('timestamp'),
-                              txpos=pos,
-                              header_hash=header_hash)
-        self.wallet.add_verified_tx(tx_hash, tx_info)
+            blockchain = self.network.blockchain()
+            headers = {height: blockchain.read_header(height) for height in proofs_by_height}
+        failures = await run_in_thread(self._verify_blocks, proofs_by_height, headers)
+        verified = {}
+        for tx_height, block_proofs in proofs_by_height.items():
+            header = headers[tx_height]
+            for tx_hash, merkle_branch, pos in block_proofs:
+                e = failures.get(tx_hash)
+                if e is not None:
+                    if self.network.config.get("skipmerklecheck"):
+                        self.logger.info(f"skipping merkle proof check {tx_hash}")
+                    else:
+                        self.logger.info(repr(e))
+                        raise GracefulDisconnect(e) from e
+                # we passed all the tests
+                self.merkle_roots[tx_hash] = header.get('merkle_root')
+                self.requested_merkle.discard(tx_hash)
+                self.logger.info(f"verified {tx_hash}")
+                verified[tx_hash] = TxMinedInfo(height=tx_height,
+                                                timestamp=header.get('timestamp'),
+                                                txpos=pos,
+                                                header_hash=hash_header(header))
+        self.wallet.add_verified_txs(verified)
+
+    def _verify_blocks(self, proofs_by_height: Dict[int, Sequence[Tuple[str, Sequence[str], int]]],
+                       headers: Dict[int, Optional[dict]]) -> Dict[str, MerkleVerificationFailure]:
+        failures = {}
+        for tx_height, block_proofs in proofs_by_height.items():
+            header = headers[tx_height]
+            known_nodes = None
+            if header:
+                merkle_root = header.get('merkle_root')
+                known_nodes = self._merkle_nodes.get(merkle_root)
+                if known_nodes is None:
+                    known_nodes = self._merkle_nodes[merkle_root] = {}
+            failures.update(verify_txs_in_block(block_proofs, header, tx_height, known_nodes=known_nodes))
+        return failures
 
     @classmethod
     def hash_merkle_root(cls, merkle_branch: Sequence[str], tx_hash: str, leaf_pos_in_tree: int):
@@ -204,3 +247,63 @@ def verify_tx_is_in_block(tx_hash: str, merkle_branch: Sequence[str],
     if block_header.get('merkle_root') != calc_merkle_root:
         raise MerkleRootMismatch("merkle verification failed for {} ({} != {})".format(
             tx_hash, block_header.get('merkle_root'), calc_merkle_root))
+
+
+def verify_txs_in_block(proofs: Sequence[Tuple[str, Sequence[str], int]],
+                        block_header: Optional[dict], block_height: int, *,
+                        known_nodes: Dict[Tuple[int, int], bytes] = None) -> Dict[str, MerkleVerificationFailure]:
+    """Verifies the merkle proofs (tx_hash, merkle_branch, leaf_pos_in_tree)
+    of txs of the same block, and returns the failures by tx_hash.
+
+    known_nodes maps (level, index) to the hash of the nodes of the merkle
+    tree of the block that are known to lead to its merkle root. It is
+    filled as proofs are verified, and the branch of a tx is only hashed
+    up to the first known node.
+    """
+    if known_nodes is None:
+        known_nodes = {}
+    failures = {}
+    for tx_hash, merkle_branch, leaf_pos_in_tree in proofs:
+        try:
+            _verify_tx_with_known_nodes(tx_hash, merkle_branch, leaf_pos_in_tree,
+                                        block_header, block_height, known_nodes)
+        except MerkleVerificationFailure as e:
+            failures[tx_hash] = e
+    return failures
+
+
+def _verify_tx_with_known_nodes(tx_hash: str, merkle_branch: Sequence[str], leaf_pos_in_tree: int,
+                                block_header: Optional[dict], block_height: int,
+                                known_nodes: Dict[Tuple[int, int], bytes]) -> None:
+    if not block_header:
+        raise MissingBlockHeader("merkle verification failed for {} (missing header {})"
+                                 .format(tx_hash, block_height))
+    if len(merkle_branch) > 30:
+        raise MerkleVerificationFailure(f"merkle branch too long: {len(merkle_branch)}")
+    try:
+        h = hash_decode(tx_hash)
+        merkle_branch_bytes = [hash_decode(item) for item in merkle_branch]
+        index = int(leaf_pos_in_tree)  # raise if invalid
+    except Exception as e:
+        raise MerkleVerificationFailure(e)
+    if index < 0:
+        raise MerkleVerificationFailure('leaf_pos_in_tree must be non-negative')
+    path = []
+    for level, item in enumerate(merkle_branch_bytes):
+        if known_nodes.get((level, index)) == h:
+            break
+        path.append(((level, index), h))
+        if len(item) != 32:
+            raise MerkleVerificationFailure('all merkle branch items have to 32 bytes long')
+        inner_node = (item + h) if (index & 1) else (h + item)
+        SPV._raise_if_valid_tx(inner_node.hex())
+        h = sha256d(inner_node)
+        index >>= 1
+    else:
+        if index != 0:
+            raise MerkleVerificationFailure(f'leaf_pos_in_tree too large for branch')
+        calc_merkle_root = hash_encode(h)
+        if block_header.get('merkle_root') != calc_merkle_root:
+            raise MerkleRootMismatch("merkle verification failed for {} ({} != {})".format(
+                tx_hash, block_header.get('merkle_root'), calc_merkle_root))
+    known_nodes.update(path)
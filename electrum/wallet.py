@@ -35,7 +35,6 @@ import copy
 import errno
 import traceback
 import operator
-import binascii
 import math
 from functools import partial
 from collections import defaultdict
@@ -60,7 +59,7 @@ from .util import get_backup_dir
 from .simple_config import SimpleConfig
 from .bitcoin import (COIN, TYPE_ADDRESS, TYPE_PUBKEY, is_address, address_to_script, serialize_privkey,
                       is_minikey, relayfee, dust_threshold, RECOMMEND_CONFIRMATIONS,
-                      TOKEN_TRANSFER_TOPIC, b58_address_to_hash160, hash160_to_p2pkh)
+                      hash160_to_p2pkh)
 from .crypto import sha256d
 from . import keystore
 from .keystore import load_keystore, Hardware_KeyStore, KeyStore, Mobile_KeyStore, Qt_Core_Keystore, KeyStoreWithMPK, AddressIndexGeneric
@@ -291,9 +290,9 @@ class Abstract_Wallet(AddressSynchronizer, ABC):
         # a wallet may have channel backups, regardless of lnworker activation
         self.lnbackups = LNBackups(self)
 
-    def save_db(self):
+    def save_db(self, *, compact: bool = False):
         if self.storage:
-            self.db.write(self.storage)
+            self.db.write(self.storage, compact=compact)
 
     def save_backup(self):
         backup_dir = get_backup_dir(self.config)
@@ -344,7 +343,8 @@ class Abstract_Wallet(AddressSynchronizer, ABC):
                 self.lnworker = None
             self.lnbackups.stop()
             self.lnbackups = None
-        self.save_db()
+        # leave a file without appended changes, readable by older versions
+        self.save_db(compact=True)
 
     def set_up_to_date(self, b):
         super().set_up_to_date(b)
@@ -459,7 +459,7 @@ class Abstract_Wallet(AddressSynchronizer, ABC):
         write_json_file(path, self.get_all_labels())
 
     def set_fiat_value(self, txid, ccy, text, fx, value_sat):
-        if not self.db.get_transaction(txid):
+        if not self.db.has_transaction(txid):
             return
         # since fx is inserting the thousands separator,
         # and not util, also have fx remove it
@@ -1247,10 +1247,7 @@ class Abstract_Wallet(AddressSynchronizer, ABC):
         if i_max is None:
             # Let the coin chooser select the coins to spend
 
-            if sender:
-                coin_chooser = coinchooser.CoinChooserHtmlcoin()
-            else:
-                coin_chooser = coinchooser.get_coin_chooser(self.config)
+            coin_chooser = coinchooser.get_coin_chooser(self.config, sender=sender)
 
             # If there is an unconfirmed RBF tx, merge with it
             base_tx = self.get_unconfirmed_base_tx_for_batching()
@@ -2195,65 +2192,41 @@ class Abstract_Wallet(AddressSynchronizer, ABC):
         return [self.keystore] if self.keystore else []
 
     @profiler
-    def get_full_token_history(self, contract_addr=None, bind_addr=None) -> list:
-        hist = []
+    def get_full_token_history(self, contract_addr=None, bind_addr=None, *,
+                               offset: int = 0, limit: int = None) -> list:
+        """Returns the token transfers of the tokens of contract_addr or
+        bind_addr (of all tokens if neither is given), skipping the first
+        offset items and returning at most limit items.
+        """
         keys = []
         for token_key in self.db.list_tokens():
             if contract_addr and contract_addr in token_key \
                     or bind_addr and bind_addr in token_key \
                     or not bind_addr and not contract_addr:
                 keys.append(token_key)
-        for key in keys:
-            contract_addr, bind_addr = key.split('_')
-            for txid, height, log_index in self.db.get_token_history(key):
-                status = self.get_tx_height(txid)
-                height, conf, timestamp = status.height, status.conf, status.timestamp
-                for call_index, contract_call in enumerate(self.db.get_tx_receipt(txid)):
-                    logs = contract_call.get('log', [])
-                    if len(logs) > log_index:
-                        log = logs[log_index]
-
-                        # check contarct address
-                        if contract_addr != log.get('address', ''):
-                            self.logger.info("contract address mismatch")
-                            continue
-
-                        # check topic name
-                        topics = log.get('topics', [])
-                        if len(topics) < 3:
-                            self.logger.info("not enough topics")
-                            continue
-                        if topics[0] != TOKEN_TRANSFER_TOPIC:
-                            self.logger.info("topic mismatch")
-                            continue
-
-                        # check user bind address
-                        __, hash160b = b58_address_to_hash160(bind_addr)
-                        hash160 = hash160b.hex().zfill(64)
-                        if hash160 not in topics:
-                            self.logger.info("address mismatch")
-                            continue
-                        amount = int(log.get('data'), 16)
-                        from_addr = hash160_to_p2pkh(binascii.a2b_hex(topics[1][-40:]))
-                        to_addr = hash160_to_p2pkh(binascii.a2b_hex(topics[2][-40:]))
-                        item = {
-                            'from_addr': from_addr,
-                            'to_addr': to_addr,
-                            'bind_addr': self.db.get_token(key).bind_addr,
-                            'amount': amount,
-                            'token_key': key,
-                            'txid': txid,
-                            'height': height,
-                            'txpos_in_block': 0,
-                            'confirmations': conf,
-                            'timestamp': timestamp,
-                            'date': timestamp_to_datetime(timestamp),
-                            'call_index': call_index,
-                            'log_index': log_index,
-                        }
-                        hist.append(item)
-                    else:
-                        continue
+        transfers = itertools.chain.from_iterable(
+            ((key, item) for item in self.get_token_transfers(key)) for key in keys)
+        stop = offset + limit if limit is not None else None
+        hist = []
+        for key, (txid, height, transfer) in itertools.islice(transfers, offset, stop):
+            status = self.get_tx_height(txid)
+            height, conf, timestamp = status.height, status.conf, status.timestamp
+            item = {
+                'from_addr': transfer.from_addr,
+                'to_addr': transfer.to_addr,
+                'bind_addr': key.split('_')[1],
+                'amount': transfer.amount,
+                'token_key': key,
+                'txid': txid,
+                'height': height,
+                'txpos_in_block': 0,
+                'confirmations': conf,
+                'timestamp': timestamp,
+                'date': timestamp_to_datetime(timestamp),
+                'call_index': transfer.call_index,
+                'log_index': transfer.log_index,
+            }
+            hist.append(item)
         return hist
 
     @abstractmethod
@@ -2461,6 +2434,7 @@ class Imported_Wallet(Simple_Wallet):
                         transactions_new.add(tx_hash)
             transactions_to_remove -= transactions_new
             self.db.remove_addr_history(address)
+            self._addr_status.pop(address, None)
             for tx_hash in transactions_to_remove:
                 self.remove_transaction(tx_hash)
         self.set_label(address, None)
@@ -2468,6 +2442,10 @@ class Imported_Wallet(Simple_Wallet):
         self.set_frozen_state_of_addresses([address], False)
         pubkey = self.get_public_key(address)
         self.db.remove_imported_address(address)
+        # txs shared with other addresses now have a different delta on the wallet
+        self._reset_history_index()
+        self._reset_utxo_index()
+        self._reset_balance_index()
         if pubkey:
             # delete key iff no other address uses it (e.g. p2pkh and p2wpkh for same key)
             for txin_type in bitcoin.WIF_SCRIPT_TYPES.keys():
@@ -2566,6 +2544,12 @@ class Deterministic_Wallet(Abstract_Wallet):
 
     def __init__(self, db, storage, *, config):
         self._ephemeral_addr_to_addr_index = {}  # type: Dict[str, Sequence[int]]
+        # gap limit state, per chain (for_change), see synchronize_sequence:
+        self._gap_window_limit = {}  # type: Dict[bool, int]  # limit the state was computed for
+        self._last_old_address_index = {}  # type: Dict[bool, int]
+        self._maybe_old_addresses = {}  # type: Dict[bool, Dict[int, str]]  # index -> address
+        self._gap_checked_height = {}  # type: Dict[bool, int]
+        self._gap_recheck_needed = set()  # type: Set[bool]
         Abstract_Wallet.__init__(self, db, storage, config=config)
         self.gap_limit = db.get('gap_limit', 20)
         # generate addresses now. note that without libsecp this might block
@@ -2619,8 +2603,11 @@ class Deterministic_Wallet(Abstract_Wallet):
         '''This method is not called in the code, it is kept for console use'''
         value = int(value)
         if value >= self.min_acceptable_gap():
-            self.gap_limit = value
-            self.db.put('gap_limit', self.gap_limit)
+            with self.lock:
+                self.gap_limit = value
+                self.db.put('gap_limit', self.gap_limit)
+                # derive the addresses the new limit requires in one batch
+                self.synchronize_sequence(False)
             self.save_db()
             return True
         else:
@@ -2652,11 +2639,22 @@ class Deterministic_Wallet(Abstract_Wallet):
     def derive_pubkeys(self, c: int, i: int) -> Sequence[str]:
         pass
 
+    def derive_pubkeys_in_range(self, c: int, start: int, stop: int) -> Sequence[Sequence[str]]:
+        return [self.derive_pubkeys(c, i) for i in range(start, stop)]
+
+    def get_derivation_num_workers(self) -> int:
+        return self.config.get('bip32_derivation_workers', 1)
+
     def derive_address(self, for_change: int, n: int) -> str:
         for_change = int(for_change)
         pubkeys = self.derive_pubkeys(for_change, n)
         return self.pubkeys_to_address(pubkeys)
 
+    def derive_addresses(self, for_change: int, start: int, stop: int) -> List[str]:
+        for_change = int(for_change)
+        return [self.pubkeys_to_address(pubkeys)
+                for pubkeys in self.derive_pubkeys_in_range(for_change, start, stop)]
+
     def export_private_key_for_path(self, path: Union[Sequence[int], str], password: Optional[str]) -> str:
         if isinstance(path, str):
             path = convert_bip32_path_to_list_of_uint32(path)
@@ -2689,32 +2687,97 @@ class Deterministic_Wallet(Abstract_Wallet):
             txinout.bip32_paths[pubkey] = (fp_bytes, der_full)
 
     def create_new_address(self, for_change: bool = False):
+        address, = self.create_new_addresses(for_change, 1)
+        return address
+
+    def create_new_addresses(self, for_change: bool, count: int) -> List[str]:
         assert type(for_change) is bool
         with self.lock:
             n = self.db.num_change_addresses() if for_change else self.db.num_receiving_addresses()
-            address = self.derive_address(int(for_change), n)
-            self.db.add_change_address(address) if for_change else self.db.add_receiving_address(address)
-            self.add_address(address)
+            addresses = self.derive_addresses(int(for_change), n, n + count)
+            for address in addresses:
+                self.db.add_change_address(address) if for_change else self.db.add_receiving_address(address)
+                self.add_address(address)
             if for_change:
                 # note: if it's actually "old", it will get filtered later
-                self._not_old_change_addresses.append(address)
-            return address
+                self._not_old_change_addresses.extend(addresses)
+            return addresses
 
     def synchronize_sequence(self, for_change):
+        """Derives new addresses as needed, so that the last `limit` addresses
+        of the chain are not old. Rather than checking the whole window every
+        time, this keeps the index of the last old address, and the addresses
+        in the window that have history but are not old yet. The latter are
+        only checked again after a history update, a verification or a new block.
+        """
         limit = self.gap_limit_for_change if for_change else self.gap_limit
-        while True:
+        with self.lock:
             num_addr = self.db.num_change_addresses() if for_change else self.db.num_receiving_addresses()
             if num_addr < limit:
-                self.create_new_address(for_change)
-                continue
-            if for_change:
-                last_few_addresses = self.get_change_addresses(slice_start=-limit)
-            else:
-                last_few_addresses = self.get_receiving_addresses(slice_start=-limit)
-            if any(map(self.address_is_old, last_few_addresses)):
-                self.create_new_address(for_change)
-            else:
-                break
+                self.create_new_addresses(for_change, limit - num_addr)
+                num_addr = limit
+            local_height = self.get_local_height()
+            if self._gap_window_limit.get(for_change) != limit:
+                self._scan_gap_window(for_change, limit)
+            elif (for_change in self._gap_recheck_needed
+                  or self._gap_checked_height.get(for_change) != local_height):
+                self._recheck_maybe_old_addresses(for_change, num_addr - limit)
+            self._gap_recheck_needed.discard(for_change)
+            self._gap_checked_height[for_change] = local_height
+            # new addresses are never old, so extending the chain until the
+            # last old address falls out of the window takes a single batch
+            num_missing = self._last_old_address_index[for_change] + limit + 1 - num_addr
+            if num_missing > 0:
+                self.create_new_addresses(for_change, num_missing)
+
+    def _scan_gap_window(self, for_change: bool, limit: int) -> None:
+        if for_change:
+            addresses = self.get_change_addresses(slice_start=-limit)
+        else:
+            addresses = self.get_receiving_addresses(slice_start=-limit)
+        num_addr = self.db.num_change_addresses() if for_change else self.db.num_receiving_addresses()
+        window_start = num_addr - len(addresses)
+        self._gap_window_limit[for_change] = limit
+        self._last_old_address_index[for_change] = -1
+        self._maybe_old_addresses[for_change] = {}
+        for n, address in enumerate(addresses, window_start):
+            if self.address_is_old(address):
+                self._last_old_address_index[for_change] = n
+            elif self.db.get_addr_history(address):
+                self._maybe_old_addresses[for_change][n] = address
+
+    def _recheck_maybe_old_addresses(self, for_change: bool, window_start: int) -> None:
+        maybe_old = self._maybe_old_addresses[for_change]
+        for n, address in list(maybe_old.items()):
+            if n < window_start:
+                # cannot require new addresses anymore, the window has moved past it
+                del maybe_old[n]
+            elif self.address_is_old(address):
+                del maybe_old[n]
+                self._last_old_address_index[for_change] = max(self._last_old_address_index[for_change], n)
+
+    def receive_history_callback(self, addr, hist, tx_fees):
+        super().receive_history_callback(addr, hist, tx_fees)
+        addr_index = self.db.get_address_index(addr)
+        if addr_index is None:
+            return
+        for_change, n = addr_index
+        for_change = bool(for_change)
+        with self.lock:
+            if for_change in self._maybe_old_addresses and hist:
+                self._maybe_old_addresses[for_change][n] = addr
+            self._gap_recheck_needed.add(for_change)
+
+    def add_verified_txs(self, infos):
+        super().add_verified_txs(infos)
+        with self.lock:
+            self._gap_recheck_needed.update((False, True))
+
+    def undo_verifications(self, blockchain, above_height):
+        tx_hashes = super().undo_verifications(blockchain, above_height)
+        with self.lock:
+            self._gap_recheck_needed.update((False, True))
+        return tx_hashes
 
     @AddressSynchronizer.with_local_height_cached
     def synchronize(self):
@@ -2798,6 +2861,10 @@ class Simple_Deterministic_Wallet(Simple_Wallet, Deterministic_Wallet):
     def derive_pubkeys(self, c, i):
         return [self.keystore.derive_pubkey(c, i).hex()]
 
+    def derive_pubkeys_in_range(self, c, start, stop):
+        pubkeys = self.keystore.derive_pubkeys(c, start, stop, num_workers=self.get_derivation_num_workers())
+        return [[pubkey.hex()] for pubkey in pubkeys]
+
 
 class Standard_Wallet(Simple_Deterministic_Wallet):
     wallet_type = 'standard'
@@ -2892,6 +2959,12 @@ class Multisig_Wallet(Deterministic_Wallet):
     def derive_pubkeys(self, c, i):
         return [k.derive_pubkey(c, i).hex() for k in self.get_keystores()]
 
+    def derive_pubkeys_in_range(self, c, start, stop):
+        num_workers = self.get_derivation_num_workers()
+        pubkeys_per_keystore = [k.derive_pubkeys(c, start, stop, num_workers=num_workers)
+                                for k in self.get_keystores()]
+        return [[pubkey.hex() for pubkey in pubkeys] for pubkeys in zip(*pubkeys_per_keystore)]
+
     def load_keystore(self):
         self.keystores = {}
         for i in range(self.n):
@@ -28,17 +28,17 @@ import json
 import copy
 import threading
 from collections import defaultdict
-from functools import reduce
 from typing import Dict, Optional, List, Tuple, Set, Iterable, NamedTuple, Sequence, TYPE_CHECKING, Union
 import binascii
 
 from . import util, bitcoin
-from .util import profiler, WalletFileException, multisig_type, TxMinedInfo, bfh
+from .util import profiler, WalletFileException, multisig_type, TxMinedInfo, bfh, LRUCache
 from .invoices import PR_TYPE_ONCHAIN, Invoice
 from .keystore import bip44_derivation
 from .transaction import Transaction, TxOutpoint, tx_from_any, PartialTransaction, PartialTxOutput
 from .logging import Logger
 from .lnutil import LOCAL, REMOTE, FeeUpdate, UpdateAddHtlc, LocalConfig, RemoteConfig, Keypair, OnlyPubkeyKeypair, RevocationStore, ChannelBackupStorage
+from .lnhtlc import ArchivedHtlc
 from .lnutil import ChannelConstraints, Outpoint, ShachainElement
 from .json_db import StoredDict, JsonDB, locked, modifier
 from .plugin import run_hook, plugin_loaders
@@ -54,9 +54,13 @@ if TYPE_CHECKING:
 
 OLD_SEED_VERSION = 4        # electrum versions < 2.0
 NEW_SEED_VERSION = 11       # electrum versions >= 2.0
-FINAL_SEED_VERSION = 32     # electrum >= 2.7 will set this to prevent
+FINAL_SEED_VERSION = 33     # electrum >= 2.7 will set this to prevent
                             # old versions from overwriting new format
 
+TX_CACHE_SIZE = 1000  # number of deserialized transactions kept in memory
+
+MULTISIG_KEYSTORE_NAMES = frozenset(('x%d/' % i) for i in range(1, 16))
+
 
 class TxFeesValue(NamedTuple):
     fee: Optional[int] = None
@@ -70,6 +74,9 @@ class WalletDB(JsonDB):
         JsonDB.__init__(self, {})
         self._manual_upgrades = manual_upgrades
         self._called_after_upgrade_tasks = False
+        # txid -> Transaction, for transactions and token_txs, which only hold raw txs
+        self._tx_cache = LRUCache(TX_CACHE_SIZE)
+        self._token_tx_cache = LRUCache(TX_CACHE_SIZE)
         if raw:  # loading existing db
             self.load_data(raw)
             self.load_plugins()
@@ -79,7 +86,7 @@ class WalletDB(JsonDB):
 
     def load_data(self, s):
         try:
-            self.data = json.loads(s)
+            self.data = self.load_json(s)
         except:
             try:
                 d = ast.literal_eval(s)
@@ -182,6 +189,7 @@ class WalletDB(JsonDB):
         self._convert_version_30()
         self._convert_version_31()
         self._convert_version_32()
+        self._convert_version_33()
         self.put('seed_version', FINAL_SEED_VERSION)  # just to be sure
 
         self._after_upgrade_tasks()
@@ -705,6 +713,19 @@ class WalletDB(JsonDB):
         self.data['invoices'] = invoices_new
         self.data['seed_version'] = 32
 
+    def _convert_version_33(self):
+        if not self._is_upgrade_method_needed(32, 32):
+            return
+        # resolved htlcs get archived by HTLCManager, see lnhtlc.ArchivedHtlc
+        channels = self.data.get('channels', {})
+        for channel_id, c in channels.items():
+            log = c.get('log')
+            if not log:
+                continue
+            for sub in ('1', '-1'):
+                log[sub]['archived_htlcs'] = {}
+        self.data['seed_version'] = 33
+
     def _convert_imported(self):
         if not self._is_upgrade_method_needed(0, 13):
             return
@@ -926,21 +947,41 @@ class WalletDB(JsonDB):
         if tx_hash != tx.txid():
             raise Exception(f"trying to add tx to db with inconsistent txid: {tx_hash} != {tx.txid()}")
         # don't allow overwriting complete tx with partial tx
-        tx_we_already_have = self.transactions.get(tx_hash, None)
+        tx_we_already_have = self.get_transaction(tx_hash)
         if tx_we_already_have is None or isinstance(tx_we_already_have, PartialTransaction):
-            self.transactions[tx_hash] = tx
+            self.transactions[tx_hash] = tx.serialize()
+            self._tx_cache[tx_hash] = tx
 
     @modifier
     def remove_transaction(self, tx_hash: str) -> Optional[Transaction]:
         assert isinstance(tx_hash, str)
-        return self.transactions.pop(tx_hash, None)
+        tx = self.get_transaction(tx_hash)
+        self.transactions.pop(tx_hash, None)
+        self._tx_cache.pop(tx_hash)
+        return tx
 
     @locked
     def get_transaction(self, tx_hash: Optional[str]) -> Optional[Transaction]:
         if tx_hash is None:
             return None
         assert isinstance(tx_hash, str)
-        return self.transactions.get(tx_hash)
+        return self._get_cached_tx(self.transactions, self._tx_cache, tx_hash)
+
+    @locked
+    def has_transaction(self, tx_hash: str) -> bool:
+        return tx_hash in self.transactions
+
+    @staticmethod
+    def _get_cached_tx(raw_txs: Dict[str, str], cache: LRUCache, tx_hash: str) -> Optional[Transaction]:
+        tx = cache.get(tx_hash)
+        if tx is None:
+            raw = raw_txs.get(tx_hash)
+            if raw is None:
+                return None
+            # note: for performance, "deserialize=False" so that we will deserialize these on-demand
+            tx = tx_from_any(raw, deserialize=False)
+            cache[tx_hash] = tx
+        return tx
 
     @locked
     def list_transactions(self) -> Sequence[str]:
@@ -992,6 +1033,11 @@ class WalletDB(JsonDB):
         assert isinstance(info, TxMinedInfo)
         self.verified_tx[txid] = (info.height, info.timestamp, info.txpos, info.header_hash)
 
+    @modifier
+    def add_verified_txs(self, infos: Dict[str, TxMinedInfo]):
+        for txid, info in infos.items():
+            self.add_verified_tx(txid, info)
+
     @modifier
     def remove_verified_tx(self, txid: str):
         assert isinstance(txid, str)
@@ -1153,7 +1199,7 @@ class WalletDB(JsonDB):
         self.txi = self.get_dict('txi')                          # type: Dict[str, Dict[str, Dict[str, int]]]
         # txid -> address -> output_index -> (value, is_coinbase)
         self.txo = self.get_dict('txo')                          # type: Dict[str, Dict[str, Dict[str, Tuple[int, bool]]]]
-        self.transactions = self.get_dict('transactions')        # type: Dict[str, Transaction]
+        self.transactions = self.get_dict('transactions')        # type: Dict[str, str]  # raw txs, see get_transaction
         self.spent_outpoints = self.get_dict('spent_outpoints')  # txid -> output_index -> next_txid
         self.history = self.get_dict('addr_history')             # address -> list of (txid, height)
         self.verified_tx = self.get_dict('verified_tx3')         # txid -> (height, timestamp, txpos, header_hash)
@@ -1178,20 +1224,11 @@ class WalletDB(JsonDB):
         self.token_history = self.get_dict('addr_token_history')
         # txid -> tx receipt
         self.tx_receipt = self.get_dict('tx_receipt')
-        # txid -> raw tx
+        # txid -> raw tx, see get_token_tx
         self.token_txs = self.get_dict('token_txs')
         self.smart_contracts = self.get_dict('smart_contracts')
         self.delegations = self.get_dict('delegations')
 
-        if self.token_history:
-            token_hist_txids = [x2[0] for x2 in reduce(lambda x1, y1: x1+y1, self.token_history.values())]
-        else:
-            token_hist_txids = []
-        for tx_hash, raw in self.token_txs.items():
-            if tx_hash in token_hist_txids:
-                tx = Transaction(raw)
-                self.token_txs[tx_hash] = tx
-
     @modifier
     def set_token(self, token: Token):
         self.tokens[token.get_key()] = token
@@ -1226,16 +1263,22 @@ class WalletDB(JsonDB):
         return list(self.token_history.keys())
 
     @modifier
-    def set_token_tx(self, txid: str, raw: str):
-        self.token_txs[txid] = raw
+    def set_token_tx(self, txid: str, tx: Union[Transaction, str]):
+        if isinstance(tx, Transaction):
+            self._token_tx_cache[txid] = tx
+            tx = tx.serialize()
+        else:
+            self._token_tx_cache.pop(txid)
+        self.token_txs[txid] = tx
 
     @modifier
     def delete_token_tx(self, txid: str):
         self.token_txs.pop(txid, None)
+        self._token_tx_cache.pop(txid)
 
     @locked
-    def get_token_tx(self, txid: str):
-        return self.token_txs.get(txid)
+    def get_token_tx(self, txid: str) -> Optional[Transaction]:
+        return self._get_cached_tx(self.token_txs, self._token_tx_cache, txid)
 
     @locked
     def list_token_txs(self) -> list:
@@ -1283,24 +1326,25 @@ class WalletDB(JsonDB):
         self.txo.clear()
         self.spent_outpoints.clear()
         self.transactions.clear()
+        self._tx_cache.clear()
         self.history.clear()
         self.verified_tx.clear()
         self.tx_fees.clear()
         self.token_txs.clear()
+        self._token_tx_cache.clear()
         self.token_history.clear()
         self.tx_receipt.clear()
         self._prevouts_by_scripthash.clear()
 
     def _convert_dict(self, path, key, v):
-        if key == 'transactions':
-            # note: for performance, "deserialize=False" so that we will deserialize these on-demand
-            v = dict((k, tx_from_any(x, deserialize=False)) for k, x in v.items())
         if key == 'invoices':
             v = dict((k, Invoice.from_json(x)) for k, x in v.items())
         if key == 'payment_requests':
             v = dict((k, Invoice.from_json(x)) for k, x in v.items())
         elif key == 'adds':
             v = dict((k, UpdateAddHtlc.from_tuple(*x)) for k, x in v.items())
+        elif key == 'archived_htlcs':
+            v = dict((k, ArchivedHtlc.from_json(x)) for k, x in v.items())
         elif key == 'fee_updates':
             v = dict((k, FeeUpdate(**x)) for k, x in v.items())
         elif key == 'submarine_swaps':
@@ -1331,22 +1375,29 @@ class WalletDB(JsonDB):
     def _should_convert_to_stored_dict(self, key) -> bool:
         if key == 'keystore':
             return False
-        multisig_keystore_names = [('x%d/' % i) for i in range(1, 16)]
-        if key in multisig_keystore_names:
+        if key in MULTISIG_KEYSTORE_NAMES:
             return False
         return True
 
-    def write(self, storage: 'WalletStorage'):
+    def write(self, storage: 'WalletStorage', *, compact: bool = False):
+        """Writes changes to storage, by appending them to the file if possible.
+        If compact is set, the file is rewritten in full if it has appended changes.
+        """
         with self.lock:
-            self._write(storage)
+            self._write(storage, compact=compact)
 
-    def _write(self, storage: 'WalletStorage'):
+    def _write(self, storage: 'WalletStorage', *, compact: bool = False):
         if threading.currentThread().isDaemon():
             self.logger.warning('daemon thread cannot write db')
             return
+        if compact and self.has_appended_changes(storage):
+            self.set_modified(True)
         if not self.modified():
             return
-        storage.write(self.dump())
+        if self.can_append(storage):
+            self.append_pending_changes(storage)
+        else:
+            self.write_all(storage)
         self.set_modified(False)
 
     def is_ready_to_be_used_by_wallet(self):